@@ -636,6 +636,10 @@ class ArmoryMainWindow(QMainWindow):
       self.menusList[MENUS.File].addAction(actSettings)
       self.menusList[MENUS.File].addAction(actMinimApp)
       self.menusList[MENUS.File].addAction(actExportLog)
+      if CLI_OPTIONS.enablePerfStats:
+         actExportPerf = self.createAction('Export &Performance Stats...', \
+                                                      self.exportPerfStats)
+         self.menusList[MENUS.File].addAction(actExportPerf)
       self.menusList[MENUS.File].addAction(actCloseApp)
 
 
@@ -3280,6 +3284,7 @@ class ArmoryMainWindow(QMainWindow):
    #############################################################################
 
    def convertLedgerToTable(self, ledger, showSentToSelfAmt=True, wltIDIn=None):
+      startTime = RightNow()
       table2D = []
       datefmt = self.getPreferredDateFormat()
       for le in ledger:
@@ -3317,7 +3322,7 @@ class ArmoryMainWindow(QMainWindow):
          # chain index
          amt = le.getValue()
          if le.isSentToSelf() and wlt and showSentToSelfAmt:
-            amt = determineSentToSelfAmt(le, wlt)[0]
+            amt = determineSentToSelfAmtCached(le, wlt)[0]
 
          # NumConf
          row.append(nConf)
@@ -3358,6 +3363,8 @@ class ArmoryMainWindow(QMainWindow):
          # Finally, attach the row to the table
          table2D.append(row)
 
+      LOGDEBUG('Converted %d ledger entries in %0.3f sec, ledger cache: %s', \
+             len(table2D), RightNow()-startTime, TheLedgerValueCache.getStats())
       return table2D
 
 
@@ -4280,6 +4287,18 @@ class ArmoryMainWindow(QMainWindow):
 
          LOGINFO('Log saved to %s', saveFile)
 
+   #############################################################################
+   def exportPerfStats(self):
+      defaultFN = 'armoryperf_%s.csv' % \
+                  unixTimeToFormatStr(RightNow(),'%Y%m%d_%H%M')
+      saveFile = self.getFileSave(title='Export Performance Stats', \
+                                  ffilter=['CSV Files (*.csv)'], \
+                                  defaultFilename=defaultFN)
+      if len(unicode(saveFile)) > 0:
+         timer = Timer()
+         timer.saveTimingsCSV(saveFile)
+         LOGINFO('Timings:\n%s', timer.getTimingsTable())
+
    #############################################################################
    def blinkTaskbar(self):
       self.activateWindow()
@@ -7153,6 +7172,8 @@ if 1:
    def endProgram():
       if reactor.threadpool is not None:
          reactor.threadpool.stop()
+      # os._exit() below skips atexit, write out pending settings now
+      form.settings.flush()
       QAPP.quit()
 
    reactor.addSystemEventTrigger('before', 'shutdown', endProgram)
@@ -286,19 +286,21 @@ class Storage:
             if DEBUG:
                 print 'reading '+file+' from '+str(pos)+' to '+str(end)
             self.lock.acquire()
-            h = self._get_file_handle(file, False)
-            if flush_first and self.whandles.has_key(file):
-                h.flush()
-                fsync(h)
-            h.seek(pos)
-            while pos < end:
-                length = min(end-pos, MAXREADSIZE)
-                data = h.read(length)
-                if len(data) != length:
-                    raise IOError('error reading data from '+file)
-                r.append(data)
-                pos += length
-            self.lock.release()
+            try:    # called from the hash-check workers, don't leave it held
+                h = self._get_file_handle(file, False)
+                if flush_first and self.whandles.has_key(file):
+                    h.flush()
+                    fsync(h)
+                h.seek(pos)
+                while pos < end:
+                    length = min(end-pos, MAXREADSIZE)
+                    data = h.read(length)
+                    if len(data) != length:
+                        raise IOError('error reading data from '+file)
+                    r.append(data)
+                    pos += length
+            finally:
+                self.lock.release()
         return r
 
     def write(self, pos, s):
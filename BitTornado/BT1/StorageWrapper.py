@@ -6,6 +6,8 @@ from sha import sha
 from BitTornado.clock import clock
 from traceback import print_exc
 from random import randrange
+from collections import deque
+from multiprocessing.pool import ThreadPool
 try:
     True
 except:
@@ -22,6 +24,13 @@ DEBUG = False
 
 STATS_INTERVAL = 0.2
 
+# resume hash-check: bytes read per worker task, number of workers,
+# seconds between MB/s reports, and seconds between polls for a chunk
+HASHCHECK_CHUNK_SIZE = 8*1048576
+HASHCHECK_WORKERS = 4
+HASHCHECK_RATE_INTERVAL = 1.0
+HASHCHECK_POLL_INTERVAL = 0.02
+
 def dummy_status(fractionDone = None, activity = None):
     pass
 
@@ -166,6 +175,7 @@ class StorageWrapper:
             statusfunc = self.statusfunc
         self.initialize_status = statusfunc
         self.initialize_next = None
+        self.initialize_wait = 0
             
         self.backfunc(self._initialize)
 
@@ -174,6 +184,9 @@ class StorageWrapper:
             self.backfunc(self._initialize, 1)
             return
         
+        # initialize_next sets this when it's waiting on something, so
+        # we don't spin on the rawserver thread
+        self.initialize_wait = 0
         if self.initialize_next:
             x = self.initialize_next()
             if x is None:
@@ -189,13 +202,13 @@ class StorageWrapper:
                 self.initialize_status(activity = msg, fractionDone = done)
                 self.initialize_next = next
 
-        self.backfunc(self._initialize)
+        self.backfunc(self._initialize, self.initialize_wait)
 
 
     def init_hashcheck(self):
         if self.flag.isSet():
             return False
-        self.check_list = []
+        self.check_list = deque()
         if len(self.hashes) == 0 or self.amount_left == 0:
             self.check_total = 0
             self.finished()
@@ -234,6 +247,13 @@ class StorageWrapper:
         self.check_numchecked = 0.0
         self.lastlen = self._piecelen(len(self.hashes) - 1)
         self.numchecked = 0.0
+        self.check_pending = deque()
+        self.check_pool = None
+        if self.check_hashes and self.check_total > 0:
+            self.check_pool = ThreadPool(HASHCHECK_WORKERS)
+        self.check_bytes = 0L
+        self.check_start = clock()
+        self.check_lastreport = self.check_start
         return self.check_total > 0
 
     def _markgot(self, piece, pos):
@@ -249,45 +269,111 @@ class StorageWrapper:
         self.waschecked[piece] = self.check_hashes
         self.stat_numfound += 1
 
+    def _hashcheck_chunk(self, pieces):
+        # runs in the worker pool: one read for a run of consecutive
+        # pieces, then the same two digests per piece as before
+        start = pieces[0] * self.piece_size
+        lengths = [self._piecelen(i) for i in pieces]
+        r = self.storage.read(start, sum(lengths))
+        d = r[:]    # may be r's own array, so release it only when done
+        results = []
+        pos = 0
+        for i, length in zip(pieces, lengths):
+            sh = sha(buffer(d, pos, self.lastlen))
+            sp = sh.digest()
+            sh.update(buffer(d, pos + self.lastlen, length - self.lastlen))
+            results.append((i, sp, sh.digest(), length))
+            pos += length
+        r.release()
+        return results
+
+    def _hashcheck_next_chunk(self):
+        pieces = [self.check_list.popleft()]
+        size = self._piecelen(pieces[0])
+        while ( self.check_list and size < HASHCHECK_CHUNK_SIZE
+                and self.check_list[0] == pieces[-1] + 1 ):
+            pieces.append(self.check_list.popleft())
+            size += self._piecelen(pieces[-1])
+        return pieces
+
+    def _hashcheck_done(self, abort = False):
+        # on failure or abort, drop the chunks still queued instead of
+        # hashing them; either way the workers are gone when this returns
+        if self.check_pool is not None:
+            if abort:
+                self.check_pool.terminate()
+            else:
+                self.check_pool.close()
+            self.check_pool.join()
+            self.check_pool = None
+        self.check_pending.clear()
+
+    def _hashcheck_piece(self, i, sp, s):
+        if s == self.hashes[i]:
+            self._markgot(i, i)
+        elif ( self.check_targets.get(s)
+               and self._piecelen(i) == self._piecelen(self.check_targets[s][-1]) ):
+            self._markgot(self.check_targets[s].pop(), i)
+            self.out_of_place += 1
+        elif ( not self.have[-1] and sp == self.hashes[-1]
+               and (i == len(self.hashes) - 1
+                    or not self._waspre(len(self.hashes) - 1)) ):
+            self._markgot(len(self.hashes) - 1, i)
+            self.out_of_place += 1
+        else:
+            self.places[i] = i
+
     def hashcheckfunc(self):
         if self.flag.isSet():
+            self._hashcheck_done(abort = True)
             return None
-        if not self.check_list:
+        if not self.check_list and not self.check_pending:
+            self._hashcheck_done()
             return None
         
-        i = self.check_list.pop(0)
         if not self.check_hashes:
+            i = self.check_list.popleft()
             self._markgot(i, i)
-        else:
-            d1 = self.read_raw(i,0,self.lastlen)
-            if d1 is None:
-                return None
-            sh = sha(d1[:])
-            d1.release()
-            sp = sh.digest()
-            d2 = self.read_raw(i,self.lastlen,self._piecelen(i)-self.lastlen)
-            if d2 is None:
-                return None
-            sh.update(d2[:])
-            d2.release()
-            s = sh.digest()
-            if s == self.hashes[i]:
-                self._markgot(i, i)
-            elif ( self.check_targets.get(s)
-                   and self._piecelen(i) == self._piecelen(self.check_targets[s][-1]) ):
-                self._markgot(self.check_targets[s].pop(), i)
-                self.out_of_place += 1
-            elif ( not self.have[-1] and sp == self.hashes[-1]
-                   and (i == len(self.hashes) - 1
-                        or not self._waspre(len(self.hashes) - 1)) ):
-                self._markgot(len(self.hashes) - 1, i)
-                self.out_of_place += 1
-            else:
-                self.places[i] = i
-        self.numchecked += 1
+            self.numchecked += 1
+            if self.amount_left == 0:
+                self.finished()
+            return (self.numchecked / self.check_total)
+
+        # keep every worker busy with one chunk and one more queued;
+        # results are applied here, in piece order, as they come back
+        while self.check_list and len(self.check_pending) < 2*HASHCHECK_WORKERS:
+            pieces = self._hashcheck_next_chunk()
+            self.check_pending.append(
+                self.check_pool.apply_async(self._hashcheck_chunk, [pieces]) )
+        chunk = self.check_pending[0]
+        if not chunk.ready():
+            # never block the rawserver thread on the workers
+            self.initialize_wait = HASHCHECK_POLL_INTERVAL
+            return (self.numchecked / self.check_total)
+        self.check_pending.popleft()
+        try:
+            results = chunk.get()
+        except IOError, e:
+            self._hashcheck_done(abort = True)
+            self.failed('IO Error: ' + str(e))
+            return None
+
+        for i, sp, s, length in results:
+            self._hashcheck_piece(i, sp, s)
+            self.check_bytes += length
+        self.numchecked += len(results)
         if self.amount_left == 0:
             self.finished()
-        return (self.numchecked / self.check_total)
+
+        fractionDone = self.numchecked / self.check_total
+        t = clock()
+        if t - self.check_lastreport >= HASHCHECK_RATE_INTERVAL:
+            self.check_lastreport = t
+            rate = self.check_bytes / 1048576.0 / max(t - self.check_start, 0.001)
+            statusfunc = getattr(self, 'initialize_status', self.statusfunc)
+            statusfunc( activity = 'checking existing data (%0.1f MB/s)' % rate,
+                        fractionDone = fractionDone )
+        return fractionDone
 
 
     def init_movedata(self):
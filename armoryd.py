@@ -93,19 +93,25 @@
 import base64
 from collections import defaultdict
 import decimal
+import functools
 from inspect import *
 import json
+import multiprocessing
 import sys
+import threading
 
 from twisted.cred.checkers import FilePasswordDB
-from twisted.internet import reactor
+from twisted.internet import defer, reactor, threads
 from twisted.internet.protocol import ClientFactory  # REMOVE IN 0.93
+from twisted.python.threadpool import ThreadPool
 from twisted.web import server
 from txjsonrpc.auth import wrapResource
 from txjsonrpc.web import jsonrpc
 
 from armoryengine.ALL import *
-from armoryengine.Decorators import EmailOutput, catchErrsForJSON
+from armoryengine.Decorators import EmailOutput, catchErrsForJSON, \
+   rpcWorkerMethod, rpcNoWalletMethod, RPC_WORKER_CPU, RPC_WORKER_IO
+from armoryengine.EmailQueue import getEmailQueue
 from armoryengine.PyBtcWalletRecovery import *
 from jasvet import readSigBlock, verifySignature
 
@@ -119,6 +125,20 @@ class UniversalEncoder(json.JSONEncoder):
 
 ARMORYD_CONF_FILE = os.path.join(ARMORY_HOME_DIR, 'armoryd.conf')
 
+# HTTP/1.1 clients keep their connection open between RPC calls; drop those
+# that have been idle this many seconds
+ARMORY_RPC_IDLE_TIMEOUT = 120
+
+# Threads for the RPC calls marked with @rpcWorkerMethod, see RpcDispatcher
+RPC_CPU_WORKERS = max(multiprocessing.cpu_count(), 2)
+RPC_IO_WORKERS  = 4
+
+# waitforpayment returns after this many seconds at most, well before the
+# client's connection would be dropped as idle.  Subscriptions nobody has
+# waited on for SUBSCRIPTION_IDLE_EXPIRE seconds are removed.
+SUBSCRIPTION_MAX_WAIT    = 60
+SUBSCRIPTION_IDLE_EXPIRE = 3600
+
 
 # Define some specific errors that can be thrown and caught
 class UnrecognizedCommand(Exception): pass
@@ -154,7 +174,8 @@ def addMultWallets(inWltPaths, inWltMap):
    for aWlt in inWltPaths:
       # Logic basically taken from loadWalletsAndSettings()
       try:
-         wltLoad = PyBtcWallet().readWalletFile(aWlt)
+         wltLoad = PyBtcWallet().readWalletFile(aWlt, lazyLoad=True, \
+                                               compactAddrs=True)
          wltID = wltLoad.uniqueIDB58
          wltLoad.fillAddressPool()
 
@@ -217,6 +238,379 @@ def addMultLockboxes(inLBPaths, inLboxMap):
    return newLBList
 
 
+################################################################################
+# Runs the JSON RPC calls for Armory_Json_Rpc_Server. Calls that use the same
+# wallet run one at a time, in the order they came in, so a call queued behind
+# a slow one waits for it. Unmarked calls run on the reactor thread as before;
+# calls marked with @rpcWorkerMethod run on the CPU or IO thread pool, which
+# keeps the reactor (other clients, the heartbeat) responsive meanwhile. All
+# methods except runTimed() are called from the reactor thread.
+class RpcDispatcher(object):
+   #############################################################################
+   def __init__(self, cpuWorkers=RPC_CPU_WORKERS, ioWorkers=RPC_IO_WORKERS):
+      self.pools = { RPC_WORKER_CPU: ThreadPool(1, cpuWorkers, 'rpc-cpu'),
+                     RPC_WORKER_IO:  ThreadPool(1, ioWorkers, 'rpc-io') }
+      self.walletLocks = {}
+
+      # Per-method timings and the number of calls waiting to run, updated
+      # from the worker threads too
+      self.statsLock = threading.Lock()
+      self.methodStats = {}
+      self.queueDepth = 0
+      self.maxQueueDepth = 0
+      self.activeCalls = 0
+
+      self.started = False
+      reactor.callWhenRunning(self.start)
+
+
+   #############################################################################
+   def start(self):
+      if self.started:
+         return
+      self.started = True
+      for pool in self.pools.values():
+         pool.start()
+      reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+
+
+   #############################################################################
+   def stop(self):
+      for pool in self.pools.values():
+         pool.stop()
+
+
+   #############################################################################
+   def getWalletLock(self, lockID):
+      if not self.walletLocks.has_key(lockID):
+         self.walletLocks[lockID] = defer.DeferredLock()
+      return self.walletLocks[lockID]
+
+
+   #############################################################################
+   def isWalletBusy(self, lockID):
+      lock = self.walletLocks.get(lockID)
+      return lock is not None and lock.locked
+
+
+   #############################################################################
+   def runWithWalletLock(self, getLockID, func, *args):
+      """
+      Runs func(*args) on the reactor thread once the lock of the wallet named
+      by getLockID() is free, for wallet work that doesn't come from an RPC
+      call (e.g. BDM notifications). Like RPC calls, it waits again if that
+      wallet changes in the meantime. Errors are logged. Returns a Deferred.
+      """
+      def logError(failure):
+         LOGERROR('%s failed: %s' % (func.__name__, failure.getErrorMessage()))
+      d = self.runWithLockOf(getLockID, func, args)
+      d.addErrback(logError)
+      return d
+
+
+   #############################################################################
+   def runWithLockOf(self, getLockID, func, args):
+      lockID = getLockID()
+      def runAcquired(lock):
+         if getLockID() != lockID:
+            lock.release()
+            return self.runWithLockOf(getLockID, func, args)
+         d = defer.maybeDeferred(func, *args)
+         def releaseLock(result):
+            lock.release()
+            return result
+         return d.addBoth(releaseLock)
+      return self.getWalletLock(lockID).acquire().addCallback(runAcquired)
+
+
+   #############################################################################
+   def callFunction(self, name, func, getLockID, args):
+      """
+      Runs func(*args) once the lock of the wallet named by getLockID() is
+      free. Returns a Deferred firing with the result.
+      """
+      with self.statsLock:
+         self.queueDepth += 1
+         self.maxQueueDepth = max(self.maxQueueDepth, self.queueDepth)
+      return self.runLocked(name, func, getLockID, args, RightNow())
+
+
+   #############################################################################
+   def runLocked(self, name, func, getLockID, args, tQueued):
+      lockID = getLockID()
+      if lockID is None:
+         # The call uses no wallet
+         return self.runAcquired(None, lockID, name, func, getLockID, args, \
+                                 tQueued)
+      d = self.getWalletLock(lockID).acquire()
+      d.addCallbacks(self.runAcquired, self.dropQueued, \
+                     (lockID, name, func, getLockID, args, tQueued))
+      return d
+
+
+   #############################################################################
+   def dropQueued(self, failure):
+      # The call was cancelled (the client went away) while it waited for the
+      # wallet lock
+      with self.statsLock:
+         self.queueDepth -= 1
+      return failure
+
+
+   #############################################################################
+   def runAcquired(self, lock, lockID, name, func, getLockID, args, tQueued):
+      if lock is not None and getLockID() != lockID:
+         # The active wallet changed while this call waited for the old one
+         lock.release()
+         return self.runLocked(name, func, getLockID, args, tQueued)
+
+      kind = getattr(func, 'rpcWorker', None)
+      if kind is None:
+         d = defer.maybeDeferred(self.runTimed, name, func, args, tQueued)
+      else:
+         d = threads.deferToThreadPool(reactor, self.pools[kind], \
+                                       self.runTimed, name, func, args, tQueued)
+
+      def releaseLock(result):
+         if lock is not None:
+            lock.release()
+         return result
+      d.addBoth(releaseLock)
+
+      if kind is not None:
+         # Cancelling a call (the client went away) can't stop the thread, so
+         # the caller gets a Deferred of its own and the lock stays held until
+         # the thread is done
+         callerD = defer.Deferred()
+         d.chainDeferred(callerD)
+         return callerD
+      return d
+
+
+   #############################################################################
+   def runTimed(self, name, func, args, tQueued):
+      tStart = RightNow()
+      with self.statsLock:
+         self.queueDepth -= 1
+         self.activeCalls += 1
+      try:
+         return func(*args)
+      finally:
+         runTime = RightNow() - tStart
+         with self.statsLock:
+            self.activeCalls -= 1
+            if not self.methodStats.has_key(name):
+               self.methodStats[name] = [TimerStats(), TimerStats()]
+            waitStats,runStats = self.methodStats[name]
+            waitStats.addCall(tStart - tQueued, tStart - tQueued, '', False)
+            runStats.addCall(runTime, runTime, '', False)
+
+
+   #############################################################################
+   def getStats(self, reset=False):
+      def statsMap(stats):
+         jsonMap = stats.toJSONMap()
+         return dict([(k, jsonMap[k]) for k in \
+                      ['calls', 'avg', 'max', 'p50', 'p90', 'p99']])
+
+      with self.statsLock:
+         result = { 'queued':     self.queueDepth,
+                    'maxqueued':  self.maxQueueDepth,
+                    'active':     self.activeCalls,
+                    'methods':    {} }
+         for name,(waitStats,runStats) in self.methodStats.iteritems():
+            result['methods'][name] = { 'wait': statsMap(waitStats),
+                                        'run':  statsMap(runStats) }
+         if reset:
+            self.methodStats = {}
+            self.maxQueueDepth = self.queueDepth
+      return result
+
+
+################################################################################
+class PaymentSubscription(object):
+   """
+   Addresses a client waits for payments to.  received maps each scrAddr to
+   the total paid to it by txs with at least minconf confirmations (spending
+   the coins doesn't lower it).  seq goes up every time received changes.
+   """
+   def __init__(self, subID, scrAddrs, target, minconf):
+      self.subID    = subID
+      self.scrAddrs = scrAddrs
+      self.target   = target
+      self.minconf  = minconf
+      self.received = dict([(scrAddr, 0) for scrAddr in scrAddrs])
+      self.seq      = 0
+      self.waiters  = []    # [Deferred, DelayedCall] per waiting client
+      self.lastUsed = RightNow()
+
+   def getTotal(self):
+      return sum(self.received.values())
+
+   def toJSONMap(self):
+      total = self.getTotal()
+      return { 'id':        self.subID,
+               'seq':       self.seq,
+               'amount':    AmountToJSON(self.target),
+               'received':  AmountToJSON(total),
+               'paid':      total >= self.target,
+               'minconf':   self.minconf,
+               'addresses': dict([(scrAddr_to_addrStr(scrAddr), \
+                                   AmountToJSON(value)) for scrAddr,value in \
+                                  self.received.iteritems()]) }
+
+
+################################################################################
+# Tells RPC clients about payments to the addresses they subscribed to, so they
+# don't have to poll their balances. Subscriptions are found through an index
+# by scrAddr. On a new zero-conf tx, only the subscribed addresses among its
+# outputs are looked up again, one lookup per address however many
+# subscriptions share it. All methods run on the reactor thread.
+class PaymentSubscriptions(object):
+   #############################################################################
+   def __init__(self, getReceived, clock=reactor):
+      # getReceived(scrAddr, minconf) -> amount received in satoshis
+      self.getReceived = getReceived
+      self.clock = clock
+      self.subMap = {}
+      self.addrIndex = {}   # scrAddr -> set of subIDs
+
+
+   #############################################################################
+   def hasSubscriptions(self):
+      return len(self.subMap) > 0
+
+
+   #############################################################################
+   def subscribe(self, scrAddrs, target, minconf=0):
+      subID = binary_to_hex(SecureBinaryData().GenerateRandom(8).toBinStr())
+      sub = PaymentSubscription(subID, scrAddrs, target, minconf)
+      for scrAddr in scrAddrs:
+         sub.received[scrAddr] = self.getReceived(scrAddr, minconf)
+         self.addrIndex.setdefault(scrAddr, set()).add(subID)
+      self.subMap[subID] = sub
+      return sub
+
+
+   #############################################################################
+   def unsubscribe(self, subID):
+      sub = self.getSubscription(subID)
+      del self.subMap[subID]
+      for scrAddr in sub.scrAddrs:
+         subIDs = self.addrIndex[scrAddr]
+         subIDs.discard(subID)
+         if len(subIDs) == 0:
+            del self.addrIndex[scrAddr]
+      # Don't leave anybody waiting for it
+      self.notifyWaiters(sub)
+      return sub
+
+
+   #############################################################################
+   def getSubscription(self, subID):
+      sub = self.subMap.get(subID)
+      if sub is None:
+         raise KeyError('Unknown subscription %s' % subID)
+      return sub
+
+
+   #############################################################################
+   def wait(self, subID, seq, timeout):
+      """
+      Returns the state of the subscription right away if it changed since
+      seq, otherwise a Deferred firing with it at the next change, or after
+      timeout seconds.  Cancelling the Deferred (the client went away) stops
+      the wait.
+      """
+      sub = self.getSubscription(subID)
+      sub.lastUsed = RightNow()
+      if seq != sub.seq or timeout <= 0:
+         return sub.toJSONMap()
+
+      waiter = [None, None]
+      waiter[0] = defer.Deferred(lambda d: self.cancelWait(sub, waiter))
+      waiter[1] = self.clock.callLater(timeout, self.endWait, sub, waiter)
+      sub.waiters.append(waiter)
+      return waiter[0]
+
+
+   #############################################################################
+   def endWait(self, sub, waiter):
+      sub.waiters.remove(waiter)
+      sub.lastUsed = RightNow()
+      waiter[0].callback(sub.toJSONMap())
+
+
+   #############################################################################
+   def cancelWait(self, sub, waiter):
+      if waiter in sub.waiters:
+         sub.waiters.remove(waiter)
+         waiter[1].cancel()
+         sub.lastUsed = RightNow()
+
+
+   #############################################################################
+   def notifyWaiters(self, sub):
+      waiters = sub.waiters
+      sub.waiters = []
+      sub.lastUsed = RightNow()
+      jsonMap = sub.toJSONMap()
+      for d,delayedCall in waiters:
+         delayedCall.cancel()
+         d.callback(jsonMap)
+
+
+   #############################################################################
+   def updateAddresses(self, scrAddrs):
+      """ Look up the amounts received by the given subscribed scrAddrs again """
+      amounts = {}
+      changed = set()
+      for scrAddr in scrAddrs:
+         for subID in self.addrIndex.get(scrAddr, []):
+            sub = self.subMap[subID]
+            key = (scrAddr, sub.minconf)
+            if not amounts.has_key(key):
+               amounts[key] = self.getReceived(scrAddr, sub.minconf)
+            if sub.received[scrAddr] != amounts[key]:
+               sub.received[scrAddr] = amounts[key]
+               sub.seq += 1
+               changed.add(subID)
+
+      for subID in changed:
+         self.notifyWaiters(self.subMap[subID])
+
+
+   #############################################################################
+   def onNewZC(self, txHashes):
+      scrAddrs = set()
+      for txHash in txHashes:
+         cppTx = TheBDM.bdv().getTxByHash(txHash)
+         if not cppTx.isInitialized():
+            continue
+         for i in range(cppTx.getNumTxOut()):
+            scrAddr = cppTx.getTxOutCopy(i).getScrAddressStr()
+            if self.addrIndex.has_key(scrAddr):
+               scrAddrs.add(scrAddr)
+      self.updateAddresses(scrAddrs)
+
+
+   #############################################################################
+   def onNewBlock(self):
+      # Confirmations changed for everything, and a block may pay an address
+      # without the tx being seen as zero-conf first
+      self.updateAddresses(self.addrIndex.keys())
+
+
+   #############################################################################
+   def expireIdle(self):
+      tooOld = RightNow() - SUBSCRIPTION_IDLE_EXPIRE
+      for subID,sub in self.subMap.items():
+         if len(sub.waiters) == 0 and sub.lastUsed < tooOld:
+            LOGINFO('Removing idle payment subscription %s' % subID)
+            self.unsubscribe(subID)
+
+
+################################################################################
 class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
    #############################################################################
    def __init__(self, wallet, lockbox=None, inWltMap=None, inLBMap=None, \
@@ -252,9 +646,52 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
       # we'll set everything up here.
       self.addrByte = addrByte
 
+      # Lockbox ID -> LedgerCursor, see getLockboxLedgerCursor()
+      self.lbLedgerCursorMap = {}
+
       # connection to bitcoind
       self.NetworkingFactory = None
 
+      self.rpcDispatcher = RpcDispatcher()
+      self.subscriptions = PaymentSubscriptions(self.getScrAddrReceived)
+
+
+   #############################################################################
+   def _getFunction(self, functionPath):
+      """
+      Returns a function that runs the RPC call through self.rpcDispatcher.
+      The call holds the lock of the wallet it uses until it is done.
+      """
+      func = jsonrpc.JSONRPC._getFunction(self, functionPath)
+      if getattr(func, 'im_self', None) is not self:
+         # Sub-handler functions, e.g. introspection
+         return func
+
+      @functools.wraps(func)
+      def dispatch(*args):
+         return self.rpcDispatcher.callFunction(functionPath, func, \
+                                   lambda: self.getRpcLockID(func, args), args)
+      return dispatch
+
+
+   #############################################################################
+   def getRpcLockID(self, func, args):
+      """ ID of the wallet whose lock an RPC call must hold, or None """
+      if getattr(func, 'rpcNoWallet', False):
+         return None
+      walletArg = getattr(func, 'rpcWalletArg', None)
+      if walletArg is not None and walletArg < len(args):
+         wltID = str(args[walletArg])
+         if self.serverWltMap.has_key(wltID):
+            return wltID
+      return self.getActiveLockID()
+
+
+   #############################################################################
+   def getActiveLockID(self):
+      """ ID of the active wallet's lock, or None if there is none """
+      return self.curWlt.uniqueIDB58 if self.curWlt else None
+
 
    #############################################################################
    @catchErrsForJSON
@@ -399,6 +836,7 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
    #############################################################################
    # backupFilePath is the file to backup the current wallet to.
    # It does not necessarily exist yet.
+   @rpcWorkerMethod(RPC_WORKER_IO)
    @catchErrsForJSON
    def jsonrpc_backupwallet(self, backupFilePath):
       """
@@ -431,50 +869,68 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
    #############################################################################
    # Get a list of UTXOs for the currently loaded wallet.
    @catchErrsForJSON
-   def jsonrpc_listunspent(self):
+   def jsonrpc_listunspent(self, sinceheight=None):
       """
       DESCRIPTION:
       Get a list of unspent transactions for the currently loaded wallet. By
       default, zero-conf UTXOs are included.
       PARAMETERS:
-      None
+      sinceheight - (Default=None) If given, only return the UTXOs that were
+                    added or changed, and the ones that were spent, at or
+                    after this block height.  Pass the "blockheight" from the
+                    previous delta call.
       RETURN:
       A dictionary listing information about each UTXO in the currently loaded
       wallet. The dictionary is similar to the one returned by the bitcoind
-      call of the same name.
+      call of the same name.  In delta mode, a dictionary with the current
+      "blockheight", the "unspent" UTXOs added or changed, the "spent"
+      outpoints (txid/vout), and "fullresync", which is true if the wallet
+      no longer has history back to sinceheight and "unspent" is the full
+      list.
       """
 
-      # Return a dictionary with a string as the key and a wallet B58 value as
-      # the value.
-      utxoList = self.curWlt.getFullUTXOList()
-      curTxOut = 0
-      totBal = 0
-      utxoOutList = []
+      if not TheBDM.getState()==BDM_BLOCKCHAIN_READY:
+         LOGERROR('Blockchain not ready. Values will not be reported.')
+         return [] if sinceheight is None else {}
+
+      # The snapshot is only rebuilt after new block/ZC notifications, and
+      # keeps the address strings, so most calls don't touch C++ at all
+      snapshot = self.curWlt.getUTXOSnapshot()
+      if sinceheight is None:
+         return self.getUTXOJSONList(snapshot, snapshot.getRecords())
+
+      sinceheight = int(sinceheight)
+      changes = snapshot.getChangesSince(sinceheight)
+      if changes is None:
+         changedRecs, spentKeys = snapshot.getRecords(), []
+      else:
+         changedRecs, spentKeys = changes
 
-      if TheBDM.getState()==BDM_BLOCKCHAIN_READY:
-         for u in utxoList:
-            curUTXODict = {}
-            curTxOut += 1
+      spentList = [{'txid': binary_to_hex(txHash, BIGENDIAN, LITTLEENDIAN),
+                    'vout': txoIdx} for txHash,txoIdx in spentKeys]
 
-            curTxOutStr = 'utxo%05d' % curTxOut
-            utxoVal = AmountToJSON(u.getValue())
-            curUTXODict['txid'] = binary_to_hex(u.getTxHash(), \
-                                                BIGENDIAN, LITTLEENDIAN)
-            curUTXODict['vout'] = u.getTxOutIndex()
-            try:
-               curUTXODict['address']  = script_to_addrStr(u.getScript())
-            except:
-               LOGEXCEPT('Error parse UTXO script -- multisig or non-standard')
-               curUTXODict['address']  = ''
-            curUTXODict['scriptPubKey'] = binary_to_hex(u.getScript())
-            curUTXODict['amount'] = utxoVal
-            curUTXODict['confirmations'] = u.getNumConfirm()
-            curUTXODict['priority'] = utxoVal * u.getNumConfirm()
+      return { 'blockheight': snapshot.topBlock,
+               'fullresync':  changes is None,
+               'unspent':     self.getUTXOJSONList(snapshot, changedRecs),
+               'spent':       spentList }
 
-            utxoOutList.append(curUTXODict)
-            totBal += utxoVal
-      else:
-         LOGERROR('Blockchain not ready. Values will not be reported.')
+
+   #############################################################################
+   def getUTXOJSONList(self, snapshot, recList):
+      """ listunspent entries for UtxoSnapshot records """
+      utxoOutList = []
+      for rec in recList:
+         curUTXODict = {}
+         curUTXODict['txid'] = binary_to_hex(rec[UTXOREC_TXHASH], \
+                                             BIGENDIAN, LITTLEENDIAN)
+         curUTXODict['vout'] = rec[UTXOREC_TXOIDX]
+         curUTXODict['address'] = rec[UTXOREC_ADDRSTR]
+         curUTXODict['scriptPubKey'] = binary_to_hex(rec[UTXOREC_SCRIPT])
+         curUTXODict['amount'] = AmountToJSON(rec[UTXOREC_VALUE])
+         curUTXODict['confirmations'] = snapshot.getNumConfirm(rec)
+         curUTXODict['priority'] = curUTXODict['amount'] * \
+                                            curUTXODict['confirmations']
+         utxoOutList.append(curUTXODict)
 
       # Maybe we'll add more later, but for now, return what we have.
       return utxoOutList
@@ -584,6 +1040,7 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
 
 
    #############################################################################
+   @rpcWorkerMethod(RPC_WORKER_CPU)
    @catchErrsForJSON
    def jsonrpc_importprivkey(self, privKey):
       """
@@ -606,7 +1063,8 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
 
       # Make sure the key is one we can support
       try:
-         self.binPrivKey, self.privKeyType = parsePrivateKeyData(privKey)
+         # Locals, not attributes: other calls may run on other threads
+         binPrivKey, privKeyType = parsePrivateKeyData(privKey)
       except:
          (errType, errVal) = sys.exc_info()[:2]
          LOGEXCEPT('Error parsing incoming private key.')
@@ -618,9 +1076,9 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
 
       if privKeyValid:
          self.curWlt.isEnabled = False
-         self.thePubKey = self.curWlt.importExternalAddressData(self.binPrivKey)
-         if self.thePubKey != None:
-            retDict['PubKey'] = binary_to_hex(self.thePubKey)
+         thePubKey = self.curWlt.importExternalAddressData(binPrivKey)
+         if thePubKey != None:
+            retDict['PubKey'] = binary_to_hex(thePubKey)
          else:
             LOGERROR('Attempt to import a private key failed.')
             retDict['Error'] = 'Attempt to import your private key failed. ' \
@@ -718,17 +1176,18 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
       if self.curWlt.isLocked:
          raise WalletUnlockNeeded
       else:
+         sbdPassphrase = SecureBinaryData(str(passphrase))
          try:
-            self.sbdPassphrase = SecureBinaryData(str(passphrase))
-            self.curWlt.changeWalletEncryption(securePassphrase=self.sbdPassphrase)
+            self.curWlt.changeWalletEncryption(securePassphrase=sbdPassphrase)
             self.curWlt.lock()
          finally:
-            self.sbdPassphrase.destroy() # Ensure SBD is destroyed.
+            sbdPassphrase.destroy() # Ensure SBD is destroyed.
 
       return retStr
 
 
    #############################################################################
+   @rpcWorkerMethod(RPC_WORKER_CPU)
    @catchErrsForJSON
    def jsonrpc_walletpassphrase(self, passphrase, timeout=10):
       """
@@ -746,13 +1205,14 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
       retStr = 'Wallet %s is already unlocked.' % self.curWlt
 
       if self.curWlt.isLocked:
+         # A local, not an attribute: other calls may run on other threads
+         sbdPassphrase = SecureBinaryData(str(passphrase))
          try:
-            self.sbdPassphrase = SecureBinaryData(str(passphrase))
-            self.curWlt.unlock(securePassphrase=self.sbdPassphrase,
-                               tempKeyLifetime=int(timeout))
+            self.curWlt.unlock(securePassphrase=sbdPassphrase,
+                               tempKeyLifetime=int(timeout), lazy=True)
             retStr = 'Wallet %s has been unlocked.' % self.curWlt.uniqueIDB58
          finally:
-            self.sbdPassphrase.destroy() # Ensure SBD is destroyed.
+            sbdPassphrase.destroy() # Ensure SBD is destroyed.
 
       return retStr
 
@@ -897,7 +1357,7 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
       retVal = ''
       addr160 = addrStr_to_hash160(addr58, False)[1]
 
-      pyBtcAddress = self.curWlt.getAddrByHash160(addr160)
+      pyBtcAddress = self.curWlt.getAddrByHash160(addr160, withPrivKey=True)
       if pyBtcAddress == None:
          raise PrivateKeyNotFound
 
@@ -912,6 +1372,7 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
             retVal = 'ERROR: Requested format (%s) is invalid.' % keyFormat
       finally:
          self.privKey.destroy()
+         self.curWlt.relockLazyKeys()
 
       return retVal
 
@@ -1061,6 +1522,92 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
       return AmountToJSON(balance)
 
 
+   #############################################################################
+   @catchErrsForJSON
+   def jsonrpc_subscribepayment(self, addresses, amount=0, minconf=0):
+      """
+      DESCRIPTION:
+      Start watching addresses for payments, to wait for them with
+      waitforpayment instead of polling the balances.
+      PARAMETERS:
+      addresses - A comma-separated list of Base58 addresses and lockbox IDs
+                  (for the lockbox P2SH address) from any loaded wallet or
+                  lockbox.
+      amount - (Default=0) The total (BTC) the addresses must receive for the
+               payment to be complete.
+      minconf - (Default=0) The minimum number of confirmations required for a
+                TX to be counted.
+      RETURN:
+      A dictionary with the subscription "id", the change counter "seq", the
+      "amount" and "minconf" subscribed to, the total "received" so far, a
+      "paid" flag and the amount received by each address ("addresses").
+      Coins count as received even after they are spent.
+      """
+
+      if CLI_OPTIONS.offline:
+         raise ValueError('Cannot watch for payments when offline')
+
+      scrAddrs = []
+      for addrOrID in str(addresses).split(','):
+         addrOrID = addrOrID.strip()
+         if self.serverLBMap.has_key(addrOrID):
+            scrAddr = self.serverLBMap[addrOrID].p2shScrAddr
+         else:
+            addrType = addrStr_to_hash160(addrOrID, True)[0]
+            if not addrType in [ADDRBYTE, P2SHBYTE]:
+               raise NetworkIDError('Addr for the wrong network!')
+            scrAddr = addrStr_to_scrAddr(addrOrID)
+         if self.getScrAddrObj(scrAddr) is None:
+            raise AddressNotInWallet('%s is not in any loaded wallet or ' \
+                                     'lockbox' % addrOrID)
+         if not scrAddr in scrAddrs:
+            scrAddrs.append(scrAddr)
+
+      sub = self.subscriptions.subscribe(scrAddrs, JSONtoAmount(amount), \
+                                         int(minconf))
+      return sub.toJSONMap()
+
+
+   #############################################################################
+   @rpcNoWalletMethod
+   @catchErrsForJSON
+   def jsonrpc_waitforpayment(self, subID, seq=-1, timeout=30):
+      """
+      DESCRIPTION:
+      Wait until the amount received by the addresses of a payment
+      subscription changes (long poll).
+      PARAMETERS:
+      subID - The ID returned by subscribepayment.
+      seq - (Default=-1) The "seq" value of the last reply seen. If the
+            subscription changed since, the call returns right away.
+      timeout - (Default=30) The maximum number of seconds to wait (at most
+                60). Use 0 to get the current state without waiting.
+      RETURN:
+      The same dictionary as subscribepayment, once "seq" differs from the
+      given value or the timeout expires.
+      """
+
+      timeout = min(float(timeout), SUBSCRIPTION_MAX_WAIT)
+      return self.subscriptions.wait(str(subID), int(seq), timeout)
+
+
+   #############################################################################
+   @rpcNoWalletMethod
+   @catchErrsForJSON
+   def jsonrpc_unsubscribepayment(self, subID):
+      """
+      DESCRIPTION:
+      Stop watching the addresses of a payment subscription. Subscriptions
+      nobody waited on for an hour are removed automatically.
+      PARAMETERS:
+      subID - The ID returned by subscribepayment.
+      RETURN:
+      The last state of the subscription, as returned by subscribepayment.
+      """
+
+      return self.subscriptions.unsubscribe(str(subID)).toJSONMap()
+
+
    #############################################################################
    @catchErrsForJSON
    def jsonrpc_createustxtoaddress(self, recAddr, amount, fee=None):
@@ -1126,6 +1673,7 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
    # Bitcoin address. (Publick keys and P2SH scripts can also be specified as
    # recipients but we don't use either one in this example.)
    # armoryd createustxformany Lockbox[83jcAqz9],1.0 mwpw68XWmvQKfsCJXETkDX2CWHPdchY6fi,0.12
+   @rpcWorkerMethod(RPC_WORKER_CPU)
    @catchErrsForJSON
    def jsonrpc_createustxformany(self, fee, *args):
       """
@@ -1205,6 +1753,7 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
 
 
    #############################################################################
+   @rpcWorkerMethod(RPC_WORKER_IO, walletArg=0)
    @catchErrsForJSON
    def jsonrpc_getledgersimple(self, inB58ID, tx_count=10, from_tx=0):
       """
@@ -1223,6 +1772,7 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
 
 
    #############################################################################
+   @rpcWorkerMethod(RPC_WORKER_IO, walletArg=0)
    @catchErrsForJSON
    def jsonrpc_getledger(self, inB58ID, tx_count=10, from_tx=0, simple=False):
       """
@@ -1241,54 +1791,41 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
 
       final_le_list = []
       b58Type = 'wallet'
-      self.b58ID = str(inB58ID)
+      b58ID = str(inB58ID)
 
       # Get the wallet.
-      (ledgerWlt, wltIsCPP) = getWltFromB58ID(self.b58ID, self.serverWltMap, \
+      (ledgerWlt, wltIsCPP) = getWltFromB58ID(b58ID, self.serverWltMap, \
                                               self.serverLBMap, \
                                               self.serverLBCppWalletMap)
 
       # Proceed only if the incoming ID (and, hence, the wallet) is valid.
       if ledgerWlt == None:
          errMsg = 'Error: Base58 ID %s does not represent a valid wallet or ' \
-                  'lockbox.' % self.b58ID
+                  'lockbox.' % b58ID
          LOGERROR(errMsg)
          final_le_list.append(errMsg)
       else:
          # For now, lockboxes can only use C++ wallets, which use a different
          # set of calls and such. If we got back a Python wallet, convert it.
          if not wltIsCPP:
+            ledgerCursor = ledgerWlt.getLedgerCursor()
             ledgerWlt = ledgerWlt.cppWallet
          else:
             b58Type = 'lockbox'
+            ledgerCursor = self.getLockboxLedgerCursor(b58ID, ledgerWlt)
 
-         # Do some setup to determine how many ledger entries we'll get and
-         # which entries we'll get.
+         # Only the pages overlapping the requested entries are fetched.
          tx_count = int(tx_count)
          from_tx = int(from_tx)
-
-         sz = 0
-         pageId = 0
-         ledgerEntries = []
          try:
-            while sz < from_tx + tx_count:
-               ledgerVector = ledgerWlt.getHistoryPageAsVector(pageId)
-               for entry in reversed(ledgerVector):
-                  ledgerEntries.append(entry)
-               
-               sz = len(ledgerEntries)
-               pageId = pageId + 1
+            ledgerEntries = ledgerCursor.getSlice(from_tx, tx_count)
          except:
-            pass
-         
-         lower = min(sz, from_tx)
-         upper = min(sz, from_tx+tx_count)
-         txSet = set([])
+            LOGEXCEPT('Error getting ledger entries')
+            ledgerEntries = []
 
          # Loop through all the potential ledger entries and create what we can.
-         for i in range(lower,upper):
+         for le in ledgerEntries:
             # Get the exact Tx we're looking for.
-            le = ledgerEntries[i]
             txHashBin = le.getTxHash()
             txHashHex = binary_to_hex(txHashBin, BIGENDIAN)
 
@@ -1297,21 +1834,16 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
             if not cppTx.isInitialized():
                LOGERROR('Tx hash not recognized by TheBDM: %s' % txHashHex)
 
-            try:
-               cppHead = TheBDM.bdv().getHeaderPtrForTx(cppTx)
-            except:
-               cppHead = None
-
-            if cppHead is None or not cppHead.isInitialized():
+            headInfo = ledgerCursor.getHeaderInfo(txHashBin, cppTx)
+            if headInfo is None:
                LOGERROR('Header pointer is not available! Probably trying'
                         ' to get a block header for a ZC.')
                headHashBin = ''
                headHashHex = ''
                headtime    = 0
             else:
-               headHashBin = cppHead.getThisHash()
+               headHashBin, headtime = headInfo
                headHashHex = binary_to_hex(headHashBin, BIGENDIAN)
-               headtime    = cppHead.getTimestamp()
 
             # Get some more data.
             # amtCoins: amt of BTC transacted, always positive (how big are
@@ -1323,7 +1855,7 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
             isToSelf = le.isSentToSelf()
             amtCoins = 0.0
             netCoins = le.getValue()
-            feeCoins = getFeeForTx(txHashBin)
+            feeCoins = ledgerCursor.getFee(txHashBin)
             scrAddrs = [cppTx.getTxOutCopy(i).getScrAddressStr() for i in \
                        range(cppTx.getNumTxOut())]
 
@@ -1334,7 +1866,8 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
                firstScrAddr = scrAddrs[0]
             elif isToSelf:
                # Sent-to-Self tx
-               amtCoins,changeIdx = determineSentToSelfAmt(le, ledgerWlt)
+               amtCoins,changeIdx = determineSentToSelfAmtCached(le, \
+                                                         ledgerWlt, b58ID)
                changeScrAddr = scrAddrs[changeIdx]
                for iout,recipScrAddr in enumerate(scrAddrs):
                   if not iout==changeIdx:
@@ -1434,6 +1967,20 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
 
       return final_le_list
 
+
+   #############################################################################
+   def getLockboxLedgerCursor(self, lbID, lbCppWlt):
+      """
+      LedgerCursor for a lockbox's C++ wallet, kept between calls so page
+      counts and fee lookups carry over.  Rebuilt if the lockbox got a new
+      C++ wallet.
+      """
+      ledgerCursor = self.lbLedgerCursorMap.get(lbID)
+      if ledgerCursor is None or not ledgerCursor.cppWallet is lbCppWlt:
+         ledgerCursor = LedgerCursor(lbCppWlt)
+         self.lbLedgerCursorMap[lbID] = ledgerCursor
+      return ledgerCursor
+
    #############################################################################
    # NB: For now, this is incompatible with lockboxes.
    @catchErrsForJSON
@@ -1469,7 +2016,8 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
       final_tx_list = []
       #this should be in a try/catch block, since it will throw if from_page is
       #out of range
-      ledgerEntries = self.curWlt.getHistoryPage(from_page)
+      ledgerCursor = self.curWlt.getLedgerCursor()
+      ledgerEntries = ledgerCursor.getPage(int(from_page))[::-1]
 
       sz = len(ledgerEntries)
       txSet = set([])
@@ -1488,16 +2036,16 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
          if not cppTx.isInitialized():
             LOGERROR('Tx hash not recognized by TheBDM: %s' % txHashHex)
 
-         #cppHead = cppTx.getHeaderPtr()
-         cppHead = TheBDM.bdv().getHeaderPtrForTx(cppTx)
-         if not cppHead.isInitialized:
+         headInfo = ledgerCursor.getHeaderInfo(txHashBin, cppTx)
+         if headInfo is None:
             LOGERROR('Header pointer is not available!')
+            headInfo = ('', 0)
 
          blockIndex = cppTx.getBlockTxIndex()
-         blockHash  = binary_to_hex(cppHead.getThisHash(), BIGENDIAN)
+         blockHash  = binary_to_hex(headInfo[0], BIGENDIAN)
          blockTime  = le.getTxTime()
          isToSelf   = le.isSentToSelf()
-         feeCoin   = getFeeForTx(txHashBin)
+         feeCoin   = ledgerCursor.getFee(txHashBin)
          totalBalDiff = le.getValue()
          nconf = (TheBDM.getTopBlockHeight() - \
                   le.getBlockNum()) + 1
@@ -1515,7 +2063,7 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
             changeAddr160 = ""
             targAddr160 = CheckHash160(cppTx.getTxOutCopy(0).getScrAddressStr())
          elif isToSelf:
-            selfamt,changeIdx = determineSentToSelfAmt(le, self.curWlt)
+            selfamt,changeIdx = determineSentToSelfAmtCached(le, self.curWlt)
             if changeIdx==-1:
                changeAddr160 = ""
             else:
@@ -1649,6 +2197,43 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
       return info
 
 
+   #############################################################################
+   @catchErrsForJSON
+   def jsonrpc_getperfstats(self, enable='', reset='False'):
+      """
+      DESCRIPTION:
+      Get the timings collected for functions marked with @TimeThisFunction
+      (run armoryd with --perfstats, or use the "enable" parameter).
+      PARAMETERS:
+      enable - (Default=unchanged) If true, start collecting timings. If
+               false, stop collecting them.
+      reset - (Default=False) If true, clear the timings after returning them.
+      RETURN:
+      A dictionary with "enabled" and a "timers" dictionary. For each timer,
+      it lists the number of calls, the total time, the time not spent in
+      nested timers ("self"), the average, max and 50/90/99th percentile
+      times (all in seconds), and the time spent under each calling timer
+      ("parents"). An "rpc" dictionary gives the number of RPC calls waiting
+      to run ("queued", "maxqueued") and running ("active"), and for each RPC
+      method, the time its calls waited ("wait") and ran ("run"). The RPC
+      timings are always collected.
+      """
+
+      if enable.lower() in ['true', 'false']:
+         setPerfStatsEnabled(enable.lower() == 'true')
+
+      timer = Timer()
+      doReset = reset.lower() == 'true'
+      result = { 'enabled': isPerfStatsEnabled(),
+                 'timers':  timer.getPerfStats(),
+                 'rpc':     self.rpcDispatcher.getStats(doReset) }
+
+      if doReset:
+         timer.resetAllTimers()
+
+      return result
+
+
    #############################################################################
    @catchErrsForJSON
    def jsonrpc_getblock(self, blkhash, verbose='True'):
@@ -1947,7 +2532,10 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
       if spendBal < totalSend + fee:
          raise NotEnoughCoinsError, "You have %s satoshis which is not enough to send %s satoshis with a fee of %s." % (spendBal, totalSend, fee)
 
-      utxoSelect = PySelectCoins(utxoList, totalSend, fee)
+      # Build the per-UTXO coin selection data once, in case we need to
+      # select again with a higher fee
+      coinIndex = CoinSelectionIndex(utxoList)
+      utxoSelect = PySelectCoins(utxoList, totalSend, fee, coinIndex=coinIndex)
 
       # Calculate the real fee and make sure it's affordable.
       # ACR: created new, more flexible fee-calc function.  Perhaps there's an
@@ -1963,7 +2551,8 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
             raise NotEnoughCoinsError, "A fee of %s is necessary for this transaction to go through. You put %s as the fee."  % (minFeeRec, fee)
          if (totalSend + minFeeRec) > spendBal:
             raise NotEnoughCoinsError, "You can't afford the fee!"
-         utxoSelect = PySelectCoins(utxoList, totalSend, minFeeRec)
+         utxoSelect = PySelectCoins(utxoList, totalSend, minFeeRec,
+                                                       coinIndex=coinIndex)
          fee = minFeeRec
 
       # If we have no coins, bail out.
@@ -2076,8 +2665,16 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
 
    #############################################################################
    # Function that signs whatever inputs it can using the active lockbox/wallet
-   # for an unsigned transaction
+   # for an unsigned transaction. Keys decrypted after a lazy unlock are
+   # relocked as soon as the signing is done.
    def sign_transaction(self, ustx):
+      try:
+         return self.sign_transaction_inputs(ustx)
+      finally:
+         self.curWlt.relockLazyKeys()
+
+   #############################################################################
+   def sign_transaction_inputs(self, ustx):
       pytx = ustx.pytxObj
       signed = 0
       for ustxi in ustx.ustxInputs:
@@ -2089,14 +2686,14 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
                if self.curWlt.useEncryption and self.curWlt.isLocked:
                   raise WalletUnlockNeeded, "You need to unlock this wallet before you can sign this transaction"
                a160 = CheckHash160(ustxi.scrAddrs[0])
-               addrObj = self.curWlt.getAddrByHash160(a160)
+               addrObj = self.curWlt.getAddrByHash160(a160, withPrivKey=True)
                ustxi.createAndInsertSignature(pytx, addrObj.binPrivKey32_Plain)
                signed += 1
          elif displayInfo['LboxID'] is not None:
             lockbox = self.serverLBMap.get(displayInfo['LboxID'])
             if lockbox:
                for a160 in lockbox.a160List:
-                  addrObj = self.curWlt.getAddrByHash160(a160)
+                  addrObj = self.curWlt.getAddrByHash160(a160, withPrivKey=True)
                   if addrObj:
                      if self.curWlt.useEncryption and self.curWlt.isLocked:
                         raise WalletUnlockNeeded, "You need to unlock this wallet before you can sign this transaction"
@@ -2398,6 +2995,10 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
          # Add or remove e-mail functs based on the user's command.
          if watchCmd == 'add':
             rpc_server.newBlockFunctions[send_from].append(reportTxFromAddrInNewBlock)
+            # E-mails from this sender left in the spool by the last run
+            # can go now
+            if smtpServer and password:
+               getEmailQueue().resumeSpooled(send_from, smtpServer, password)
          elif watchCmd == 'remove':
             rpc_server.newBlockFunctions[send_from] = []
          retStr = 'watchwallet command succeeded.'
@@ -2408,7 +3009,10 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
    #############################################################################
    # Send ASCII-encoded lockboxes to recipients via e-mail. For now, only
    # lockboxes from ArmoryQt's master list (multisigs.txt) or from the Armory
-   # home directory will be searched.
+   # home directory will be searched. The e-mail goes through the e-mail queue,
+   # which retries it if the server can't be reached.
+   @rpcNoWalletMethod
+   @rpcWorkerMethod(RPC_WORKER_IO)
    @catchErrsForJSON
    def jsonrpc_sendlockbox(self, lbIDs, sender, server, pwd, recips,
                            msgSubj='Armory Lockbox'):
@@ -2425,40 +3029,32 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
                of recipients.
       msgSubj - (Default=Armory Lockbox) The email subject.
       RETURN:
-      A string indicating whether or not the attempt to send was successful.
+      A string indicating whether or not the e-mail was queued, with the ID
+      of the queued e-mail.
       """
 
       # Initial setup
-      retStr = 'sendlockbox command succeeded.'
       if msgSubj == None:
          msgSubj = 'Armory Lockboxes'
       lbIDs = lbIDs.split(":")
 
-      # Write the decorated function that will send the e-mail out.
-      @EmailOutput(sender, server, pwd, recips, msgSubj)
-      def sendLockboxes(lockboxes):
-         emailText = '%s has sent you lockboxes used by Armory.' % sender
-         emailText += ' The lockboxes can be found printed below.\n\n'
-         emailText += 'TOTAL LOCKBOXES: %d\n\n' % len(lockboxes)
-         for curLB in lockboxes:
-            emailText += self.serverLBMap[curLB].serializeAscii() + '\n\n'
-
-         return emailText
-
       # Do these lockboxes actually exist? If not, let the user know and bail.
-      allLBsValid = True
       for curLB in lbIDs:
          if not curLB in self.serverLBMap.keys():
             LOGERROR('Lockbox %s does not exist! Exiting.' % curLB)
-            allLBsValid = False
-            retStr = 'sendlockbox command failed. %s does not exist.' % curLB
-            break
+            return 'sendlockbox command failed. %s does not exist.' % curLB
 
-      # Send the lockbox notifications if all the lockboxes exist.
-      if allLBsValid:
-         sendLockboxes(lbIDs)
+      emailText = '%s has sent you lockboxes used by Armory.' % sender
+      emailText += ' The lockboxes can be found printed below.\n\n'
+      emailText += 'TOTAL LOCKBOXES: %d\n\n' % len(lbIDs)
+      for curLB in lbIDs:
+         emailText += self.serverLBMap[curLB].serializeAscii() + '\n\n'
 
-      return retStr
+      # Sent in the background, with retries if the server can't be reached
+      emailID = getEmailQueue().queueEmail(sender, server, pwd, recips, \
+                                           msgSubj, emailText)
+
+      return 'sendlockbox command succeeded. E-mail %s queued.' % emailID
 
 
    #############################################################################
@@ -2814,6 +3410,57 @@ class Armory_Json_Rpc_Server(jsonrpc.JSONRPC):
       return None
 
 
+   #############################################################################
+   def getScrAddrObj(self, scrAddr):
+      """
+      The C++ ScrAddrObj of a scrAddr in any loaded wallet or lockbox, or None
+      if none of them has it.
+      """
+      if scrAddr[0] == SCRADDR_P2SH_BYTE:
+         for lbID,lbox in self.serverLBMap.iteritems():
+            if lbox.p2shScrAddr == scrAddr:
+               return self.serverLBCppWalletMap[lbID].getScrAddrObjByKey(scrAddr)
+         return None
+
+      for wlt in [self.curWlt] + self.serverWltMap.values():
+         if wlt is not None and wlt.hasScrAddr(scrAddr):
+            return wlt.cppWallet.getScrAddrObjByKey(scrAddr)
+      return None
+
+
+   #############################################################################
+   def getScrAddrReceived(self, scrAddr, minconf=0):
+      """
+      Total of the outputs paying scrAddr in txs with at least minconf
+      confirmations, whether they were spent since or not.  The balance
+      calls can't be used for this: they drop when coins are spent, and only
+      tell zero-conf coins apart from confirmed ones.
+      """
+      scrAddrObj = self.getScrAddrObj(scrAddr)
+      if scrAddrObj is None:
+         return None
+
+      # Zero-conf txs have a block number of UINT32_MAX
+      maxHeight = UINT32_MAX
+      if minconf > 0:
+         maxHeight = TheBDM.getTopBlockHeight() - minconf + 1
+
+      received = 0
+      for pageID in range(scrAddrObj.getPageCount()):
+         for le in scrAddrObj.getHistoryPageById(pageID):
+            if le.getBlockNum() > maxHeight:
+               continue
+            # The ledger value nets out coins this tx spent from scrAddr
+            cppTx = TheBDM.bdv().getTxByHash(le.getTxHash())
+            if not cppTx.isInitialized():
+               continue
+            for i in range(cppTx.getNumTxOut()):
+               txOut = cppTx.getTxOutCopy(i)
+               if txOut.getScrAddressStr() == scrAddr:
+                  received += txOut.getValue()
+      return received
+
+
 
 # Now that we have completed the armoryd server class, let's build the
 # dict that includes the functions clients can call, along with documentation.
@@ -3042,7 +3689,8 @@ class Armory_Daemon(object):
 
             # This is LISTEN call for armory RPC server
             reactor.listenTCP(ARMORY_RPC_PORT, \
-                              server.Site(secured_resource), \
+                              server.Site(secured_resource, \
+                                          timeout=ARMORY_RPC_IDLE_TIMEOUT), \
                               interface="127.0.0.1")
 
             # Setup the heartbeat function to run every
@@ -3079,12 +3727,20 @@ class Armory_Daemon(object):
                         func_newTx       = self.execOnNewTx, \
                         func_newBlock    = self.execOnNewBlock)
 
+         # execOnNewBlock doesn't read the block's txs, so only locate them
+         # and leave decoding each PyTx until something asks for it
+         self.NetworkingFactory.setLazyPayloadCommands(['block'])
+
          reactor.connectTCP('127.0.0.1', BITCOIN_PORT, self.NetworkingFactory)
          # give access to the networking factory from json-rpc listener
          self.resource.NetworkingFactory = self.NetworkingFactory
 
       elif action == NEW_ZC_ACTION:
-         # for zero-confirmation transcations, do nothing for now.
+         # Subscriptions are only touched from the reactor thread
+         if self.resource.subscriptions.hasSubscriptions():
+            reactor.callFromThread(self.resource.subscriptions.onNewZC, \
+                                   [le.getTxHash() for le in args])
+
          print 'New ZC'
          for le in args:
             wltID = le.getWalletID()
@@ -3101,6 +3757,9 @@ class Armory_Daemon(object):
          if newBlocks>0:
             LOGINFO('New Block! : %d', TheBDM.getTopBlockHeight())
 
+            if self.resource.subscriptions.hasSubscriptions():
+               reactor.callFromThread(self.resource.subscriptions.onNewBlock)
+
             self.blkReceived  = RightNow()
             self.writeSetting('LastBlkRecvTime', self.blkReceived)
             self.writeSetting('LastBlkRecv',     TheBDM.getTopBlockHeight())
@@ -3115,6 +3774,7 @@ class Armory_Daemon(object):
                # reorg with multiple blocks and we only want to process the new
                # blocks on the main chain, not the invalid ones
                prevTopBlock = TheBDM.getTopBlockHeight() - newBlocks
+               blockList = []
                for blknum in range(newBlocks):
                   cppHeader = TheBDM.bdv().getHeaderByHeight(prevTopBlock + blknum)
                   pyHeader = PyBlockHeader().unserialize(cppHeader.serialize())
@@ -3122,9 +3782,14 @@ class Armory_Daemon(object):
                   cppBlock = TheBDM.bdv().getMainBlockFromDB(blknum)
                   pyTxList = [PyTx().unserialize(cppBlock.getSerializedTx(i)) for
                                  i in range(cppBlock.getNumTx())]
-                  for funcKey in self.newBlockFunctions:
-                     for blockFunc in self.newBlockFunctions[funcKey]:
-                        blockFunc(pyHeader, pyTxList)
+                  blockList.append((pyHeader, pyTxList))
+
+               # The functions look at the active wallet, so they wait for the
+               # RPC calls using it, like the calls wait for each other. Only
+               # the RPC resource knows which wallet setactivewallet picked.
+               reactor.callFromThread(self.runWithWalletLock, \
+                                      self.resource.getActiveLockID, \
+                                      self.runNewBlockFunctions, blockList)
 
       elif action == REFRESH_ACTION:
          #The wallet ledgers have been updated from an event outside of new ZC
@@ -3133,8 +3798,10 @@ class Armory_Daemon(object):
          for wltID in args:
             if len(wltID) > 0:
                if wltID in self.WltMap:
-                  self.WltMap[wltID].doAfterScan()
-                  self.WltMap[wltID].isEnabled = True
+                  # Not while an RPC call is using the wallet
+                  reactor.callFromThread(self.runWithWalletLock, \
+                                         lambda wltID=wltID: wltID, \
+                                         self.finishWalletRefresh, wltID)
                else:
                   if wltID not in self.lboxMap:
                      raise RuntimeError("cpp says %s exists, but armoryd can't find it" % wltId)
@@ -3155,6 +3822,24 @@ class Armory_Daemon(object):
          LOGWARN(args[0])
 
 
+   #############################################################################
+   def runWithWalletLock(self, getLockID, func, *args):
+      # Only from the reactor thread, see RpcDispatcher.runWithWalletLock
+      return self.resource.rpcDispatcher.runWithWalletLock(getLockID, func, \
+                                                           *args)
+
+   #############################################################################
+   def runNewBlockFunctions(self, blockList):
+      for pyHeader,pyTxList in blockList:
+         for funcKey in self.newBlockFunctions:
+            for blockFunc in self.newBlockFunctions[funcKey]:
+               blockFunc(pyHeader, pyTxList)
+
+   #############################################################################
+   def finishWalletRefresh(self, wltID):
+      self.WltMap[wltID].doAfterScan()
+      self.WltMap[wltID].isEnabled = True
+
    #############################################################################
    def writeSetting(self, settingName, val):
       self.settings.set(settingName, val)
@@ -3356,14 +4041,21 @@ class Armory_Daemon(object):
 
       try:
 
+         # Leave wallets alone while an RPC call is using them; they are
+         # checked again on the next beat
+         dispatcher = self.resource.rpcDispatcher
          for wltID,wlt in self.WltMap.iteritems():
-            wlt.checkWalletLockTimeout()
+            if not dispatcher.isWalletBusy(wltID):
+               wlt.checkWalletLockTimeout()
+
+         self.resource.subscriptions.expireIdle()
 
          # Check for new blocks in the latest blk0XXXX.dat file.
          if TheBDM.getState()==BDM_BLOCKCHAIN_READY:
             #check wallet every checkStep seconds
             nextCheck = self.lastChecked + self.checkStep
-            if RightNow() >= nextCheck:
+            if RightNow() >= nextCheck and \
+               not dispatcher.isWalletBusy(self.curWlt.uniqueIDB58):
                self.checkWallet()
 
       except:
@@ -3379,5 +4071,9 @@ class Armory_Daemon(object):
 
 
 if __name__ == "__main__":
+   # Keep log file writes off the reactor thread
+   useQueuedLogFile()
+   # Send the e-mails the last run left in the spool
+   getEmailQueue()
    rpc_server = Armory_Daemon()
    rpc_server.start()
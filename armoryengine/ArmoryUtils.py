@@ -13,6 +13,8 @@
 #
 ################################################################################
 import ast
+import atexit
+from contextlib import contextmanager
 from datetime import datetime
 from email.MIMEMultipart import MIMEMultipart
 from email.MIMEBase import MIMEBase
@@ -28,6 +30,7 @@ import multiprocessing
 import optparse
 import os
 import platform
+import Queue
 import random
 import signal
 import smtplib
@@ -42,6 +45,7 @@ import shutil
 import base64
 import socket
 import subprocess
+import weakref
 
 #from psutil import Popen
 import psutil
@@ -102,7 +106,9 @@ parser.add_option("--debug",           dest="doDebug",     default=False,     ac
 parser.add_option("--nologging",       dest="logDisable",  default=False,     action="store_true", help="Disable all logging")
 parser.add_option("--netlog",          dest="netlog",      default=False,     action="store_true", help="Log networking messages sent and received by Armory")
 parser.add_option("--logfile",         dest="logFile",     default=DEFAULT, type='str',          help="Specify a non-default location to send logging information")
+parser.add_option("--async-log",       dest="asyncLog",    default=False,     action="store_true", help="Write the log file from a background thread")
 parser.add_option("--mtdebug",         dest="mtdebug",     default=False,     action="store_true", help="Log multi-threaded call sequences")
+parser.add_option("--perfstats",       dest="enablePerfStats", default=False, action="store_true", help="Collect timings of functions marked with @TimeThisFunction")
 parser.add_option("--skip-online-check",dest="forceOnline", default=False,   action="store_true", help="Go into online mode, even if internet connection isn't detected")
 parser.add_option("--skip-stats-report", dest="skipStatsReport", default=False, action="store_true", help="Does announcement checking without any OS/version reporting (for ATI statistics)")
 parser.add_option("--skip-announce-check",dest="skipAnnounceCheck", default=False, action="store_true", help="Do not query for Armory announcements")
@@ -721,18 +727,31 @@ def execAndWait(cli_str, timeout=0, useStartInfo=True):
 # Want to get the line in which an error was triggered, but by wrapping
 # the logger function (as I will below), the displayed "file:linenum"
 # references the logger function, not the function that called it.
-# So I use traceback to find the file and line number two up in the
-# stack trace, and return that to be displayed instead of default
-# [Is this a hack?  Yes and no.  I see no other way to do this]
-def getCallerLine():
-   stkTwoUp = traceback.extract_stack()[-3]
-   filename,method = stkTwoUp[0], stkTwoUp[1]
-   return '%s:%d' % (os.path.basename(filename),method)
+# So I look at the frame two up from here (the caller of the LOG* function)
+# and return its file and line number to be displayed instead of default.
+# The file part only depends on the code object, so it is cached per
+# code object; the line number is read straight from the frame.
+callerFileCache = {}
+def getCallerLine(depth=2):
+   frame = sys._getframe(depth)
+   code = frame.f_code
+   filename = callerFileCache.get(code)
+   if filename is None:
+      filename = os.path.basename(code.co_filename)
+      callerFileCache[code] = filename
+   return '%s:%d' % (filename, frame.f_lineno)
+
+# Filtered-out messages should cost as little as possible:  check the level
+# before formatting the message or looking up the caller
+def isLogLevelEnabled(level):
+   return not rootLogger.disabled and rootLogger.isEnabledFor(level)
 
 # When there's an error in the logging function, it's impossible to find!
 # These wrappers will print the full stack so that it's possible to find
 # which line triggered the error
 def LOGDEBUG(msg, *a):
+   if not isLogLevelEnabled(logging.DEBUG):
+      return
    try:
       logstr = msg if len(a)==0 else (msg%a)
       callerStr = getCallerLine() + ' - '
@@ -742,6 +761,8 @@ def LOGDEBUG(msg, *a):
       raise
 
 def LOGINFO(msg, *a):
+   if not isLogLevelEnabled(logging.INFO):
+      return
    try:
       logstr = msg if len(a)==0 else (msg%a)
       callerStr = getCallerLine() + ' - '
@@ -750,6 +771,8 @@ def LOGINFO(msg, *a):
       traceback.print_stack()
       raise
 def LOGWARN(msg, *a):
+   if not isLogLevelEnabled(logging.WARNING):
+      return
    try:
       logstr = msg if len(a)==0 else (msg%a)
       callerStr = getCallerLine() + ' - '
@@ -758,6 +781,8 @@ def LOGWARN(msg, *a):
       traceback.print_stack()
       raise
 def LOGERROR(msg, *a):
+   if not isLogLevelEnabled(logging.ERROR):
+      return
    try:
       logstr = msg if len(a)==0 else (msg%a)
       callerStr = getCallerLine() + ' - '
@@ -766,6 +791,8 @@ def LOGERROR(msg, *a):
       traceback.print_stack()
       raise
 def LOGCRIT(msg, *a):
+   if not isLogLevelEnabled(logging.CRITICAL):
+      return
    try:
       logstr = msg if len(a)==0 else (msg%a)
       callerStr = getCallerLine() + ' - '
@@ -774,6 +801,8 @@ def LOGCRIT(msg, *a):
       traceback.print_stack()
       raise
 def LOGEXCEPT(msg, *a):
+   if not isLogLevelEnabled(logging.ERROR):
+      return
    try:
       logstr = msg if len(a)==0 else (msg%a)
       callerStr = getCallerLine() + ' - '
@@ -835,15 +864,97 @@ if CLI_OPTIONS.logDisable:
    DEFAULT_FILE_LOGTHRESH     += 100
 
 
+################################################################################
+class QueuedFileHandler(logging.FileHandler):
+   """
+   A FileHandler that formats records on the logging thread, but hands the
+   disk writes to a background thread.  Anything still queued is written
+   out on flush() and close(), which logging.shutdown() calls at exit.
+   """
+   def __init__(self, filename, mode='a'):
+      logging.FileHandler.__init__(self, filename, mode)
+      self.logQueue = Queue.Queue()
+      self.writerThread = threading.Thread(target=self.writeQueuedLines, \
+                                           name='QueuedFileHandler')
+      self.writerThread.daemon = True
+      self.writerThread.start()
+
+   def emit(self, record):
+      try:
+         line = self.format(record) + '\n'
+         if isinstance(line, unicode):
+            line = line.encode('utf-8')
+         self.logQueue.put(line)
+      except (KeyboardInterrupt, SystemExit):
+         raise
+      except:
+         self.handleError(record)
+
+   def writeQueuedLines(self):
+      isClosing = False
+      while not isClosing:
+         # Write everything that is waiting with a single write and flush
+         lines = [self.logQueue.get()]
+         try:
+            while True:
+               lines.append(self.logQueue.get_nowait())
+         except Queue.Empty:
+            pass
+         isClosing = None in lines
+         # Only this thread writes to the stream until close() has joined
+         # it, so no handler lock here (logging.shutdown holds it while
+         # waiting on flush)
+         try:
+            if self.stream:
+               self.stream.write(''.join([l for l in lines if l]))
+               self.stream.flush()
+         except:
+            traceback.print_exc()
+         finally:
+            for l in lines:
+               self.logQueue.task_done()
+
+   def flush(self):
+      if self.writerThread.isAlive():
+         self.logQueue.join()
+      logging.FileHandler.flush(self)
+
+   def close(self):
+      if self.writerThread.isAlive():
+         self.logQueue.put(None)
+         self.writerThread.join()
+      logging.FileHandler.close(self)
+
+
 DateFormat = '%Y-%m-%d %H:%M'
-logging.getLogger('').setLevel(logging.DEBUG)
+# Messages below both handler thresholds are dropped by the LOG* functions
+# before they do any work
+logging.getLogger('').setLevel(min(DEFAULT_FILE_LOGTHRESH, \
+                                   DEFAULT_CONSOLE_LOGTHRESH))
 fileFormatter  = logging.Formatter('%(asctime)s (%(levelname)s) -- %(message)s', \
                                      datefmt=DateFormat)
-fileHandler = logging.FileHandler(ARMORY_LOG_FILE)
+if CLI_OPTIONS.asyncLog:
+   fileHandler = QueuedFileHandler(ARMORY_LOG_FILE)
+else:
+   fileHandler = logging.FileHandler(ARMORY_LOG_FILE)
 fileHandler.setLevel(DEFAULT_FILE_LOGTHRESH)
 fileHandler.setFormatter(fileFormatter)
 logging.getLogger('').addHandler(fileHandler)
 
+# Swap the log file handler for a QueuedFileHandler, so that logging does
+# not block the calling thread on disk writes (armoryd does this at startup)
+def useQueuedLogFile():
+   global fileHandler
+   if isinstance(fileHandler, QueuedFileHandler):
+      return
+   newHandler = QueuedFileHandler(ARMORY_LOG_FILE)
+   newHandler.setLevel(fileHandler.level)
+   newHandler.setFormatter(fileFormatter)
+   rootLogger.addHandler(newHandler)
+   rootLogger.removeHandler(fileHandler)
+   fileHandler.close()
+   fileHandler = newHandler
+
 consoleFormatter = logging.Formatter('(%(levelname)s) %(message)s')
 consoleHandler = logging.StreamHandler()
 consoleHandler.setLevel(DEFAULT_CONSOLE_LOGTHRESH)
@@ -866,20 +977,24 @@ class stringAggregator(object):
 # Do this by swapping out sys.stdout temporarily, execute theObj.pprint()
 # then set sys.stdout back to the original.
 def LOGPPRINT(theObj, loglevel=DEFAULT_PPRINT_LOGLEVEL):
+   if not isLogLevelEnabled(loglevel):
+      return
    sys.stdout = stringAggregator()
    theObj.pprint()
    printedStr = sys.stdout.getStr()
    sys.stdout = sys.__stdout__
-   stkOneUp = traceback.extract_stack()[-2]
-   filename,method = stkOneUp[0], stkOneUp[1]
+   frameOneUp = sys._getframe(1)
+   filename,method = frameOneUp.f_code.co_filename, frameOneUp.f_lineno
    methodStr  = '(PPRINT from %s:%d)\n' % (filename,method)
    logging.log(loglevel, methodStr + printedStr)
 
 # For super-debug mode, we'll write out raw data
 def LOGRAWDATA(rawStr, loglevel=DEFAULT_RAWDATA_LOGLEVEL):
+   if not isLogLevelEnabled(loglevel):
+      return
    dtype = isLikelyDataType(rawStr)
-   stkOneUp = traceback.extract_stack()[-2]
-   filename,method = stkOneUp[0], stkOneUp[1]
+   frameOneUp = sys._getframe(1)
+   filename,method = frameOneUp.f_code.co_filename, frameOneUp.f_lineno
    methodStr  = '(PPRINT from %s:%d)\n' % (filename,method)
    pstr = rawStr[:]
    if dtype==DATATYPE.Binary:
@@ -3388,13 +3503,20 @@ def decompressPK(inKey, inStr=False):
 
 
 ################################################################################
-# Function that can be used to send an e-mail to multiple recipients.
-def send_email(send_from, server, password, send_to, subject, text):
-   # smtp.sendmail() requires a list of recipients. If we didn't get a list,
-   # create one, and delimit based on a colon.
-   if not type(send_to) == list:
-      send_to = send_to.split(":")
+# Build the text of an e-mail to send with smtplib.
+def createEmailMessage(send_from, send_to, subject, text):
+   msg = MIMEMultipart()
+   msg['From'] = send_from
+   msg['To'] = COMMASPACE.join(send_to)
+   msg['Date'] = formatdate(localtime=True)
+   msg['Subject'] = subject
+   msg.attach(MIMEText(text))
+   return msg.as_string()
 
+
+################################################################################
+# Connect and log in to an SMTP server, given as "host[:port]".
+def openSmtpConnection(server, send_from, password):
    # Split the server info. Also, use a default port in case the user goofed and
    # didn't specify a port.
    server = server.split(":")
@@ -3404,18 +3526,27 @@ def send_email(send_from, server, password, send_to, subject, text):
       serverPort = int(server[1])
 
    # Some of this may have to be modded to support non-TLS servers.
-   msg = MIMEMultipart()
-   msg['From'] = send_from
-   msg['To'] = COMMASPACE.join(send_to)
-   msg['Date'] = formatdate(localtime=True)
-   msg['Subject'] = subject
-   msg.attach(MIMEText(text))
    mailServer = smtplib.SMTP(serverAddr, serverPort)
    mailServer.ehlo()
    mailServer.starttls()
    mailServer.ehlo()
    mailServer.login(send_from, password)
-   mailServer.sendmail(send_from, send_to, msg.as_string())
+   return mailServer
+
+
+################################################################################
+# Function that can be used to send an e-mail to multiple recipients. This
+# blocks until the server took the e-mail; see armoryengine.EmailQueue for
+# sending in the background.
+def send_email(send_from, server, password, send_to, subject, text):
+   # smtp.sendmail() requires a list of recipients. If we didn't get a list,
+   # create one, and delimit based on a colon.
+   if not type(send_to) == list:
+      send_to = send_to.split(":")
+
+   mailServer = openSmtpConnection(server, send_from, password)
+   mailServer.sendmail(send_from, send_to, \
+                       createEmailMessage(send_from, send_to, subject, text))
    mailServer.close()
 
 
@@ -3502,6 +3633,20 @@ def HardcodedKeyMaskParams():
    paramMap['FUNC_CHKPWD'] = hardcodeCheckSecurePrintCode
    return paramMap
 
+# Seconds SettingsFile waits before writing out changes, so that a burst of
+# changes ends up as a single write
+SETTINGS_FLUSH_DELAY = 1.0
+
+# Every SettingsFile still in use, so pending changes can be written out at
+# exit.  A weak set, so it doesn't keep settings objects alive.
+liveSettingsFiles = weakref.WeakSet()
+
+def flushAllSettingsFiles():
+   for settings in list(liveSettingsFiles):
+      settings.flush()
+
+atexit.register(flushAllSettingsFiles)
+
 ################################################################################
 ################################################################################
 class SettingsFile(object):
@@ -3522,12 +3667,28 @@ class SettingsFile(object):
    """
 
    #############################################################################
-   def __init__(self, path=None):
+   def __init__(self, path=None, flushDelay=SETTINGS_FLUSH_DELAY):
       self.settingsPath = path
       self.settingsMap = {}
       if not path:
          self.settingsPath = os.path.join(ARMORY_HOME_DIR, 'ArmorySettings.txt')
 
+      # Changes are kept in settingsMap and written out at most once per
+      # flushDelay seconds, by a timer thread.  A flushDelay of 0 writes on
+      # every change, like before.
+      self.flushDelay = flushDelay
+      self.settingsLock = threading.RLock()
+      self.batchDepth = 0
+      self.isDirty = False
+      self.flushTimer = None
+      liveSettingsFiles.add(self)
+
+      # A crash between writing the temp file and the rename leaves only
+      # the temp file, which is complete
+      tempPath = self.settingsPath + '.tmp'
+      if not os.path.exists(self.settingsPath) and os.path.exists(tempPath):
+         os.rename(tempPath, self.settingsPath)
+
       LOGINFO('Using settings file: %s', self.settingsPath)
       if os.path.exists(self.settingsPath):
          self.loadSettingsFile(path)
@@ -3548,28 +3709,30 @@ class SettingsFile(object):
 
    #############################################################################
    def set(self, name, value):
-      if isinstance(value, tuple):
-         self.settingsMap[name] = list(value)
-      else:
-         self.settingsMap[name] = value
-      self.writeSettingsFile()
+      with self.settingsLock:
+         if isinstance(value, tuple):
+            self.settingsMap[name] = list(value)
+         else:
+            self.settingsMap[name] = value
+         self.scheduleWrite()
 
    #############################################################################
    def extend(self, name, value):
       """ Adds/converts setting to list, appends value to the end of it """
-      if not self.settingsMap.has_key(name):
-         if isinstance(value, list):
-            self.set(name, value)
-         else:
-            self.set(name, [value])
-      else:
-         origVal = self.get(name, expectList=True)
-         if isinstance(value, list):
-            origVal.extend(value)
+      with self.settingsLock:
+         if not self.settingsMap.has_key(name):
+            if isinstance(value, list):
+               self.set(name, value)
+            else:
+               self.set(name, [value])
          else:
-            origVal.append(value)
-         self.settingsMap[name] = origVal
-      self.writeSettingsFile()
+            origVal = self.get(name, expectList=True)
+            if isinstance(value, list):
+               origVal.extend(value)
+            else:
+               origVal.append(value)
+            self.settingsMap[name] = origVal
+         self.scheduleWrite()
 
    #############################################################################
    def get(self, name, expectList=False):
@@ -3603,15 +3766,76 @@ class SettingsFile(object):
 
    #############################################################################
    def delete(self, name):
-      if self.hasSetting(name):
-         del self.settingsMap[name]
-      self.writeSettingsFile()
+      with self.settingsLock:
+         if self.hasSetting(name):
+            del self.settingsMap[name]
+         self.scheduleWrite()
+
+   #############################################################################
+   def beginBatch(self):
+      """ Hold back all writes until the matching endBatch() """
+      with self.settingsLock:
+         self.batchDepth += 1
+
+   #############################################################################
+   def endBatch(self):
+      with self.settingsLock:
+         self.batchDepth = max(self.batchDepth - 1, 0)
+         if self.batchDepth == 0 and self.isDirty:
+            self.scheduleWrite()
+
+   #############################################################################
+   @contextmanager
+   def batch(self):
+      """
+      Use as "with settings.batch(): ..." to make a series of changes that
+      end up in a single write of the settings file
+      """
+      self.beginBatch()
+      try:
+         yield self
+      finally:
+         self.endBatch()
+
+   #############################################################################
+   def scheduleWrite(self):
+      with self.settingsLock:
+         self.isDirty = True
+         if self.batchDepth > 0:
+            return
+
+         if self.flushDelay <= 0:
+            self.flush()
+         elif self.flushTimer is None:
+            self.flushTimer = threading.Timer(self.flushDelay, self.flush)
+            self.flushTimer.daemon = True
+            self.flushTimer.start()
+
+   #############################################################################
+   def flush(self):
+      """ Write out any pending changes now """
+      with self.settingsLock:
+         if self.flushTimer is not None:
+            self.flushTimer.cancel()
+            self.flushTimer = None
+
+         if self.isDirty:
+            try:
+               self.writeSettingsFile()
+               self.isDirty = False
+            except:
+               LOGEXCEPT('Failed to write settings file %s', self.settingsPath)
 
    #############################################################################
    def writeSettingsFile(self, path=None):
+      """
+      Writes to a temp file that then replaces the settings file, so a crash
+      in the middle of a write never leaves a truncated settings file
+      """
       if not path:
          path = self.settingsPath
-      f = open(path, 'w')
+      tempPath = path + '.tmp'
+      f = open(tempPath, 'w')
       for key,val in self.settingsMap.iteritems():
          try:
             # Skip anything that throws an exception
@@ -3631,8 +3855,15 @@ class SettingsFile(object):
             f.write('\n')
          except:
             LOGEXCEPT('Invalid entry in SettingsFile... skipping')
+      f.flush()
+      os.fsync(f.fileno())
       f.close()
 
+      # Windows won't rename over an existing file
+      if OS_WINDOWS and os.path.exists(path):
+         os.remove(path)
+      os.rename(tempPath, path)
+
 
    #############################################################################
    def loadSettingsFile(self, path=None):
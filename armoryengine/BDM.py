@@ -56,6 +56,7 @@ class PySide_CallBack(Cpp.BDM_CallBack):
          if action == Cpp.BDMAction_Ready:
             act = FINISH_LOAD_BLOCKCHAIN_ACTION
             TheBDM.topBlockHeight = block
+            TheBDM.reorgEpoch += 1
             TheBDM.setState(BDM_BLOCKCHAIN_READY)
          elif action == Cpp.BDMAction_ZC:
             act = NEW_ZC_ACTION
@@ -65,6 +66,10 @@ class PySide_CallBack(Cpp.BDM_CallBack):
             act = NEW_BLOCK_ACTION
             castArg = Cpp.BtcUtils_cast_to_int(arg)
             arglist.append(castArg)
+            # castArg counts the blocks scanned from the reorg branch point
+            # if there was one, so it only adds up without a reorg
+            if not TheBDM.topBlockHeight + castArg == block:
+               TheBDM.reorgEpoch += 1
             TheBDM.topBlockHeight = block
          elif action == Cpp.BDMAction_Refresh:
             act = REFRESH_ACTION
@@ -80,6 +85,11 @@ class PySide_CallBack(Cpp.BDM_CallBack):
             act = SCAN_ACTION
             argstr = Cpp.BtcUtils_cast_to_string_vec(arg)
             arglist.append(argstr)
+
+         # Anything cached off wallet UTXO lists is stale after these
+         if act in [FINISH_LOAD_BLOCKCHAIN_ACTION, NEW_ZC_ACTION,
+                    NEW_BLOCK_ACTION, REFRESH_ACTION]:
+            TheBDM.utxoEpoch += 1
             
          listenerList = TheBDM.getListenerList()
          for cppNotificationListener in listenerList:
@@ -187,6 +197,8 @@ class BlockDataManager(object):
       self.lastPctLoad = 0
       
       self.topBlockHeight = 0
+      self.utxoEpoch = 0
+      self.reorgEpoch = 0
       self.cppNotificationListenerList = []
    
    
@@ -227,6 +239,24 @@ class BlockDataManager(object):
    @ActLikeASingletonBDM
    def getTopBlockHeight(self):
       return self.topBlockHeight
+
+   #############################################################################
+   @ActLikeASingletonBDM
+   def getUtxoEpoch(self):
+      """
+      Bumped on every notification that can change wallet UTXO lists, so
+      caches of those lists only need to compare this number
+      """
+      return self.utxoEpoch
+
+   #############################################################################
+   @ActLikeASingletonBDM
+   def getReorgEpoch(self):
+      """
+      Bumped when the chain is (re)loaded or reorganized, which is all that
+      can change what the ledger shows for a tx that is already confirmed
+      """
+      return self.reorgEpoch
    
    #############################################################################
    @ActLikeASingletonBDM
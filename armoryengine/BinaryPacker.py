@@ -14,7 +14,7 @@
 ################################################################################
 from armoryengine.ArmoryUtils import LITTLEENDIAN, int_to_binary, packVarInt
 UINT8, UINT16, UINT32, UINT64, INT8, INT16, INT32, INT64, VAR_INT, VAR_STR, FLOAT, BINARY_CHUNK = range(12)
-from struct import pack, unpack
+from struct import pack, unpack, Struct, error as StructError
 
 class PackerError(Exception): pass
 
@@ -84,3 +84,76 @@ class BinaryPacker(object):
          raise PackerError, "Var type not recognized!  VarType="+str(varType)
 
 
+
+################################################################################
+# Precompiled struct writers, one per (varType, endianness) pair
+FIXED_WIDTH_CODES = { UINT8:'B', UINT16:'H', UINT32:'I', UINT64:'Q', \
+                      INT8:'b',  INT16:'h',  INT32:'i',  INT64:'q', FLOAT:'f' }
+
+STRUCT_WRITERS = {}
+for vtype,code in FIXED_WIDTH_CODES.iteritems():
+   for E in ['<', '>', '!', '=']:
+      STRUCT_WRITERS[(vtype,E)] = Struct(E+code)
+
+
+################################################################################
+class FastBinaryPacker(BinaryPacker):
+   """
+   Same interface as BinaryPacker, but everything is written into a single
+   growable bytearray with precompiled Struct.pack_into() writers, so
+   getSize() is O(1) and no per-field strings are concatenated.  If you
+   know (or can bound) the final size, pass it in to avoid any regrowth:
+      >> bp = FastBinaryPacker(80)
+      >> bp.put(UINT32, 1)
+      >> ...etc...
+   """
+   def __init__(self, reserveSize=0):
+      self.binaryConcat = bytearray(reserveSize)
+      self.pos = 0
+
+   def getSize(self):
+      return self.pos
+
+   def getBinaryString(self):
+      return str(buffer(self.binaryConcat, 0, self.pos))
+
+   def reserve(self, nBytes):
+      """ Make sure the next nBytes can be written without regrowing """
+      needed = self.pos + nBytes - len(self.binaryConcat)
+      if needed > 0:
+         # Grow geometrically so a long run of put()s stays linear overall
+         self.binaryConcat.extend(bytearray(max(needed, len(self.binaryConcat))))
+
+
+   def putRaw(self, binStr):
+      sz = len(binStr)
+      self.reserve(sz)
+      self.binaryConcat[self.pos:self.pos+sz] = binStr
+      self.pos += sz
+
+
+   def put(self, varType, theData, width=None, endianness=LITTLEENDIAN):
+      writer = STRUCT_WRITERS.get((varType, endianness))
+      if writer is not None:
+         self.reserve(writer.size)
+         try:
+            writer.pack_into(self.binaryConcat, self.pos, theData)
+         except StructError, e:
+            raise PackerError, 'Cannot pack %s as VarType=%d: %s' % \
+                                                   (str(theData), varType, e)
+         self.pos += writer.size
+      elif varType == VAR_INT:
+         self.putRaw(packVarInt(theData)[0])
+      elif varType == VAR_STR:
+         self.putRaw(packVarInt(len(theData))[0])
+         self.putRaw(theData)
+      elif varType == BINARY_CHUNK:
+         if width==None:
+            self.putRaw(theData)
+         else:
+            if len(theData)>width:
+               raise PackerError, 'Too much data to fit into fixed width field'
+            self.putRaw(theData)
+            self.putRaw('\x00'*(width-len(theData)))
+      else:
+         raise PackerError, "Var type not recognized!  VarType="+str(varType)
@@ -21,7 +21,8 @@
 #  Classes for reading and writing large binary objects
 ################################################################################
 ################################################################################
-from struct import pack, unpack
+import mmap
+from struct import pack, unpack, Struct
 from BinaryPacker import UINT8, UINT16, UINT32, UINT64, INT8, INT16, INT32, INT64, VAR_INT, VAR_STR, FLOAT, BINARY_CHUNK
 from armoryengine.ArmoryUtils import LITTLEENDIAN, unpackVarInt, LOGERROR
 
@@ -45,12 +46,27 @@ class BinaryUnpacker(object):
    def getRemainingSize(self): return len(self.binaryStr) - self.pos
    def getBinaryString(self): return self.binaryStr
    def getRemainingString(self): return self.binaryStr[self.pos:]
+   def getSubString(self, startPos, endPos): return self.binaryStr[startPos:endPos]
    def append(self, binaryStr): self.binaryStr += binaryStr
    def advance(self, bytesToAdvance): self.pos += bytesToAdvance
    def rewind(self, bytesToRewind): self.pos -= bytesToRewind
    def resetPosition(self, toPos=0): self.pos = toPos
    def getPosition(self): return self.pos
 
+   def getMany(self, fieldList, endianness=LITTLEENDIAN):
+      """
+      Read a sequence of fields in one call.  Each entry of fieldList is
+      either a varType, or a (BINARY_CHUNK, nBytes) pair:
+         >> ver, prevHash, nonce = bup.getMany([UINT32, (BINARY_CHUNK,32), UINT32])
+      """
+      out = []
+      for field in fieldList:
+         if isinstance(field, tuple):
+            out.append(self.get(field[0], field[1], endianness))
+         else:
+            out.append(self.get(field, endianness=endianness))
+      return out
+
    def get(self, varType, sz=0, endianness=LITTLEENDIAN):
       """
       First argument is the data-type:  UINT32, VAR_INT, etc.
@@ -128,3 +144,174 @@ class BinaryUnpacker(object):
       raise UnpackerError, "Var type not recognized!  VarType="+str(varType)
 
 ################################################################################
+
+
+
+################################################################################
+# Precompiled struct readers, one per (varType, endianness) pair.  Shared by
+# all FastBinaryUnpacker instances so the format strings are only parsed once
+FIXED_WIDTH_CODES = { UINT8:'B', UINT16:'H', UINT32:'I', UINT64:'Q', \
+                      INT8:'b',  INT16:'h',  INT32:'i',  INT64:'q', FLOAT:'f' }
+
+STRUCT_READERS = {}
+for vtype,code in FIXED_WIDTH_CODES.iteritems():
+   for E in ['<', '>', '!', '=']:
+      STRUCT_READERS[(vtype,E)] = Struct(E+code)
+
+VARINT_READERS = { 0xfd: (Struct('<H'), 3),
+                   0xfe: (Struct('<I'), 5),
+                   0xff: (Struct('<Q'), 9) }
+
+# Compiled getMany() plans, keyed by (tuple(fieldList), endianness)
+GETMANY_PLANS = {}
+
+
+################################################################################
+class FastBinaryUnpacker(BinaryUnpacker):
+   """
+   Same interface as BinaryUnpacker, but integers are read in-place with
+   precompiled Struct.unpack_from() calls instead of slicing a new string
+   for every field, and getMany() folds runs of fixed-width fields into a
+   single unpack.  The data may be a str, bytearray, mmap or memoryview.
+
+   This is opt-in:  hand one of these to any unserialize() method that
+   accepts a BinaryUnpacker and nested objects will use it too:
+      >> tx = PyTx().unserialize(FastBinaryUnpacker(rawTx))
+   """
+   def __init__(self, binaryStr):
+      self.binaryStr = binaryStr
+      self.pos = 0
+      # Slicing a str or an mmap gives a str.  Python 2 mmaps can't be
+      # wrapped in a memoryview, so they must take the slicing path.
+      self.isStr = isinstance(binaryStr, (str, mmap.mmap))
+      self.size  = len(binaryStr)
+
+   def getSize(self): return self.size
+   def getRemainingSize(self): return self.size - self.pos
+
+   def getRemainingString(self): return self.getSubString(self.pos, self.size)
+
+   def getRemainingView(self):
+      """
+      No-copy access to the unread data.  Do not append() to this unpacker
+      while holding on to the returned view.  For an mmap this is a
+      read-only buffer, since mmaps can't be wrapped in a memoryview.
+      """
+      if isinstance(self.binaryStr, mmap.mmap):
+         return buffer(self.binaryStr, self.pos)
+      return memoryview(self.binaryStr)[self.pos:]
+
+   def getSubString(self, startPos, endPos):
+      """ Copy of the underlying data between two absolute positions """
+      if self.isStr:
+         return self.binaryStr[startPos:endPos]
+      return str(memoryview(self.binaryStr)[startPos:endPos].tobytes())
+
+   def append(self, binaryStr):
+      """
+      The first append converts the data to a bytearray, so that repeated
+      appends extend it in place instead of copying everything each time
+      """
+      if not isinstance(self.binaryStr, bytearray):
+         self.binaryStr = bytearray(self.binaryStr)
+         self.isStr = False
+      self.binaryStr.extend(binaryStr)
+      self.size = len(self.binaryStr)
+
+
+   def get(self, varType, sz=0, endianness=LITTLEENDIAN):
+      pos = self.pos
+      reader = STRUCT_READERS.get((varType, endianness))
+      if reader is not None:
+         nBytes = reader.size
+         if self.size - pos < nBytes:
+            raise UnpackerError
+         self.pos = pos + nBytes
+         return reader.unpack_from(self.binaryStr, pos)[0]
+
+      if varType == BINARY_CHUNK:
+         if self.size - pos < sz:
+            raise UnpackerError
+         self.pos = pos + sz
+         return self.getSubString(pos, pos+sz)
+      elif varType == VAR_INT:
+         return self.readVarInt()
+      elif varType == VAR_STR:
+         strLen = self.readVarInt()
+         if self.size - self.pos < strLen:
+            raise UnpackerError
+         pos = self.pos
+         self.pos = pos + strLen
+         return self.getSubString(pos, pos+strLen)
+
+      LOGERROR('Var Type not recognized!  VarType = %d', varType)
+      raise UnpackerError, "Var type not recognized!  VarType="+str(varType)
+
+
+   def readVarInt(self):
+      pos = self.pos
+      if self.size - pos < 1:
+         raise UnpackerError
+      code = STRUCT_READERS[(UINT8,'<')].unpack_from(self.binaryStr, pos)[0]
+      if code < 0xfd:
+         self.pos = pos + 1
+         return code
+
+      reader,nBytes = VARINT_READERS[code]
+      if self.size - pos < nBytes:
+         raise UnpackerError
+      self.pos = pos + nBytes
+      return reader.unpack_from(self.binaryStr, pos+1)[0]
+
+
+   def getMany(self, fieldList, endianness=LITTLEENDIAN):
+      """
+      Consecutive fixed-width fields (integers and BINARY_CHUNKs) are read
+      with one compiled Struct.  VAR_INT/VAR_STR fields split the plan.
+      """
+      planKey = (tuple(fieldList), endianness)
+      plan = GETMANY_PLANS.get(planKey)
+      if plan is None:
+         plan = compileGetManyPlan(fieldList, endianness)
+         GETMANY_PLANS[planKey] = plan
+
+      out = []
+      for step in plan:
+         if isinstance(step, Struct):
+            if self.size - self.pos < step.size:
+               raise UnpackerError
+            vals = step.unpack_from(self.binaryStr, self.pos)
+            self.pos += step.size
+            out.extend(vals)
+         else:
+            out.append(self.get(step, endianness=endianness))
+      return out
+
+
+################################################################################
+def compileGetManyPlan(fieldList, endianness=LITTLEENDIAN):
+   """
+   Turn a getMany() field list into a list of steps, where each step is
+   either a Struct covering a run of fixed-width fields, or a bare VAR_INT/
+   VAR_STR varType to be read individually
+   """
+   plan = []
+   fmt = ''
+   for field in fieldList:
+      if isinstance(field, tuple):
+         if not field[0] == BINARY_CHUNK:
+            raise UnpackerError, 'Only BINARY_CHUNK fields take a size'
+         fmt += '%ds' % field[1]
+      elif field in FIXED_WIDTH_CODES:
+         fmt += FIXED_WIDTH_CODES[field]
+      elif field in (VAR_INT, VAR_STR):
+         if fmt:
+            plan.append(Struct(endianness+fmt))
+            fmt = ''
+         plan.append(field)
+      else:
+         raise UnpackerError, "Var type not recognized!  VarType="+str(field)
+
+   if fmt:
+      plan.append(Struct(endianness+fmt))
+   return plan
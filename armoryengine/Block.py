@@ -9,7 +9,7 @@ from armoryengine.ArmoryUtils import UNINITIALIZED, UnitializedBlockDataError, \
    hash256, LITTLEENDIAN, BIGENDIAN, binary_switchEndian, binary_to_hex, \
    binaryBits_to_difficulty
 from armoryengine.BDM import TheBDM
-from armoryengine.BinaryUnpacker import BinaryUnpacker
+from armoryengine.BinaryUnpacker import BinaryUnpacker, FastBinaryUnpacker
 from armoryengine.Transaction import BlockComponent, indent, PyTx
 from armoryengine.BinaryPacker import BinaryPacker, UINT32, BINARY_CHUNK, \
    VAR_INT
@@ -18,7 +18,11 @@ from armoryengine.BinaryPacker import BinaryPacker, UINT32, BINARY_CHUNK, \
 
 ################################################################################
 #  Block Information
-################################################################################
+################################################################################
+# version, prevBlkHash, merkleRoot, timestamp, diffBits, nonce
+HEADER_FIELDS = [UINT32, (BINARY_CHUNK,32), (BINARY_CHUNK,32), \
+                 UINT32, (BINARY_CHUNK,4),  UINT32]
+
 class PyBlockHeader(BlockComponent):
    def __init__(self):
       self.version      = 1
@@ -58,13 +62,13 @@ class PyBlockHeader(BlockComponent):
       else:
          blkData = BinaryUnpacker( toUnpack )
 
-      self.version     = blkData.get(UINT32)
-      self.prevBlkHash = blkData.get(BINARY_CHUNK, 32)
-      self.merkleRoot  = blkData.get(BINARY_CHUNK, 32)
-      self.timestamp   = blkData.get(UINT32)
-      self.diffBits    = blkData.get(BINARY_CHUNK, 4)
-      self.nonce       = blkData.get(UINT32)
-      self.theHash     = hash256(self.serialize())
+      startPos = blkData.getPosition()
+      self.version, self.prevBlkHash, self.merkleRoot, self.timestamp, \
+         self.diffBits, self.nonce = blkData.getMany(HEADER_FIELDS)
+      if isinstance(blkData, FastBinaryUnpacker):
+         self.theHash  = hash256(blkData.getSubString(startPos, startPos+80))
+      else:
+         self.theHash  = hash256(self.serialize())
       return self
 
    def getHash(self, endian=LITTLEENDIAN):
@@ -59,6 +59,7 @@
 ################################################################################
 import math
 import random
+from bisect import bisect_left, bisect_right
 
 from armoryengine.ArmoryUtils import CheckHash160, binary_to_hex, coin2str, \
    hash160_to_addrStr, ONE_BTC, CENT, int_to_binary, MIN_RELAY_TX_FEE, MIN_TX_FEE
@@ -144,6 +145,145 @@ class PyUnspentTxOut(object):
       print self.prettyStr(indent)
 
 
+################################################################################
+# Fields of the compact UTXO records kept by UtxoSnapshot
+UTXOREC_TXHASH  = 0
+UTXOREC_TXOIDX  = 1
+UTXOREC_VALUE   = 2
+UTXOREC_HEIGHT  = 3
+UTXOREC_SCRIPT  = 4
+UTXOREC_SCRADDR = 5
+UTXOREC_ADDRSTR = 6
+
+################################################################################
+class UtxoSnapshot(object):
+   """
+   A wallet's full UTXO list as of one BDM state, so that repeated
+   getFullUTXOList()/listunspent calls don't go back to the C++ wallet and
+   re-derive address strings every time.  Each UTXO is kept as a tuple
+   indexed by the UTXOREC_* constants.  ADDRSTR is '' for scripts that
+   don't have an address string.
+
+   PyBtcWallet.getUTXOSnapshot() calls update() whenever TheBDM's UTXO
+   epoch has moved (new block, zero-conf or refresh notification).  Each
+   update also records the top block height at which every outpoint was
+   added, changed or spent, so getChangesSince() can answer delta requests.
+   That history goes back maxHistory blocks.
+   """
+   def __init__(self, maxHistory=2016):
+      self.maxHistory = maxHistory
+      self.records    = {}   # (txHash, txOutIndex) -> record tuple
+      self.keyOrder   = []   # outpoints, in the order the C++ wallet gave
+      self.changedAt  = {}   # outpoint -> top height when added/changed
+      self.removedAt  = {}   # outpoint -> top height when spent
+      self.topBlock   = -1
+      self.epoch      = None
+      self.oldestDelta = None  # deltas from before this need a full list
+      self.utxoList   = None
+
+   #############################################################################
+   def isCurrent(self, epoch, topBlock):
+      return self.epoch is not None and \
+             self.epoch == epoch and \
+             self.topBlock == topBlock
+
+   #############################################################################
+   def invalidate(self):
+      """ Force a rebuild on next use, without dropping the delta history """
+      self.epoch = None
+
+   #############################################################################
+   def update(self, cppUtxoList, topBlock, epoch):
+      """
+      cppUtxoList holds C++ UnspentTxOut objects (anything with the same
+      getters, including getTxHeight).  Records for outpoints that didn't
+      change height are reused, so address strings are only derived for
+      new UTXOs.
+      """
+      newRecords = {}
+      keyOrder = []
+      for utxo in cppUtxoList:
+         key = (utxo.getTxHash(), utxo.getTxOutIndex())
+         height = utxo.getTxHeight()
+         rec = self.records.get(key)
+         if rec is None or not rec[UTXOREC_HEIGHT] == height:
+            script = utxo.getScript()
+            try:
+               addrStr = script_to_addrStr(script)
+            except:
+               LOGEXCEPT('Error parse UTXO script -- multisig or non-standard')
+               addrStr = ''
+            rec = (key[0], key[1], utxo.getValue(), height, script,
+                   utxo.getRecipientScrAddr(), addrStr)
+            self.changedAt[key] = topBlock
+            self.removedAt.pop(key, None)
+         newRecords[key] = rec
+         keyOrder.append(key)
+
+      for key in self.records:
+         if not key in newRecords:
+            self.removedAt[key] = topBlock
+            self.changedAt.pop(key, None)
+
+      # Drop spent outpoints older than maxHistory blocks
+      if self.oldestDelta is None:
+         self.oldestDelta = topBlock
+      cutoff = topBlock - self.maxHistory
+      if cutoff > self.oldestDelta:
+         for key,height in self.removedAt.items():
+            if height < cutoff:
+               del self.removedAt[key]
+         self.oldestDelta = cutoff
+
+      self.records  = newRecords
+      self.keyOrder = keyOrder
+      self.topBlock = topBlock
+      self.epoch    = epoch
+      self.utxoList = None
+
+   #############################################################################
+   def getRecords(self):
+      return [self.records[key] for key in self.keyOrder]
+
+   #############################################################################
+   def getNumConfirm(self, rec):
+      return self.topBlock - rec[UTXOREC_HEIGHT] + 1
+
+   #############################################################################
+   def getUtxoList(self):
+      """
+      PyUnspentTxOut objects for every record, built once per update.  The
+      list is a copy, but the objects are shared:  don't modify them.
+      """
+      if self.utxoList is None:
+         self.utxoList = [PyUnspentTxOut(rec[UTXOREC_SCRADDR],
+                                         rec[UTXOREC_TXHASH],
+                                         rec[UTXOREC_TXOIDX],
+                                         rec[UTXOREC_VALUE],
+                                         self.getNumConfirm(rec),
+                                         rec[UTXOREC_SCRIPT]) \
+                                             for rec in self.getRecords()]
+      return list(self.utxoList)
+
+   #############################################################################
+   def getChangesSince(self, sinceHeight):
+      """
+      Returns (changedRecords, removedOutpoints) for everything recorded at
+      or after sinceHeight, or None if sinceHeight is older than the
+      history we have (the caller needs the full list then).  Changes at
+      sinceHeight itself are included, since zero-conf updates don't move
+      the top block:  clients may see an entry twice, but never miss one.
+      """
+      if self.oldestDelta is None or sinceHeight < self.oldestDelta:
+         return None
+
+      changed = [self.records[key] for key in self.keyOrder \
+                                    if self.changedAt[key] >= sinceHeight]
+      removed = [key for key,height in self.removedAt.iteritems() \
+                                                if height >= sinceHeight]
+      return changed, removed
+
+
 ################################################################################
 def sumTxOutList(txoutList):
    return sum([u.getValue() for u in txoutList])
@@ -409,28 +549,48 @@ def getSelectCoinsScores(utxoSelectList, targetOutVal, minFee):
           indirectly available with the current set of factors here
    """
 
-   # Need to calculate how much the change will be returned to sender on this tx
-   totalIn = sum([utxo.getValue() for utxo in utxoSelectList])
-   totalChange = totalIn - (targetOutVal+minFee)
-
    # Abort if this is an empty list (negative score) or not enough coins
+   totalIn = sum([utxo.getValue() for utxo in utxoSelectList])
    if len(utxoSelectList)==0 or totalIn<targetOutVal+minFee:
       return -1
 
-
    ##################
    # -- Does this selection include any zero-confirmation tx?
    # -- How many addresses are linked together by this tx?
    addrSet = set()
    noZeroConf = 1
+   prioritySum = 0
    for utxo in utxoSelectList:
       
       addrSet.add(script_to_scrAddr(utxo.getScript()))
       if utxo.getNumConfirm() == 0:
          noZeroConf = 0
-   numAddr = len(addrSet)
-   numAddrFactor = 4.0/(numAddr+1)**2  # values in the range (0, 1]
+      else:
+         prioritySum += utxo.getValue() * utxo.getNumConfirm()
+
+   return computeSelectScores(len(utxoSelectList), totalIn, prioritySum,
+                           len(addrSet), noZeroConf, targetOutVal, minFee)
+
+
+################################################################################
+def computeSelectScores(numInputs, totalIn, prioritySum, numAddr, noZeroConf,
+                                                       targetOutVal, minFee):
+   """
+   The getSelectCoinsScores() factors, computed from the totals of a
+   selection instead of the selection itself:  the number of inputs, the sum
+   of their values, the sum of value*numConf, the number of distinct
+   scrAddrs, and 0 if any input has zero confirmations (1 otherwise).
+   CoinSelectionIndex keeps these totals as it builds candidates.
+   """
 
+   # Need to calculate how much the change will be returned to sender on this tx
+   totalChange = totalIn - (targetOutVal+minFee)
+
+   # Abort if this is an empty list (negative score) or not enough coins
+   if numInputs==0 or totalIn<targetOutVal+minFee:
+      return -1
+
+   numAddrFactor = 4.0/(numAddr+1)**2  # values in the range (0, 1]
 
 
    ##################
@@ -491,7 +651,7 @@ def getSelectCoinsScores(utxoSelectList, targetOutVal, minFee):
    # Tx size:  we don't have signatures yet, but we assume that each txin is
    #           about 180 Bytes, TxOuts are 35, and 10 other bytes in the Tx
    numBytes  =  10
-   numBytes += 180 * len(utxoSelectList)
+   numBytes += 180 * numInputs
    numBytes +=  35 * (1 if totalChange==0 else 2)
    txSizeFactor = 0
    numKb = int(numBytes / 1000)
@@ -505,15 +665,7 @@ def getSelectCoinsScores(utxoSelectList, targetOutVal, minFee):
    #            then we might be allowed a free tx.  But, if its priority
    #            isn't much above this thresh, it might take a couple blocks
    #            to be included
-   dPriority = 0
-   anyZeroConfirm = False
-   for utxo in utxoSelectList:
-      if utxo.getNumConfirm() == 0:
-         anyZeroConfirm = True
-      else:
-         dPriority += utxo.getValue() * utxo.getNumConfirm()
-
-   dPriority = dPriority / numBytes
+   dPriority = prioritySum / numBytes
    priorityThresh = ONE_BTC * 144 / 250
    if dPriority < priorityThresh:
       priorityFactor = 0
@@ -595,6 +747,12 @@ def PyEvalCoinSelect(utxoSelectList, targetOutVal, minFee, weights=WEIGHTS):
    "balanced", etc).
    """
    scores = getSelectCoinsScores(utxoSelectList, targetOutVal, minFee)
+   return weightSelectScores(scores, minFee, weights)
+
+
+################################################################################
+def weightSelectScores(scores, minFee, weights=WEIGHTS):
+   """ Combine a getSelectCoinsScores() tuple into the PyEvalCoinSelect score """
    if scores==-1:
       return -1
 
@@ -613,15 +771,444 @@ def PyEvalCoinSelect(utxoSelectList, targetOutVal, minFee, weights=WEIGHTS):
    return theScore
 
 
+################################################################################
+class CoinSelectionIndex(object):
+   """
+   Per-UTXO features used by coin selection, computed once:  value,
+   numConf, priority (value*numConf), zero-conf flag, and the scrAddr of
+   the script as a small integer ID.  The PySortCoins orderings are lists
+   of indices into those arrays, cached after the first use, and every
+   candidate selection is a list of indices scored from its totals via
+   computeSelectScores().  No candidate touches the UTXO objects or calls
+   script_to_scrAddr again.
+
+   Build one per UTXO list and reuse it for as long as the list doesn't
+   change, e.g. when retrying coin selection with a higher fee.
+   """
+
+   #############################################################################
+   def __init__(self, unspentTxOutInfo):
+      # NOTE: list(unspentTxOutInfo) upsets swig::vector<type>, see below
+      self.utxoList = [utxo for utxo in unspentTxOutInfo]
+
+      self.values    = [utxo.getValue() for utxo in self.utxoList]
+      self.confs     = [utxo.getNumConfirm() for utxo in self.utxoList]
+      self.priority  = [v*c for v,c in zip(self.values, self.confs)]
+      self.zeroConf  = [c==0 for c in self.confs]
+      self.recipScrAddrs = [u.getRecipientScrAddr() for u in self.utxoList]
+
+      # Same scrAddr used by getSelectCoinsScores, as a dense integer ID
+      scrAddrIDs = {}
+      self.addrIDs = []
+      for utxo in self.utxoList:
+         scrAddr = script_to_scrAddr(utxo.getScript())
+         self.addrIDs.append(scrAddrIDs.setdefault(scrAddr, len(scrAddrIDs)))
+
+      self.totalValue = sum(self.values)
+      self.orderCache = {}
+      self.scoreCache = {}
+
+
+   #############################################################################
+   def __len__(self):
+      return len(self.utxoList)
+
+   #############################################################################
+   def getUtxos(self, idxList):
+      return [self.utxoList[i] for i in idxList]
+
+   #############################################################################
+   def getOrder(self, sortMethod, stopSum=None):
+      """
+      Same orderings as PySortCoins, as index lists.  The deterministic
+      ones (0-7) are cached; 8 and 9 are random and made fresh every call.
+
+      For the random shuffle (8), stopSum lets us shuffle only as far as
+      the selectors will actually read:  the order is cut off one input
+      after the running sum first exceeds stopSum.
+      """
+      if sortMethod in self.orderCache:
+         return self.orderCache[sortMethod]
+
+      P = self.priority
+      allIdx = range(len(self.utxoList))
+      if sortMethod==0:
+         order = sorted(allIdx, key=lambda i: P[i], reverse=True)
+      elif sortMethod==1:
+         order = sorted(allIdx, key=lambda i: P[i]**(1/3.), reverse=True)
+      elif sortMethod==2:
+         order = sorted(allIdx, key=lambda i: (math.log(P[i]+1)+4)**4,
+                                                                reverse=True)
+      elif sortMethod==3:
+         V,C = self.values, self.confs
+         order = sorted(allIdx, key=lambda i: V[i] if C[i]>0 else 0,
+                                                                reverse=True)
+      elif sortMethod==4:
+         V,C = self.values, self.confs
+         addrMap = {}
+         zeroConfirm = []
+         for i in allIdx:
+            if self.zeroConf[i]:
+               zeroConfirm.append(i)
+            else:
+               addrMap.setdefault(self.addrIDs[i], []).append(i)
+
+         priorityUTXO = lambda i: C[i]*V[i]**0.333
+         for idxList in addrMap.itervalues():
+            idxList.sort(key=priorityUTXO, reverse=True)
+
+         # Groups with the same priority stay in the order their addresses
+         # first appear in the UTXO list (addrIDs are handed out that way)
+         priorityGrp = lambda a: max([priorityUTXO(i) for i in a])
+         groups = [addrMap[addrID] for addrID in sorted(addrMap)]
+         order = []
+         for idxList in sorted(groups, key=priorityGrp, reverse=True):
+            order.extend(idxList)
+         order.extend(zeroConfirm)
+      elif sortMethod in (5, 6, 7):
+         # Rotate the top 1,2 or 3 elements to the bottom of the list
+         order = list(self.getOrder(1))
+         nRotate = (sortMethod-4) % len(order) if order else 0
+         order = order[nRotate:] + order[:nRotate]
+      elif sortMethod==8:
+         # Fisher-Yates, stopping early once we're past stopSum
+         order = [i for i in allIdx if not self.zeroConf[i]]
+         V = self.values
+         sumVal = 0
+         for n in range(len(order)):
+            j = random.randint(n, len(order)-1)
+            order[n], order[j] = order[j], order[n]
+            if stopSum is not None and sumVal > stopSum and V[order[n]] > 0:
+               return order[:n+1]
+            sumVal += V[order[n]]
+         order.extend([i for i in allIdx if self.zeroConf[i]])
+         return order
+      elif sortMethod==9:
+         order = list(self.getOrder(1))
+         sz = len([i for i in order if not self.zeroConf[i]])
+         # swap 1/3 of the values at random
+         topsz = int(min(max(round(sz/3), 5), sz))
+         uniform = random.uniform
+         for i in range(topsz):
+            pick1 = int(uniform(0,topsz))
+            pick2 = int(uniform(0,sz-topsz))
+            order[pick1], order[pick2] = order[pick2], order[pick1]
+         return order
+      elif sortMethod=='priorityAsc':
+         order = sorted(allIdx, key=lambda i: P[i])
+      else:
+         raise ValueError('Unknown sort method: %s' % str(sortMethod))
+
+      self.orderCache[sortMethod] = order
+      return order
+
+
+   #############################################################################
+   def getOrderPositions(self, sortMethod):
+      """ orderPos[i] is the position of UTXO i in getOrder(sortMethod) """
+      key = ('pos', sortMethod)
+      if not key in self.orderCache:
+         orderPos = [0]*len(self.utxoList)
+         for n,i in enumerate(self.getOrder(sortMethod)):
+            orderPos[i] = n
+         self.orderCache[key] = orderPos
+      return self.orderCache[key]
+
+   #############################################################################
+   def getValueSorted(self):
+      """ (UTXO indices sorted by value, and those values) """
+      if not 'byValue' in self.orderCache:
+         V = self.values
+         byValue = sorted(range(len(V)), key=lambda i: V[i])
+         self.orderCache['byValue'] = (byValue, [V[i] for i in byValue])
+      return self.orderCache['byValue']
+
+   #############################################################################
+   def pickFirstByValue(self, orderPos, matchVals):
+      """
+      The single-input selectors keep the first UTXO in the sort order among
+      those with the best value.  Find it from the value-sorted list and the
+      order positions instead of scanning the whole order.
+      """
+      byValue, sortedVals = self.getValueSorted()
+      matchIdx = []
+      for val in set(matchVals):
+         lo = bisect_left(sortedVals, val)
+         hi = bisect_right(sortedVals, val)
+         matchIdx.extend(byValue[lo:hi])
+      return [min(matchIdx, key=lambda i: orderPos[i])] if matchIdx else []
+
+
+   #############################################################################
+   # The four PySelectCoins_* algorithms, on index lists.  The single-input
+   # ones can use getOrderPositions() to skip the linear scan
+   #############################################################################
+   def selectSingleInput(self, order, targetOutVal, minFee=0, orderPos=None):
+      target = targetOutVal + minFee
+      if orderPos is not None:
+         byValue, sortedVals = self.getValueSorted()
+         k = bisect_left(sortedVals, target)
+         if k == len(sortedVals):
+            return []
+         return self.pickFirstByValue(orderPos, [sortedVals[k]])
+
+      bestMatchVal = 2**64
+      bestMatchIdx = None
+      V = self.values
+      for i in order:
+         if target <= V[i] < bestMatchVal:
+            bestMatchVal = V[i]
+            bestMatchIdx = i
+
+      return [] if bestMatchIdx is None else [bestMatchIdx]
+
+   #############################################################################
+   def selectMultiInput(self, order, targetOutVal, minFee=0):
+      target = targetOutVal + minFee
+      V = self.values
+      sumVal = 0
+      for n,i in enumerate(order):
+         sumVal += V[i]
+         if sumVal>=target:
+            return order[:n+1]
+      return list(order)
+
+   #############################################################################
+   def selectSingleInputDouble(self, order, targetOutVal, minFee=0,
+                                                             orderPos=None):
+      idealTarget = 2*targetOutVal + minFee
+      minTarget   = max(long(0.75 * idealTarget), targetOutVal+minFee)
+      maxTarget   = long(1.25 * idealTarget)
+      if self.totalValue < minTarget:
+         return []
+
+      if orderPos is not None:
+         # Closest values to idealTarget from below and above, in range
+         byValue, sortedVals = self.getValueSorted()
+         lo = bisect_left(sortedVals, minTarget)
+         hi = bisect_right(sortedVals, maxTarget)
+         k  = bisect_left(sortedVals, idealTarget, lo, hi)
+         nearVals = [sortedVals[j] for j in [k-1, k] if lo <= j < hi]
+         if len(nearVals)==0:
+            return []
+         bestMatch = min([abs(v-idealTarget) for v in nearVals])
+         return self.pickFirstByValue(orderPos, \
+                   [v for v in nearVals if abs(v-idealTarget)==bestMatch])
+
+      V = self.values
+      bestMatch = 2**64-1
+      bestIdx   = None
+      for i in order:
+         if minTarget <= V[i] <= maxTarget:
+            if abs(V[i]-idealTarget) < bestMatch:
+               bestMatch = abs(V[i]-idealTarget)
+               bestIdx = i
+
+      return [] if bestIdx is None else [bestIdx]
+
+   #############################################################################
+   def selectMultiInputDouble(self, order, targetOutVal, minFee=0):
+      idealTarget = 2.0 * targetOutVal
+      minTarget   = max(long(0.80 * idealTarget), targetOutVal+minFee)
+      if self.totalValue < minTarget:
+         return []
+
+      V = self.values
+      lastDiff = 2**64-1
+      sumVal   = 0
+      for n,i in enumerate(order):
+         sumVal += V[i]
+         currDiff = abs(sumVal - idealTarget)
+         # should switch from decreasing to increasing when best match
+         if sumVal>=minTarget and currDiff>lastDiff:
+            return order[:n]
+         lastDiff = currDiff
+      return list(order)
+
+
+   #############################################################################
+   def selectExactMatch(self, targetOutVal, minFee=0, maxTries=100000):
+      """
+      Branch-and-bound search for a set of confirmed UTXOs that adds up to
+      exactly targetOutVal+minFee, so the tx needs no change output.  Inputs
+      are tried largest-first, so the first match found tends to use few
+      inputs.  Gives up (returns []) after maxTries steps.
+      """
+      target = targetOutVal + minFee
+      V = self.values
+      cands = [i for i in range(len(V)) if not self.zeroConf[i] and \
+                                                       0 < V[i] <= target]
+      cands.sort(key=lambda i: V[i], reverse=True)
+      vals = [V[i] for i in cands]
+
+      # One or two inputs can be found directly by value lookup
+      posByVal = {}
+      for p,val in enumerate(vals):
+         if val == target:
+            return [cands[p]]
+         if target-val in posByVal:
+            return [cands[posByVal[target-val]], cands[p]]
+         posByVal.setdefault(val, p)
+
+      # remain[p] is the sum of all candidates from p onwards, and
+      # nextVal[p] is the first position after p with a smaller value
+      nVals  = len(vals)
+      remain = [0]*(nVals+1)
+      nextVal = [nVals]*(nVals+1)
+      for p in range(nVals-1, -1, -1):
+         remain[p] = remain[p+1] + vals[p]
+         nextVal[p] = nextVal[p+1] if p+1<nVals and vals[p+1]==vals[p] else p+1
+
+      selected = []
+      currSum  = 0
+      pos      = 0
+      for tries in xrange(maxTries):
+         if currSum == target:
+            return [cands[p] for p in selected]
+
+         if currSum > target or currSum + remain[pos] < target:
+            # Backtrack:  drop the last included value and try without it.
+            # Skipping equal values avoids re-searching identical sums.
+            if len(selected)==0:
+               break
+            p = selected.pop()
+            currSum -= vals[p]
+            pos = nextVal[p]
+            continue
+
+         selected.append(pos)
+         currSum += vals[pos]
+         pos += 1
+
+      return []
+
+
+   #############################################################################
+   def getSelectionScores(self, idxList, targetOutVal, minFee):
+      """ Same result as getSelectCoinsScores(self.getUtxos(idxList), ...) """
+      cacheKey = (frozenset(idxList), targetOutVal, minFee)
+      if cacheKey in self.scoreCache:
+         return self.scoreCache[cacheKey]
+
+      V,P = self.values, self.priority
+      totalIn     = sum([V[i] for i in idxList])
+      prioritySum = sum([P[i] for i in idxList])
+      numAddr     = len(set([self.addrIDs[i] for i in idxList]))
+      noZeroConf  = 0 if any([self.zeroConf[i] for i in idxList]) else 1
+      scores = computeSelectScores(len(idxList), totalIn, prioritySum, numAddr,
+                                          noZeroConf, targetOutVal, minFee)
+      self.scoreCache[cacheKey] = scores
+      return scores
+
+   #############################################################################
+   def evalSelection(self, idxList, targetOutVal, minFee, weights=WEIGHTS):
+      """ Same result as PyEvalCoinSelect(self.getUtxos(idxList), ...) """
+      scores = self.getSelectionScores(idxList, targetOutVal, minFee)
+      return weightSelectScores(scores, minFee, weights)
+
+
+   #############################################################################
+   def selectCoins(self, targetOutVal, minFee=0, numRand=10, margin=CENT,
+                                          weights=WEIGHTS, exactMatch=True):
+      """
+      Same candidates as PySelectCoins_BruteForce, plus an exact-match
+      (no change) candidate from selectExactMatch.  Returns UTXO objects.
+      """
+      if self.totalValue < targetOutVal:
+         return []
+
+      targExact  = targetOutVal
+      targMargin = targetOutVal+margin
+
+      # Scores are only reused between candidates of the same run, so
+      # don't let them pile up across targets and fees
+      self.scoreCache = {}
+
+      selectLists = []
+
+      # Start with the intelligent solutions with different sortings
+      for sortMethod in range(8):
+         order = self.getOrder(sortMethod)
+         pos   = self.getOrderPositions(sortMethod)
+         for targ in [targExact, targMargin]:
+            selectLists.append(self.selectSingleInput(order, targ, minFee, pos))
+            selectLists.append(self.selectMultiInput(order, targ, minFee))
+         for targ in [targExact, targMargin]:
+            selectLists.append(self.selectSingleInputDouble(order, targ, minFee, pos))
+            selectLists.append(self.selectMultiInputDouble(order, targ, minFee))
+
+      # Throw in a couple random solutions, maybe we get lucky.  None of
+      # the multi-input selectors read past a sum of 2*targMargin+minFee
+      for method in range(8,10):
+         for i in range(numRand):
+            order = self.getOrder(method, 2*targMargin+minFee)
+            for targ in [targExact, targMargin]:
+               selectLists.append(self.selectMultiInput(order, targ, minFee))
+               selectLists.append(self.selectMultiInputDouble(order, targ, minFee))
+
+      if exactMatch:
+         selectLists.append(self.selectExactMatch(targetOutVal, minFee))
+
+      scoreFunc = lambda idxs: self.evalSelection(idxs, targetOutVal, minFee,
+                                                                     weights)
+      finalSelection = list(max(selectLists, key=scoreFunc))
+      if len(finalSelection)==0:
+         return []
+
+      SCORES = self.getSelectionScores(finalSelection, targetOutVal, minFee)
+
+      # Throw in a few tiny UTXOs from addresses that are already linked by
+      # this tx, under the same conditions as PySelectCoins_BruteForce
+      IDEAL_NUM_INPUTS = 5
+      if len(finalSelection) < IDEAL_NUM_INPUTS and not SCORES==-1 and \
+                                             SCORES[IDX_OUTANONYM] == 0:
+         alreadyUsedAddr = set([self.recipScrAddrs[i] for i in finalSelection])
+         finalSelectIDs  = set(finalSelection)
+         for i in self.getOrder('priorityAsc'):
+            if i in finalSelectIDs or \
+               not self.recipScrAddrs[i] in alreadyUsedAddr or \
+               self.zeroConf[i] or \
+               self.priority[i] > ONE_BTC*144:
+               continue
+
+            finalSelection.append(i)
+            if len(finalSelection)>=IDEAL_NUM_INPUTS:
+               break
+
+      return self.getUtxos(finalSelection)
+
+
 ################################################################################
 # https://bitcointalk.org/index.php?topic=92496.msg1126310#msg1126310 contains a
 # description (possibly out-of-date?) of how this function works.
 @TimeThisFunction
-def PySelectCoins(unspentTxOutInfo, targetOutVal, minFee=0, numRand=10, margin=CENT):
+def PySelectCoins(unspentTxOutInfo, targetOutVal, minFee=0, numRand=10,
+                                             margin=CENT, coinIndex=None):
+   """
+   Intense algorithm for coin selection:  computes about 100 different ways
+   to select coins based on the desired target output and the min tx fee.
+   Then ranks the various solutions and picks the best one
+
+   Pass in a CoinSelectionIndex of unspentTxOutInfo to reuse its per-UTXO
+   data across calls (unspentTxOutInfo is ignored in that case).
+   """
+   if coinIndex is None:
+      coinIndex = CoinSelectionIndex(unspentTxOutInfo)
+   return coinIndex.selectCoins(targetOutVal, minFee, numRand, margin)
+
+
+################################################################################
+def PySelectCoins_BruteForce(unspentTxOutInfo, targetOutVal, minFee=0,
+                                                   numRand=10, margin=CENT):
    """
    Intense algorithm for coin selection:  computes about 30 different ways to
    select coins based on the desired target output and the min tx fee.  Then
    ranks the various solutions and picks the best one
+
+   This is the original object-based implementation, which re-sorts and
+   re-scores the whole UTXO list for every candidate.  PySelectCoins now
+   runs the same candidates through a CoinSelectionIndex; this is kept as
+   the reference for tests and extras/benchmark_coinselect.py
    """
 
    if sum([u.getValue() for u in unspentTxOutInfo]) < targetOutVal:
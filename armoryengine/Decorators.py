@@ -13,8 +13,8 @@
 #
 ################################################################################
 
-from armoryengine.ArmoryUtils import send_email, LOGERROR, LOGRAWDATA,\
-   CLI_OPTIONS
+from armoryengine.ArmoryUtils import LOGERROR, LOGRAWDATA, CLI_OPTIONS
+from armoryengine.EmailQueue import getEmailQueue
 import functools
 import sys
 from threading import Lock
@@ -28,7 +28,10 @@ def EmailOutput(send_from, server, password, send_to, subject='Armory Output'):
       def wrapper(*args, **kwargs):
          ret = func(*args, **kwargs)  # Run dec'd func before sending e-mail
          if ret and send_from and server and password and send_to:
-            send_email(send_from, server, password, send_to, subject, ret)
+            # Sent in the background, so a slow mail server doesn't hold up
+            # the caller (e.g. new-block processing)
+            getEmailQueue().queueEmail(send_from, server, password, send_to, \
+                                       subject, ret)
          return ret
       return wrapper
 
@@ -109,6 +112,27 @@ def catchErrsForJSON(func):
          return rv
    return inner
 
+# Marks a JSON RPC function as too slow to run on the reactor thread. armoryd
+# runs it on one of its worker threads instead (see RpcDispatcher). The kind is
+# RPC_WORKER_CPU for calls that mostly compute (KDF, coin selection) and
+# RPC_WORKER_IO for calls that mostly wait on the disk or the BDM. walletArg is
+# the position of an argument that may hold the ID of the wallet the call uses.
+# Otherwise the call is assumed to use the active wallet.
+RPC_WORKER_CPU = 'cpu'
+RPC_WORKER_IO  = 'io'
+def rpcWorkerMethod(kind=RPC_WORKER_CPU, walletArg=None):
+   def ActualRpcWorkerDecorator(func):
+      func.rpcWorker = kind
+      func.rpcWalletArg = walletArg
+      return func
+   return ActualRpcWorkerDecorator
+
+# Marks a JSON RPC function that uses no wallet, so armoryd runs it without
+# waiting for the wallet locks, e.g. a call that waits for a notification.
+def rpcNoWalletMethod(func):
+   func.rpcNoWallet = True
+   return func
+
 #Makes sure only a single thread is running the method at a given time,
 #using threading.Lock() 
 def singleEntrantMethod(func):
@@ -0,0 +1,408 @@
+################################################################################
+#
+# Copyright (C) 2011-2015, Armory Technologies, Inc.
+# Distributed under the GNU Affero General Public License (AGPL v3)
+# See LICENSE or http://www.gnu.org/licenses/agpl.html
+#
+################################################################################
+#
+# Send e-mail notifications from a background thread, so a slow or unreachable
+# mail server doesn't hold up whoever queued them (e.g. armoryd's new-block
+# functions).  Queued e-mails are written to a spool directory first and only
+# removed once the server took them, so they survive a restart.  The SMTP
+# passwords are never written to the spool: e-mails left over from the last run
+# wait until the same sender is registered again (e.g. armoryd's watchwallet)
+# or queues another e-mail for the same server, and go out with its password.
+# If that doesn't happen within EMAIL_SPOOL_WAIT seconds, they are dropped.
+#
+################################################################################
+import json
+import os
+import smtplib
+import socket
+import threading
+
+from armoryengine.ArmoryUtils import ARMORY_HOME_DIR, LOGINFO, LOGWARN, \
+   LOGERROR, LOGEXCEPT, RightNow, createEmailMessage, openSmtpConnection
+
+
+EMAIL_SPOOL_DIR    = os.path.join(ARMORY_HOME_DIR, 'emailspool')
+
+# E-mails to the same recipients queued within this many seconds of each
+# other are sent as one message
+EMAIL_BATCH_DELAY  = 5.0
+
+# Failed sends are retried after EMAIL_RETRY_MIN seconds, doubling up to
+# EMAIL_RETRY_MAX, and dropped after EMAIL_MAX_ATTEMPTS tries
+EMAIL_RETRY_MIN    = 30.0
+EMAIL_RETRY_MAX    = 3600.0
+EMAIL_MAX_ATTEMPTS = 20
+
+# SMTP connections are kept open between sends, up to this many idle seconds
+EMAIL_CONN_IDLE    = 60.0
+
+# Spooled e-mails from the last run whose sender doesn't supply its password
+# again within this many seconds of the start are dropped
+EMAIL_SPOOL_WAIT   = 86400.0
+
+EMAIL_BATCH_SEPARATOR = '\n\n' + '-'*70 + '\n\n'
+
+
+################################################################################
+class EmailQueue(object):
+   """
+   Each queued e-mail is a dict, saved as <id>.json in spoolDir:
+
+      id, from, server, password, to (list), subject, text,
+      attempts, nextTry
+
+   The password is left out of the spool file and is None for e-mails loaded
+   from the spool until resumeSpooled() or queueEmail() supplies it again.
+   connectFunc(server, send_from, password) returns a logged-in smtplib.SMTP.
+   """
+
+   #############################################################################
+   def __init__(self, spoolDir=EMAIL_SPOOL_DIR, batchDelay=EMAIL_BATCH_DELAY, \
+                connectFunc=openSmtpConnection, spoolWait=EMAIL_SPOOL_WAIT):
+      self.spoolDir    = spoolDir
+      self.batchDelay  = batchDelay
+      self.connectFunc = connectFunc
+      self.spoolExpire = RightNow() + spoolWait
+
+      self.cond        = threading.Condition()
+      self.entries     = {}    # id -> entry, only while it's not sent
+      self.connections = {}    # (server, from, password) -> [SMTP, lastUsed]
+      self.nQueued     = 0
+      self.running     = False
+      self.thread      = None
+
+      if not os.path.exists(self.spoolDir):
+         os.makedirs(self.spoolDir)
+      self.loadSpool()
+
+
+   #############################################################################
+   def start(self):
+      with self.cond:
+         if self.running:
+            return
+         self.running = True
+      self.thread = threading.Thread(target=self.run, name='EmailQueue')
+      self.thread.daemon = True
+      self.thread.start()
+
+
+   #############################################################################
+   def stop(self):
+      """ E-mails not sent yet stay in the spool for the next start """
+      with self.cond:
+         self.running = False
+         self.cond.notify()
+      if self.thread:
+         self.thread.join()
+         self.thread = None
+      self.closeConnections(None)
+
+
+   #############################################################################
+   def queueEmail(self, send_from, server, password, send_to, subject, text):
+      # Same arguments as send_email()
+      if not type(send_to) == list:
+         send_to = send_to.split(":")
+
+      with self.cond:
+         self.nQueued += 1
+         entryID = '%016x-%06x' % (int(RightNow()*1e6), self.nQueued % 2**24)
+         entry = { 'id':        entryID,
+                   'from':      send_from,
+                   'server':    server,
+                   'password':  password,
+                   'to':        send_to,
+                   'subject':   subject,
+                   'text':      text,
+                   'attempts':  0,
+                   'nextTry':   RightNow() + self.batchDelay }
+         self.writeSpool(entry)
+         self.entries[entryID] = entry
+         self.resumeSpooled(send_from, server, password)
+         self.cond.notify()
+      return entryID
+
+
+   #############################################################################
+   def resumeSpooled(self, send_from, server, password):
+      """
+      Send the spooled e-mails from the last run by send_from via server,
+      which wait for this password.  Call it when the sender is set up again.
+      """
+      with self.cond:
+         nResumed = 0
+         for entry in self.entries.values():
+            if entry['password'] is None and entry['from'] == send_from and \
+                                             entry['server'] == server:
+               entry['password'] = password
+               entry['nextTry'] = RightNow()
+               nResumed += 1
+         if nResumed > 0:
+            LOGINFO('Sending %d spooled e-mail(s) from %s' % \
+                    (nResumed, send_from))
+            self.cond.notify()
+      return nResumed
+
+
+   #############################################################################
+   def expireSpooled(self):
+      """ Drop the spooled e-mails still waiting for their password """
+      with self.cond:
+         waiting = [e for e in self.entries.values() if e['password'] is None]
+         for entry in waiting:
+            self.removeSpool(entry)
+            del self.entries[entry['id']]
+         self.cond.notifyAll()
+      if len(waiting) > 0:
+         LOGWARN('Dropped %d spooled e-mail(s) from the last run, their ' \
+                 'sender was not set up again' % len(waiting))
+      return len(waiting)
+
+
+   #############################################################################
+   def getNumQueued(self):
+      with self.cond:
+         return len(self.entries)
+
+
+   #############################################################################
+   def getNumWaiting(self):
+      """ Number of spooled e-mails still waiting for their password """
+      with self.cond:
+         return len([e for e in self.entries.values() if e['password'] is None])
+
+
+   #############################################################################
+   def waitUntilSent(self, timeout=None):
+      """
+      Returns True if nothing is left to send within timeout seconds, not
+      counting the e-mails that wait for their password
+      """
+      endTime = None if timeout is None else RightNow() + timeout
+      with self.cond:
+         while len(self.entries) > self.getNumWaiting():
+            remaining = None if endTime is None else endTime - RightNow()
+            if remaining is not None and remaining <= 0:
+               return False
+            self.cond.wait(remaining)
+      return True
+
+
+   #############################################################################
+   def getSpoolPath(self, entryID):
+      return os.path.join(self.spoolDir, entryID + '.json')
+
+
+   #############################################################################
+   def writeSpool(self, entry):
+      path = self.getSpoolPath(entry['id'])
+      tmpPath = path + '.tmp'
+      fd = os.open(tmpPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+      f = os.fdopen(fd, 'w')
+      try:
+         f.write(json.dumps(dict([(k,v) for k,v in entry.iteritems() \
+                                  if k != 'password'])))
+         f.flush()
+         os.fsync(f.fileno())
+      finally:
+         f.close()
+      if os.path.exists(path) and os.name == 'nt':
+         os.remove(path)
+      os.rename(tmpPath, path)
+
+
+   #############################################################################
+   def removeSpool(self, entry):
+      try:
+         os.remove(self.getSpoolPath(entry['id']))
+      except OSError:
+         LOGEXCEPT('Could not remove spooled e-mail %s' % entry['id'])
+
+
+   #############################################################################
+   def loadSpool(self):
+      for fn in sorted(os.listdir(self.spoolDir)):
+         path = os.path.join(self.spoolDir, fn)
+         if fn.endswith('.json.tmp'):
+            # Never finished writing, so never queued
+            os.remove(path)
+            continue
+         if not fn.endswith('.json'):
+            continue
+         try:
+            with open(path) as f:
+               entry = json.loads(f.read())
+            # json gives back unicode, smtplib wants str
+            for key in ['from', 'server', 'subject', 'text']:
+               if isinstance(entry[key], unicode):
+                  entry[key] = entry[key].encode('utf-8')
+            entry['to'] = [str(addr) for addr in entry['to']]
+            entry['password'] = None
+            entry['nextTry'] = RightNow()
+            self.entries[entry['id']] = entry
+         except:
+            LOGEXCEPT('Skipping bad spooled e-mail %s' % fn)
+            os.rename(path, path + '.bad')
+
+      if len(self.entries) > 0:
+         LOGINFO('%d spooled e-mail(s) to send once their sender is set up ' \
+                 'again' % len(self.entries))
+
+
+   #############################################################################
+   def run(self):
+      while True:
+         with self.cond:
+            if not self.running:
+               return
+            now = RightNow()
+            readyList = [e for e in self.entries.values() \
+                                          if e['password'] is not None]
+            nWaiting = len(self.entries) - len(readyList)
+            dueList = [e for e in readyList if e['nextTry'] <= now]
+            if len(dueList) > 0:
+               # Take along the e-mails for the same recipients that were
+               # queued within the batch delay
+               dueKeys = set([self.getBatchKey(e) for e in dueList])
+               dueList = [e for e in readyList if \
+                          self.getBatchKey(e) in dueKeys and \
+                          e['nextTry'] <= now + self.batchDelay]
+            else:
+               # Sleep until the next e-mail is due, waking up now and then
+               # to close idle connections
+               wakeTimes = [e['nextTry'] for e in readyList]
+               wakeTimes.append(now + EMAIL_CONN_IDLE)
+               if nWaiting > 0:
+                  wakeTimes.append(self.spoolExpire)
+               self.cond.wait(max(min(wakeTimes) - now, 0.01))
+
+         if nWaiting > 0 and RightNow() >= self.spoolExpire:
+            self.expireSpooled()
+
+         # Talk to the servers without holding the lock, so queueEmail()
+         # never waits for them
+         if len(dueList) == 0:
+            self.closeConnections(RightNow() - EMAIL_CONN_IDLE)
+         for batch in self.getBatches(dueList):
+            self.sendBatch(batch)
+
+
+   #############################################################################
+   def getBatchKey(self, entry):
+      return (entry['from'], entry['server'], entry['password'], \
+              tuple(entry['to']), entry['subject'])
+
+
+   #############################################################################
+   def getBatches(self, entryList):
+      """ Group e-mails that go to the same recipients, oldest first """
+      batchMap = {}
+      for entry in sorted(entryList, key=lambda e: e['id']):
+         batchMap.setdefault(self.getBatchKey(entry), []).append(entry)
+      return sorted(batchMap.values(), key=lambda batch: batch[0]['id'])
+
+
+   #############################################################################
+   def sendBatch(self, batch):
+      first = batch[0]
+      subject = first['subject']
+      if len(batch) > 1:
+         subject = '%s (%d notifications)' % (subject, len(batch))
+      msgStr = createEmailMessage(first['from'], first['to'], subject, \
+                     EMAIL_BATCH_SEPARATOR.join([e['text'] for e in batch]))
+
+      try:
+         self.sendMessage(first['server'], first['from'], first['password'], \
+                          first['to'], msgStr)
+      except Exception as e:
+         self.retryBatch(batch, e)
+         return
+
+      with self.cond:
+         for entry in batch:
+            self.removeSpool(entry)
+            del self.entries[entry['id']]
+         self.cond.notifyAll()
+
+
+   #############################################################################
+   def sendMessage(self, server, send_from, password, send_to, msgStr):
+      key = (server, send_from, password)
+      conn = self.connections.get(key)
+      if conn is not None:
+         try:
+            conn[0].sendmail(send_from, send_to, msgStr)
+            conn[1] = RightNow()
+            return
+         except (smtplib.SMTPServerDisconnected, socket.error):
+            # The server closed the idle connection; reconnect below
+            self.closeConnection(key)
+
+      conn = [self.connectFunc(server, send_from, password), RightNow()]
+      self.connections[key] = conn
+      try:
+         conn[0].sendmail(send_from, send_to, msgStr)
+      except (smtplib.SMTPServerDisconnected, socket.error):
+         self.closeConnection(key)
+         raise
+
+
+   #############################################################################
+   def retryBatch(self, batch, err):
+      with self.cond:
+         for entry in batch:
+            entry['attempts'] += 1
+            if entry['attempts'] >= EMAIL_MAX_ATTEMPTS:
+               LOGERROR('Giving up on e-mail "%s" to %s after %d attempts' % \
+                        (entry['subject'], ':'.join(entry['to']), \
+                         entry['attempts']))
+               self.removeSpool(entry)
+               del self.entries[entry['id']]
+               continue
+            delay = min(EMAIL_RETRY_MIN * 2**(entry['attempts']-1), \
+                        EMAIL_RETRY_MAX)
+            entry['nextTry'] = RightNow() + delay
+            self.writeSpool(entry)
+         self.cond.notifyAll()
+
+      LOGWARN('Could not send e-mail "%s" via %s (%s), will retry' % \
+              (batch[0]['subject'], batch[0]['server'], err))
+
+
+   #############################################################################
+   def closeConnection(self, key):
+      conn = self.connections.pop(key, None)
+      if conn is not None:
+         try:
+            conn[0].quit()
+         except:
+            conn[0].close()
+
+
+   #############################################################################
+   def closeConnections(self, unusedSince):
+      """ Close connections not used since unusedSince, or all if None """
+      for key,conn in self.connections.items():
+         if unusedSince is None or conn[1] < unusedSince:
+            self.closeConnection(key)
+
+
+################################################################################
+# The queue e-mail notifications go through.  Created and started on first
+# use, which also sends whatever the last run left in the spool.
+TheEmailQueue = None
+theEmailQueueLock = threading.Lock()
+
+def getEmailQueue():
+   global TheEmailQueue
+   with theEmailQueueLock:
+      if TheEmailQueue is None:
+         TheEmailQueue = EmailQueue()
+         TheEmailQueue.start()
+   return TheEmailQueue
@@ -21,6 +21,7 @@
 
 import os.path
 import random
+from struct import Struct
 
 from twisted.internet.defer import Deferred
 from twisted.internet.protocol import Protocol, ReconnectingClientFactory
@@ -33,10 +34,11 @@ from armoryengine.ArmoryUtils import LOGINFO, LOGWARN, RightNow, getVersionStrin
 from armoryengine.BDM import  BDM_OFFLINE, BDM_SCANNING,\
    BDM_BLOCKCHAIN_READY
 from armoryengine.BinaryPacker import BinaryPacker, BINARY_CHUNK, UINT32, UINT64, \
-   UINT16, VAR_INT, INT32, INT64, VAR_STR, INT8
-from armoryengine.BinaryUnpacker import BinaryUnpacker, UnpackerError
+   UINT16, VAR_INT, INT32, INT64, VAR_STR, INT8, FastBinaryPacker
+from armoryengine.BinaryUnpacker import BinaryUnpacker, UnpackerError, \
+   FastBinaryUnpacker
 from armoryengine.Block import PyBlockHeader
-from armoryengine.Transaction import PyTx, indent
+from armoryengine.Transaction import PyTx, indent, skipTx
 
 
 class ArmoryClient(Protocol):
@@ -49,7 +51,7 @@ class ArmoryClient(Protocol):
 
    ############################################################
    def __init__(self):
-      self.recvData = ''
+      self.frameDecoder = NetworkFrameDecoder()
       self.gotVerack = False
       self.sentVerack = False
       self.sentHeadersReq = True
@@ -88,87 +90,84 @@ class ArmoryClient(Protocol):
    def dataReceived(self, data):
       """
       Called by the reactor when data is received over the connection. 
-      This method will do nothing if we don't receive a full message.
+      The frame decoder only hands us complete, checksummed messages, so
+      a partial message simply stays in its buffer until the rest arrives.
       """
+      stats = self.factory.netStats
+      stats.addBytes(len(data))
 
-      
-      #print '\n\nData Received:',
-      #pprintHex(binary_to_hex(data), withAddr=False)
+      self.frameDecoder.feed(data)
+      for magic,cmd,payload in self.frameDecoder.popFrames():
+         if magic != MAGIC_BYTES:
+            LOGERROR('Message for a different network!' )
+            if BLOCKCHAINS.has_key(magic):
+               LOGERROR( '(for network: %s)', BLOCKCHAINS[magic])
+            continue
 
-      # Put the current buffer into an unpacker, process until empty
-      self.recvData += data
-      buf = BinaryUnpacker(self.recvData)
+         if not cmd in PayloadMap:
+            LOGDEBUG('Ignoring unknown network message: %s', cmd)
+            continue
 
-      messages = []
-      while True:
+         msgClass = LazyPyMessage if cmd in self.factory.lazyCommands \
+                                  else PyMessage
+         tstart = RightNow()
          try:
-            # recvData is only modified if the unserialize succeeds
-            # Had a serious issue with references, so I had to convert 
-            # messages to strings to guarantee that copies were being 
-            # made!  (yes, hacky...)
-            thisMsg = PyMessage().unserialize(buf)
-            messages.append( thisMsg.serialize() )
-            self.recvData = buf.getRemainingString()
-         except NetworkIDError:
-            LOGERROR('Message for a different network!' )
-            if BLOCKCHAINS.has_key(self.recvData[:4]):
-               LOGERROR( '(for network: %s)', BLOCKCHAINS[self.recvData[:4]])
-            # Before raising the error, we should've finished reading the msg
-            # So pop it off the front of the buffer
-            self.recvData = buf.getRemainingString()
-            return
-         except UnknownNetworkPayload:
-            return
+            msg = msgClass().unserializePayload(cmd, payload, magic)
          except UnpackerError:
-            # Expect this error when buffer isn't full enough for a whole msg
-            break
+            LOGERROR('Malformed "%s" message from peer, skipping it', cmd)
+            continue
+         stats.addMessage(cmd, RightNow() - tstart)
+         self.handleMessage(msg)
 
-      # We might've gotten here without anything to process -- if so, bail
-      if len(messages)==0:
-         return
+      if self.frameDecoder.isBroken():
+         LOGERROR('Dropping the connection to the peer')
+         self.transport.loseConnection()
 
 
-      # Finally, we have some message to process, let's do it
-      for msgStr in messages:
-         msg = PyMessage().unserialize(msgStr)
-         cmd = msg.cmd
+   ############################################################
+   def handleMessage(self, msg):
+      cmd = msg.cmd
 
-         # Log the message if netlog option
-         if CLI_OPTIONS.netlog:
-            LOGDEBUG( 'DataReceived: %s', msg.payload.command)
-            if msg.payload.command == 'tx':
+      # Log the message if netlog option
+      if CLI_OPTIONS.netlog:
+         LOGDEBUG( 'DataReceived: %s', cmd)
+         try:
+            if cmd == 'tx':
                LOGDEBUG('\t' + binary_to_hex(msg.payload.tx.thisHash))
-            elif msg.payload.command == 'block':
+            elif cmd == 'block':
                LOGDEBUG('\t' + msg.payload.header.getHashHex())
-            elif msg.payload.command == 'inv':
+            elif cmd == 'inv':
                for inv in msg.payload.invList:
                   LOGDEBUG(('\tBLOCK: ' if inv[0]==2 else '\tTX   : ') + \
                                                       binary_to_hex(inv[1]))
-
-
-         # We process version and verackk only if we haven't yet
-         if cmd=='version' and not self.sentVerack:
-            self.peerInfo = {}
-            self.peerInfo['version'] = msg.payload.version
-            self.peerInfo['subver']  = msg.payload.subver
-            self.peerInfo['time']    = msg.payload.time
-            self.peerInfo['height']  = msg.payload.height0
-            LOGINFO('Received version message from peer:')
-            LOGINFO('   Version:     %s', str(self.peerInfo['version']))
-            LOGINFO('   SubVersion:  %s', str(self.peerInfo['subver']))
-            LOGINFO('   TimeStamp:   %s', str(self.peerInfo['time']))
-            LOGINFO('   StartHeight: %s', str(self.peerInfo['height']))
-            self.sentVerack = True
-            self.sendMessage( PayloadVerack() )
-         elif cmd=='verack':
-            self.gotVerack = True
-            self.factory.handshakeFinished(self)
-            #self.startHeaderDL()
-
-         ####################################################################
-         # Don't process any other messages unless the handshake is finished
-         if self.gotVerack and self.sentVerack:
-            self.processMessage(msg)
+         except UnpackerError:
+            # A malformed lazy payload is reported by processMessage
+            pass
+
+
+      # We process version and verackk only if we haven't yet
+      if cmd=='version' and not self.sentVerack:
+         self.peerInfo = {}
+         self.peerInfo['version'] = msg.payload.version
+         self.peerInfo['subver']  = msg.payload.subver
+         self.peerInfo['time']    = msg.payload.time
+         self.peerInfo['height']  = msg.payload.height0
+         LOGINFO('Received version message from peer:')
+         LOGINFO('   Version:     %s', str(self.peerInfo['version']))
+         LOGINFO('   SubVersion:  %s', str(self.peerInfo['subver']))
+         LOGINFO('   TimeStamp:   %s', str(self.peerInfo['time']))
+         LOGINFO('   StartHeight: %s', str(self.peerInfo['height']))
+         self.sentVerack = True
+         self.sendMessage( PayloadVerack() )
+      elif cmd=='verack':
+         self.gotVerack = True
+         self.factory.handshakeFinished(self)
+         #self.startHeaderDL()
+
+      ####################################################################
+      # Don't process any other messages unless the handshake is finished
+      if self.gotVerack and self.sentVerack:
+         self.processMessage(msg)
 
 
    ############################################################
@@ -210,8 +209,14 @@ class ArmoryClient(Protocol):
          invList = msg.payload.invList
          self.factory.func_inv(invList)
       elif msg.cmd=='block':
-         pyHeader = msg.payload.header
-         pyTxList = msg.payload.txList
+         # With lazy decoding this is the first read of the payload, which
+         # parses the header and locates the txs (they are decoded on use)
+         try:
+            pyHeader = msg.payload.header
+            pyTxList = msg.payload.txList
+         except UnpackerError:
+            LOGERROR('Malformed "block" message from peer, skipping it')
+            return
          LOGINFO('Received new block.  %s', binary_to_hex(pyHeader.getHash(), BIGENDIAN))
          self.factory.func_newBlock(pyHeader, pyTxList)
       elif msg.cmd=='alert':
@@ -339,6 +344,32 @@ class ArmoryClientFactory(ReconnectingClientFactory):
       self.func_newBlock    = func_newBlock
       self.func_inv         = func_inv
       self.proto = None
+      self.netStats = NetworkStats()
+      self.lazyCommands = set()
+
+   #############################################################################
+   def setLazyPayloadCommands(self, cmdList):
+      """
+      Messages for these commands (such as 'block' or 'inv') are delivered
+      as LazyPyMessage objects, which only decode the payload when it is
+      first accessed.  Use this when the callbacks for a command only look
+      at part of the payload, or ignore it entirely.  A malformed 'block'
+      is logged and skipped when processMessage first reads it; for other
+      commands UnpackerError is raised from whichever callback reads it.
+      """
+      self.lazyCommands = set(cmdList)
+
+   #############################################################################
+   def getNetworkStats(self):
+      """
+      Throughput and per-command parse times for messages from our peer.
+      See NetworkStats.getStats() for the fields.
+      """
+      return self.netStats.getStats()
+
+   #############################################################################
+   def resetNetworkStats(self):
+      self.netStats.reset()
 
    #############################################################################
    def getProto(self):
@@ -446,10 +477,10 @@ class PyMessage(object):
 
 
    def serialize(self):
-      bp = BinaryPacker()
+      payloadBin = self.payload.serialize()
+      bp = FastBinaryPacker(24 + len(payloadBin))
       bp.put(BINARY_CHUNK, self.magic,                    width= 4)
       bp.put(BINARY_CHUNK, self.cmd.ljust(12, '\x00'),    width=12)
-      payloadBin = self.payload.serialize()
       bp.put(UINT32, len(payloadBin))
       bp.put(BINARY_CHUNK, hash256(payloadBin)[:4],     width= 4)
       bp.put(BINARY_CHUNK, payloadBin)
@@ -470,7 +501,9 @@ class PyMessage(object):
       payload    = verifyChecksum(payload, chksum)
 
       try:
-         self.payload = PayloadMap[self.cmd]().unserialize(payload)
+         # Parse the payload with the same unpacker engine we were given
+         self.payload = PayloadMap[self.cmd]().unserialize( \
+                                                   msgData.__class__(payload))
       except KeyError:
          raise UnknownNetworkPayload
 
@@ -479,6 +512,21 @@ class PyMessage(object):
       return self
 
 
+   def unserializePayload(self, cmd, payload, magic=MAGIC_BYTES):
+      """
+      Build the message from a frame that has already been split off the
+      stream and checksummed (see NetworkFrameDecoder), so we don't have
+      to re-read the header or re-hash the payload
+      """
+      self.magic = magic
+      self.cmd   = cmd
+      try:
+         self.payload = PayloadMap[cmd]().unserialize(FastBinaryUnpacker(payload))
+      except KeyError:
+         raise UnknownNetworkPayload
+      return self
+
+
    def pprint(self, nIndent=0):
       indstr = indent*nIndent
       print ''
@@ -489,6 +537,57 @@ class PyMessage(object):
       self.payload.pprint(nIndent+1)
 
 
+################################################################################
+class LazyPyMessage(PyMessage):
+   """
+   Keeps the raw payload bytes and only decodes them the first time .payload
+   is accessed.  Commands listed in LazyPayloadMap are decoded into their
+   lazy payload classes (such as LazyPayloadBlock) even then.
+   """
+   def __init__(self, cmd='', payload=None):
+      self.rawPayload = None
+      self.decodedPayload = None
+      PyMessage.__init__(self, cmd, payload)
+
+   def getPayload(self):
+      if self.decodedPayload is None and self.rawPayload is not None:
+         payloadClass = LazyPayloadMap.get(self.cmd, PayloadMap[self.cmd])
+         self.decodedPayload = payloadClass().unserialize( \
+                                          FastBinaryUnpacker(self.rawPayload))
+      return self.decodedPayload
+
+   def setPayload(self, payload):
+      self.decodedPayload = payload
+      self.rawPayload = None
+
+   payload = property(getPayload, setPayload)
+
+   def isDecoded(self):
+      return self.rawPayload is None or self.decodedPayload is not None
+
+   def unserializePayload(self, cmd, payload, magic=MAGIC_BYTES):
+      if not cmd in PayloadMap:
+         raise UnknownNetworkPayload
+      self.magic = magic
+      self.cmd   = cmd
+      self.decodedPayload = None
+      self.rawPayload = payload
+      return self
+
+   def serialize(self):
+      # No need to decode the payload just to write it back out
+      if self.isDecoded():
+         return PyMessage.serialize(self)
+
+      bp = FastBinaryPacker(24 + len(self.rawPayload))
+      bp.put(BINARY_CHUNK, self.magic,                    width= 4)
+      bp.put(BINARY_CHUNK, self.cmd.ljust(12, '\x00'),    width=12)
+      bp.put(UINT32, len(self.rawPayload))
+      bp.put(BINARY_CHUNK, hash256(self.rawPayload)[:4],  width= 4)
+      bp.put(BINARY_CHUNK, self.rawPayload)
+      return bp.getBinaryString()
+
+
 ################################################################################
 class PyNetAddress(object):
 
@@ -550,8 +649,9 @@ class PayloadAddr(object):
 
    command = 'addr'
    
-   def __init__(self, addrList=[]):
-      self.addrList   = addrList  # PyNetAddress objs
+   def __init__(self, addrList=None):
+      # PyNetAddress objs
+      self.addrList   = addrList if addrList is not None else []
 
    def unserialize(self, toUnpack):
       if isinstance(toUnpack, BinaryUnpacker):
@@ -746,7 +846,7 @@ class PayloadGetData(object):
 
    command = 'getdata'
 
-   def __init__(self, invList=[]):
+   def __init__(self, invList=None):
       if invList:
          self.invList = invList
       else:
@@ -789,9 +889,9 @@ class PayloadGetData(object):
 class PayloadGetHeaders(object):
    command = 'getheaders'
 
-   def __init__(self, hashStartList=[], hashStop=''):
+   def __init__(self, hashStartList=None, hashStop=''):
       self.version    = 1
-      self.hashList   = hashStartList
+      self.hashList   = hashStartList if hashStartList is not None else []
       self.hashStop   = hashStop
    
 
@@ -834,9 +934,9 @@ class PayloadGetHeaders(object):
 class PayloadGetBlocks(object):
    command = 'getblocks'
 
-   def __init__(self, version=1, startCt=-1, hashStartList=[], hashStop=''):
+   def __init__(self, version=1, startCt=-1, hashStartList=None, hashStop=''):
       self.version    = 1
-      self.hashList  = hashStartList
+      self.hashList  = hashStartList if hashStartList is not None else []
       self.hashStop   = hashStop
    
 
@@ -879,8 +979,9 @@ class PayloadGetBlocks(object):
 class PayloadTx(object):
    command = 'tx'
 
-   def __init__(self, tx=PyTx()):
-      self.tx = tx
+   def __init__(self, tx=None):
+      # Don't share a default PyTx between payloads, unserialize modifies it
+      self.tx = tx if tx else PyTx()
 
    def unserialize(self, toUnpack):
       self.tx.unserialize(toUnpack)
@@ -901,9 +1002,9 @@ class PayloadTx(object):
 class PayloadHeaders(object):
    command = 'headers'
 
-   def __init__(self, header=PyBlockHeader(), headerlist=[]):
-      self.header = header
-      self.headerList = headerlist
+   def __init__(self, header=None, headerlist=None):
+      self.header = header if header else PyBlockHeader()
+      self.headerList = headerlist if headerlist is not None else []
    
 
    def unserialize(self, toUnpack):
@@ -943,9 +1044,9 @@ class PayloadHeaders(object):
 class PayloadBlock(object):
    command = 'block'
 
-   def __init__(self, header=PyBlockHeader(), txlist=[]):
-      self.header = header
-      self.txList = txlist
+   def __init__(self, header=None, txlist=None):
+      self.header = header if header else PyBlockHeader()
+      self.txList = txlist if txlist is not None else []
    
 
    def unserialize(self, toUnpack):
@@ -977,6 +1078,87 @@ class PayloadBlock(object):
       for tx in self.txList:
          print indstr + indent + 'Tx:', tx.getHashHex()
 
+   def getHeader(self):
+      return self.header
+
+   def getNumTx(self):
+      return len(self.txList)
+
+   def getTxHashList(self):
+      return [tx.getHash() for tx in self.txList]
+
+
+################################################################################
+class LazyTxList(object):
+   """
+   Read-only, list-like container over the raw transactions of a block.
+   Each PyTx is only created the first time it is accessed.
+   """
+   def __init__(self, rawBlock, txOffsets):
+      self.rawBlock  = rawBlock
+      self.txOffsets = txOffsets
+      self.txCache   = [None]*len(txOffsets)
+
+   def __len__(self):
+      return len(self.txOffsets)
+
+   def __getitem__(self, idx):
+      if isinstance(idx, slice):
+         return [self[i] for i in xrange(*idx.indices(len(self)))]
+      if self.txCache[idx] is None:
+         self.txCache[idx] = PyTx().unserialize(FastBinaryUnpacker(self.getRawTx(idx)))
+      return self.txCache[idx]
+
+   def __iter__(self):
+      for i in xrange(len(self)):
+         yield self[i]
+
+   def getRawTx(self, idx):
+      startPos,endPos = self.txOffsets[idx]
+      return self.rawBlock[startPos:endPos]
+
+   def getTxHash(self, idx):
+      return hash256(self.getRawTx(idx))
+
+
+################################################################################
+class LazyPayloadBlock(PayloadBlock):
+   """
+   Only the 80-byte header is decoded up front.  The transactions are just
+   located (with skipTx), so getTxHashList() can hash the raw bytes, and
+   txList is a LazyTxList that creates each PyTx on first access.
+   """
+   def __init__(self, header=None, txlist=None):
+      PayloadBlock.__init__(self, header, txlist)
+      self.rawBlock = None
+
+   def unserialize(self, toUnpack):
+      if isinstance(toUnpack, BinaryUnpacker):
+         blkData = toUnpack
+      else:
+         blkData = FastBinaryUnpacker( toUnpack )
+
+      startPos = blkData.getPosition()
+      self.header.unserialize(blkData)
+      txOffsets = []
+      for i in xrange(blkData.get(VAR_INT)):
+         txStart = blkData.getPosition() - startPos
+         txOffsets.append([txStart, txStart + skipTx(blkData)])
+
+      self.rawBlock = blkData.getSubString(startPos, blkData.getPosition())
+      self.txList = LazyTxList(self.rawBlock, txOffsets)
+      return self
+
+   def serialize(self):
+      if self.rawBlock is not None:
+         return self.rawBlock
+      return PayloadBlock.serialize(self)
+
+   def getTxHashList(self):
+      if self.rawBlock is None:
+         return PayloadBlock.getTxHashList(self)
+      return [self.txList.getTxHash(i) for i in xrange(len(self.txList))]
+
 
 ################################################################################
 class PayloadAlert(object):
@@ -1109,6 +1291,143 @@ PayloadMap = {
    'alert':       PayloadAlert,
    'reject':      PayloadReject }
 
+# Payload classes used by LazyPyMessage when they differ from PayloadMap
+LazyPayloadMap = {
+   'block':       LazyPayloadBlock }
+
+
+################################################################################
+# magic, command, payload length, checksum
+MSG_HEADER_STRUCT = Struct('<4s12sI4s')
+MSG_HEADER_SIZE   = MSG_HEADER_STRUCT.size
+
+# Largest payload a peer may send:  a full block, plus the message header as
+# headroom.  Anything claiming to be bigger is not buffered, the peer is
+# dropped instead.
+MAX_BLOCK_SIZE   = 1000000
+MAX_PAYLOAD_SIZE = MAX_BLOCK_SIZE + MSG_HEADER_SIZE
+
+class NetworkFrameDecoder(object):
+   """
+   Incremental splitter for the Bitcoin wire protocol.  Received data is
+   appended to one bytearray; each 24-byte header is decoded exactly once,
+   and then we wait until its whole payload is buffered.  Each payload is
+   copied out and hashed once, so the work done is linear in the number
+   of bytes received no matter how the stream is chunked:
+
+      >> decoder.feed(data)
+      >> for magic,cmd,payload in decoder.popFrames():
+      >>    ...
+
+   A header claiming a payload over maxPayload bytes makes the stream
+   unusable:  the buffer is dropped, nothing more is decoded, and isBroken()
+   tells the caller to disconnect.
+   """
+   def __init__(self, maxPayload=MAX_PAYLOAD_SIZE):
+      self.buf = bytearray()
+      self.readPos = 0
+      self.pendingHeader = None
+      self.nBadChecksum = 0
+      self.maxPayload = maxPayload
+      self.broken = False
+
+   def feed(self, data):
+      if not self.broken:
+         self.buf.extend(data)
+
+   def isBroken(self):
+      return self.broken
+
+   def getBufferedSize(self):
+      return len(self.buf) - self.readPos
+
+   def popFrames(self):
+      """
+      Returns a list of (magic, cmd, payload) for every complete message
+      in the buffer.  Messages with a bad checksum are logged and dropped.
+      """
+      frames = []
+      while True:
+         if self.pendingHeader is None:
+            if self.getBufferedSize() < MSG_HEADER_SIZE:
+               break
+            self.pendingHeader = MSG_HEADER_STRUCT.unpack_from(self.buf,
+                                                               self.readPos)
+            self.readPos += MSG_HEADER_SIZE
+
+         magic,cmd,length,chksum = self.pendingHeader
+         if length > self.maxPayload:
+            LOGERROR('"%s" message of %d bytes is over the %d byte limit',
+                                 cmd.strip('\x00'), length, self.maxPayload)
+            self.broken = True
+            self.buf = bytearray()
+            self.readPos = 0
+            self.pendingHeader = None
+            break
+         if self.getBufferedSize() < length:
+            break
+
+         payload = str(buffer(self.buf, self.readPos, length))
+         self.readPos += length
+         self.pendingHeader = None
+
+         cmd = cmd.strip('\x00')
+         if not hash256(payload)[:4] == chksum:
+            self.nBadChecksum += 1
+            LOGERROR('Checksum mismatch on "%s" message (%d bytes), dropped',
+                                                                   cmd, length)
+            continue
+
+         frames.append((magic, cmd, payload))
+
+      # Drop consumed bytes, so the buffer only holds the partial message
+      if self.readPos > 0:
+         del self.buf[:self.readPos]
+         self.readPos = 0
+
+      return frames
+
+
+################################################################################
+class NetworkStats(object):
+   """
+   Counters for data received from the Satoshi node:  total bytes and
+   messages (and rates since the last reset), plus the number of messages
+   and time spent parsing them, per command
+   """
+   def __init__(self):
+      self.reset()
+
+   def reset(self):
+      self.startTime = RightNow()
+      self.nBytes    = 0
+      self.nMsgs     = 0
+      self.cmdStats  = {}
+
+   def addBytes(self, nBytes):
+      self.nBytes += nBytes
+
+   def addMessage(self, cmd, parseTime):
+      self.nMsgs += 1
+      count,totalTime,maxTime = self.cmdStats.get(cmd, [0, 0., 0.])
+      self.cmdStats[cmd] = [count+1, totalTime+parseTime, max(maxTime,parseTime)]
+
+   def getStats(self):
+      elapsed = max(RightNow() - self.startTime, 1e-6)
+      perCmd = {}
+      for cmd,(count,totalTime,maxTime) in self.cmdStats.iteritems():
+         perCmd[cmd] = { 'count':        count,
+                         'totalParseSec': totalTime,
+                         'avgParseSec':   totalTime / count,
+                         'maxParseSec':   maxTime }
+
+      return { 'seconds':      elapsed,
+               'bytes':        self.nBytes,
+               'messages':     self.nMsgs,
+               'bytesPerSec':  self.nBytes / elapsed,
+               'msgsPerSec':   self.nMsgs / elapsed,
+               'commands':     perCmd }
+
 
 class FakeClientFactory(ReconnectingClientFactory):
    """
@@ -1130,6 +1449,9 @@ class FakeClientFactory(ReconnectingClientFactory):
    def connectionFailed(self, protoObj, reason): pass
    def sendTx(self, pytxObj): pass
    def sendMessage(self, msgObj): pass
+   def getNetworkStats(self): return NetworkStats().getStats()
+   def resetNetworkStats(self): pass
+   def setLazyPayloadCommands(self, cmdList): pass
 
 ################################################################################
 # It seems we need to do this frequently when downloading headers & blocks
@@ -12,12 +12,16 @@ from armoryengine.ArmoryUtils import ADDRBYTE, hash256, binary_to_base58, \
    computeChecksum, getVersionInt, PYBTCWALLET_VERSION, bitset_to_int, \
    LOGDEBUG, Hash160ToScrAddr, int_to_bitset, UnserializeError, \
    hash160_to_addrStr, int_to_binary, BIGENDIAN, \
-   BadAddressError, checkAddrStrValid, binary_to_hex, ENABLE_DETSIGN
-from armoryengine.BinaryPacker import BinaryPacker, UINT8, UINT16, UINT32, UINT64, \
-   INT8, INT16, INT32, INT64, VAR_INT, VAR_STR, FLOAT, BINARY_CHUNK
+   BadAddressError, checkAddrStrValid, binary_to_hex, ENABLE_DETSIGN, \
+   emptyFunc, LOGCRIT
+from armoryengine.BinaryPacker import FastBinaryPacker, UINT8, \
+   UINT16, UINT32, UINT64, INT8, INT16, INT32, INT64, VAR_INT, VAR_STR, FLOAT, \
+   BINARY_CHUNK
 from armoryengine.BinaryUnpacker import BinaryUnpacker
 from armoryengine.Timer import TimeThisFunction
 import CppBlockUtils as Cpp
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 
 #############################################################################
@@ -422,9 +426,10 @@ class PyBtcAddress(object):
 
    
    #############################################################################
-   def safeExtendPrivateKey(self, privKey, chn, pubKey=None):
+   def safeExtendPrivateKey(self, privKey, chn, pubKey=None, chainEngine=None):
       # We do this computation twice, in case one is somehow corrupted
       # (Must be ultra paranoid with computing keys)
+      # With a ChainDerivationEngine, the second computation is handed to it
       logMult1 = SecureBinaryData()
       logMult2 = SecureBinaryData()
       a160hex = ''
@@ -435,6 +440,13 @@ class PyBtcAddress(object):
       else:
          a160hex = binary_to_hex(pubKey.getHash160())
 
+      if chainEngine is not None:
+         newPriv = CryptoECDSA().ComputeChainedPrivateKey(privKey, chn, pubKey, logMult1)
+         chainEngine.submitCheck( \
+            (True, privKey.copy(), chn.copy(), pubKey.copy(), newPriv.copy()), \
+            'PrvChain (pkh, mult): %s,%s\n' % (a160hex,logMult1.toHexStr()))
+         return newPriv
+
       newPriv1 = CryptoECDSA().ComputeChainedPrivateKey(privKey, chn, pubKey, logMult1)
       newPriv2 = CryptoECDSA().ComputeChainedPrivateKey(privKey, chn, pubKey, logMult2)
 
@@ -474,12 +486,20 @@ class PyBtcAddress(object):
       
 
    #############################################################################
-   def safeExtendPublicKey(self, pubKey, chn):
+   def safeExtendPublicKey(self, pubKey, chn, chainEngine=None):
       # We do this computation twice, in case one is somehow corrupted
       # (Must be ultra paranoid with computing keys)
+      # With a ChainDerivationEngine, the second computation is handed to it
       a160hex = binary_to_hex(pubKey.getHash160())
       logMult1 = SecureBinaryData()
       logMult2 = SecureBinaryData()
+      if chainEngine is not None:
+         newPub = CryptoECDSA().ComputeChainedPublicKey(pubKey, chn, logMult1)
+         chainEngine.submitCheck( \
+            (False, pubKey.copy(), chn.copy(), SecureBinaryData(0), newPub.copy()), \
+            'PubChain (pkh, mult): %s,%s\n' % (a160hex, logMult1.toHexStr()))
+         return newPub
+
       newPub1 = CryptoECDSA().ComputeChainedPublicKey(pubKey, chn, logMult1)
       newPub2 = CryptoECDSA().ComputeChainedPublicKey(pubKey, chn, logMult2)
 
@@ -762,7 +782,7 @@ class PyBtcAddress(object):
 
    #############################################################################
    @TimeThisFunction
-   def extendAddressChain(self, secureKdfOutput=None, newIV=None):
+   def extendAddressChain(self, secureKdfOutput=None, newIV=None, chainEngine=None):
       """
       We require some fairly complicated logic here, due to the fact that a
       user with a full, private-key-bearing wallet, may try to generate a new
@@ -771,6 +791,9 @@ class PyBtcAddress(object):
       generate a new address, but we can't compute the private key until the
       next time the user unlocks their wallet.  Thus, we have to save off the
       data they will need to create the key, to be applied on next unlock.
+
+      Use ChainDerivationEngine.extendChain() rather than passing chainEngine
+      here directly:  the key checks it collects have to be waited for.
       """
       if not self.chaincode.getSize() == 32:
          raise KeyDataError, 'No chaincode has been defined to extend chain'
@@ -799,14 +822,16 @@ class PyBtcAddress(object):
             newPriv = self.safeExtendPrivateKey( \
                                     self.binPrivKey32_Plain, \
                                     self.chaincode, \
-                                    self.binPublicKey65)
+                                    self.binPublicKey65, \
+                                    chainEngine=chainEngine)
          else:
             #newPriv = CryptoECDSA().ComputeChainedPrivateKey( \
                                     #self.binPrivKey32_Plain, \
                                     #self.chaincode)
             newPriv = self.safeExtendPrivateKey( \
                                     self.binPrivKey32_Plain, \
-                                    self.chaincode)
+                                    self.chaincode, \
+                                    chainEngine=chainEngine)
 
          newPub  = CryptoECDSA().ComputePublicKey(newPriv)
          newAddr160 = newPub.getHash160()
@@ -834,7 +859,8 @@ class PyBtcAddress(object):
          #newAddr.binPublicKey65 = CryptoECDSA().ComputeChainedPublicKey( \
                                     #self.binPublicKey65, self.chaincode)
          newAddr.binPublicKey65 = self.safeExtendPublicKey( \
-                                    self.binPublicKey65, self.chaincode)
+                                    self.binPublicKey65, self.chaincode, \
+                                    chainEngine=chainEngine)
 
          newAddr.addrStr20 = newAddr.binPublicKey65.getHash160()
          newAddr.useEncryption = self.useEncryption
@@ -943,7 +969,7 @@ class PyBtcAddress(object):
       # able to determine where each field is, and will never corrupt the
       # whole wallet so badly we have to go hex-diving to figure out what
       # happened.
-      binOut = BinaryPacker()
+      binOut = FastBinaryPacker(237)
       binOut.put(BINARY_CHUNK,   self.addrStr20,                    width=20)
       binOut.put(BINARY_CHUNK,   chk(self.addrStr20),               width= 4)
       binOut.put(UINT32,         getVersionInt(PYBTCWALLET_VERSION))
@@ -1295,5 +1321,281 @@ class PyBtcAddress(object):
          result = ''.join([result, '\n',   indent + '           ***** :', 'PrivKeys available on next unlock'])
       return result
 
+
+
+################################################################################
+class PyBtcAddressCompact(object):
+   """
+   The public part of a PyBtcAddress, for addresses without private key data
+   (all the addresses of a watching-only wallet).  Everything is kept in
+   __slots__ as plain strings and ints, instead of a per-instance __dict__
+   holding half a dozen SecureBinaryData objects (extras/benchmark_addrmem.py
+   compares the two).
+
+   It has the read-only interface of a PyBtcAddress, and serializes to the
+   same bytes.  Anything that needs to modify key data must use the full
+   PyBtcAddress from toPyBtcAddress() instead (see
+   PyBtcWallet.promoteAddress).
+   """
+   __slots__ = ('addrStr20', 'pubKey65', 'chaincodeStr', 'chainIndex', \
+                'chainDepth', 'useEncryption', 'walletByteLoc', \
+                'firstTime', 'lastTime', 'firstBlk', 'lastBlk')
+
+   # Never any private key data in here
+   isLocked                = False
+   isInitialized           = True
+   keyChanged              = False
+   createPrivKeyNextUnlock = False
+   createPrivKeyNextUnlock_IVandKey = (None, None)
+
+   binPublicKey65     = property(lambda self: SecureBinaryData(self.pubKey65))
+   chaincode          = property(lambda self: SecureBinaryData(self.chaincodeStr))
+   binPrivKey32_Encr  = property(lambda self: SecureBinaryData())
+   binPrivKey32_Plain = property(lambda self: SecureBinaryData())
+   binInitVect16      = property(lambda self: SecureBinaryData())
+   timeRange          = property(lambda self: [self.firstTime, self.lastTime])
+   blkRange           = property(lambda self: [self.firstBlk, self.lastBlk])
+   createPrivKeyNextUnlock_ChainDepth = property(lambda self: self.chainDepth)
+
+   #############################################################################
+   def createFromPyBtcAddress(self, addrObj):
+      if addrObj.hasPrivKey():
+         raise KeyDataError, 'Compact addresses cannot hold private keys'
+
+      self.addrStr20     = addrObj.addrStr20
+      self.pubKey65      = addrObj.binPublicKey65.toBinStr()
+      # Every address of a wallet has the same chaincode, share the string
+      self.chaincodeStr  = intern(addrObj.chaincode.toBinStr())
+      self.chainIndex    = addrObj.chainIndex
+      self.chainDepth    = addrObj.createPrivKeyNextUnlock_ChainDepth
+      self.useEncryption = addrObj.useEncryption
+      self.walletByteLoc = addrObj.walletByteLoc
+      self.firstTime,self.lastTime = addrObj.timeRange
+      self.firstBlk, self.lastBlk  = addrObj.blkRange
+      return self
+
+   #############################################################################
+   def toPyBtcAddress(self):
+      """ A new PyBtcAddress with the same data """
+      newAddr = PyBtcAddress()
+      newAddr.addrStr20      = self.addrStr20
+      newAddr.binPublicKey65 = SecureBinaryData(self.pubKey65)
+      newAddr.chaincode      = SecureBinaryData(self.chaincodeStr)
+      newAddr.chainIndex     = self.chainIndex
+      newAddr.createPrivKeyNextUnlock_ChainDepth = self.chainDepth
+      newAddr.useEncryption  = self.useEncryption
+      newAddr.walletByteLoc  = self.walletByteLoc
+      newAddr.timeRange      = [self.firstTime, self.lastTime]
+      newAddr.blkRange       = [self.firstBlk, self.lastBlk]
+      newAddr.isInitialized  = True
+      return newAddr
+
+   #############################################################################
+   def hasPrivKey(self):
+      return False
+
+   def hasPubKey(self):
+      return len(self.pubKey65) != 0
+
+   def getPubKey(self):
+      if len(self.pubKey65) != 65:
+         raise KeyDataError, 'PyBtcAddress does not have a public key!'
+      return self.binPublicKey65
+
+   def hasChainCode(self):
+      return len(self.chaincodeStr) != 0
+
+   def getChainCode(self):
+      if len(self.chaincodeStr) != 32:
+         raise KeyDataError, 'PyBtcAddress does not have a chain code!'
+      return self.chaincode
+
+   def getAddrStr(self, netbyte=ADDRBYTE):
+      chksum = hash256(netbyte + self.addrStr20)[:4]
+      return binary_to_base58(netbyte + self.addrStr20 + chksum)
+
+   def getAddr160(self):
+      if len(self.addrStr20)!=20:
+         raise KeyDataError, 'PyBtcAddress does not have an address string!'
+      return self.addrStr20
+
+   def isCompressed(self):
+      return False
+
+   def isAddrChainRoot(self):
+      return (self.chainIndex==-1)
+
+   def getTimeRange(self):
+      return self.timeRange
+
+   def getBlockRange(self):
+      return self.blkRange
+
+   def serializePublicKey(self):
+      return self.pubKey65
+
+   #############################################################################
+   def touch(self, unixTime=None, blkNum=None):
+      fullAddr = self.toPyBtcAddress()
+      fullAddr.touch(unixTime, blkNum)
+      self.firstTime,self.lastTime = fullAddr.timeRange
+      self.firstBlk, self.lastBlk  = fullAddr.blkRange
+
+   #############################################################################
+   def lock(self, secureKdfOutput=None, generateIVIfNecessary=False):
+      # Same as PyBtcAddress.lock() without a private key
+      return
+
+   def unlock(self, secureKdfOutput, skipCheck=False):
+      return
+
+   #############################################################################
+   def copy(self):
+      """ Copies are full PyBtcAddress objects, callers may modify them """
+      return self.toPyBtcAddress()
+
+   #############################################################################
+   # These don't modify the address, so a temporary PyBtcAddress will do
+   def serialize(self):
+      return self.toPyBtcAddress().serialize()
+
+   def extendAddressChain(self, secureKdfOutput=None, newIV=None, chainEngine=None):
+      return self.toPyBtcAddress().extendAddressChain(secureKdfOutput, \
+                                                       newIV, chainEngine)
+
+   def verifyDERSignature(self, binMsgVerify, derSig):
+      return self.toPyBtcAddress().verifyDERSignature(binMsgVerify, derSig)
+
+   def pprint(self, withPrivKey=True, indent=''):
+      self.toPyBtcAddress().pprint(withPrivKey, indent)
+
+   def toString(self, withPrivKey=True, indent=''):
+      return self.toPyBtcAddress().toString(withPrivKey, indent)
+
+
+
+################################################################################
+def writeMultiplierLog(logLines):
+   """ Append a batch of multiplier log lines with one open and write """
+   if len(logLines) > 0:
+      with open(MULT_LOG_FILE,'a') as f:
+         f.write(''.join(logLines))
+
+
+################################################################################
+def checkChainedKey(keyCheck):
+   """
+   The second computation of a chained key, run on a ChainDerivationEngine
+   worker.  keyCheck is (isPriv, baseKey, chaincode, pubKey, expectedKey),
+   all copies that are destroyed here.
+   """
+   isPriv, baseKey, chn, pubKey, expected = keyCheck
+   logMult = SecureBinaryData()
+   if isPriv:
+      check = CryptoECDSA().ComputeChainedPrivateKey(baseKey, chn, pubKey, logMult)
+   else:
+      check = CryptoECDSA().ComputeChainedPublicKey(baseKey, chn, logMult)
+
+   isValid = (check == expected)
+   for sbd in [baseKey, chn, pubKey, expected, check]:
+      sbd.destroy()
+   return isValid
+
+
+################################################################################
+class ChainDerivationEngine(object):
+   """
+   Extends address chains with the same compute-twice check as
+   safeExtendPrivateKey/safeExtendPublicKey, but pipelined:  the chain is
+   computed once, in order, on the calling thread, and the second
+   computation of every key is queued on a pool of worker threads while
+   the chain moves on.  CppBlockUtils is built with "swig -threads", so
+   the ECDSA calls release the GIL.
+
+   If any check fails, every address from that one on is thrown away and
+   re-derived with the plain extendAddressChain(), which does its own
+   (triple) check.  Multiplier log lines are written once per chain
+   instead of once per key.
+   """
+   def __init__(self, numWorkers=None):
+      if numWorkers is None:
+         numWorkers = multiprocessing.cpu_count()
+      self.numWorkers = max(int(numWorkers), 1)
+      self.pool       = None
+      self.curIndex   = 0
+      self.pending    = []   # [addrIndex, AsyncResult, logLine]
+      self.nDerived   = 0
+      self.timeSpent  = 0.
+
+   #############################################################################
+   def getPool(self):
+      if self.pool is None:
+         self.pool = ThreadPool(self.numWorkers)
+      return self.pool
+
+   #############################################################################
+   def shutdown(self):
+      if self.pool is not None:
+         self.pool.close()
+         self.pool.join()
+         self.pool = None
+
+   #############################################################################
+   def submitCheck(self, keyCheck, logLine):
+      """ Called by safeExtend*Key for the address currently being derived """
+      asyncResult = self.getPool().apply_async(checkChainedKey, (keyCheck,))
+      self.pending.append([self.curIndex, asyncResult, logLine])
+
+   #############################################################################
+   def getAddrPerSec(self):
+      """ Addresses per second over everything this engine has derived """
+      return self.nDerived / self.timeSpent if self.timeSpent > 0 else 0.
+
+   #############################################################################
+   def extendChain(self, startAddr, numAddr, secureKdfOutput=None, \
+                                             Progress=emptyFunc):
+      """
+      Returns numAddr new PyBtcAddress objects, each extended from the one
+      before it, starting from startAddr.  Nothing is returned until all
+      the key checks are done.
+      """
+      startTime = RightNow()
+      self.pending = []
+      newAddrList = []
+      prevAddr = startAddr
+      for i in range(numAddr):
+         Progress(i+1, numAddr)
+         self.curIndex = i
+         prevAddr = prevAddr.extendAddressChain(secureKdfOutput, \
+                                                chainEngine=self)
+         newAddrList.append(prevAddr)
+
+      # Checks come back in chain order, stop at the first bad one
+      logLines = []
+      firstBad = None
+      for addrIndex,asyncResult,logLine in self.pending:
+         if firstBad is None and not asyncResult.get():
+            firstBad = addrIndex
+         elif firstBad is None:
+            logLines.append(logLine)
+         else:
+            asyncResult.wait()
+      self.pending = []
+      writeMultiplierLog(logLines)
+
+      if firstBad is not None:
+         LOGCRIT('Chaining failed at address %d!  Computed keys are '
+                 'different!  Re-deriving the rest of the chain', firstBad)
+         newAddrList = newAddrList[:firstBad]
+         prevAddr = newAddrList[-1] if firstBad > 0 else startAddr
+         for i in range(firstBad, numAddr):
+            prevAddr = prevAddr.extendAddressChain(secureKdfOutput)
+            newAddrList.append(prevAddr)
+
+      self.nDerived  += numAddr
+      self.timeSpent += RightNow() - startTime
+      return newAddrList
+
+
 # Put the import at the end to avoid circular reference problem
 from armoryengine.BDM import *
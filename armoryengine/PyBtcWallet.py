@@ -5,8 +5,11 @@
 # See LICENSE or http://www.gnu.org/licenses/agpl.html                         #
 #                                                                              #
 ################################################################################
+import mmap
 import os.path
 import shutil
+from collections import OrderedDict
+from struct import Struct
 
 from CppBlockUtils import SecureBinaryData, KdfRomix, CryptoAES, CryptoECDSA
 import CppBlockUtils as Cpp
@@ -36,6 +39,9 @@ WLT_DATATYPE_DELETED     = 4
 DEFAULT_COMPUTE_TIME_TARGET = 0.25
 DEFAULT_MAXMEM_LIMIT        = 32*1024*1024
 
+# Address batches at least this big are derived with a ChainDerivationEngine
+CHAIN_ENGINE_MIN_ADDRS = 100
+
 PYROOTPKCCVER = 1 # Current version of root pub key/chain code backup format
 PYROOTPKCCVERMASK = 0x7F
 PYROOTPKCCSIGNMASK = 0x80
@@ -61,6 +67,167 @@ def CheckWalletRegistration(func):
 def buildWltFileName(uniqueIDB58):
    return 'armory_%s_.wallet' % uniqueIDB58
    
+################################################################################
+class LazyAddrMap(dict):
+   """
+   The addrMap of a wallet read with readWalletFile(lazyLoad=True).  Every
+   addr160 is a key from the start, but its PyBtcAddress is only unserialized
+   from the memory-mapped wallet file the first time it is looked up.  Until
+   then, addrIndex holds [byteLoc, chainIndex, flags] for it, read straight
+   from the file without checking anything.
+
+   Anything returning values (iteritems, values, get, ...) loads what it
+   returns, so this can be used anywhere a plain addrMap is.
+   """
+
+   # Address flags (UINT64) and chainIndex (INT64) in serialized PyBtcAddress
+   INDEX_OFFSET = 28
+   INDEX_READER = Struct('<Q36xq')
+
+   def __init__(self, fileBuf, addrSize, fixAddrData, compactAddr=None):
+      dict.__init__(self)
+      self.fileBuf     = fileBuf      # mmap of the file, str once detached
+      self.addrSize    = addrSize
+      self.fixAddrData = fixAddrData  # (byteLoc, fixedData) for byte errors
+      self.compactAddr = compactAddr  # applied to each loaded address
+      self.addrIndex   = {}
+      self.lock        = threading.Lock()
+
+   #############################################################################
+   def addIndexEntry(self, addr160, byteLoc, chainIndex, flags):
+      dict.__setitem__(self, addr160, None)
+      self.addrIndex[addr160] = [byteLoc, chainIndex, flags]
+
+   #############################################################################
+   def isLoaded(self, addr160):
+      return not addr160 in self.addrIndex
+
+   #############################################################################
+   def getChainIndex(self, addr160):
+      """ Same as self[addr160].chainIndex, without loading the address """
+      entry = self.addrIndex.get(addr160)
+      if entry is not None:
+         return entry[1]
+      return dict.__getitem__(self, addr160).chainIndex
+
+   #############################################################################
+   def getPendingList(self):
+      return self.addrIndex.keys()
+
+   #############################################################################
+   def getPendingData(self, addr160):
+      """ Raw address data of an address not loaded yet, or None """
+      with self.lock:
+         entry = self.addrIndex.get(addr160)
+         if entry is None or self.fileBuf is None:
+            return None
+         return self.fileBuf[entry[0]:entry[0]+self.addrSize]
+
+   #############################################################################
+   def loadAddr(self, addr160):
+      with self.lock:
+         entry = self.addrIndex.get(addr160)
+         if entry is None:
+            # Another thread got here first
+            return dict.__getitem__(self, addr160)
+         if self.fileBuf is None:
+            raise WalletAddressError('Wallet file was closed')
+
+         rawData = self.fileBuf[entry[0]:entry[0]+self.addrSize]
+         newAddr = PyBtcAddress()
+         newAddr.unserialize(FastBinaryUnpacker(rawData))
+         newAddr.walletByteLoc = entry[0]
+         fixedAddrData = newAddr.serialize()
+         if newAddr.useEncryption:
+            newAddr.isLocked = True
+         if newAddr.chainIndex < -2:
+            newAddr.chainIndex = -2
+         if self.compactAddr is not None:
+            newAddr = self.compactAddr(newAddr)
+
+         dict.__setitem__(self, addr160, newAddr)
+         del self.addrIndex[addr160]
+
+      # Fix byte errors in the address data.  Not under self.lock, the
+      # file update may need to detach the file
+      if not rawData==fixedAddrData:
+         self.fixAddrData(newAddr.walletByteLoc, fixedAddrData)
+      return newAddr
+
+   #############################################################################
+   def detachFile(self):
+      """
+      Copy what we still need out of the mapped file, so that it can be
+      modified.  Called before every wallet file update.
+      """
+      with self.lock:
+         if isinstance(self.fileBuf, mmap.mmap):
+            fileMap = self.fileBuf
+            self.fileBuf = fileMap[:] if len(self.addrIndex)>0 else ''
+            fileMap.close()
+
+   #############################################################################
+   def attachFile(self, fileBuf):
+      """ Use a new mapping of the file, after it was detached and updated """
+      with self.lock:
+         self.fileBuf = fileBuf
+
+   #############################################################################
+   def close(self):
+      with self.lock:
+         if isinstance(self.fileBuf, mmap.mmap):
+            self.fileBuf.close()
+         self.fileBuf = None
+
+   #############################################################################
+   def iterloaded(self):
+      """ (addr160, PyBtcAddress) for only the addresses already loaded """
+      for addr160,addrObj in dict.iteritems(self):
+         if not addr160 in self.addrIndex:
+            yield addr160,addrObj
+
+   #############################################################################
+   def __getitem__(self, addr160):
+      if addr160 in self.addrIndex:
+         return self.loadAddr(addr160)
+      return dict.__getitem__(self, addr160)
+
+   def __setitem__(self, addr160, addrObj):
+      self.addrIndex.pop(addr160, None)
+      dict.__setitem__(self, addr160, addrObj)
+
+   def __delitem__(self, addr160):
+      self.addrIndex.pop(addr160, None)
+      dict.__delitem__(self, addr160)
+
+   def get(self, addr160, default=None):
+      return self[addr160] if addr160 in self else default
+
+   def pop(self, addr160, *default):
+      if addr160 in self:
+         addrObj = self[addr160]
+         del self[addr160]
+         return addrObj
+      return dict.pop(self, addr160, *default)
+
+   def iteritems(self):
+      for addr160 in self.keys():
+         yield addr160,self[addr160]
+
+   def itervalues(self):
+      for addr160 in self.keys():
+         yield self[addr160]
+
+   def items(self):
+      return list(self.iteritems())
+
+   def values(self):
+      return list(self.itervalues())
+
+   def copy(self):
+      return dict(self.iteritems())
+
+
 class PyBtcWallet(object):
    """
    This class encapsulates all the concepts and variables in a "wallet",
@@ -198,6 +365,8 @@ class PyBtcWallet(object):
       self.linearAddr160List = []
       self.chainIndexMap = {}
       self.txAddrMap = {}    # cache for getting tx-labels based on addr search
+      self.utxoSnapshot = None  # cache for getFullUTXOList, see getUTXOSnapshot
+      self.ledgerCursor = None  # see getLedgerCursor
       if USE_TESTNET:
          self.addrPoolSize = 10  # this makes debugging so much easier!
       else:
@@ -218,6 +387,19 @@ class PyBtcWallet(object):
       self.isLocked       = False
       self.testedComputeTime=None
 
+      # After unlock(lazy=True), addresses are decrypted one at a time by
+      # unlockAddress and kept decrypted in this LRU (addr160 -> time)
+      self.lazyUnlock        = False
+      self.lazyUnlockedAddrs = OrderedDict()
+      self.lazyKeyCacheSize  = 100   # at most this many decrypted keys
+      self.lazyKeyLifetime   = 10    # seconds a decrypted key is kept
+
+      # Background check of the address data after readWalletFile(lazyLoad=True)
+      self.addrCheckThread = None
+
+      # Keep addresses without private keys as PyBtcAddressCompact objects
+      self.compactPublicAddrs = False
+
       # Deterministic wallet, need a root key.  Though we can still import keys.
       # The unique ID contains the network byte (id[-1]) but is not intended to
       # resemble the address of the root key
@@ -274,11 +456,15 @@ class PyBtcWallet(object):
       #instantiated at registration and is unique for the BDV object, so we
       #should only ever set the cppWallet member here 
       self.cppWallet = TheBDM.registerWallet(prefixedKeys, self.uniqueIDB58, isNew)
+      self.invalidateUTXOCache()
+      self.ledgerCursor = None
       
    #############################################################################
    def unregisterWallet(self):
       TheBDM.unregisterWallet(self.uniqueIDB58)
       self.cppWallet = None
+      self.utxoSnapshot = None
+      self.ledgerCursor = None
       
    #############################################################################
    def isWltSigningAnyLockbox(self, lockboxList):
@@ -443,18 +629,41 @@ class PyBtcWallet(object):
       
       #return full set of unspent TxOuts
       if not self.doBlockchainSync==BLOCKCHAIN_DONOTUSE:
-         #calling this with no value argument will return the full UTXO list
-         from CoinSelection import PyUnspentTxOut
-         utxos = self.cppWallet.getSpendableTxOutListForValue(IGNOREZC)
-         utxoList = []
-         for i in range(len(utxos)):
-            utxoList.append(PyUnspentTxOut().createFromCppUtxo(utxos[i]))
-         return utxoList         
+         return self.getUTXOSnapshot().getUtxoList()
       else:
          LOGERROR('***Blockchain is not available for accessing wallet-tx data')
          return []
 
 
+   #############################################################################
+   @CheckWalletRegistration
+   def getUTXOSnapshot(self):
+      """
+      Returns the wallet's UtxoSnapshot, refreshed from the C++ wallet only
+      if there has been a new block, zero-conf or refresh notification since
+      the last call (or invalidateUTXOCache() was called).
+      """
+      from CoinSelection import UtxoSnapshot
+      if self.utxoSnapshot is None:
+         self.utxoSnapshot = UtxoSnapshot()
+
+      # Read these before fetching:  if a notification comes in while we're
+      # fetching, the next call will fetch again
+      epoch    = TheBDM.getUtxoEpoch()
+      topBlock = TheBDM.getTopBlockHeight()
+      if not self.utxoSnapshot.isCurrent(epoch, topBlock):
+         #calling this with no value argument will return the full UTXO list
+         utxos = self.cppWallet.getSpendableTxOutListForValue(IGNOREZC)
+         self.utxoSnapshot.update([utxos[i] for i in range(len(utxos))],
+                                                             topBlock, epoch)
+      return self.utxoSnapshot
+
+   #############################################################################
+   def invalidateUTXOCache(self):
+      if self.utxoSnapshot is not None:
+         self.utxoSnapshot.invalidate()
+
+
    #############################################################################
    @CheckWalletRegistration
    def getUTXOListForBlockRange(self, startBlock, endBlock):
@@ -489,8 +698,41 @@ class PyBtcWallet(object):
 
 
    #############################################################################
-   def getAddrByHash160(self, addr160):
-      return (None if not self.hasAddr(addr160) else self.addrMap[addr160])
+   def getAddrByHash160(self, addr160, withPrivKey=False):
+      """
+      Callers that need the private key pass withPrivKey=True:  then a
+      PyBtcAddressCompact is promoted to a full PyBtcAddress, and if the
+      wallet was unlocked with lazy=True, the address is decrypted here.
+      They should call relockLazyKeys() when they are done with the key.
+      """
+      addrObj = (None if not self.hasAddr(addr160) else self.addrMap[addr160])
+      if addrObj and withPrivKey:
+         addrObj = self.promoteAddress(addr160)
+         if self.lazyUnlock and addrObj.isLocked:
+            self.unlockAddress(addrObj)
+      return addrObj
+
+   #############################################################################
+   def compactAddr(self, addrObj):
+      """
+      With compactPublicAddrs, addresses without private key data are kept
+      in addrMap as PyBtcAddressCompact objects
+      """
+      if self.compactPublicAddrs and not addrObj.hasPrivKey():
+         return PyBtcAddressCompact().createFromPyBtcAddress(addrObj)
+      return addrObj
+
+   #############################################################################
+   def promoteAddress(self, addr160):
+      """
+      Replace a PyBtcAddressCompact in addrMap with the full PyBtcAddress,
+      for anything that will modify its key data
+      """
+      addrObj = self.addrMap[addr160]
+      if isinstance(addrObj, PyBtcAddressCompact):
+         addrObj = addrObj.toPyBtcAddress()
+         self.addrMap[addr160] = addrObj
+      return addrObj
 
    #############################################################################
    def hasScrAddr(self, scrAddr):
@@ -526,6 +768,9 @@ class PyBtcWallet(object):
 
    #############################################################################
    def checkWalletLockTimeout(self):
+      if self.lazyUnlock:
+         self.relockLazyKeys()
+
       if not self.isLocked and self.kdfKey and RightNow()>self.lockWalletAtTime:
          self.lock()
          if self.kdfKey:
@@ -975,11 +1220,13 @@ class PyBtcWallet(object):
       if not addr160:
          addr160 = self.lastComputedChainAddr160
 
-      newAddr = self.addrMap[addr160].extendAddressChain(self.kdfKey)
+      parentAddr = self.addrMap[addr160]
+      newAddr = parentAddr.extendAddressChain(self.kdfKey)
+      self.relockChainedAddrs([parentAddr, newAddr])
       new160 = newAddr.getAddr160()
       newDataLoc = self.walletFileSafeUpdate( \
          [[WLT_UPDATE_ADD, WLT_DATATYPE_KEYDATA, new160, newAddr]])
-      self.addrMap[new160] = newAddr
+      self.addrMap[new160] = self.compactAddr(newAddr)
       self.addrMap[new160].walletByteLoc = newDataLoc[0] + 21
 
       if newAddr.chainIndex > self.lastComputedChainIndex:
@@ -1001,10 +1248,75 @@ class PyBtcWallet(object):
       # BDM private methods directly
 
       return new160
+
+   #############################################################################
+   def computeNextAddressBatch(self, numAddr, isActuallyNew=True,
+                               doRegister=True, Progress=emptyFunc,
+                               chainEngine=None):
+      """
+      Same as calling computeNextAddress() numAddr times from the tip of the
+      chain, but all the new addresses go to the wallet file in a single
+      walletFileSafeUpdate.  That is one consistency check and one set of
+      flag files and fsyncs instead of one per address, and the batch is
+      either completely in the file or not at all.
+
+      Batches of CHAIN_ENGINE_MIN_ADDRS or more are derived with a
+      ChainDerivationEngine (pass one in to reuse its worker pool).
+
+      Nothing is added to the wallet in memory until the file update has
+      succeeded.  Returns the list of new addr160 values.
+      """
+      if numAddr <= 0:
+         return []
+
+      tipAddr = self.addrMap[self.lastComputedChainAddr160]
+      if chainEngine is None and numAddr < CHAIN_ENGINE_MIN_ADDRS:
+         newAddrList = []
+         prevAddr = tipAddr
+         for i in range(numAddr):
+            Progress(i+1, numAddr)
+            prevAddr = prevAddr.extendAddressChain(self.kdfKey)
+            newAddrList.append(prevAddr)
+      else:
+         ownEngine = chainEngine is None
+         if ownEngine:
+            chainEngine = ChainDerivationEngine()
+         try:
+            newAddrList = chainEngine.extendChain(tipAddr, numAddr, \
+                                                  self.kdfKey, Progress)
+         finally:
+            if ownEngine:
+               chainEngine.shutdown()
+         LOGINFO('Derived %d addresses for wallet %s, %0.1f addr/sec', \
+                  numAddr, self.uniqueIDB58, chainEngine.getAddrPerSec())
+      self.relockChainedAddrs([tipAddr] + newAddrList)
+
+      updateList = [[WLT_UPDATE_ADD, WLT_DATATYPE_KEYDATA, \
+                       newAddr.getAddr160(), newAddr] for newAddr in newAddrList]
+      newDataLocs = self.walletFileSafeUpdate(updateList)
+      if not len(newDataLocs) == numAddr:
+         raise WalletAddressError, 'Could not write new addresses to wallet file'
+
+      time0,blk0 = getCurrTimeAndBlock() if isActuallyNew else (0,0)
+      new160List = []
+      for newAddr,dataLoc in zip(newAddrList, newDataLocs):
+         new160 = newAddr.getAddr160()
+         newAddr.walletByteLoc = dataLoc + 21
+         self.addrMap[new160] = self.compactAddr(newAddr)
+         self.linearAddr160List.append(new160)
+         self.chainIndexMap[newAddr.chainIndex] = new160
+         if doRegister and self.isRegistered():
+            self.cppWallet.addScrAddress_5_(Hash160ToScrAddr(new160), \
+                                   time0,blk0,time0,blk0)
+         new160List.append(new160)
+
+      self.lastComputedChainAddr160 = new160List[-1]
+      self.lastComputedChainIndex = newAddrList[-1].chainIndex
+      return new160List
       
    #############################################################################
    def fillAddressPool(self, numPool=None, isActuallyNew=True, 
-                       doRegister=True, Progress=emptyFunc):
+                       doRegister=True, Progress=emptyFunc, chainEngine=None):
       """
       Usually, when we fill the address pool, we are generating addresses
       for the first time, and thus there is no chance it's ever seen the
@@ -1019,13 +1331,13 @@ class PyBtcWallet(object):
       gap = self.lastComputedChainIndex - self.highestUsedChainIndex
       numToCreate = max(numPool - gap, 0)
       
-      newAddrList = []
-      
-      for i in range(numToCreate):
-         Progress(i+1, numToCreate)
-         newAddrList.append(Hash160ToScrAddr(self.computeNextAddress(\
-                                 isActuallyNew=isActuallyNew, \
-                                 doRegister=False))) 
+      # All the new addresses are written to the wallet file at once
+      new160List = self.computeNextAddressBatch(numToCreate, \
+                                                isActuallyNew=isActuallyNew, \
+                                                doRegister=False, \
+                                                Progress=Progress, \
+                                                chainEngine=chainEngine)
+      newAddrList = [Hash160ToScrAddr(a160) for a160 in new160List]
          
       #add addresses in bulk once they are all computed   
       if doRegister and self.isRegistered():
@@ -1136,14 +1448,21 @@ class PyBtcWallet(object):
       # out [stepsize] addresses beyond topUsed, and the topUsed will not
       # change, thus escaping the while loop
       nWhile = 0
-      while topCompute - topUsed < 0.9*stepSize:
-         topCompute = self.fillAddressPool(stepSize, isActuallyNew=False)
-         topUsed = self.detectHighestUsedIndex(True)
-         nWhile += 1
-         if nWhile>10000:
-            raise WalletAddressError('Escaping inf loop in freshImport...')
-            
+      # One engine for all the steps, so its workers are started only once
+      chainEngine = ChainDerivationEngine()
+      try:
+         while topCompute - topUsed < 0.9*stepSize:
+            topCompute = self.fillAddressPool(stepSize, isActuallyNew=False, \
+                                              chainEngine=chainEngine)
+            topUsed = self.detectHighestUsedIndex(True)
+            nWhile += 1
+            if nWhile>10000:
+               raise WalletAddressError('Escaping inf loop in freshImport...')
+      finally:
+         chainEngine.shutdown()
 
+      LOGINFO('Restore of wallet %s derived %d addresses at %0.1f addr/sec', \
+               self.uniqueIDB58, chainEngine.nDerived, chainEngine.getAddrPerSec())
       self.addrPoolSize = oldPoolSize
       return topUsed
 
@@ -1789,6 +2108,8 @@ class PyBtcWallet(object):
       updEntry.append([WLT_UPDATE_ADD, dtype, hashVal, newComment])
       newCommentLoc = self.walletFileSafeUpdate(updEntry)
       self.commentsMap[hashVal] = newComment
+      # Address comments show up on every tx touching the address
+      TheLedgerValueCache.evictWallet(self.uniqueIDB58, 'comment')
 
       # If there was a wallet overwrite, it's location is the first element
       self.commentLocs[hashVal] = newCommentLoc[-1]
@@ -1843,6 +2164,11 @@ class PyBtcWallet(object):
       # Smart comments for LedgerEntry objects:  get any direct comments ... 
       # if none, then grab the one for any associated addresses.
       txHash = le.getTxHash()
+      found, comment = TheLedgerValueCache.lookup(txHash, self.uniqueIDB58,
+                                                                  'comment')
+      if found:
+         return comment
+
       if self.commentsMap.has_key(txHash):
          comment = self.commentsMap[txHash]
       else:
@@ -1851,6 +2177,7 @@ class PyBtcWallet(object):
          if comment.startswith('[[') and comment.endswith(']]'):
             comment = ''
 
+      TheLedgerValueCache.store(txHash, self.uniqueIDB58, 'comment', comment)
       return comment
 
 
@@ -2064,12 +2391,28 @@ class PyBtcWallet(object):
 
    #############################################################################
    @TimeThisFunction
-   def readWalletFile(self, wltpath, verifyIntegrity=True, reportProgress=None):
+   def readWalletFile(self, wltpath, verifyIntegrity=True, reportProgress=None,
+                            fastUnpack=False, lazyLoad=False, compactAddrs=False):
+      """
+      Set fastUnpack=True to parse the file with FastBinaryUnpacker, which
+      reads fields in-place instead of slicing the file for each one
+
+      Set lazyLoad=True to memory-map the file and only index the address
+      entries:  each PyBtcAddress is unserialized the first time it is looked
+      up (see LazyAddrMap).  The checksum check of the address data is then
+      done by a background thread (self.addrCheckThread) if verifyIntegrity.
+
+      Set compactAddrs=True to keep the addresses that have no private key
+      data (all of them, in a watching-only wallet) as PyBtcAddressCompact.
+      """
       if not os.path.exists(wltpath):
          raise FileExistsError("No wallet file:"+wltpath)
 
+      if isinstance(self.addrMap, LazyAddrMap):
+         self.addrMap.close()
       self.__init__()
       self.walletPath = wltpath
+      self.compactPublicAddrs = compactAddrs
 
       if verifyIntegrity:
          try:
@@ -2079,60 +2422,69 @@ class PyBtcWallet(object):
             raise KeyDataError(errmsg)
 
 
-      wltfile = open(wltpath, 'rb')
-      wltdata = BinaryUnpacker(wltfile.read())
-      wltfile.close()
-
-      self.unpackHeader(wltdata)      
+      if lazyLoad:
+         self.readWalletIndex(wltpath, reportProgress)
+         if verifyIntegrity:
+            self.addrCheckThread = PyBackgroundThread(self.verifyLazyAddrData)
+            self.addrCheckThread.start()
+      else:
+         unpackerClass = FastBinaryUnpacker if fastUnpack else BinaryUnpacker
+         wltfile = open(wltpath, 'rb')
+         wltdata = unpackerClass(wltfile.read())
+         wltfile.close()
 
-      self.lastComputedChainIndex = -UINT32_MAX
-      self.lastComputedChainAddr160  = None
-      i=0
-      while wltdata.getRemainingSize()>0:
-         byteLocation = wltdata.getPosition()
-         i += 1
-         if i%10 == 0 and reportProgress is not None:
-            progress = float(byteLocation) / float(wltdata.getSize())
-            reportProgress(progress)
+         self.unpackHeader(wltdata)      
+
+         self.lastComputedChainIndex = -UINT32_MAX
+         self.lastComputedChainAddr160  = None
+         i=0
+         while wltdata.getRemainingSize()>0:
+            byteLocation = wltdata.getPosition()
+            i += 1
+            if i%10 == 0 and reportProgress is not None:
+               progress = float(byteLocation) / float(wltdata.getSize())
+               reportProgress(progress)
             
-         dtype, hashVal, rawData = self.unpackNextEntry(wltdata)
-         if dtype==WLT_DATATYPE_KEYDATA:
-            newAddr = PyBtcAddress()
-            newAddr.unserialize(rawData)
-            newAddr.walletByteLoc = byteLocation + 21
-            # Fix byte errors in the address data
-            fixedAddrData = newAddr.serialize()
-
-            if not rawData==fixedAddrData:
-               self.walletFileSafeUpdate([ \
-                  [WLT_UPDATE_MODIFY, newAddr.walletByteLoc, fixedAddrData]])
-            if newAddr.useEncryption:
-               newAddr.isLocked = True
-            self.addrMap[hashVal] = newAddr
-            if newAddr.chainIndex > self.lastComputedChainIndex:
-               self.lastComputedChainIndex   = newAddr.chainIndex
-               self.lastComputedChainAddr160 = newAddr.getAddr160()
+            dtype, hashVal, rawData = self.unpackNextEntry(wltdata)
+            if dtype==WLT_DATATYPE_KEYDATA:
+               newAddr = PyBtcAddress()
+               newAddr.unserialize(unpackerClass(rawData))
+               newAddr.walletByteLoc = byteLocation + 21
+               # Fix byte errors in the address data
+               fixedAddrData = newAddr.serialize()
+
+               if not rawData==fixedAddrData:
+                  self.walletFileSafeUpdate([ \
+                     [WLT_UPDATE_MODIFY, newAddr.walletByteLoc, fixedAddrData]])
+               if newAddr.useEncryption:
+                  newAddr.isLocked = True
+               if newAddr.chainIndex > self.lastComputedChainIndex:
+                  self.lastComputedChainIndex   = newAddr.chainIndex
+                  self.lastComputedChainAddr160 = newAddr.getAddr160()
                
-            if newAddr.chainIndex == -2:
-               abc = 1
-            if newAddr.chainIndex < -2:
-               newAddr.chainIndex = -2
-               self.hasNegativeImports = True
+               if newAddr.chainIndex < -2:
+                  newAddr.chainIndex = -2
+                  self.hasNegativeImports = True
                                  
-            self.linearAddr160List.append(newAddr.getAddr160())
-            self.chainIndexMap[newAddr.chainIndex] = newAddr.getAddr160()
+               self.linearAddr160List.append(newAddr.getAddr160())
+               self.chainIndexMap[newAddr.chainIndex] = newAddr.getAddr160()
    
-            # Update the parallel C++ object that scans the blockchain for us
-            timeRng = newAddr.getTimeRange()
-            blkRng  = newAddr.getBlockRange()
+               # Update the parallel C++ object that scans the blockchain for us
+               timeRng = newAddr.getTimeRange()
+               blkRng  = newAddr.getBlockRange()
+
+               self.addrMap[hashVal] = self.compactAddr(newAddr)
                
-         if dtype in (WLT_DATATYPE_ADDRCOMMENT, WLT_DATATYPE_TXCOMMENT):
-            self.commentsMap[hashVal] = rawData # actually ASCII data, here
-            self.commentLocs[hashVal] = byteLocation
-         if dtype==WLT_DATATYPE_OPEVAL:
-            raise NotImplementedError('OP_EVAL not support in wallet yet')
-         if dtype==WLT_DATATYPE_DELETED:
-            pass
+            if dtype in (WLT_DATATYPE_ADDRCOMMENT, WLT_DATATYPE_TXCOMMENT):
+               self.commentsMap[hashVal] = rawData # actually ASCII data, here
+               self.commentLocs[hashVal] = byteLocation
+            if dtype==WLT_DATATYPE_OPEVAL:
+               raise NotImplementedError('OP_EVAL not support in wallet yet')
+            if dtype==WLT_DATATYPE_DELETED:
+               pass
+
+      # Anything cached for a wallet with this ID may be from another copy
+      TheLedgerValueCache.evictWallet(self.uniqueIDB58)
 
       ### Update the wallet version if necessary ###
       if getVersionInt(self.version) < getVersionInt(PYBTCWALLET_VERSION):
@@ -2142,9 +2494,111 @@ class PyBtcWallet(object):
       return self
 
 
+   #############################################################################
+   def readWalletIndex(self, wltpath, reportProgress=None):
+      """
+      The lazyLoad half of readWalletFile:  map the file, read the header and
+      comments, and put every address entry in a LazyAddrMap index
+      """
+      def mapWalletFile():
+         wltfile = open(wltpath, 'rb')
+         try:
+            return mmap.mmap(wltfile.fileno(), 0, access=mmap.ACCESS_READ)
+         finally:
+            wltfile.close()
+
+      fileBuf = mapWalletFile()
+      self.addrMap = LazyAddrMap(fileBuf, self.pybtcaddrSize, \
+                                 self.writeFixedAddrData, self.compactAddr)
+      wltdata = FastBinaryUnpacker(fileBuf)
+      self.unpackHeader(wltdata)
+      if not self.addrMap.fileBuf is fileBuf:
+         # unpackHeader fixed the root address in the file (e.g. for a forked
+         # watching-only wallet), which closed our mapping.  The fix was
+         # written in place, so map the file again and carry on from there
+         headerSize = wltdata.getPosition()
+         fileBuf = mapWalletFile()
+         self.addrMap.attachFile(fileBuf)
+         wltdata = FastBinaryUnpacker(fileBuf)
+         wltdata.advance(headerSize)
+
+      self.lastComputedChainIndex = -UINT32_MAX
+      self.lastComputedChainAddr160  = None
+      entrySize = 21 + self.pybtcaddrSize
+      fileSize  = wltdata.getSize()
+      i=0
+      while wltdata.getRemainingSize()>0:
+         byteLocation = wltdata.getPosition()
+         i += 1
+         if i%1000 == 0 and reportProgress is not None:
+            reportProgress(float(byteLocation) / float(fileSize))
+
+         if not ord(fileBuf[byteLocation])==WLT_DATATYPE_KEYDATA:
+            dtype, hashVal, rawData = self.unpackNextEntry(wltdata)
+            if dtype in (WLT_DATATYPE_ADDRCOMMENT, WLT_DATATYPE_TXCOMMENT):
+               self.commentsMap[hashVal] = rawData # actually ASCII data, here
+               self.commentLocs[hashVal] = byteLocation
+            continue
+
+         if byteLocation + entrySize > fileSize:
+            raise UnpackerError, 'Truncated address entry in wallet file'
+         hashVal = fileBuf[byteLocation+1:byteLocation+21]
+         flags,chainIndex = LazyAddrMap.INDEX_READER.unpack_from(fileBuf, \
+                              byteLocation + 21 + LazyAddrMap.INDEX_OFFSET)
+         wltdata.advance(entrySize)
+
+         if chainIndex < -2:
+            chainIndex = -2
+            self.hasNegativeImports = True
+
+         self.addrMap.addIndexEntry(hashVal, byteLocation+21, chainIndex, flags)
+         if chainIndex > self.lastComputedChainIndex:
+            self.lastComputedChainIndex   = chainIndex
+            self.lastComputedChainAddr160 = hashVal
+
+         self.linearAddr160List.append(hashVal)
+         self.chainIndexMap[chainIndex] = hashVal
+
+
+   #############################################################################
+   def verifyLazyAddrData(self):
+      """
+      What readWalletFile(verifyIntegrity=True) does for each address, for the
+      ones a lazy load hasn't loaded yet:  unserialize it (checking all the
+      checksums) and reserialize it.  Addresses with byte errors are loaded,
+      which writes the corrected data to the file.
+      """
+      addrMap = self.addrMap
+      nFixed = 0
+      for addr160 in addrMap.getPendingList():
+         rawData = addrMap.getPendingData(addr160)
+         if rawData is None:
+            continue
+
+         try:
+            fixedAddrData = PyBtcAddress().unserialize( \
+                                       FastBinaryUnpacker(rawData)).serialize()
+         except UnserializeError:
+            LOGEXCEPT('Bad address data in wallet %s', self.uniqueIDB58)
+            continue
+
+         if not fixedAddrData==rawData:
+            addrMap[addr160]
+            nFixed += 1
+
+      LOGINFO('Checked wallet %s, fixed %d addresses', self.uniqueIDB58, nFixed)
+      return nFixed
+
+
+   #############################################################################
+   def writeFixedAddrData(self, byteLoc, fixedAddrData):
+      self.walletFileSafeUpdate([[WLT_UPDATE_MODIFY, byteLoc, fixedAddrData]])
+
+
 
    #############################################################################
    @singleEntrantMethod
+   @TimeThisFunction
    def walletFileSafeUpdate(self, updateList):
             
       """
@@ -2206,6 +2660,10 @@ class PyBtcWallet(object):
       if len(updateList)==0:
          return []
 
+      # A lazily loaded wallet can't have its file modified under the mapping
+      if isinstance(self.addrMap, LazyAddrMap):
+         self.addrMap.detachFile()
+
       # Make sure that the primary and backup files are synced before update
       self.doWalletFileConsistencyCheck()
 
@@ -2218,7 +2676,8 @@ class PyBtcWallet(object):
       oldWalletSize = os.path.getsize(self.walletPath)
       updateLocations = []
       dataToChange    = []
-      toAppend = BinaryPacker()
+      # FastBinaryPacker.getSize() is O(1), unlike BinaryPacker's
+      toAppend = FastBinaryPacker()
 
       try:
          for entry in updateList:
@@ -2327,6 +2786,7 @@ class PyBtcWallet(object):
 
 
    #############################################################################
+   @TimeThisFunction
    def doWalletFileConsistencyCheck(self, onlySyncBackup=True):
       """
       First we check the file-update flags (files we touched/removed during
@@ -2432,6 +2892,7 @@ class PyBtcWallet(object):
       passCppWallet = self.cppWallet
       if self.isRegistered():
          self.cppWallet.removeAddressBulk([Hash160ToScrAddr(addr160)])
+         self.invalidateUTXOCache()
          
       self.readWalletFile(wltPath)
       self.cppWallet = passCppWallet
@@ -2546,7 +3007,9 @@ class PyBtcWallet(object):
       self.linearAddr160List.append(newAddr160)
       if self.useEncryption and self.kdfKey:
          self.addrMap[newAddr160].lock(self.kdfKey)
-         if not self.isLocked:
+         # After a lazy unlock, keys are only decrypted on use by
+         # unlockAddress, which keeps track of them to lock them again
+         if not self.isLocked and not self.lazyUnlock:
             self.addrMap[newAddr160].unlock(self.kdfKey)
 
       if self.isRegistered() and doReg==True:
@@ -2726,31 +3189,30 @@ class PyBtcWallet(object):
 
       # Unlock the wallet if necessary, sign inputs 
       maxChainIndex = -1
-      for addrObj,idx,sigIdx in wltAddr:
-         maxChainIndex = max(maxChainIndex, addrObj.chainIndex)
-         if addrObj.isLocked:
-            if self.kdfKey:
-               if addrObj.createPrivKeyNextUnlock:
-                  self.unlock(self.kdfKey)
+      try:
+         for addrObj,idx,sigIdx in wltAddr:
+            maxChainIndex = max(maxChainIndex, addrObj.chainIndex)
+            if addrObj.isLocked:
+               if self.kdfKey:
+                  self.unlockAddress(addrObj)
                else:
-                  addrObj.unlock(self.kdfKey)
-            else:
-               self.lock()
-               raise WalletLockError('Cannot sign tx without unlocking wallet')
-
-         if not addrObj.hasPubKey():
-            # Make sure the public key is available for this address
-            addrObj.binPublicKey65 = \
-               CryptoECDSA().ComputePublicKey(addrObj.binPrivKey32_Plain)
+                  raise WalletLockError('Cannot sign tx without unlocking wallet')
 
+            if not addrObj.hasPubKey():
+               # Make sure the public key is available for this address
+               addrObj.binPublicKey65 = \
+                  CryptoECDSA().ComputePublicKey(addrObj.binPrivKey32_Plain)
 
-         ##### MAGIC #####
-         ustx.createAndInsertSignatureForInput(idx, addrObj.binPrivKey32_Plain)
-         ##### MAGIC #####
-                                               
 
-      if self.useEncryption:
-         self.lock()
+            ##### MAGIC #####
+            ustx.createAndInsertSignatureForInput(idx, addrObj.binPrivKey32_Plain)
+            ##### MAGIC #####
+      finally:
+         # After a lazy unlock, the keys we used are relocked by the LRU
+         if self.lazyUnlock:
+            self.relockLazyKeys()
+         elif self.useEncryption:
+            self.lock()
       
       prevHighestIndex = self.highestUsedChainIndex  
       if prevHighestIndex<maxChainIndex:
@@ -2763,13 +3225,16 @@ class PyBtcWallet(object):
    #############################################################################
    def unlock(self, secureKdfOutput=None, \
                     securePassphrase=None, \
-                    tempKeyLifetime=0, Progress=emptyFunc):
+                    tempKeyLifetime=0, Progress=emptyFunc, lazy=False):
       """
       We must assume that the kdfResultKey is a SecureBinaryData object
       containing the result of the KDF-passphrase.  The wallet unlocked-
       lifetime will be set to X seconds from time.time() [now] and next
       time the checkWalletLockTimeout function is called it will be re-
       locked.
+
+      With lazy=True, only the KDF key is checked and kept:  no address is
+      decrypted until it is needed, see unlockAddress().
       """
       
       LOGDEBUG('Attempting to unlock wallet: %s', self.uniqueIDB58)
@@ -2795,6 +3260,13 @@ class PyBtcWallet(object):
       else:
          self.lockWalletAtTime = RightNow() + tempKeyLifetime
 
+      if lazy:
+         self.lazyUnlock = True
+         self.isLocked = False
+         LOGDEBUG('Lazy unlock succeeded: %s', self.uniqueIDB58)
+         return
+      self.lazyUnlock = False
+
       #Fix to n2 unlock issue: newly chained addresses on a locked wallet 
       #cannot have their private key computed until the next unlock.
       #When that unlock takes place, certain address entries lack context
@@ -2815,15 +3287,7 @@ class PyBtcWallet(object):
          
          needToSaveAddrAfterUnlock = addrObj.createPrivKeyNextUnlock
          if needToSaveAddrAfterUnlock and addrObjPrev is not None:
-               ChainDepth = addrObj.chainIndex - addrObjPrev.chainIndex
-
-               if ChainDepth > 0 and addrObjPrev.chainIndex > -1:
-                  addrObj.createPrivKeyNextUnlock_IVandKey[0] = \
-                                             addrObjPrev.binInitVect16.copy()
-                  addrObj.createPrivKeyNextUnlock_IVandKey[1] = \
-                                          addrObjPrev.binPrivKey32_Encr.copy()
-
-                  addrObj.createPrivKeyNextUnlock_ChainDepth  = ChainDepth
+            self.setNextUnlockContext(addrObj, addrObjPrev)
 
          addrObj.unlock(self.kdfKey)
          if addrObj.chainIndex > -1: addrObjPrev = addrObj
@@ -2837,6 +3301,105 @@ class PyBtcWallet(object):
       self.isLocked = False
       LOGDEBUG('Unlock succeeded: %s', self.uniqueIDB58)
 
+   #############################################################################
+   def setNextUnlockContext(self, addrObj, addrObjPrev):
+      """
+      addrObj was chained while the wallet was locked:  have it compute its
+      private key from addrObjPrev, the closest computed address below it
+      """
+      ChainDepth = addrObj.chainIndex - addrObjPrev.chainIndex
+
+      if ChainDepth > 0 and addrObjPrev.chainIndex > -1:
+         addrObj.createPrivKeyNextUnlock_IVandKey[0] = \
+                                    addrObjPrev.binInitVect16.copy()
+         addrObj.createPrivKeyNextUnlock_IVandKey[1] = \
+                                 addrObjPrev.binPrivKey32_Encr.copy()
+
+         addrObj.createPrivKeyNextUnlock_ChainDepth  = ChainDepth
+
+   #############################################################################
+   def unlockAddress(self, addrObj):
+      """
+      Decrypt the private key of a single address with the wallet's kdfKey.
+      After a lazy unlock, the address goes into an LRU of at most
+      lazyKeyCacheSize decrypted keys, and is locked again when it falls out
+      of it or after lazyKeyLifetime seconds (see relockLazyKeys).
+      """
+      addr160 = addrObj.getAddr160()
+      if not self.useEncryption or not addrObj.isLocked:
+         if addr160 in self.lazyUnlockedAddrs:
+            self.lazyUnlockedAddrs.pop(addr160)
+            self.lazyUnlockedAddrs[addr160] = RightNow()
+         return addrObj
+
+      if not self.kdfKey:
+         raise WalletLockError('Cannot decrypt address without unlocking wallet')
+
+      # Addresses chained while the wallet was locked are computed from the
+      # closest computed address below them, like in a full unlock, so we
+      # need the run of such addresses leading up to this one
+      toUnlock = [addrObj]
+      while toUnlock[-1].createPrivKeyNextUnlock:
+         prev160 = self.chainIndexMap.get(toUnlock[-1].chainIndex - 1)
+         if prev160 is None or not self.addrMap.has_key(prev160):
+            break
+         toUnlock.append(self.addrMap[prev160])
+
+      addrObjPrev = None
+      now = RightNow()
+      for nextAddr in reversed(toUnlock):
+         needToSaveAddrAfterUnlock = nextAddr.createPrivKeyNextUnlock
+         if needToSaveAddrAfterUnlock and addrObjPrev is not None:
+            self.setNextUnlockContext(nextAddr, addrObjPrev)
+
+         if nextAddr is addrObj or needToSaveAddrAfterUnlock:
+            nextAddr.unlock(self.kdfKey)
+            if self.lazyUnlock:
+               next160 = nextAddr.getAddr160()
+               self.lazyUnlockedAddrs.pop(next160, None)
+               self.lazyUnlockedAddrs[next160] = now
+
+         if nextAddr.chainIndex > -1: addrObjPrev = nextAddr
+
+         if needToSaveAddrAfterUnlock:
+            self.walletFileSafeUpdate( [[WLT_UPDATE_MODIFY,
+                                         nextAddr.walletByteLoc,
+                                         nextAddr.serialize()]])
+
+      if self.lazyUnlock:
+         self.relockLazyKeys()
+      return addrObj
+
+   #############################################################################
+   def relockChainedAddrs(self, addrList):
+      """
+      After a lazy unlock, extending the chain decrypts each parent address
+      (and the new ones chained from a decrypted parent) behind the LRU's
+      back.  Lock every address in addrList that isn't in lazyUnlockedAddrs.
+      """
+      if not self.lazyUnlock:
+         return
+      for addrObj in addrList:
+         if not addrObj.getAddr160() in self.lazyUnlockedAddrs:
+            addrObj.lock(self.kdfKey)
+      self.relockLazyKeys()
+
+   #############################################################################
+   def relockLazyKeys(self):
+      """
+      Lock the least recently used decrypted keys over lazyKeyCacheSize,
+      and any decrypted more than lazyKeyLifetime seconds ago
+      """
+      expireTime = RightNow() - self.lazyKeyLifetime
+      while len(self.lazyUnlockedAddrs) > 0:
+         addr160,unlockTime = next(self.lazyUnlockedAddrs.iteritems())
+         if len(self.lazyUnlockedAddrs) <= self.lazyKeyCacheSize and \
+                                               unlockTime >= expireTime:
+            break
+         del self.lazyUnlockedAddrs[addr160]
+         if self.addrMap.has_key(addr160):
+            self.addrMap[addr160].lock(self.kdfKey)
+
    ############################################################################
    def lock(self, Progress=emptyFunc):
       """
@@ -2874,8 +3437,11 @@ class PyBtcWallet(object):
          LOGDEBUG('Attempting to lock wallet: %s', self.uniqueIDB58)
          i=1
          nAddr = len(self.addrMap)
+         # Addresses a lazy load hasn't loaded yet are locked already
+         addrItems = self.addrMap.iterloaded() \
+            if isinstance(self.addrMap, LazyAddrMap) else self.addrMap.iteritems()
          try:
-            for addr160,addrObj in self.addrMap.iteritems():
+            for addr160,addrObj in addrItems:
                Progress(i, nAddr)
                i = i +1
                
@@ -2885,6 +3451,8 @@ class PyBtcWallet(object):
                self.kdfKey.destroy()
                self.kdfKey = None
             self.isLocked = True
+            self.lazyUnlock = False
+            self.lazyUnlockedAddrs.clear()
          except WalletLockError:
             LOGERROR('Locking wallet requires encryption key.  This error')
             LOGERROR('Usually occurs on newly-encrypted wallets that have')
@@ -3117,6 +3685,17 @@ class PyBtcWallet(object):
          return self.cppWallet.getHistoryPageAsVector(pageID)
       except:
          raise 'pageID is out of range'  
+
+   ###############################################################################
+   @CheckWalletRegistration
+   def getLedgerCursor(self):
+      """
+      LedgerCursor over this wallet's history, kept as long as the wallet
+      stays registered so page counts and fee lookups carry over
+      """
+      if self.ledgerCursor is None:
+         self.ledgerCursor = LedgerCursor(self.cppWallet)
+      return self.ledgerCursor
       
    ###############################################################################
    @CheckWalletRegistration
@@ -3183,7 +3762,8 @@ def getSuffixedPath(walletPath, nameSuffix):
 
 # Putting this at the end because of the circular dependency
 from armoryengine.BDM import TheBDM, getCurrTimeAndBlock, BDM_BLOCKCHAIN_READY
-from armoryengine.PyBtcAddress import PyBtcAddress
+from armoryengine.PyBtcAddress import PyBtcAddress, PyBtcAddressCompact, \
+   ChainDerivationEngine
 from armoryengine.Transaction import *
 from armoryengine.Script import scriptPushData
 
@@ -139,16 +139,18 @@ class PyScriptProcessor(object):
       scriptIsValid = PyScriptProcessor().executeScript(binScript)
    """
 
-   def __init__(self, txOldData=None, txNew=None, txInIndex=None):
+   def __init__(self, txOldData=None, txNew=None, txInIndex=None,
+                                                      sigHashCache=None):
       self.stack   = []
       self.txNew   = None
       self.script1 = None
       self.script2 = None
+      self.sigHashCache = None
       if txOldData and txNew and not txInIndex==None:
-         self.setTxObjects(txOldData, txNew, txInIndex)
+         self.setTxObjects(txOldData, txNew, txInIndex, sigHashCache)
 
 
-   def setTxObjects(self, txOldData, txNew, txInIndex):
+   def setTxObjects(self, txOldData, txNew, txInIndex, sigHashCache=None):
       """
       The minimal amount of data necessary to evaluate a script that
       has an signature check is the TxOut script that is being spent
@@ -157,8 +159,15 @@ class PyScriptProcessor(object):
       TxIn index (so we know which TxIn is spending that TxOut).
       It is acceptable to pass in the full TxOut or the tx of the
       TxOut instead of just the script itself.
+
+      The SigHashCache snapshots everything OP_CHECKSIG hashes, so we don't
+      need our own copy of txNew.  When verifying several inputs of the same
+      tx, pass the same SigHashCache(txNew) into each call.
       """
-      self.txNew = PyTx().unserialize(txNew.serialize())
+      if sigHashCache is None or not sigHashCache.isCacheFor(txNew):
+         sigHashCache = SigHashCache(txNew)
+      self.sigHashCache = sigHashCache
+      self.txNew = txNew
       self.script1 = str(txNew.inputs[txInIndex].binScript) # copy
       self.txInIndex  = txInIndex
       self.txOutIndex = txNew.inputs[txInIndex].outpoint.txOutIndex
@@ -174,9 +183,10 @@ class PyScriptProcessor(object):
          self.script2 = str(txOldData)
 
    @TimeThisFunction
-   def verifyTransactionValid(self, txOldData=None, txNew=None, txInIndex=-1):
+   def verifyTransactionValid(self, txOldData=None, txNew=None, txInIndex=-1,
+                                                         sigHashCache=None):
       if txOldData and txNew and txInIndex != -1:
-         self.setTxObjects(txOldData, txNew, txInIndex)
+         self.setTxObjects(txOldData, txNew, txInIndex, sigHashCache)
       else:
          txOldData = self.script2
          txNew = self.txNew
@@ -264,23 +274,20 @@ class PyScriptProcessor(object):
          LOGERROR('Non-unity hashtypes not implemented yet! (hashtype = %d)', hashtype)
          assert(False)
 
-      # 5. Make a copy of the transaction -- we will be hashing a modified version
-      txCopy = PyTx().unserialize( txInTx.serialize() )
+      # 5. We hash a modified version of the tx.  Instead of copying it, we
+      #    use the pre-serialized pieces in the SigHashCache
+      sigHashCache = self.sigHashCache
+      if sigHashCache is None or not sigHashCache.isCacheFor(txInTx):
+         sigHashCache = SigHashCache(txInTx)
 
       # 6. Remove all OP_CODESEPARATORs
       subscript.replace( int_to_binary(OP_CODESEPARATOR), '')
 
       # 7. All the TxIn scripts in the copy are blanked (set to empty string)
-      for txin in txCopy.inputs:
-         txin.binScript = ''
-
       # 8. Script for the current input in the copy is set to subscript
-      txCopy.inputs[txInIndex].binScript = subscript
-
       # 9. Prepare the signature and public key
       senderAddr = PyBtcAddress().createFromPublicKey(binPubKey)
-      binHashCode = int_to_binary(hashtype, widthBytes=4)
-      toHash = txCopy.serialize() + binHashCode
+      toHash = sigHashCache.getPreHashMsg(txInIndex, subscript, hashtype)
 
       # Hashes are computed as part of CppBlockUtils::CryptoECDSA methods
       ##hashToVerify = hash256(toHash)
@@ -12,8 +12,97 @@
 # Orig Date:  20 November, 2011
 #
 ################################################################################
-from armoryengine.ArmoryUtils import LOGWARN, RightNow, LOGERROR
-   
+from functools import wraps
+import math
+import threading
+
+from armoryengine.ArmoryUtils import LOGWARN, RightNow, LOGERROR, CLI_OPTIONS
+
+
+# Durations go into power-of-two buckets, starting at 1 microsecond.  The
+# last bucket catches everything above ~9.5 hours.
+PERF_HIST_MIN  = 1e-6
+PERF_HIST_SIZE = 36
+
+# @TimeThisFunction only times calls while this is set (--perfstats, or
+# setPerfStatsEnabled() at runtime).  Explicit startTimer/stopTimer calls
+# are always timed.
+perfStatsEnabled = CLI_OPTIONS.enablePerfStats
+
+def setPerfStatsEnabled(enable=True):
+   global perfStatsEnabled
+   perfStatsEnabled = enable
+
+def isPerfStatsEnabled():
+   return perfStatsEnabled
+
+
+################################################################################
+class TimerStats(object):
+   """
+   Accumulated timings for one timer name.  totalTime includes time spent in
+   nested timers, selfTime does not.  parentTime maps the name of the timer
+   that was running around each call (or '' at the top level) to the total
+   time of those calls.  Recursive calls are counted, but only the outermost
+   one adds to totalTime.
+   """
+   __slots__ = ('nCall', 'totalTime', 'selfTime', 'maxTime', 'hist', \
+                'parentTime')
+
+   def __init__(self):
+      self.nCall      = 0
+      self.totalTime  = 0.0
+      self.selfTime   = 0.0
+      self.maxTime    = 0.0
+      self.hist       = [0]*PERF_HIST_SIZE
+      self.parentTime = {}
+
+   def addCall(self, elapsed, selfTime, parentName, isRecursive):
+      self.nCall    += 1
+      self.selfTime += selfTime
+      if not isRecursive:
+         self.totalTime += elapsed
+      if elapsed > self.maxTime:
+         self.maxTime = elapsed
+      # frexp gives the power-of-two exponent without a log() call
+      bucket = math.frexp(elapsed / PERF_HIST_MIN)[1] if elapsed > 0 else 0
+      self.hist[min(max(bucket, 0), PERF_HIST_SIZE-1)] += 1
+      self.parentTime[parentName] = self.parentTime.get(parentName, 0) + elapsed
+
+   def merge(self, other):
+      self.nCall     += other.nCall
+      self.totalTime += other.totalTime
+      self.selfTime  += other.selfTime
+      self.maxTime    = max(self.maxTime, other.maxTime)
+      self.hist       = [a+b for a,b in zip(self.hist, other.hist)]
+      for name,t in other.parentTime.items():
+         self.parentTime[name] = self.parentTime.get(name, 0) + t
+
+   def getPercentile(self, pct):
+      """ Upper edge of the histogram bucket holding the pct-th percentile """
+      if self.nCall == 0:
+         return 0.0
+      target = self.nCall * pct / 100.
+      count = 0
+      for bucket,n in enumerate(self.hist):
+         count += n
+         if count >= target:
+            return min(PERF_HIST_MIN * 2**bucket, self.maxTime)
+      return self.maxTime
+
+   def toJSONMap(self):
+      return { 'calls':    self.nCall,
+               'total':    self.totalTime,
+               'self':     self.selfTime,
+               'avg':      self.totalTime / self.nCall if self.nCall else 0,
+               'max':      self.maxTime,
+               'p50':      self.getPercentile(50),
+               'p90':      self.getPercentile(90),
+               'p99':      self.getPercentile(99),
+               'parents':  dict(self.parentTime) }
+
+
+################################################################################
 class Timer(object):
    
    ################################################################################
@@ -21,82 +110,164 @@ class Timer(object):
    #  Keep track of lots of different timers:
    #
    #     Key:    timerName  
-   #     Value:  [cumulTime, numStart, lastStart, isRunning]
+   #     Value:  TimerStats
+   #
+   #  Every thread accumulates into its own timerMap, so timing a call takes
+   #  no locks.  The maps of all threads are merged when the stats are read.
+   #  Each thread also keeps a stack of running timers:
+   #
+   #     [timerName, startTime, timeInNestedTimers]
    #
-   timerMap = {}
+   threadData   = threading.local()
+   threadMaps   = []    # [thread, timerMap] for every thread that timed
+   retiredMap   = {}    # merged timerMaps of threads that have exited
+   registryLock = threading.Lock()
+   
+   def getThreadState(self):
+      td = self.threadData
+      if not hasattr(td, 'timerMap'):
+         td.timerMap = {}
+         td.timerStack = []
+         with self.registryLock:
+            self.threadMaps.append([threading.current_thread(), td.timerMap])
+      return td.timerMap, td.timerStack
    
    def startTimer(self, timerName):
-      if not self.timerMap.has_key(timerName):
-         self.timerMap[timerName] = [0, 0, 0, False]
-      timerEntry = self.timerMap[timerName]
-      timerEntry[1] += 1
-      timerEntry[2]  = RightNow()
-      timerEntry[3]  = True
+      timerStack = self.getThreadState()[1]
+      timerStack.append([timerName, RightNow(), 0.0])
    
    def stopTimer(self, timerName):
-      if not self.timerMap.has_key(timerName):
-         LOGWARN('Requested stop timer that does not exist! (%s)' % timerName)
-         return
-      if not self.timerMap[timerName][3]:
-         LOGWARN('Requested stop timer that is not running! (%s)' % timerName)
-         return
-      timerEntry = self.timerMap[timerName]
-      timerEntry[0] += RightNow() - timerEntry[2]
-      timerEntry[2]  = 0
-      timerEntry[3]  = False
+      timerMap,timerStack = self.getThreadState()
+      if not timerStack or timerStack[-1][0] != timerName:
+         # Usually a timer stopped out of order; drop it and whatever was
+         # started inside it
+         names = [entry[0] for entry in timerStack]
+         if not timerName in names:
+            LOGWARN('Requested stop timer that is not running! (%s)' % timerName)
+            return
+         LOGWARN('Timer stopped out of order, dropping nested timers (%s)' % \
+                                                                     timerName)
+         while timerStack[-1][0] != timerName:
+            timerStack.pop()
+   
+      name,startTime,nestedTime = timerStack.pop()
+      elapsed = RightNow() - startTime
+      parentName = ''
+      if timerStack:
+         timerStack[-1][2] += elapsed
+         parentName = timerStack[-1][0]
+   
+      isRecursive = any([entry[0]==timerName for entry in timerStack])
+      if not timerMap.has_key(timerName):
+         timerMap[timerName] = TimerStats()
+      timerMap[timerName].addCall(elapsed, elapsed - nestedTime, parentName, \
+                                                                  isRecursive)
    
    def resetTimer(self, timerName):
-      if not self.timerMap.has_key(timerName):
+      with self.registryLock:
+         maps = [m for thr,m in self.threadMaps] + [self.retiredMap]
+      if not any([m.has_key(timerName) for m in maps]):
          LOGERROR('Requested reset timer that does not exist! (%s)' % timerName)
+      for m in maps:
+         m.pop(timerName, None)
       # Even if it didn't exist, it will be created now
-      self.timerMap[timerName] = [0, 0, 0, False]
+      self.getThreadState()[0][timerName] = TimerStats()
+   
+   def resetAllTimers(self):
+      with self.registryLock:
+         for thr,m in self.threadMaps:
+            m.clear()
+         self.retiredMap.clear()
    
    def readTimer(self, timerName):
-      if not self.timerMap.has_key(timerName):
+      stats = self.getTimerStats().get(timerName)
+      if stats is None:
          LOGERROR('Requested read timer that does not exist! (%s)' % timerName)
          return
-      timerEntry = self.timerMap[timerName]
-      return timerEntry[0] + (RightNow() - timerEntry[2])
+      # Include the running time if it is running in this thread
+      running = 0
+      for name,startTime,nestedTime in self.getThreadState()[1]:
+         if name == timerName:
+            running = RightNow() - startTime
+            break
+      return stats.totalTime + running
+   
+   def getTimerStats(self):
+      """ Returns {timerName: TimerStats} merged across all threads """
+      with self.registryLock:
+         # Fold the maps of finished threads into retiredMap for good
+         for thrMap in self.threadMaps[:]:
+            if not thrMap[0].is_alive():
+               self.mergeTimerMap(self.retiredMap, thrMap[1])
+               self.threadMaps.remove(thrMap)
+         merged = {}
+         self.mergeTimerMap(merged, self.retiredMap)
+         for thr,m in self.threadMaps:
+            self.mergeTimerMap(merged, m)
+      return merged
+   
+   def mergeTimerMap(self, dst, src):
+      for tname,stats in src.items():
+         if not dst.has_key(tname):
+            dst[tname] = TimerStats()
+         dst[tname].merge(stats)
+   
+   def getPerfStats(self):
+      """ getTimerStats(), as plain maps for JSON output """
+      return dict([(tname, stats.toJSONMap()) \
+                   for tname,stats in self.getTimerStats().iteritems()])
+   
+   def getTimingsTable(self):
+      lines = []
+      lines.append('Timings:  '.ljust(30) + \
+                   ''.join([h.rjust(13) for h in ['nCall', 'cumulTime', \
+                      'selfTime', 'avgTime', 'p50', 'p99', 'maxTime']]))
+      lines.append('-'*121)
+      timerStats = self.getTimerStats()
+      for tname in sorted(timerStats, key=lambda n: -timerStats[n].totalTime):
+         stats = timerStats[tname]
+         jsonMap = stats.toJSONMap()
+         lines.append(('%s' % tname).ljust(30) + ('%d' % stats.nCall).rjust(13) + \
+            ''.join([('%0.6f' % jsonMap[k]).rjust(13) for k in \
+                     ['total', 'self', 'avg', 'p50', 'p99', 'max']]))
+      lines.append('-'*121)
+      return '\n'.join(lines)
    
    def printTimings(self):
-      print 'Timings:  '.ljust(30), 
-      print 'nCall'.rjust(13),
-      print 'cumulTime'.rjust(13),
-      print 'avgTime'.rjust(13)
-      print '-'*70
-      for tname,quad in self.timerMap.iteritems():
-         print ('%s' % tname).ljust(30), 
-         print ('%d' % quad[1]).rjust(13),
-         print ('%0.6f' % quad[0]).rjust(13),
-         avg = quad[0]/quad[1]
-         print ('%0.6f' % avg).rjust(13)
-      print '-'*70
+      print self.getTimingsTable()
    
    def saveTimingsCSV(self, fname):
       f = open(fname, 'w')
       f.write( 'TimerName,')
       f.write( 'nCall,')
       f.write( 'cumulTime,')
-      f.write( 'avgTime\n\n')
-      for tname,quad in self.timerMap.iteritems():
+      f.write( 'selfTime,')
+      f.write( 'avgTime,')
+      f.write( 'p50,p90,p99,')
+      f.write( 'maxTime\n\n')
+      for tname,stats in self.getTimerStats().iteritems():
+         jsonMap = stats.toJSONMap()
          f.write('%s,' % tname)
-         f.write('%d,' % quad[1])
-         f.write('%0.6f,' % quad[0])
-         avg = quad[0]/quad[1]
-         f.write('%0.6f\n' % avg)
-      f.write('\n\nNote: timings may be incorrect if errors '
-                         'were triggered in the timed functions')
+         f.write('%d,' % stats.nCall)
+         f.write(','.join(['%0.6f' % jsonMap[k] for k in \
+                  ['total', 'self', 'avg', 'p50', 'p90', 'p99', 'max']]))
+         f.write('\n')
+      f.close()
       print 'Saved timings to file: %s' % fname
-
+   
    def __init__(selfparams):  # @NoSelf
       pass
    
 
 def TimeThisFunction(func):
    timer = Timer()
+   @wraps(func)
    def inner(*args, **kwargs):
+      if not perfStatsEnabled:
+         return func(*args, **kwargs)
       timer.startTimer(func.__name__)
-      ret = func(*args, **kwargs)
-      timer.stopTimer(func.__name__)
-      return ret
+      try:
+         return func(*args, **kwargs)
+      finally:
+         timer.stopTimer(func.__name__)
    return inner
@@ -6,7 +6,9 @@
 #                                                                              #
 ################################################################################
 import logging
+import multiprocessing
 import os
+from collections import OrderedDict
 
 import CppBlockUtils as Cpp
 from armoryengine.ArmoryUtils import *
@@ -492,7 +494,7 @@ class PyOutPoint(BlockComponent):
       return self
 
    def serialize(self):
-      binOut = BinaryPacker()
+      binOut = FastBinaryPacker(36)
       binOut.put(BINARY_CHUNK, self.txHash)
       binOut.put(UINT32, self.txOutIndex)
       return binOut.getBinaryString()
@@ -531,7 +533,7 @@ class PyTxIn(BlockComponent):
       return self.binScript
    
    def serialize(self):
-      binOut = BinaryPacker()
+      binOut = FastBinaryPacker(len(self.binScript) + 49)
       binOut.put(BINARY_CHUNK, self.outpoint.serialize() )
       binOut.put(VAR_INT, len(self.binScript))
       binOut.put(BINARY_CHUNK, self.binScript)
@@ -595,7 +597,7 @@ class PyTxOut(BlockComponent):
       return self.binScript
 
    def serialize(self):
-      binOut = BinaryPacker()
+      binOut = FastBinaryPacker(len(self.binScript) + 17)
       binOut.put(UINT64, self.value)
       binOut.put(VAR_INT, len(self.binScript))
       binOut.put(BINARY_CHUNK, self.binScript)
@@ -657,7 +659,7 @@ class PyTx(BlockComponent):
       self.thisHash   = UNINITIALIZED
 
    def serialize(self):
-      binOut = BinaryPacker()
+      binOut = FastBinaryPacker()
       binOut.put(UINT32, self.version)
       binOut.put(VAR_INT, len(self.inputs))
       for txin in self.inputs:
@@ -687,7 +689,11 @@ class PyTx(BlockComponent):
       self.lockTime   = txData.get(UINT32)
       endPos = txData.getPosition()
       self.nBytes = endPos - startPos
-      self.thisHash = hash256(self.serialize())
+      if isinstance(txData, FastBinaryUnpacker):
+         # Hash the bytes we just read instead of re-serializing
+         self.thisHash = hash256(txData.getSubString(startPos, endPos))
+      else:
+         self.thisHash = hash256(self.serialize())
       return self
 
    def getHash(self):
@@ -784,6 +790,28 @@ class PyTx(BlockComponent):
 
 
 
+################################################################################
+def skipTx(txData):
+   """
+   Advance a BinaryUnpacker past one serialized transaction without
+   building any PyTxIn/PyTxOut objects.  Returns the number of bytes skipped,
+   so the caller can slice out the raw tx if it needs to.
+   """
+   startPos = txData.getPosition()
+   txData.advance(4)
+   for i in xrange(txData.get(VAR_INT)):
+      txData.advance(36)
+      txData.advance(txData.get(VAR_INT) + 4)
+   for i in xrange(txData.get(VAR_INT)):
+      txData.advance(8)
+      txData.advance(txData.get(VAR_INT))
+   txData.advance(4)
+
+   if txData.getRemainingSize() < 0:
+      raise UnpackerError, 'Ran out of data while skipping tx'
+   return txData.getPosition() - startPos
+
+
 
 # Use to identify status of individual sigs on an UnsignedTxINPUT
 TXIN_SIGSTAT = enum('ALREADY_SIGNED',
@@ -810,6 +838,7 @@ class InputSigningStatus(object):
       self.wltCanSign     = False
       self.wltIsRelevant  = False
       self.wltCanComplete = False
+      self.invalidSigs    = []
 
 
    def pprint(self, indent=3, lutFunc=None):
@@ -854,7 +883,90 @@ class TxSigningStatus(object):
 
 
 ################################################################################
-def generatePreHashTxMsgToSign(pytx, txInIndex, prevTxOutScript, hashcode=1):
+class SigHashCache(object):
+   """
+   Every SIGHASH_ALL preimage of a tx is the same serialization with all
+   TxIn scripts blanked except the one being signed.  This class serializes
+   the tx once, keeps the shared pieces (version, blanked inputs, outputs,
+   locktime), and builds each input's preimage by splicing in one script.
+   Checking every signature on a tx is then linear in the tx size per
+   signature, instead of a full PyTx copy + reserialize each time.
+
+   The pieces are snapshots of the PyTx.  isCacheFor() compares the fields
+   they come from, so a cache is not used any more once the PyTx is modified
+   in place (e.g. an output or the locktime changed).
+   """
+   def __init__(self, pytx):
+      self.pytx = pytx
+      self.txFields = self.getTxFields(pytx)
+
+      packer = FastBinaryPacker()
+      packer.put(UINT32,  pytx.version)
+      packer.put(VAR_INT, len(pytx.inputs))
+      self.txHead = packer.getBinaryString()
+
+      self.outpoints = [txin.outpoint.serialize() for txin in pytx.inputs]
+      self.seqs = [pack('<I', txin.intSeq) for txin in pytx.inputs]
+
+      # All inputs with empty scripts, and where each one starts
+      self.inputOffsets = [0]
+      blanked = []
+      for op,seq in zip(self.outpoints, self.seqs):
+         blanked.append(op + '\x00' + seq)
+         self.inputOffsets.append(self.inputOffsets[-1] + len(blanked[-1]))
+      self.blankedInputs = ''.join(blanked)
+
+      packer = FastBinaryPacker()
+      packer.put(VAR_INT, len(pytx.outputs))
+      for txout in pytx.outputs:
+         packer.put(BINARY_CHUNK, txout.serialize())
+      packer.put(UINT32, pytx.lockTime)
+      self.txTail = packer.getBinaryString()
+
+      self.inputIndexMap = dict([(op,i) for i,op in enumerate(self.outpoints)])
+
+
+   @staticmethod
+   def getTxFields(pytx):
+      # Everything a SIGHASH_ALL preimage covers besides the signed script.
+      # Comparing these is much cheaper than serializing the tx again.
+      return ( pytx.version,
+               pytx.lockTime,
+               [(txin.outpoint.txHash, txin.outpoint.txOutIndex, txin.intSeq) \
+                                                   for txin in pytx.inputs],
+               [(txout.value, txout.binScript) for txout in pytx.outputs] )
+
+
+   def isCacheFor(self, pytx):
+      return self.pytx is pytx and self.getTxFields(pytx) == self.txFields
+
+
+   def getInputIndex(self, outpointBin):
+      """ Returns -1 if the serialized outpoint is not spent by this tx """
+      return self.inputIndexMap.get(outpointBin, -1)
+
+
+   def getPreHashMsg(self, txInIndex, prevTxOutScript, hashcode=1):
+      if not hashcode == 1:
+         raise SignatureError('SigHashCache only supports SIGHASH_ALL')
+
+      startPos = self.inputOffsets[txInIndex]
+      endPos   = self.inputOffsets[txInIndex+1]
+      return ''.join([ self.txHead,
+                       self.blankedInputs[:startPos],
+                       self.outpoints[txInIndex],
+                       packVarInt(len(prevTxOutScript))[0],
+                       prevTxOutScript,
+                       self.seqs[txInIndex],
+                       self.blankedInputs[endPos:],
+                       self.txTail,
+                       pack('<I', hashcode) ])
+
+
+
+################################################################################
+def generatePreHashTxMsgToSign(pytx, txInIndex, prevTxOutScript, hashcode=1,
+                                                           sigHashCache=None):
    """
    This wraps up all the complexity of:
    https://en.bitcoin.it/w/images/en/7/70/Bitcoin_OpCheckSig_InDetail.png
@@ -862,6 +974,9 @@ def generatePreHashTxMsgToSign(pytx, txInIndex, prevTxOutScript, hashcode=1):
    (blank all scripts except this one, insert prev script, append hashcode)
 
    Right now only supports SIGHASH_ALL
+
+   Pass in a SigHashCache for pytx when producing preimages for more than
+   one input or signature of the same tx
    """
    if not hashcode == 1:
       # NO OTHER HASHCODES HAVE BEEN TESTED
@@ -869,6 +984,11 @@ def generatePreHashTxMsgToSign(pytx, txInIndex, prevTxOutScript, hashcode=1):
       LOGERROR('Requested hashcode=%d' % hashcode)
       return None
 
+   if sigHashCache is not None and sigHashCache.isCacheFor(pytx):
+      preHashMsg = sigHashCache.getPreHashMsg(txInIndex, prevTxOutScript,
+                                                                    hashcode)
+      return preHashMsg, int_to_binary(hashcode, widthBytes=1)
+
    # Create a copy of the tx with all scripts blanked out
    txCopy = pytx.copy()
    for i in range(len(txCopy.inputs)):
@@ -894,6 +1014,95 @@ def generatePreHashTxMsgToSign(pytx, txInIndex, prevTxOutScript, hashcode=1):
 
 
 
+################################################################################
+def verifySigCheck(sigCheck):
+   """
+   sigCheck is a (preHashMsg, rsSig, pubKey) tuple of plain strings, so it
+   can be shipped to worker processes.  None means the signature could not
+   even be parsed, which is never valid.
+   """
+   if sigCheck is None:
+      return False
+   msg, rsSig, pubKey = sigCheck
+   return CryptoECDSA().VerifyData(SecureBinaryData(msg),
+                                   SecureBinaryData(rsSig),
+                                   SecureBinaryData(pubKey))
+
+
+################################################################################
+class SigVerifyEngine(object):
+   """
+   Spreads signature checks over a pool of workers.  CppBlockUtils is built
+   with "swig -threads", so VerifyData releases the GIL and a thread pool
+   is enough in most cases.  Set useProcesses=True to use a process pool
+   instead.
+
+   Results always come back in the order of the checks, and a stop function
+   sees them in that order too, so short-circuiting is deterministic:  we
+   stop at the same check no matter how the workers were scheduled.
+   """
+   def __init__(self, numWorkers=None, useProcesses=False, chunkSize=8):
+      if numWorkers is None:
+         numWorkers = multiprocessing.cpu_count()
+      self.numWorkers   = max(int(numWorkers), 1)
+      self.useProcesses = useProcesses
+      self.chunkSize    = max(int(chunkSize), 1)
+      self.pool         = None
+
+
+   #############################################################################
+   def getPool(self):
+      if self.pool is None:
+         if self.useProcesses:
+            self.pool = multiprocessing.Pool(self.numWorkers)
+         else:
+            from multiprocessing.pool import ThreadPool
+            self.pool = ThreadPool(self.numWorkers)
+      return self.pool
+
+
+   #############################################################################
+   def shutdown(self):
+      if self.pool is not None:
+         self.pool.close()
+         self.pool.join()
+         self.pool = None
+
+
+   #############################################################################
+   def verifyBatch(self, sigCheckList, stopOnFirstFail=False, stopFunc=None):
+      """
+      Returns a list of True/False, one per check.  If stopOnFirstFail is
+      set, or stopFunc(index, isValid) returns True, the remaining entries
+      are left as None.
+      """
+      if stopFunc is None and stopOnFirstFail:
+         stopFunc = lambda idx,isValid: not isValid
+
+      results = [None]*len(sigCheckList)
+
+      # Hand out one chunk per worker at a time, so a short-circuit doesn't
+      # leave the whole remaining batch queued in the pool
+      if self.numWorkers == 1 or len(sigCheckList) <= 1:
+         batchSize = 1
+         mapFunc = lambda checks: [verifySigCheck(c) for c in checks]
+      else:
+         batchSize = self.numWorkers * self.chunkSize
+         pool = self.getPool()
+         mapFunc = lambda checks: pool.map(verifySigCheck, checks,
+                                                         self.chunkSize)
+
+      for start in range(0, len(sigCheckList), batchSize):
+         batch = sigCheckList[start:start+batchSize]
+         for i,isValid in enumerate(mapFunc(batch)):
+            results[start+i] = bool(isValid)
+            if stopFunc and stopFunc(start+i, results[start+i]):
+               return results
+
+      return results
+
+
+
 ################################################################################
 class UnsignedTxInput(AsciiSerializable):
    """
@@ -1192,7 +1401,7 @@ class UnsignedTxInput(AsciiSerializable):
 
    #############################################################################
    def createTxSignature(self, pytx, sbdPrivKey, hashcode=1,
-                         DetSign=ENABLE_DETSIGN):
+                         DetSign=ENABLE_DETSIGN, sigHashCache=None):
       """
       This might be a little confusing ... remember this is an input for a
       transaction which may not have been fully defined at the time this
@@ -1208,16 +1417,12 @@ class UnsignedTxInput(AsciiSerializable):
       if not computedPub in self.pubKeys:
          raise SignatureError('No PubKey that matches this privKey')
 
-      txiIdx = -1
-      for i,txin in enumerate(pytx.inputs):
-         if self.outpoint.serialize()==txin.outpoint.serialize():
-            txiIdx = i
-            break
-      else:
+      txiIdx = self.getTxInIndex(pytx, sigHashCache)
+      if txiIdx < 0:
          raise SignatureError('No TxIn in tx that matches this USTXI')
 
       msg,hc = generatePreHashTxMsgToSign(pytx, txiIdx, 
-                                    self.getTxoScriptToSign(), hashcode)
+                        self.getTxoScriptToSign(), hashcode, sigHashCache)
       sbdSig = CryptoECDSA().SignData(SecureBinaryData(msg), sbdPrivKey, DetSign)
       binSig = sbdSig.toBinStr()
       return createDERSigFromRS(binSig[:32], binSig[32:]) + hc
@@ -1245,19 +1450,35 @@ class UnsignedTxInput(AsciiSerializable):
 
 
    #############################################################################
-   def createAndInsertSignature(self, pytx, sbdPrivKey, hashcode=1, DetSign=ENABLE_DETSIGN):
-      derSig = self.createTxSignature(pytx, sbdPrivKey, hashcode, DetSign)
+   def createAndInsertSignature(self, pytx, sbdPrivKey, hashcode=1,
+                                DetSign=ENABLE_DETSIGN, sigHashCache=None):
+      derSig = self.createTxSignature(pytx, sbdPrivKey, hashcode, DetSign,
+                                                                sigHashCache)
       computedPub = CryptoECDSA().ComputePublicKey(sbdPrivKey).toBinStr()
 
       msIdx = self.insertSignature(derSig, computedPub)
       return derSig, msIdx
 
    #############################################################################
-   def verifyTxSignature(self, pytx, sigStr, pubKey=None):
-      return (self.getValidIndexForSignature(pytx, sigStr, pubKey) >= 0)
+   def verifyTxSignature(self, pytx, sigStr, pubKey=None, sigHashCache=None):
+      return (self.getValidIndexForSignature(pytx, sigStr, pubKey,
+                                                         sigHashCache) >= 0)
+
+   #############################################################################
+   def getTxInIndex(self, pytx, sigHashCache=None):
+      """ Index of the TxIn in pytx that spends this USTXI, or -1 """
+      opBin = self.outpoint.serialize()
+      if sigHashCache is not None and sigHashCache.isCacheFor(pytx):
+         return sigHashCache.getInputIndex(opBin)
+
+      for i,txin in enumerate(pytx.inputs):
+         if opBin==txin.outpoint.serialize():
+            return i
+      return -1
 
    #############################################################################
-   def getValidIndexForSignature(self, pytx, sigStr, pubKey=None):
+   def getValidIndexForSignature(self, pytx, sigStr, pubKey=None,
+                                                         sigHashCache=None):
       """
       IMPORTANT:  This returns the index in the self.pubKeys list, for which
                   the signature is valid!  -1 is returned if the signature is
@@ -1265,12 +1486,8 @@ class UnsignedTxInput(AsciiSerializable):
 
                      isValid = (verifyTxSignature(...) >= 0)
       """
-      txiIdx = -1
-      for i,txin in enumerate(pytx.inputs):
-         if self.outpoint.serialize()==txin.outpoint.serialize():
-            txiIdx = i
-            break
-      else:
+      txiIdx = self.getTxInIndex(pytx, sigHashCache)
+      if txiIdx < 0:
          raise SignatureError('No TxIn that matches this USTXI')
 
 
@@ -1280,8 +1497,10 @@ class UnsignedTxInput(AsciiSerializable):
       # always be available with the supportingTx, all as part of the
       # USTXI class
       if pubKey is None:
+         if sigHashCache is None:
+            sigHashCache = SigHashCache(pytx)
          for i,pubk in enumerate(self.pubKeys):
-            if self.verifyTxSignature(pytx, sigStr, pubk):
+            if self.verifyTxSignature(pytx, sigStr, pubk, sigHashCache):
                return i
          return -1
 
@@ -1301,7 +1520,7 @@ class UnsignedTxInput(AsciiSerializable):
 
       # Don't forget "sigStr" has the 1-byte hashcode at the end
       msg = generatePreHashTxMsgToSign(pytx, txiIdx,
-            self.getTxoScriptToSign(), hashcode)[0]
+            self.getTxoScriptToSign(), hashcode, sigHashCache)[0]
       sbdMsg = SecureBinaryData(msg)
       sbdSig = SecureBinaryData(rBin + sBin)
       sbdPub = SecureBinaryData(pubKey)
@@ -1315,7 +1534,46 @@ class UnsignedTxInput(AsciiSerializable):
       return self.p2shScript if self.p2shScript else self.txoScript
       
    #############################################################################
-   def verifyAllSignatures(self, pytx):
+   def getSigChecks(self, pytx, sigHashCache=None):
+      """
+      Returns [slotIndex, sigCheck] for every pubkey slot that holds a
+      signature, where sigCheck is the tuple that verifySigCheck expects
+      (or None if the signature can't be checked at all)
+      """
+      txiIdx = self.getTxInIndex(pytx, sigHashCache)
+      if txiIdx < 0:
+         raise SignatureError('No TxIn that matches this USTXI')
+
+      if sigHashCache is None:
+         sigHashCache = SigHashCache(pytx)
+
+      sigChecks = []
+      for i,sigStr in enumerate(self.signatures):
+         if len(sigStr) == 0:
+            continue
+
+         if not binary_to_int(sigStr[-1])==1:
+            LOGERROR('Cannot allow non-standard SIGHASH types: %d' % \
+                                                    binary_to_int(sigStr[-1]))
+            sigChecks.append([i, None])
+            continue
+
+         try:
+            rBin, sBin = getRSFromDERSig(sigStr)
+         except Exception:
+            LOGERROR('Could not parse signature in USTXI')
+            sigChecks.append([i, None])
+            continue
+
+         msg = generatePreHashTxMsgToSign(pytx, txiIdx,
+                           self.getTxoScriptToSign(), 1, sigHashCache)[0]
+         sigChecks.append([i, (msg, rBin+sBin, self.pubKeys[i])])
+
+      return sigChecks
+
+
+   #############################################################################
+   def verifyAllSignatures(self, pytx, sigHashCache=None, verifyEngine=None):
       M = self.sigsNeeded
       N = self.keysListed
       signStat = self.evaluateSigningStatus()
@@ -1324,6 +1582,13 @@ class UnsignedTxInput(AsciiSerializable):
       if not signStat.allSigned:
          return False
 
+      if verifyEngine is not None:
+         sigChecks = self.getSigChecks(pytx, sigHashCache)
+         results = verifyEngine.verifyBatch([c for i,c in sigChecks])
+         if not all(results):
+            LOGERROR('Signature in USTXI is not valid')
+         return (sum(results) >= M)
+
       # Now check that all the raw signatures are actually value
       numValid = 0  # we'll double check sufficient sigs
       for i in range(signStat.N):
@@ -1331,7 +1596,7 @@ class UnsignedTxInput(AsciiSerializable):
                                     TXIN_SIGSTAT.WLT_ALREADY_SIGNED]:
             pub = self.pubKeys[i]
             sig = self.signatures[i]
-            if self.verifyTxSignature(pytx, sig, pub):
+            if self.verifyTxSignature(pytx, sig, pub, sigHashCache):
                numValid +=1
             else:
                LOGERROR('Signature in USTXI is not valid')
@@ -1507,7 +1772,13 @@ class UnsignedTxInput(AsciiSerializable):
       return self
 
    #############################################################################
-   def evaluateSigningStatus(self, cppWlt=None):
+   def evaluateSigningStatus(self, cppWlt=None, sigValidity=None):
+      """
+      By default a signature counts as soon as it's present.  Pass in
+      sigValidity, a map of {slotIndex: isValid} (see getSigChecks), to
+      treat signatures that failed verification as missing.  Those slots
+      are listed in signStatus.invalidSigs
+      """
 
       signStatus = InputSigningStatus()
 
@@ -1522,12 +1793,18 @@ class UnsignedTxInput(AsciiSerializable):
       signStatus.wltIsRelevant = False
       signStatus.wltCanSign    = False
       for i in range(signStatus.N):
-         if len(self.signatures[i]) > 0:
+         hasSig = len(self.signatures[i]) > 0
+         if hasSig and sigValidity is not None and \
+                                          not sigValidity.get(i, False):
+            signStatus.invalidSigs.append(i)
+            hasSig = False
+
+         if hasSig:
             signStatus.statusN[i] = TXIN_SIGSTAT.ALREADY_SIGNED
 
          if cppWlt and cppWlt.hasScrAddress(self.scrAddrs[i]):
             signStatus.wltIsRelevant = True
-            if len(self.signatures[i]) > 0:
+            if hasSig:
                signStatus.statusN[i] = TXIN_SIGSTAT.WLT_ALREADY_SIGNED
             else:
                signStatus.wltCanSign    = True
@@ -2325,11 +2602,23 @@ class UnsignedTransaction(AsciiSerializable):
 
 
    #############################################################################
-   def evaluateSigningStatus(self, cppWlt=None):
+   def evaluateSigningStatus(self, cppWlt=None, verifyEngine=None):
+      """
+      With a SigVerifyEngine, every signature present is also verified
+      against this tx, and invalid ones are treated as missing
+      """
+      sigValidity = [None]*len(self.ustxInputs)
+      if verifyEngine is not None:
+         owners, sigChecks = self.getAllSigChecks()
+         results = verifyEngine.verifyBatch(sigChecks)
+         sigValidity = [{} for ustxi in self.ustxInputs]
+         for (inIdx,slotIdx),isValid in zip(owners, results):
+            sigValidity[inIdx][slotIdx] = isValid
+
       txSigStat = TxSigningStatus()
       txSigStat.numInputs = len(self.ustxInputs)
-      txSigStat.statusList = [ustxi.evaluateSigningStatus(cppWlt) \
-                                       for ustxi in self.ustxInputs]
+      txSigStat.statusList = [ustxi.evaluateSigningStatus(cppWlt, sigValid) \
+                     for ustxi,sigValid in zip(self.ustxInputs, sigValidity)]
 
       txSigStat.canBroadcast   = True
       txSigStat.wltCanSign     = False
@@ -2370,9 +2659,76 @@ class UnsignedTransaction(AsciiSerializable):
 
 
    #############################################################################
-   def verifySigsAllInputs(self):
+   def getSigHashCache(self):
+      """
+      All signature creation and verification on this USTX shares one
+      SigHashCache, rebuilt if pytxObj is replaced or modified
+      """
+      cache = getattr(self, 'sigHashCache', None)
+      if cache is None or not cache.isCacheFor(self.pytxObj):
+         cache = SigHashCache(self.pytxObj)
+         self.sigHashCache = cache
+      return cache
+
+   #############################################################################
+   def getAllSigChecks(self):
+      """
+      Flattens the signature checks of every input into one list, for a
+      SigVerifyEngine.  Returns ([(inputIndex, slotIndex), ...], sigChecks)
+      """
+      sigHashCache = self.getSigHashCache()
+      owners, sigChecks = [], []
+      for inIdx,ustxi in enumerate(self.ustxInputs):
+         for slotIdx,sigCheck in ustxi.getSigChecks(self.pytxObj, sigHashCache):
+            owners.append((inIdx, slotIdx))
+            sigChecks.append(sigCheck)
+      return owners, sigChecks
+
+   #############################################################################
+   def verifySigsAllInputs(self, verifyEngine=None, stopOnFirstFail=False):
+      """
+      Pass in a SigVerifyEngine to check all (input, sig, pubkey) triples
+      in parallel.  With stopOnFirstFail, verification stops as soon as one
+      input can no longer have M valid signatures.
+      """
+      sigHashCache = self.getSigHashCache()
+      if verifyEngine is None:
+         for ustxi in self.ustxInputs:
+            if not ustxi.verifyAllSignatures(self.pytxObj, sigHashCache):
+               return False
+         return True
+
+      # Not enough raw signatures is a failure before any ECDSA is done
       for ustxi in self.ustxInputs:
-         if not ustxi.verifyAllSignatures(self.pytxObj):
+         if not ustxi.evaluateSigningStatus().allSigned:
+            return False
+
+      owners, sigChecks = self.getAllSigChecks()
+
+      # An M-of-N input can absorb (#sigs - M) bad signatures
+      spareSigs = [-ustxi.sigsNeeded for ustxi in self.ustxInputs]
+      for inIdx,slotIdx in owners:
+         spareSigs[inIdx] += 1
+
+      def inputFailed(idx, isValid):
+         if isValid:
+            return False
+         inIdx = owners[idx][0]
+         spareSigs[inIdx] -= 1
+         return spareSigs[inIdx] < 0
+
+      stopFunc = inputFailed if stopOnFirstFail else None
+      results = verifyEngine.verifyBatch(sigChecks, stopFunc=stopFunc)
+
+      numValid = [0]*len(self.ustxInputs)
+      for (inIdx,slotIdx),isValid in zip(owners, results):
+         if isValid:
+            numValid[inIdx] += 1
+         elif isValid is not None:
+            LOGERROR('Signature in USTXI %d is not valid' % inIdx)
+
+      for ustxi,nValid in zip(self.ustxInputs, numValid):
+         if nValid < ustxi.sigsNeeded:
             return False
 
       return True
@@ -2448,7 +2804,8 @@ class UnsignedTransaction(AsciiSerializable):
          raise SignatureError('TxIn index is out of range for this USTX')
 
       ustxi = self.ustxInputs[txInIndex]
-      return ustxi.verifyTxSignature(self.pytxObj, sigStr, pubKey)
+      return ustxi.verifyTxSignature(self.pytxObj, sigStr, pubKey,
+                                                      self.getSigHashCache())
 
 
    #############################################################################
@@ -2458,13 +2815,15 @@ class UnsignedTransaction(AsciiSerializable):
          raise SignatureError('TxIn index is out of range for this USTX')
 
       ustxi = self.ustxInputs[txInIndex]
-      ustxi.createAndInsertSignature(self.pytxObj, sbdPrivKey, hashcode, DetSign)
+      ustxi.createAndInsertSignature(self.pytxObj, sbdPrivKey, hashcode, DetSign,
+                                                      self.getSigHashCache())
 
 
    #############################################################################
    def insertSignatureForInput(self, txInIndex, sigStr, pubKey=None):
       ustxi = self.ustxInputs[txInIndex]
-      sigIndex = ustxi.getValidIndexForSignature(self.pytxObj, sigStr, pubKey)
+      sigIndex = ustxi.getValidIndexForSignature(self.pytxObj, sigStr, pubKey,
+                                                      self.getSigHashCache())
       if sigIndex >= 0:
          ustxi.setSignature(sigIndex, sigStr)
          return sigIndex
@@ -2757,6 +3116,91 @@ def PyCreateAndSignTx_old(srcTxOuts, dstAddrsVals):
    return newTx
 
 
+################################################################################
+class LedgerValueCache(object):
+   """
+   Bounded LRU cache for values the ledger displays for each tx:  fees,
+   sent-to-self amounts and comments.  Keys are (txHash, wltID, kind), with
+   wltID None for values that don't depend on the wallet (fees).  Shared by
+   the GUI and armoryd through TheLedgerValueCache, and safe to use from
+   any thread.
+
+   Everything is dropped when TheBDM's reorg epoch moves.  Callers must
+   evict values that can change otherwise (comments, see evictWallet).
+   """
+   def __init__(self, maxEntries=50000):
+      self.maxEntries = maxEntries
+      self.lock       = threading.Lock()
+      self.entries    = OrderedDict()
+      self.reorgEpoch = None
+      self.resetStats()
+
+   #############################################################################
+   def resetStats(self):
+      self.hits      = 0
+      self.misses    = 0
+      self.evictions = 0
+
+   #############################################################################
+   def checkReorg(self):
+      # Called with the lock held
+      reorgEpoch = TheBDM.getReorgEpoch()
+      if not reorgEpoch == self.reorgEpoch:
+         self.entries.clear()
+         self.reorgEpoch = reorgEpoch
+
+   #############################################################################
+   def lookup(self, txHash, wltID, kind):
+      """ Returns (True, value) on a hit, (False, None) on a miss """
+      key = (txHash, wltID, kind)
+      with self.lock:
+         self.checkReorg()
+         if key in self.entries:
+            # Move it to the most-recently-used end
+            value = self.entries.pop(key)
+            self.entries[key] = value
+            self.hits += 1
+            return (True, value)
+         self.misses += 1
+         return (False, None)
+
+   #############################################################################
+   def store(self, txHash, wltID, kind, value):
+      key = (txHash, wltID, kind)
+      with self.lock:
+         self.checkReorg()
+         self.entries.pop(key, None)
+         self.entries[key] = value
+         while len(self.entries) > self.maxEntries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+   #############################################################################
+   def evictWallet(self, wltID, kind=None):
+      """ Drop all values for wltID, or only those of one kind """
+      with self.lock:
+         for key in self.entries.keys():
+            if key[1] == wltID and (kind is None or key[2] == kind):
+               del self.entries[key]
+
+   #############################################################################
+   def clear(self):
+      with self.lock:
+         self.entries.clear()
+
+   #############################################################################
+   def getStats(self):
+      with self.lock:
+         nLookups = self.hits + self.misses
+         return { 'hits':      self.hits,
+                  'misses':    self.misses,
+                  'evictions': self.evictions,
+                  'size':      len(self.entries),
+                  'hitrate':   float(self.hits)/nLookups if nLookups else 0.0 }
+
+TheLedgerValueCache = LedgerValueCache()
+
+
 #############################################################################
 def getFeeForTx(txHash):
    if TheBDM.getState()==BDM_BLOCKCHAIN_READY:
@@ -2808,6 +3252,150 @@ def determineSentToSelfAmt(le, wlt):
    return (amt, changeIndex)
 
 
+#############################################################################
+def getFeeForTxCached(txHash):
+   """
+   getFeeForTx() through TheLedgerValueCache.  A zero/None result usually
+   means the tx couldn't be found, so it isn't cached.
+   """
+   found, fee = TheLedgerValueCache.lookup(txHash, None, 'fee')
+   if not found:
+      fee = getFeeForTx(txHash)
+      if fee:
+         TheLedgerValueCache.store(txHash, None, 'fee', fee)
+   return fee
+
+#############################################################################
+def determineSentToSelfAmtCached(le, wlt, wltID=None):
+   """
+   determineSentToSelfAmt() through TheLedgerValueCache.  Only confirmed
+   sent-to-self entries are cached.  C++ wallets don't know their ID, so
+   callers passing a cppWallet must pass the ID of the wallet or lockbox
+   it belongs to as wltID, otherwise nothing is cached.
+   """
+   if wltID is None:
+      wltID = getattr(wlt, 'uniqueIDB58', None)
+   if wltID is None or not le.isSentToSelf() or \
+                       le.getBlockNum() >= UINT32_MAX:
+      return determineSentToSelfAmt(le, wlt)
+
+   txHash = le.getTxHash()
+   found, result = TheLedgerValueCache.lookup(txHash, wltID, 'sentToSelf')
+   if not found:
+      result = determineSentToSelfAmt(le, wlt)
+      TheLedgerValueCache.store(txHash, wltID, 'sentToSelf', result)
+   return result
+
+
+################################################################################
+class LedgerCursor(object):
+   """
+   Random access into the ledger of a C++ wallet (a registered PyBtcWallet's
+   cppWallet, or a lockbox wallet), newest entry first, the same order
+   getledger has always used.
+
+   The number of entries on each history page is remembered the first time
+   the page is fetched, so getSlice() skips straight over the pages before
+   the requested offset and only fetches the ones overlapping the slice.
+   A few pages are kept around for the next call.  Everything is dropped
+   when TheBDM's epoch moves (new block, zero-conf or refresh), since the
+   pages are rebuilt then.
+
+   Also memoizes block header info (per epoch), and gets fees through
+   TheLedgerValueCache, since the ledger RPCs need both for every entry.
+   """
+   def __init__(self, cppWallet, maxCachedPages=4):
+      self.cppWallet      = cppWallet
+      self.maxCachedPages = maxCachedPages
+      self.epoch          = None
+      self.resetPages()
+
+   #############################################################################
+   def resetPages(self):
+      self.pageCounts  = {}   # pageId -> number of entries on the page
+      self.pages       = {}   # pageId -> entries, newest first
+      self.headerCache = {}   # txHash -> (headHashBin, headTime)
+
+   #############################################################################
+   def checkEpoch(self):
+      epoch = TheBDM.getUtxoEpoch()
+      if not epoch == self.epoch:
+         self.resetPages()
+         self.epoch = epoch
+
+   #############################################################################
+   def getNumPages(self):
+      self.checkEpoch()
+      return self.cppWallet.getHistoryPageCount()
+
+   #############################################################################
+   def getPage(self, pageId):
+      """ Ledger entries on one history page, newest first """
+      self.checkEpoch()
+      entries = self.pages.get(pageId)
+      if entries is None:
+         ledgerVector = self.cppWallet.getHistoryPageAsVector(pageId)
+         entries = [le for le in reversed(ledgerVector)]
+         if len(self.pages) >= self.maxCachedPages:
+            self.pages.clear()
+         self.pages[pageId] = entries
+         self.pageCounts[pageId] = len(entries)
+      return entries
+
+   #############################################################################
+   def getSlice(self, fromIdx, count):
+      """
+      Ledger entries fromIdx to fromIdx+count (or fewer at the end of the
+      history).  Only pages whose entry count isn't known yet, or which
+      overlap the slice, are fetched.
+      """
+      numPages = self.getNumPages()
+      sliceList = []
+      offset = 0
+      pageId = 0
+      while pageId < numPages and len(sliceList) < count:
+         pageCount = self.pageCounts.get(pageId)
+         if pageCount is not None and offset + pageCount <= fromIdx:
+            offset += pageCount
+            pageId += 1
+            continue
+
+         entries = self.getPage(pageId)
+         start = max(fromIdx - offset, 0)
+         sliceList.extend(entries[start:start + count - len(sliceList)])
+         offset += len(entries)
+         pageId += 1
+
+      return sliceList
+
+   #############################################################################
+   def getFee(self, txHash):
+      return getFeeForTxCached(txHash)
+
+   #############################################################################
+   def getHeaderInfo(self, txHash, cppTx):
+      """
+      Returns (headHashBin, headTime) of the block holding cppTx (the BDM's
+      Tx for txHash), or None if there is no header for it (usually a
+      zero-conf tx).  The header pointer itself isn't kept, only what the
+      ledger RPCs read from it.
+      """
+      self.checkEpoch()
+      headInfo = self.headerCache.get(txHash)
+      if headInfo is None:
+         try:
+            cppHead = TheBDM.bdv().getHeaderPtrForTx(cppTx)
+         except:
+            cppHead = None
+
+         if cppHead is None or not cppHead.isInitialized():
+            return None
+
+         headInfo = (cppHead.getThisHash(), cppHead.getTimestamp())
+         self.headerCache[txHash] = headInfo
+      return headInfo
+
+
 ################################################################################
 #def getUnspentTxOutsForAddrList(addr160List, utxoType='Sweep', startBlk=-1, \
 def getUnspentTxOutsForAddr160List(addr160List):
@@ -197,7 +197,7 @@ class TorrentDownloadManager(object):
          return
 
 
-      pr  = ''
+      pr  = ('%s;  ' % activity) if activity else ''
       pr += ('Done: %0.1f%%' % (fractionDone*100)) if fractionDone else ''
       pr += (' (%0.1f kB/s' % (downRate/1024.)) if downRate else ' ('
       pr += (' from %d seeds' % statistics.numSeeds) if statistics else ''
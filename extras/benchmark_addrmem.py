@@ -0,0 +1,73 @@
+#! /usr/bin/python
+################################################################################
+#
+# Compare the memory used by PyBtcAddress and PyBtcAddressCompact objects for
+# the addresses of a watching-only wallet.
+#
+#    python extras/benchmark_addrmem.py [nAddr]
+#
+# Each representation is measured in its own process, as the growth of the
+# resident set size while building nAddr (default 200000) addresses.
+#
+################################################################################
+import sys
+sys.path.append('..')
+sys.path.append('.')
+sys.argv.append('--nologging')
+
+import gc
+import os
+import subprocess
+
+from armoryengine.ALL import *
+
+nAddr = int(sys.argv[1]) if len(sys.argv)>1 and sys.argv[1].isdigit() else 200000
+
+
+def getRSS():
+   proc = psutil.Process(os.getpid())
+   if hasattr(proc, 'memory_info'):
+      return proc.memory_info().rss
+   return proc.get_memory_info().rss
+
+
+def buildAddrMap(nAddr, compact):
+   # Same public key data for all of them, only the sizes matter here
+   root = PyBtcAddress().createFromPublicKeyData( \
+                  CryptoECDSA().ComputePublicKey(SecureBinaryData('\xaa'*32)))
+   root.markAsRootAddr(SecureBinaryData('\xee'*32))
+   rawAddr = root.extendAddressChain().serialize()
+
+   addrMap = {}
+   for i in xrange(nAddr):
+      newAddr = PyBtcAddress().unserialize(rawAddr)
+      newAddr.chainIndex = i
+      if compact:
+         newAddr = PyBtcAddressCompact().createFromPyBtcAddress(newAddr)
+      addrMap[hash160(str(i))] = newAddr
+   return addrMap
+
+
+if '--measure' in sys.argv:
+   compact = '--compact' in sys.argv
+   gc.collect()
+   rss0 = getRSS()
+   addrMap = buildAddrMap(nAddr, compact)
+   gc.collect()
+   print getRSS() - rss0
+   sys.exit(0)
+
+
+print '%-10s %-22s %14s %14s' % ('Addrs', 'Type', 'Total (MB)', 'Per addr (B)')
+results = {}
+for name,flag in [('PyBtcAddress', ''), ('PyBtcAddressCompact', '--compact')]:
+   cmd = [sys.executable, os.path.abspath(__file__), str(nAddr), '--measure']
+   if flag:
+      cmd.append(flag)
+   nBytes = int(subprocess.check_output(cmd).strip().split()[-1])
+   results[name] = nBytes
+   print '%-10d %-22s %14.1f %14.1f' % (nAddr, name, nBytes/2.0**20, \
+                                        float(nBytes)/nAddr)
+
+print 'Compact addresses use %0.1fx less memory' % \
+   (float(results['PyBtcAddress']) / max(results['PyBtcAddressCompact'], 1))
@@ -0,0 +1,64 @@
+#! /usr/bin/python
+################################################################################
+#
+# Compare extending a wallet's address chain one computeNextAddress() call
+# at a time (one walletFileSafeUpdate each) against a single
+# computeNextAddressBatch() call, for 100, 1k and 10k new addresses.
+#
+#    python extras/benchmark_addrpool.py [--seq10k]
+#
+# The one-at-a-time run for 10k addresses does 10k consistency checks and
+# fsync pairs, so it is skipped unless --seq10k is given.
+#
+################################################################################
+import sys
+sys.path.append('..')
+sys.path.append('.')
+sys.argv.append('--nologging')
+
+import os
+import shutil
+import tempfile
+import time
+
+from armoryengine.ALL import *
+
+runSeq10k = '--seq10k' in sys.argv
+
+
+def newTestWallet(tempDir, name):
+   wltPath = os.path.join(tempDir, 'armory_%s_.wallet' % name)
+   return PyBtcWallet().createNewWallet(newWalletFilePath=wltPath, \
+                                        withEncrypt=False, \
+                                        plainRootKey=SecureBinaryData('\xaa'*32), \
+                                        chaincode=SecureBinaryData('\xee'*32), \
+                                        doRegisterWithBDM=False, \
+                                        armoryHomeDir=tempDir)
+
+
+def timeIt(func):
+   start = time.time()
+   func()
+   return time.time() - start
+
+
+print '%-8s %14s %14s %10s' % ('Addrs', 'one-by-one (s)', 'batch (s)', 'speedup')
+
+tempDir = tempfile.mkdtemp()
+try:
+   for nAddr in [100, 1000, 10000]:
+      batchWlt = newTestWallet(tempDir, 'batch%d' % nAddr)
+      tBatch = timeIt(lambda: batchWlt.computeNextAddressBatch(nAddr, \
+                                                         doRegister=False))
+
+      if nAddr < 10000 or runSeq10k:
+         seqWlt = newTestWallet(tempDir, 'seq%d' % nAddr)
+         tSeq = timeIt(lambda: [seqWlt.computeNextAddress(doRegister=False) \
+                                                     for i in range(nAddr)])
+         assert(seqWlt.lastComputedChainAddr160 == \
+                batchWlt.lastComputedChainAddr160)
+         print '%-8d %14.3f %14.3f %9.1fx' % (nAddr, tSeq, tBatch, tSeq/tBatch)
+      else:
+         print '%-8d %14s %14.3f %10s' % (nAddr, 'skipped', tBatch, '')
+finally:
+   shutil.rmtree(tempDir)
@@ -0,0 +1,74 @@
+#! /usr/bin/python
+################################################################################
+#
+# Compare PySelectCoins_BruteForce and the CoinSelectionIndex-based
+# PySelectCoins on synthetic UTXO sets of 1k, 10k and 100k entries.
+#
+#    python extras/benchmark_coinselect.py [--brute100k]
+#
+# The brute-force run on 100k UTXOs takes minutes, so it is skipped unless
+# --brute100k is given.
+#
+################################################################################
+import sys
+sys.path.append('..')
+sys.path.append('.')
+sys.argv.append('--nologging')
+
+import random
+import time
+
+from armoryengine.ALL import *
+
+runBrute100k = '--brute100k' in sys.argv
+
+
+def timeIt(func, nRep=1):
+   start = time.time()
+   for i in xrange(nRep):
+      func()
+   return (time.time() - start) / nRep
+
+
+def makeUtxoList(nUtxo, seed=0):
+   # A wallet with a mix of round payments, random amounts, dust, some
+   # address reuse and a few unconfirmed outputs
+   rnd = random.Random(seed)
+   nAddr = max(nUtxo/3, 1)
+   utxoList = []
+   for i in xrange(nUtxo):
+      a160 = hash160(int_to_binary(rnd.randint(0, nAddr), widthBytes=4))
+      val  = rnd.choice([rnd.randint(1,50)*CENT, rnd.randint(1,ONE_BTC*10), \
+                         rnd.randint(1,30)*10*CENT, 5430])
+      conf = rnd.choice([0, 1, 6, 100, 1000, rnd.randint(0,50000)])
+      utxoList.append(PyUnspentTxOut(SCRADDR_P2PKH_BYTE+a160, hash256(str(i)), \
+                               0, val, conf, hash160_to_p2pkhash_script(a160)))
+   return utxoList
+
+
+print '%-8s %-10s %12s %12s %12s %12s' % \
+   ('UTXOs', 'Target', 'brute (s)', 'index (s)', 'reuse (s)', 'exact (s)')
+
+fee = 10000
+for nUtxo in [1000, 10000, 100000]:
+   utxoList = makeUtxoList(nUtxo)
+   coinIndex = CoinSelectionIndex(utxoList)
+   for target in [CENT, ONE_BTC, 50*ONE_BTC]:
+      if nUtxo < 100000 or runBrute100k:
+         tBrute = '%12.3f' % timeIt(lambda: PySelectCoins_BruteForce(utxoList, target, fee))
+      else:
+         tBrute = '%12s' % 'skipped'
+
+      tIndex = timeIt(lambda: PySelectCoins(utxoList, target, fee))
+      tReuse = timeIt(lambda: PySelectCoins(utxoList, target, fee,
+                                                      coinIndex=coinIndex))
+      tExact = timeIt(lambda: coinIndex.selectExactMatch(target, fee))
+
+      print '%-8d %-10s %s %12.3f %12.3f %12.3f' % \
+         (nUtxo, coin2strNZS(target), tBrute, tIndex, tReuse, tExact)
+
+   # Both must agree when the random candidates are turned off
+   if nUtxo <= 10000:
+      expected = PySelectCoins_BruteForce(utxoList, ONE_BTC, fee, numRand=0)
+      result = coinIndex.selectCoins(ONE_BTC, fee, numRand=0, exactMatch=False)
+      assert([id(u) for u in result] == [id(u) for u in expected])
@@ -0,0 +1,90 @@
+#! /usr/bin/python
+################################################################################
+#
+# Signed-message verifications per second in jasvet: the old affine
+# double-and-add recovery, the Jacobian engine one signature at a time, and
+# verifySignatures() on the whole list.
+#
+#    python extras/benchmark_jasvet.py [nSigs]
+#
+################################################################################
+import sys
+sys.path.append('..')
+sys.path.append('.')
+sys.argv.append('--nologging')
+
+import base64
+import time
+
+from jasvet import *
+
+nSigs = int(sys.argv[1]) if len(sys.argv)>1 and sys.argv[1].isdigit() else 50
+
+
+def timeIt(func):
+   start = time.time()
+   func()
+   return time.time() - start
+
+
+def affineMul(point, e):
+   # The NAF loop jasvet used before, one affine Point per step
+   e3 = 3 * e
+   negPoint = Point(point.curve(), point.x(), -point.y())
+   i = 1L
+   while i <= e3: i *= 2
+   i /= 4
+   result = point
+   while i > 1:
+      result = result.double()
+      if (e3 & i) != 0 and (e & i) == 0: result = result + point
+      if (e3 & i) == 0 and (e & i) != 0: result = result + negPoint
+      i /= 2
+   return result
+
+
+def verifyAffine(b64sig, msg):
+   # verify_message_Bitcoin() as it was, up to the recovered public key
+   G = generator_secp256k1
+   p, order = curve_secp256k1.p(), G.order()
+   sig = base64.b64decode(b64sig)
+   hb = ord(sig[0])
+   r,s = str_to_long(sig[1:33]), str_to_long(sig[33:65])
+   compressed = hb >= 31
+   recid = (hb - 31 if compressed else hb - 27)
+   x = (r + (recid/2) * order) % p
+   y = sqrt_mod((pow(x,3,p) + 7) % p, p)
+   if (y - recid) % 2 != 0:
+      y = p - y
+   R = Point(curve_secp256k1, x, y, order)
+   e = str_to_long(Hash(format_msg_to_sign(msg)))
+   Q = affineMul(affineMul(R, s) + affineMul(G, -e % order), \
+                 inverse_mod(r, order))
+   affineMul(Q, order)   # the old order check in Public_key
+   return Public_key(G, Q, compressed)
+
+
+print 'Signing %d messages...' % nSigs
+tSign = time.time()
+sigList = []
+for i in range(nSigs):
+   sv0 = ASv0(Hash(str(i)), 'Benchmark message %d' % i)
+   sigList.append((sv0['b64-signature'], sv0['message'], 'v0'))
+tSign = time.time() - tSign
+print '%-32s %8.1f sigs/s' % ('Signing (Jacobian)', nSigs / tSign)
+
+nAffine = max(nSigs / 10, 1)
+tAffine = timeIt(lambda: [verifyAffine(b64sig, msg) for b64sig,msg,v in \
+                                                      sigList[:nAffine]])
+tSingle = timeIt(lambda: [verifySignature(b64sig, msg) for b64sig,msg,v in \
+                                                      sigList])
+tBatch  = timeIt(lambda: verifySignatures(sigList))
+
+assert verifySignatures(sigList) == \
+       [verifySignature(b64sig, msg) for b64sig,msg,v in sigList]
+
+for name,n,t in [('Verify, affine (old)', nAffine, tAffine), \
+                 ('Verify, Jacobian', nSigs, tSingle), \
+                 ('verifySignatures() batch', nSigs, tBatch)]:
+   print '%-32s %8.1f sigs/s' % (name, n / t)
+print 'Jacobian speedup: %0.1fx' % ((tAffine/nAffine) / (tSingle/nSigs))
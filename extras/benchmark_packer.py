@@ -0,0 +1,75 @@
+#! /usr/bin/python
+################################################################################
+#
+# Microbenchmark comparing BinaryPacker and FastBinaryPacker on the field
+# mix used by transactions, wallet entries and network messages.
+#
+#    python extras/benchmark_packer.py [nIter]
+#
+################################################################################
+import sys
+sys.path.append('..')
+sys.path.append('.')
+sys.argv.append('--nologging')
+
+import os
+import time
+
+from armoryengine.ALL import *
+from armoryengine.Block import PyBlock
+from armoryengine.BinaryPacker import BinaryPacker, FastBinaryPacker
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+nIter = int(sys.argv[1]) if len(sys.argv)>1 else 2000
+
+
+def timeIt(func, nRep):
+   start = time.time()
+   for i in xrange(nRep):
+      func()
+   return time.time() - start
+
+
+# Field layout of a 2-input, 2-output standard tx
+TXIN_FIELDS  = [(BINARY_CHUNK, '\xab'*32), (UINT32, 1), (VAR_INT, 139), \
+                (BINARY_CHUNK, '\xcd'*139), (UINT32, UINT32_MAX)]
+TXOUT_FIELDS = [(UINT64, 5*ONE_BTC), (VAR_INT, 25), (BINARY_CHUNK, '\xef'*25)]
+TX_FIELDS    = [(UINT32, 1), (VAR_INT, 2)] + TXIN_FIELDS*2 + \
+               [(VAR_INT, 2)] + TXOUT_FIELDS*2 + [(UINT32, 0)]
+
+# Field layout of a PyBtcAddress wallet entry
+ADDR_FIELDS  = [(BINARY_CHUNK, '\x11'*20), (BINARY_CHUNK, '\x22'*4), \
+                (UINT32, 1), (UINT64, 3)] + \
+               [(BINARY_CHUNK, '\x33'*32), (BINARY_CHUNK, '\x44'*4), \
+                (INT64, 10), (INT64, 0)] + \
+               [(BINARY_CHUNK, '\x55'*16), (BINARY_CHUNK, '\x66'*4), \
+                (BINARY_CHUNK, '\x77'*32), (BINARY_CHUNK, '\x88'*4), \
+                (BINARY_CHUNK, '\x99'*65), (BINARY_CHUNK, '\xaa'*4), \
+                (UINT64, 2**32-1), (UINT64, 0), (UINT32, 2**32-1), (UINT32, 0)]
+
+
+def packAll(packerClass, fieldList, *args):
+   bp = packerClass(*args)
+   for vtype,val in fieldList:
+      bp.put(vtype, val)
+   bp.getSize()
+   return bp.getBinaryString()
+
+
+for name,fields in [('Tx fields', TX_FIELDS), ('Address fields', ADDR_FIELDS)]:
+   assert(packAll(BinaryPacker, fields) == packAll(FastBinaryPacker, fields))
+   nBytes = len(packAll(BinaryPacker, fields))
+   tOld = timeIt(lambda: packAll(BinaryPacker, fields), nIter)
+   tNew = timeIt(lambda: packAll(FastBinaryPacker, fields), nIter)
+   tRes = timeIt(lambda: packAll(FastBinaryPacker, fields, nBytes), nIter)
+   print '%-16s (%4d bytes)  old: %8.1f us   fast: %8.1f us   reserved: %8.1f us' % \
+      (name, nBytes, 1e6*tOld/nIter, 1e6*tNew/nIter, 1e6*tRes/nIter)
+
+
+# End-to-end serialization of real objects with the new packer
+blk = PyBlock().unserialize(open(os.path.join(HERE, 'blk170.bin'), 'rb').read())
+tx  = blk.blockData.txList[-1]
+msg = PyMessage('tx', PayloadTx(tx))
+for name,obj in [('PyTx.serialize', tx), ('PyMessage.serialize', msg)]:
+   t = timeIt(obj.serialize, nIter)
+   print '%-20s %8.1f us' % (name, 1e6*t/nIter)
@@ -0,0 +1,123 @@
+#! /usr/bin/python
+################################################################################
+#
+# Compare signature verification with and without a shared SigHashCache on
+# a 200-input single-sig tx and a 15-of-15 multisig spend, and with a
+# SigVerifyEngine spreading the checks over worker threads.
+#
+#    python extras/benchmark_sighash.py [nInputs]
+#
+################################################################################
+import sys
+sys.path.append('..')
+sys.path.append('.')
+sys.argv.append('--nologging')
+
+import time
+
+from armoryengine.ALL import *
+
+nInputs = int(sys.argv[1]) if len(sys.argv)>1 and sys.argv[1].isdigit() else 200
+
+
+def timeIt(func, nRep=1):
+   start = time.time()
+   for i in xrange(nRep):
+      func()
+   return time.time() - start
+
+
+def makeSupportTx(txoScript, value, seed):
+   # Fake funding tx, only the output script and value matter here
+   tx = PyTx()
+   tx.version  = 1
+   tx.lockTime = 0
+   txin = PyTxIn()
+   txin.outpoint  = PyOutPoint(hash256(int_to_binary(seed, widthBytes=4)), 0)
+   txin.binScript = ''
+   txin.intSeq    = UINT32_MAX
+   txout = PyTxOut()
+   txout.value     = value
+   txout.binScript = txoScript
+   tx.inputs  = [txin]
+   tx.outputs = [txout]
+   return tx.serialize()
+
+
+def newKeyPair():
+   prv = SecureBinaryData().GenerateRandom(32)
+   pub = CryptoECDSA().ComputePublicKey(prv)
+   return prv, pub.toBinStr()
+
+
+def verifyUncached(ustx):
+   # Pre-cache behavior: every signature copies and re-serializes the tx
+   for ustxi in ustx.ustxInputs:
+      if not ustxi.verifyAllSignatures(ustx.pytxObj):
+         return False
+   return True
+
+
+def report(name, nSigs, tOld, tNew):
+   print '%-28s %4d sigs   uncached: %8.3f s   cached: %8.3f s   speedup: %5.2fx' % \
+                                          (name, nSigs, tOld, tNew, tOld/tNew)
+
+
+payTo = DecoratedTxOut(hash160_to_p2pkhash_script('\x42'*20), ONE_BTC)
+
+################################################################################
+# Many single-sig inputs
+keys, ustxiList = [], []
+for i in range(nInputs):
+   prv,pub = newKeyPair()
+   script = hash160_to_p2pkhash_script(hash160(pub))
+   keys.append(prv)
+   ustxiList.append(UnsignedTxInput(makeSupportTx(script, ONE_BTC, i), 0, \
+                                                             None, pub))
+
+ustx = UnsignedTransaction().createFromUnsignedTxIO(ustxiList, [payTo])
+tSign = timeIt(lambda: [ustx.createAndInsertSignatureForInput(i, keys[i]) \
+                                                  for i in range(nInputs)])
+print 'Signed %d inputs in %0.3f s' % (nInputs, tSign)
+
+assert(verifyUncached(ustx) and ustx.verifySigsAllInputs())
+report('%d-input P2PKH' % nInputs, nInputs, timeIt(lambda: verifyUncached(ustx)),
+                                           timeIt(ustx.verifySigsAllInputs))
+
+engine = SigVerifyEngine()
+assert(ustx.verifySigsAllInputs(engine))
+report('%d-input P2PKH, %d threads' % (nInputs, engine.numWorkers), nInputs,
+       timeIt(ustx.verifySigsAllInputs),
+       timeIt(lambda: ustx.verifySigsAllInputs(engine)))
+
+
+################################################################################
+# Multisig, every key signs every input
+nMulti = 15
+msKeys = [newKeyPair() for i in range(nMulti)]
+msScript = pubkeylist_to_multisig_script([msPub for msPrv,msPub in msKeys], nMulti)
+nMsInputs = max(nInputs/20, 1)
+ustxiList = [UnsignedTxInput(makeSupportTx(msScript, ONE_BTC, i), 0) \
+                                                  for i in range(nMsInputs)]
+
+ustx = UnsignedTransaction().createFromUnsignedTxIO(ustxiList, [payTo])
+for i in range(nMsInputs):
+   for prv,pub in msKeys:
+      ustx.createAndInsertSignatureForInput(i, prv)
+
+assert(verifyUncached(ustx) and ustx.verifySigsAllInputs())
+report('%d-input %d-of-%d multisig' % (nMsInputs, nMulti, nMulti),
+       nMsInputs*nMulti, timeIt(lambda: verifyUncached(ustx)),
+                         timeIt(ustx.verifySigsAllInputs))
+
+
+################################################################################
+# Raw preimage construction, no ECDSA
+cache = ustx.getSigHashCache()
+nRep  = 200
+tOld = timeIt(lambda: generatePreHashTxMsgToSign(ustx.pytxObj, 0, msScript), nRep)
+tNew = timeIt(lambda: generatePreHashTxMsgToSign(ustx.pytxObj, 0, msScript,
+                                             sigHashCache=cache), nRep)
+report('Preimage only', nRep, tOld, tNew)
+
+engine.shutdown()
@@ -0,0 +1,78 @@
+#! /usr/bin/python
+################################################################################
+#
+# Compare parse throughput of BinaryUnpacker and FastBinaryUnpacker on real
+# block and wallet data.
+#
+#    python extras/benchmark_unpacker.py [nIter] [walletFile]
+#
+################################################################################
+import sys
+sys.path.append('..')
+sys.path.append('.')
+sys.argv.append('--nologging')
+
+import os
+import time
+
+from armoryengine.ALL import *
+from armoryengine.Block import PyBlock
+from armoryengine.BinaryUnpacker import BinaryUnpacker, FastBinaryUnpacker
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+nIter   = int(sys.argv[1]) if len(sys.argv)>1 and sys.argv[1].isdigit() else 200
+wltPath = os.path.join(HERE, 'test', 'FakeWallet123.wallet')
+for arg in sys.argv[1:]:
+   if arg.endswith('.wallet'):
+      wltPath = arg
+
+
+def timeIt(func, nRep):
+   start = time.time()
+   for i in xrange(nRep):
+      func()
+   return time.time() - start
+
+
+def report(name, nBytes, nRep, tOld, tNew):
+   mbOld = nBytes*nRep / tOld / 2**20
+   mbNew = nBytes*nRep / tNew / 2**20
+   print '%-24s  old: %8.2f MB/s   fast: %8.2f MB/s   speedup: %5.2fx' % \
+                                          (name, mbOld, mbNew, tOld/tNew)
+
+
+################################################################################
+# Blocks
+blkList = [open(os.path.join(HERE, 'blk170.bin'), 'rb').read()]
+hexBlk  = open(os.path.join(HERE, 'blk135687.hex'), 'r').read()
+blkList.append(hex_to_binary(''.join(hexBlk.split())))
+
+for blk in blkList:
+   assert(PyBlock().unserialize(BinaryUnpacker(blk)).serialize() == \
+          PyBlock().unserialize(FastBinaryUnpacker(blk)).serialize())
+
+   tOld = timeIt(lambda: PyBlock().unserialize(BinaryUnpacker(blk)), nIter)
+   tNew = timeIt(lambda: PyBlock().unserialize(FastBinaryUnpacker(blk)), nIter)
+   report('Block (%d bytes)' % len(blk), len(blk), nIter, tOld, tNew)
+
+   txRaw = PyBlock().unserialize(blk).blockData.txList[-1].serialize()
+   tOld = timeIt(lambda: PyTx().unserialize(BinaryUnpacker(txRaw)), nIter*10)
+   tNew = timeIt(lambda: PyTx().unserialize(FastBinaryUnpacker(txRaw)), nIter*10)
+   report('Tx (%d bytes)' % len(txRaw), len(txRaw), nIter*10, tOld, tNew)
+
+
+################################################################################
+# Wallets
+if os.path.exists(wltPath):
+   nWlt = max(nIter/20, 1)
+   wltSize = os.path.getsize(wltPath)
+   loadOld = lambda: PyBtcWallet().readWalletFile(wltPath, False)
+   loadNew = lambda: PyBtcWallet().readWalletFile(wltPath, False, fastUnpack=True)
+   assert(loadOld().addrMap.keys() == loadNew().addrMap.keys())
+
+   tOld = timeIt(loadOld, nWlt)
+   tNew = timeIt(loadNew, nWlt)
+   report('Wallet (%d bytes)' % wltSize, wltSize, nWlt, tOld, tNew)
+else:
+   print 'No wallet file found at %s, skipping wallet benchmark' % wltPath
@@ -0,0 +1,78 @@
+#! /usr/bin/python
+################################################################################
+#
+# Compare wallet startup time of readWalletFile() and
+# readWalletFile(lazyLoad=True), for wallets of 10k and 100k addresses.
+#
+#    python extras/benchmark_walletload.py [--keep]
+#
+# The wallets are created in a temp dir on the first run, which takes a while
+# for 100k addresses.  Use --keep to keep them for the next run.
+#
+################################################################################
+import sys
+sys.path.append('..')
+sys.path.append('.')
+sys.argv.append('--nologging')
+
+import os
+import shutil
+import tempfile
+import time
+
+from armoryengine.ALL import *
+
+keepWallets = '--keep' in sys.argv
+wltDir = os.path.join(tempfile.gettempdir(), 'armory_benchmark_walletload')
+
+
+def getTestWallet(nAddr):
+   wltPath = os.path.join(wltDir, 'armory_load%d_.wallet' % nAddr)
+   if not os.path.exists(wltPath):
+      wlt = PyBtcWallet().createNewWallet(newWalletFilePath=wltPath, \
+                                          withEncrypt=False, \
+                                          plainRootKey=SecureBinaryData('\xaa'*32), \
+                                          chaincode=SecureBinaryData('\xee'*32), \
+                                          doRegisterWithBDM=False, \
+                                          armoryHomeDir=wltDir)
+      wlt.computeNextAddressBatch(nAddr - len(wlt.linearAddr160List), \
+                                                         doRegister=False)
+   return wltPath
+
+
+def timeIt(func):
+   start = time.time()
+   func()
+   return time.time() - start
+
+
+def loadAndTouch(wltPath, nTouch):
+   wlt = PyBtcWallet().readWalletFile(wltPath, False, lazyLoad=True)
+   for a160 in wlt.linearAddr160List[-nTouch:]:
+      wlt.addrMap[a160]
+
+
+if not os.path.exists(wltDir):
+   os.makedirs(wltDir)
+
+print '%-8s %12s %12s %12s %12s %12s' % ('Addrs', 'eager (s)', \
+   'eager+chk (s)', 'lazy (s)', 'lazy+100 (s)', 'lazy+all (s)')
+
+try:
+   for nAddr in [10000, 100000]:
+      wltPath = getTestWallet(nAddr)
+      eagerWlt = PyBtcWallet().readWalletFile(wltPath, False)
+      lazyWlt  = PyBtcWallet().readWalletFile(wltPath, False, lazyLoad=True)
+      assert(lazyWlt.isEqualTo(eagerWlt))
+
+      tEager = timeIt(lambda: PyBtcWallet().readWalletFile(wltPath, False))
+      tCheck = timeIt(lambda: PyBtcWallet().readWalletFile(wltPath, True))
+      tLazy  = timeIt(lambda: PyBtcWallet().readWalletFile(wltPath, False, \
+                                                            lazyLoad=True))
+      tTouch = timeIt(lambda: loadAndTouch(wltPath, 100))
+      tAll   = timeIt(lambda: loadAndTouch(wltPath, nAddr))
+      print '%-8d %12.3f %12.3f %12.3f %12.3f %12.3f' % \
+                               (nAddr, tEager, tCheck, tLazy, tTouch, tAll)
+finally:
+   if not keepWallets:
+      shutil.rmtree(wltDir)
@@ -212,6 +212,209 @@ def inverse_mod( a, m ):
    if ud > 0: return ud
    else: return ud + m
 
+# Jacobian-coordinate arithmetic for secp256k1 (a=0).  A point (X, Y, Z)
+# stands for the affine point (X/Z^2, Y/Z^3), and Z == 0 is the point at
+# infinity, so additions and doublings need no modular inverse.  Only the
+# final result is converted back to affine.
+
+_JAC_INFINITY = (0L, 1L, 0L)
+
+def _jac_double( P, p ):
+   X1, Y1, Z1 = P
+   if Z1 == 0 or Y1 == 0: return _JAC_INFINITY
+   A = X1 * X1 % p
+   B = Y1 * Y1 % p
+   C = B * B % p
+   D = 2 * ( ( X1 + B ) * ( X1 + B ) - A - C ) % p
+   E = 3 * A
+   X3 = ( E * E - 2 * D ) % p
+   Y3 = ( E * ( D - X3 ) - 8 * C ) % p
+   Z3 = 2 * Y1 * Z1 % p
+   return ( X3, Y3, Z3 )
+
+def _jac_add_affine( P, x2, y2, p ):
+   # P + (x2, y2), with (x2, y2) affine and not infinity
+   X1, Y1, Z1 = P
+   if Z1 == 0: return ( x2, y2, 1L )
+   Z1Z1 = Z1 * Z1 % p
+   H = ( x2 * Z1Z1 - X1 ) % p
+   r = ( y2 * Z1 * Z1Z1 - Y1 ) % p
+   if H == 0:
+      if r == 0: return _jac_double( P, p )
+      return _JAC_INFINITY
+   HH = H * H % p
+   HHH = H * HH % p
+   V = X1 * HH % p
+   X3 = ( r * r - HHH - 2 * V ) % p
+   Y3 = ( r * ( V - X3 ) - Y1 * HHH ) % p
+   Z3 = Z1 * H % p
+   return ( X3, Y3, Z3 )
+
+def _jac_add( P, Q, p ):
+   X1, Y1, Z1 = P
+   X2, Y2, Z2 = Q
+   if Z1 == 0: return Q
+   if Z2 == 0: return P
+   Z1Z1 = Z1 * Z1 % p
+   Z2Z2 = Z2 * Z2 % p
+   U1 = X1 * Z2Z2 % p
+   S1 = Y1 * Z2 * Z2Z2 % p
+   H = ( X2 * Z1Z1 - U1 ) % p
+   r = ( Y2 * Z1 * Z1Z1 - S1 ) % p
+   if H == 0:
+      if r == 0: return _jac_double( P, p )
+      return _JAC_INFINITY
+   HH = H * H % p
+   HHH = H * HH % p
+   V = U1 * HH % p
+   X3 = ( r * r - HHH - 2 * V ) % p
+   Y3 = ( r * ( V - X3 ) - S1 * HHH ) % p
+   Z3 = Z1 * Z2 * H % p
+   return ( X3, Y3, Z3 )
+
+def _batch_inverse( values, m ):
+   # Montgomery's trick: the inverses of all values for one inverse_mod.
+   # Zeros stay zero.
+   prefix = []
+   acc = 1L
+   for v in values:
+      prefix.append( acc )
+      if v: acc = acc * v % m
+   inv = inverse_mod( acc, m )
+   result = [0L] * len( values )
+   for i in xrange( len( values ) - 1, -1, -1 ):
+      if values[i]:
+         result[i] = inv * prefix[i] % m
+         inv = inv * values[i] % m
+   return result
+
+def _jac_to_affine_list( points, p ):
+   # [(x, y) or None for infinity] for a list of Jacobian points
+   zinvs = _batch_inverse( [ Z for X, Y, Z in points ], p )
+   result = []
+   for ( X, Y, Z ), zinv in zip( points, zinvs ):
+      if Z == 0:
+         result.append( None )
+      else:
+         zinv2 = zinv * zinv % p
+         result.append( ( X * zinv2 % p, Y * zinv2 * zinv % p ) )
+   return result
+
+def _wnaf( k, w ):
+   # Width-w NAF digits of k, least significant first; the nonzero ones are
+   # odd and below 2^(w-1) in absolute value
+   digits = []
+   half = 1 << ( w - 1 )
+   while k > 0:
+      if k & 1:
+         d = k & ( ( 1 << w ) - 1 )
+         if d >= half: d -= 1 << w
+         k -= d
+      else:
+         d = 0
+      digits.append( d )
+      k >>= 1
+   return digits
+
+_WNAF_WIDTH = 5
+
+def _odd_multiples( x, y, p, count ):
+   # Affine P, 3P, 5P, ... (count of them)
+   twoP = _jac_to_affine_list( [ _jac_double( ( x, y, 1L ), p ) ], p )[0]
+   jacList = [ ( x, y, 1L ) ]
+   for i in xrange( count - 1 ):
+      jacList.append( _jac_add_affine( jacList[-1], twoP[0], twoP[1], p ) )
+   return _jac_to_affine_list( jacList, p )
+
+def _jac_multi_mul( pairs, p ):
+   """
+   Straus' method: sum(k*P) over the (k, (x, y)) pairs with one shared chain
+   of doublings, each scalar in width-5 NAF.  Returns a Jacobian point.
+   """
+   nafs = []
+   tables = []
+   for k, ( x, y ) in pairs:
+      if k == 0: continue
+      nafs.append( _wnaf( k, _WNAF_WIDTH ) )
+      tables.append( _odd_multiples( x, y, p, 1 << ( _WNAF_WIDTH - 2 ) ) )
+
+   result = _JAC_INFINITY
+   for i in xrange( max( [ len( naf ) for naf in nafs ] + [ 0 ] ) - 1, -1, -1 ):
+      result = _jac_double( result, p )
+      for naf, table in zip( nafs, tables ):
+         if i < len( naf ) and naf[i]:
+            d = naf[i]
+            if d > 0:
+               x, y = table[ d >> 1 ]
+               result = _jac_add_affine( result, x, y, p )
+            else:
+               x, y = table[ ( -d ) >> 1 ]
+               result = _jac_add_affine( result, x, p - y, p )
+   return result
+
+# k*G is the sum of one precomputed point per window of _G_TABLE_BITS bits
+# of k: _g_table[i][j-1] = j * 2^(i*_G_TABLE_BITS) * G.  No doublings are
+# needed.  The table is built on first use.
+_G_TABLE_BITS = 6
+_g_table = None
+
+def _get_g_table():
+   global _g_table
+   if _g_table is None:
+      nWindows = ( 256 + _G_TABLE_BITS - 1 ) / _G_TABLE_BITS
+      jacList = []
+      base = ( _Gx, _Gy, 1L )
+      for i in xrange( nWindows ):
+         baseAff = _jac_to_affine_list( [ base ], _p )[0]
+         mult = base
+         jacList.append( mult )
+         for j in xrange( 2, 1 << _G_TABLE_BITS ):
+            mult = _jac_add_affine( mult, baseAff[0], baseAff[1], _p )
+            jacList.append( mult )
+         for j in xrange( _G_TABLE_BITS ):
+            base = _jac_double( base, _p )
+      affList = _jac_to_affine_list( jacList, _p )
+      rowLen = ( 1 << _G_TABLE_BITS ) - 1
+      _g_table = [ affList[ i*rowLen : (i+1)*rowLen ] for i in xrange( nWindows ) ]
+   return _g_table
+
+def _jac_mul_g( k ):
+   # k*G for 0 <= k < 2^256, as a Jacobian point
+   table = _get_g_table()
+   mask = ( 1 << _G_TABLE_BITS ) - 1
+   result = _JAC_INFINITY
+   i = 0
+   while k > 0:
+      j = k & mask
+      if j:
+         x, y = table[i][ j - 1 ]
+         result = _jac_add_affine( result, x, y, _p )
+      k >>= _G_TABLE_BITS
+      i += 1
+   return result
+
+def _jac_mul_add_g( u1, u2, Q ):
+   # u1*G + u2*Q for secp256k1, Q affine (x, y); a Jacobian point
+   return _jac_add( _jac_mul_g( u1 % _r ), \
+                    _jac_multi_mul( [ ( u2 % _r, Q ) ], _p ), _p )
+
+def _is_secp256k1_g( point ):
+   return point.curve() is not None and point.curve().p() == _p and \
+          point.x() == _Gx and point.y() == _Gy
+
+def _affine_to_point( curve, xy ):
+   if xy is None: return INFINITY
+   return Point( curve, xy[0], xy[1] )
+
+def mul_add_G( u1, u2, point ):
+   """ u1*G + u2*point on secp256k1 """
+   if point == INFINITY:
+      Pjac = _jac_mul_g( u1 % _r )
+   else:
+      Pjac = _jac_mul_add_g( u1, u2, ( point.x(), point.y() ) )
+   return _affine_to_point( curve_secp256k1, \
+                            _jac_to_affine_list( [ Pjac ], _p )[0] )
+
 class CurveFp( object ):
    def __init__( self, p, a, b ):
       self.__p = p
@@ -268,6 +471,16 @@ class Point( object ):
       if e == 0: return INFINITY
       if self == INFINITY: return INFINITY
       assert e > 0
+      if self.__curve.a() == 0:
+         # Jacobian coordinates, see _jac_multi_mul() and _jac_mul_g()
+         p = self.__curve.p()
+         if _is_secp256k1_g( self ) and e < ( 1 << 256 ):
+            jac = _jac_mul_g( e )
+         else:
+            jac = _jac_multi_mul( [ ( e, ( self.__x, self.__y ) ) ], p )
+         xy = _jac_to_affine_list( [ jac ], p )[0]
+         if xy is None: return INFINITY
+         return Point( self.__curve, xy[0], xy[1] )
       e3 = 3 * e
       negative_self = Point( self.__curve, self.__x, -self.__y, self.__order )
       i = leftmost_bit( e3 ) / 2
@@ -329,7 +542,12 @@ class Public_key( object ):
       n = generator.order()
       if not n:
          raise RuntimeError, "Generator point must have order."
-      if not n * point == INFINITY:
+      if self.curve.p() == _p:
+         # secp256k1 has cofactor 1, so every point on it has order n
+         if point == INFINITY or \
+               not self.curve.contains_point( point.x(), point.y() ):
+            raise RuntimeError, "Generator point order is bad."
+      elif not n * point == INFINITY:
          raise RuntimeError, "Generator point order is bad."
       if point.x() < 0 or n <= point.x() or point.y() < 0 or n <= point.y():
          raise RuntimeError, "Generator point has x or y out of range."
@@ -346,7 +564,11 @@ class Public_key( object ):
       c = inverse_mod( s, n )
       u1 = ( hashValue * c ) % n
       u2 = ( r * c ) % n
-      xy = u1 * G + u2 * self.point
+      if _is_secp256k1_g( G ):
+         xy = mul_add_G( u1, u2, self.point )
+      else:
+         xy = u1 * G + u2 * self.point
+      if xy == INFINITY: return False
       v = xy.x() % n
       return v == r
 
@@ -401,8 +623,7 @@ class Private_key( object ):
 
 class EC_KEY(object):
    def __init__( self, secret, c=False):
-      curve = CurveFp( _p, _a, _b )
-      generator = Point( curve, _Gx, _Gy, _r )
+      generator = generator_secp256k1
       self.pubkey = Public_key( generator, generator * secret, c )
       self.privkey = Private_key( self.pubkey, secret )
       self.secret = secret
@@ -441,7 +662,9 @@ randrange = random.SystemRandom().randrange
 
 # Signing/verifying
 
-def verify_message_Bitcoin(signature, message, pureECDSASigning=False, networkVersionNumber=0):
+def _recover_pubkey_jacobian(signature, message, pureECDSASigning=False):
+   # The public key of a Bitcoin message signature as a Jacobian point, and
+   # whether it is compressed
    msg=message
    if not pureECDSASigning:
       msg=Hash(format_msg_to_sign(message))
@@ -474,14 +697,47 @@ def verify_message_Bitcoin(signature, message, pureECDSASigning=False, networkVe
    else:
       y=_p - yomy
 
-   R = Point(curve, x, y, order)
+   if not curve.contains_point(x, y):
+      raise Exception("vmB","Bad signature")
    e = str_to_long(msg)
    minus_e = -e % order
    inv_r = inverse_mod(r,order)
-   Q = inv_r * ( R*s + G*minus_e )
-   public_key = Public_key(G, Q, compressed)
-   addr = public_key_to_bc_address(public_key.ser(), networkVersionNumber)
-   return addr
+   # Q = inv_r * (s*R - e*G), in one pass
+   Q = _jac_mul_add_g( minus_e * inv_r, s * inv_r, ( x, y ) )
+   return Q, compressed
+
+def _pubkey_to_address(xy, compressed, networkVersionNumber):
+   public_key = Public_key(generator_secp256k1, \
+                           _affine_to_point(curve_secp256k1, xy), compressed)
+   return public_key_to_bc_address(public_key.ser(), networkVersionNumber)
+
+def verify_message_Bitcoin(signature, message, pureECDSASigning=False, networkVersionNumber=0):
+   Q, compressed = _recover_pubkey_jacobian(signature, message, pureECDSASigning)
+   xy = _jac_to_affine_list([Q], _p)[0]
+   return _pubkey_to_address(xy, compressed, networkVersionNumber)
+
+def verify_messages_Bitcoin(sigMsgList, pureECDSASigning=False, networkVersionNumber=0):
+   """
+   verify_message_Bitcoin() for a list of (signature, message) pairs, with
+   one modular inverse for the whole list.  Returns the list of addresses,
+   with None for the signatures that could not be verified.
+   """
+   recovered = []
+   for signature, message in sigMsgList:
+      try:
+         recovered.append(_recover_pubkey_jacobian(signature, message, \
+                                                   pureECDSASigning))
+      except Exception:
+         recovered.append((_JAC_INFINITY, False))
+
+   xyList = _jac_to_affine_list([Q for Q, compressed in recovered], _p)
+   addrList = []
+   for xy, (Q, compressed) in zip(xyList, recovered):
+      try:
+         addrList.append(_pubkey_to_address(xy, compressed, networkVersionNumber))
+      except Exception:
+         addrList.append(None)
+   return addrList
 
 def sign_message(secret, message, pureECDSASigning=False):
    if len(secret) == 32:
@@ -632,6 +888,18 @@ def verifySignature(b64sig, msg, signVer='v0', networkVersionNumber=0):
       msg = FormatText(msg, True)
    return verify_message_Bitcoin(b64sig, msg, networkVersionNumber = networkVersionNumber)
 
+def verifySignatures(sigList, networkVersionNumber=0):
+   """
+   verifySignature() for a list of (b64sig, msg, signVer) tuples.  Returns
+   the list of addresses, with None for the bad signatures.
+   """
+   sigMsgList = []
+   for b64sig, msg, signVer in sigList:
+      if signVer=='v1':
+         msg = FormatText(msg, True)
+      sigMsgList.append((b64sig, msg))
+   return verify_messages_Bitcoin(sigMsgList, networkVersionNumber = networkVersionNumber)
+
 def ASv0(privkey, msg):
    return sign_message_Bitcoin(privkey, msg)
 
@@ -7,9 +7,11 @@ import sys
 sys.path.append('..')
 import hashlib
 import locale
+import mmap
 from random import shuffle
 import time
 import unittest
+import weakref
 
 
 from armoryengine.ArmoryUtils import *
@@ -365,6 +367,79 @@ class ArmoryEngineTest(unittest.TestCase):
       self.assertEqual(thr.getErrorMsg(), 'This is a forced error')
       self.assertRaises(ValueError, thr.raiseLastError)
 
+   #############################################################################
+   def testGetCallerLine(self):
+      def logFromHere():
+         return getCallerLine()
+      thisLine = sys._getframe().f_lineno
+      self.assertEqual(logFromHere(), 'testArmoryEngineUtils.py:%d' % (thisLine+1))
+
+   #############################################################################
+   def testQueuedFileHandler(self):
+      logPath = os.path.join(ARMORY_HOME_DIR, 'queued_handler_test.log')
+      handler = QueuedFileHandler(logPath, 'w')
+      handler.setFormatter(logging.Formatter('%(message)s'))
+      logger = logging.getLogger('queuedHandlerTest')
+      logger.propagate = False
+      logger.setLevel(logging.INFO)
+      logger.addHandler(handler)
+      try:
+         for i in range(100):
+            logger.info('line %d', i)
+         handler.flush()
+         with open(logPath) as f:
+            lines = f.read().splitlines()
+         self.assertEqual(lines, ['line %d' % i for i in range(100)])
+      finally:
+         logger.removeHandler(handler)
+         handler.close()
+         os.remove(logPath)
+      self.assertFalse(handler.writerThread.isAlive())
+
+   #############################################################################
+   def testSettingsFileBatch(self):
+      settingsPath = os.path.join(ARMORY_HOME_DIR, 'batch_test_settings.txt')
+      if os.path.exists(settingsPath):
+         os.remove(settingsPath)
+      settings = SettingsFile(settingsPath, flushDelay=60)
+      try:
+         # Nothing is written until the flush, but reads see the new values
+         with settings.batch():
+            settings.set('IntSetting', 42)
+            settings.set('ListSetting', ('a', 'b'))
+            settings.extend('ListSetting', 'c')
+         self.assertEqual(settings.get('IntSetting'), 42)
+         self.assertFalse(os.path.exists(settingsPath))
+
+         settings.flush()
+         self.assertTrue(os.path.exists(settingsPath))
+         self.assertFalse(os.path.exists(settingsPath + '.tmp'))
+         reloaded = SettingsFile(settingsPath)
+         self.assertEqual(reloaded.get('IntSetting'), 42)
+         self.assertEqual(reloaded.get('ListSetting'), ['a', 'b', 'c'])
+      finally:
+         settings.flush()
+         os.remove(settingsPath)
+
+   #############################################################################
+   def testSettingsFileFlushedAtExit(self):
+      settingsPath = os.path.join(ARMORY_HOME_DIR, 'exit_test_settings.txt')
+      settings = SettingsFile(settingsPath, flushDelay=60)
+      try:
+         settings.set('IntSetting', 42)
+         self.assertFalse(os.path.exists(settingsPath))
+         flushTimer = settings.flushTimer
+         flushAllSettingsFiles()
+         self.assertEqual(SettingsFile(settingsPath).get('IntSetting'), 42)
+
+         # Settings objects that are no longer used aren't kept alive
+         flushTimer.join()
+         settingsRef = weakref.ref(settings)
+         del settings, flushTimer
+         self.assertEqual(settingsRef(), None)
+      finally:
+         os.remove(settingsPath)
+
    #############################################################################
    def test_read_address(self):
       hashVal = hex_to_binary('c3a9eb6753c449c88ac193e9ddf7ab3a0be8c5ad')
@@ -578,6 +653,93 @@ class BinaryPackerUnpackerTest(unittest.TestCase):
       self.assertRaises(UnpackerError, bu.get, UNKNOWN_TYPE)
       self.assertRaises(UnpackerError, bu.get, BINARY_CHUNK, 1)
 
+   #############################################################################
+   def testFastBinaryPacker(self):
+      UNKNOWN_TYPE = 100
+      fieldList = [(UINT8, 0xff), (UINT16, 0xff), (UINT32, 0xff), \
+                   (UINT64, 0xff), (INT8, -1), (INT16, -1), (INT32, -1), \
+                   (INT64, -1), (VAR_INT, 78), (VAR_INT, 0x10000), \
+                   (VAR_STR, 'abc'), (FLOAT, 1.23456789), \
+                   (BINARY_CHUNK, '\xff\xff\xff')]
+
+      # Output must be byte-for-byte identical to the original packer,
+      # whether or not we reserved enough space up front
+      for reserveSize in [0, 3, 1000]:
+         bp  = BinaryPacker()
+         fbp = FastBinaryPacker(reserveSize)
+         for vtype,val in fieldList:
+            bp.put(vtype, val)
+            fbp.put(vtype, val)
+            self.assertEqual(fbp.getSize(), bp.getSize())
+         bp.put(BINARY_CHUNK, '\xff', width=4)
+         fbp.put(BINARY_CHUNK, '\xff', width=4)
+         bp.put(UINT32, 1, endianness=BIGENDIAN)
+         fbp.put(UINT32, 1, endianness=BIGENDIAN)
+         self.assertEqual(fbp.getBinaryString(), bp.getBinaryString())
+         self.assertEqual(str(fbp), str(bp))
+         self.assertTrue(isinstance(fbp.getBinaryString(), str))
+
+      fbp = FastBinaryPacker()
+      self.assertRaises(PackerError, fbp.put, UNKNOWN_TYPE, 1)
+      self.assertRaises(PackerError, fbp.put, BINARY_CHUNK, '\xff'*3, 2)
+      self.assertRaises(PackerError, fbp.put, UINT8, 256)
+      self.assertEqual(fbp.getSize(), 0)
+
+   #############################################################################
+   def testFastBinaryUnpacker(self):
+      UNKNOWN_TYPE = 100
+      ts = hex_to_binary('ffff00ff000000ff00000000000000ffffffffffffffffffffff'
+                         'ffffffff4e0361626352069e3fffffffffffff00fd0001')
+      fieldList = [UINT8, UINT16, UINT32, UINT64, INT8, INT16, INT32, INT64, \
+                   VAR_INT, VAR_STR, FLOAT, (BINARY_CHUNK,3), \
+                   (BINARY_CHUNK,4), VAR_INT]
+
+      # Every field must come out the same as the original unpacker
+      for data in [ts, bytearray(ts), memoryview(ts)]:
+         bu  = BinaryUnpacker(ts)
+         fbu = FastBinaryUnpacker(data)
+         self.assertEqual(fbu.getSize(), len(ts))
+         for field in fieldList:
+            if isinstance(field, tuple):
+               self.assertEqual(fbu.get(*field), bu.get(*field))
+            else:
+               self.assertEqual(fbu.get(field), bu.get(field))
+            self.assertEqual(fbu.getPosition(), bu.getPosition())
+         self.assertEqual(fbu.getRemainingSize(), 0)
+         self.assertRaises(UnpackerError, fbu.get, BINARY_CHUNK, 1)
+         self.assertRaises(UnpackerError, fbu.get, UINT8)
+         self.assertRaises(UnpackerError, fbu.get, VAR_INT)
+         self.assertRaises(UnpackerError, fbu.get, UNKNOWN_TYPE)
+
+      # getMany matches field-by-field reads in both engines
+      bu  = BinaryUnpacker(ts)
+      fbu = FastBinaryUnpacker(ts)
+      self.assertEqual(fbu.getMany(fieldList), bu.getMany(fieldList))
+      self.assertEqual(fbu.getPosition(), len(ts))
+      fbu.resetPosition(len(ts)-2)
+      self.assertRaises(UnpackerError, fbu.getMany, [UINT32])
+
+      # Big-endian readers are compiled separately
+      fbu = FastBinaryUnpacker('\x00\x01')
+      self.assertEqual(fbu.get(UINT16, endianness=BIGENDIAN), 1)
+
+      # Appending keeps the unread part intact
+      fbu = FastBinaryUnpacker('\x01\x02')
+      fbu.advance(1)
+      fbu.append('\x03')
+      self.assertEqual(fbu.getSize(), 3)
+      self.assertEqual(fbu.getRemainingString(), '\x02\x03')
+      self.assertEqual(fbu.getRemainingView().tobytes(), '\x02\x03')
+      self.assertEqual(fbu.get(UINT16, endianness=BIGENDIAN), 0x0203)
+
+      # mmaps get a read-only buffer instead of a memoryview
+      mappedData = mmap.mmap(-1, 3)
+      mappedData.write('\x01\x02\x03')
+      fbu = FastBinaryUnpacker(mappedData)
+      fbu.advance(1)
+      self.assertEqual(str(fbu.getRemainingView()), '\x02\x03')
+      self.assertEqual(fbu.get(UINT16, endianness=BIGENDIAN), 0x0203)
+
 # Running tests with "python <module name>" will NOT work for any Armory tests
 # You must run tests with "python -m unittest <module name>" or run all tests with "python -m unittest discover"
 # if __name__ == "__main__":
@@ -0,0 +1,216 @@
+import sys
+sys.path.append('..')
+import unittest
+import random
+
+from armoryengine.ArmoryUtils import ONE_BTC, CENT, SCRADDR_P2PKH_BYTE, \
+   SCRADDR_P2SH_BYTE, hash160_to_p2pkhash_script, hash160_to_p2sh_script
+from armoryengine.CoinSelection import PyUnspentTxOut, CoinSelectionIndex, \
+   PySelectCoins, PySelectCoins_BruteForce, PySortCoins, getSelectCoinsScores, \
+   PyEvalCoinSelect, UtxoSnapshot, UTXOREC_VALUE, UTXOREC_ADDRSTR
+
+
+################################################################################
+def makeUtxoList(nUtxo, seed):
+   rnd = random.Random(seed)
+   utxoList = []
+   for i in range(nUtxo):
+      a160 = chr(rnd.randint(0, max(nUtxo/3, 1)) % 256) * 20
+      val  = rnd.choice([rnd.randint(1,50)*CENT, rnd.randint(1,ONE_BTC*10), \
+                         rnd.randint(1,30)*10*CENT, 5430])
+      conf = rnd.choice([0, 1, 6, 100, rnd.randint(0,50000)])
+      utxoList.append(PyUnspentTxOut(SCRADDR_P2PKH_BYTE+a160, chr(i%256)*32, \
+                               i, val, conf, hash160_to_p2pkhash_script(a160)))
+   return utxoList
+
+
+################################################################################
+def sortByAddressGroups(utxoList):
+   """
+   Sort method 4, built straight from the UTXO objects:  confirmed UTXOs
+   grouped by address, best UTXO first in each group, groups by their best
+   UTXO (ties keep the order addresses first appear in the list, zero-conf
+   UTXOs included), then the zero-conf UTXOs in list order.
+   """
+   priority = lambda u: u.getNumConfirm()*u.getValue()**0.333
+   addrList = []
+   for utxo in utxoList:
+      if not utxo.getRecipientScrAddr() in addrList:
+         addrList.append(utxo.getRecipientScrAddr())
+   groups = [[u for u in utxoList if u.getRecipientScrAddr()==addr and \
+                                     u.getNumConfirm() > 0] for addr in addrList]
+   groups = [group for group in groups if group]
+
+   for group in groups:
+      group.sort(key=priority, reverse=True)
+   groups.sort(key=lambda group: priority(group[0]), reverse=True)
+   return sum(groups, []) + [u for u in utxoList if u.getNumConfirm() == 0]
+
+
+################################################################################
+class CoinSelectionIndexTest(unittest.TestCase):
+
+   #############################################################################
+   def testScoresMatchUtxoScores(self):
+      utxoList = makeUtxoList(60, 1)
+      coinIndex = CoinSelectionIndex(utxoList)
+      rnd = random.Random(2)
+      for i in range(50):
+         idxList = rnd.sample(range(60), rnd.randint(0,10))
+         target = rnd.randint(1, 5*ONE_BTC)
+         fee = rnd.choice([0, 10000])
+         utxos = coinIndex.getUtxos(idxList)
+         self.assertEqual(coinIndex.getSelectionScores(idxList, target, fee),
+                          getSelectCoinsScores(utxos, target, fee))
+         self.assertEqual(coinIndex.evalSelection(idxList, target, fee),
+                          PyEvalCoinSelect(utxos, target, fee))
+
+   #############################################################################
+   def testScoresIgnoreScriptType(self):
+      # Scoring assumes the same size for every TxIn, as it always has:
+      # P2SH (e.g. lockbox) inputs score exactly like P2PKH ones
+      utxoList = makeUtxoList(30, 4)
+      p2shList = [PyUnspentTxOut(SCRADDR_P2SH_BYTE+u.getRecipientScrAddr()[1:],
+                                 u.getTxHash(), u.getTxOutIndex(),
+                                 u.getValue(), u.getNumConfirm(),
+                                 hash160_to_p2sh_script(u.getRecipientScrAddr()[1:]))
+                                 for u in utxoList]
+      p2pkhIndex = CoinSelectionIndex(utxoList)
+      p2shIndex  = CoinSelectionIndex(p2shList)
+      rnd = random.Random(5)
+      for i in range(20):
+         idxList = rnd.sample(range(30), rnd.randint(1,8))
+         target = rnd.randint(1, 5*ONE_BTC)
+         self.assertEqual(p2shIndex.getSelectionScores(idxList, target, 0),
+                          p2pkhIndex.getSelectionScores(idxList, target, 0))
+         self.assertEqual(PyEvalCoinSelect(p2shIndex.getUtxos(idxList), target, 0),
+                          PyEvalCoinSelect(p2pkhIndex.getUtxos(idxList), target, 0))
+
+   #############################################################################
+   def testSortOrders(self):
+      utxoList = makeUtxoList(40, 3)
+      coinIndex = CoinSelectionIndex(utxoList)
+      for sortMethod in [0,1,2,3,5,6,7]:
+         self.assertEqual(coinIndex.getUtxos(coinIndex.getOrder(sortMethod)),
+                          PySortCoins(utxoList, sortMethod))
+
+   #############################################################################
+   def testSortByAddressGroups(self):
+      def utxo(i, a160, conf):
+         return PyUnspentTxOut(SCRADDR_P2PKH_BYTE+a160, chr(i)*32, i, ONE_BTC,
+                               conf, hash160_to_p2pkhash_script(a160))
+      addrA, addrB, addrC = '\x0a'*20, '\x0b'*20, '\x0c'*20
+      utxoList = [utxo(0, addrA, 10),  utxo(1, addrB, 100),
+                  utxo(2, addrA, 50),  utxo(3, addrC, 0),
+                  utxo(4, addrC, 100), utxo(5, addrB, 1),
+                  utxo(6, addrA, 0)]
+      coinIndex = CoinSelectionIndex(utxoList)
+
+      # Groups by their best UTXO, B and C tie so B (seen first) goes first.
+      # Zero-conf UTXOs go last, in list order.
+      self.assertEqual(coinIndex.getUtxos(coinIndex.getOrder(4)),
+                       sortByAddressGroups(utxoList))
+      for seed in range(10):
+         randomList = makeUtxoList(40, seed)
+         randomIndex = CoinSelectionIndex(randomList)
+         self.assertEqual(randomIndex.getUtxos(randomIndex.getOrder(4)),
+                          sortByAddressGroups(randomList))
+
+      # PySortCoins breaks the B/C tie by dict order, so it can only be
+      # checked for the same UTXOs
+      self.assertEqual(sorted(coinIndex.getUtxos(coinIndex.getOrder(4))),
+                       sorted(PySortCoins(utxoList, 4)))
+
+   #############################################################################
+   def testSameResultAsBruteForce(self):
+      # Without the random candidates, both must pick the same UTXOs
+      for seed in range(10):
+         utxoList = makeUtxoList(30, seed)
+         coinIndex = CoinSelectionIndex(utxoList)
+         total = sum([u.getValue() for u in utxoList])
+         for target in [total/5, total/2, total-10000]:
+            expected = PySelectCoins_BruteForce(utxoList, target, 10000, numRand=0)
+            result = coinIndex.selectCoins(target, 10000, numRand=0,
+                                                           exactMatch=False)
+            self.assertEqual([id(u) for u in result], [id(u) for u in expected])
+
+   #############################################################################
+   def testExactMatch(self):
+      # Subset-sum is exponential, keep the list small enough that the
+      # search can't run out of tries
+      utxoList = makeUtxoList(25, 4)
+      coinIndex = CoinSelectionIndex(utxoList)
+      confirmed = [i for i in range(25) if utxoList[i].getNumConfirm()>0]
+      for nPick in [1,2,3]:
+         picked = random.Random(nPick).sample(confirmed, nPick)
+         target = sum([utxoList[i].getValue() for i in picked])
+         match = coinIndex.selectExactMatch(target-10000, 10000)
+         self.assertEqual(sum([utxoList[i].getValue() for i in match]), target)
+
+      self.assertEqual(coinIndex.selectExactMatch(coinIndex.totalValue+1), [])
+
+   #############################################################################
+   def testPySelectCoins(self):
+      utxoList = makeUtxoList(500, 5)
+      coinIndex = CoinSelectionIndex(utxoList)
+      for target in [CENT, ONE_BTC, 20*ONE_BTC]:
+         selection = PySelectCoins(utxoList, target, 10000, coinIndex=coinIndex)
+         self.assertTrue(sum([u.getValue() for u in selection]) >= target+10000)
+         # Scores are only kept for the last run
+         self.assertTrue(all([key[1:] == (target, 10000) \
+                              for key in coinIndex.scoreCache]))
+
+      self.assertEqual(PySelectCoins(utxoList, coinIndex.totalValue+1), [])
+
+
+################################################################################
+class FakeCppUtxo(object):
+   def __init__(self, txHash, txoIdx, value, height, a160):
+      self.txHash, self.txoIdx = txHash, txoIdx
+      self.value, self.height, self.a160 = value, height, a160
+   def getTxHash(self):           return self.txHash
+   def getTxOutIndex(self):       return self.txoIdx
+   def getValue(self):            return self.value
+   def getTxHeight(self):         return self.height
+   def getScript(self):           return hash160_to_p2pkhash_script(self.a160)
+   def getRecipientScrAddr(self): return SCRADDR_P2PKH_BYTE + self.a160
+
+
+################################################################################
+class UtxoSnapshotTest(unittest.TestCase):
+
+   #############################################################################
+   def testUpdateAndDeltas(self):
+      utxoA = FakeCppUtxo('\xaa'*32, 0, ONE_BTC, 100, '\x01'*20)
+      utxoB = FakeCppUtxo('\xbb'*32, 1, CENT, 105, '\x02'*20)
+      snapshot = UtxoSnapshot(maxHistory=10)
+      snapshot.update([utxoA, utxoB], 110, 1)
+      self.assertTrue(snapshot.isCurrent(1, 110))
+      self.assertFalse(snapshot.isCurrent(2, 110))
+
+      recA,recB = snapshot.getRecords()
+      self.assertEqual(recA[UTXOREC_VALUE], ONE_BTC)
+      self.assertTrue(len(recA[UTXOREC_ADDRSTR]) > 0)
+      self.assertEqual(snapshot.getNumConfirm(recB), 6)
+      utxoList = snapshot.getUtxoList()
+      self.assertEqual([u.getNumConfirm() for u in utxoList], [11, 6])
+
+      # B spent, C received: A's record is reused as-is
+      utxoC = FakeCppUtxo('\xcc'*32, 0, 2*ONE_BTC, 112, '\x03'*20)
+      snapshot.update([utxoA, utxoC], 112, 2)
+      self.assertTrue(snapshot.getRecords()[0] is recA)
+      changed, removed = snapshot.getChangesSince(111)
+      self.assertEqual([r[UTXOREC_VALUE] for r in changed], [2*ONE_BTC])
+      self.assertEqual(removed, [('\xbb'*32, 1)])
+      self.assertEqual(len(snapshot.getChangesSince(110)[0]), 2)
+
+      # Deltas from before the kept history need a full list
+      snapshot.update([utxoA, utxoC], 130, 3)
+      self.assertEqual(snapshot.getChangesSince(111), None)
+      self.assertEqual(snapshot.getChangesSince(125), ([], []))
+
+
+# Running tests with "python <module name>" will NOT work for any Armory tests
+# You must run tests with "python -m unittest <module name>" or run all tests with "python -m unittest discover"
+# if __name__ == "__main__":
+#    unittest.main()
@@ -16,7 +16,8 @@ import sys
 sys.path.append('..')
 from pytest.Tiab import TiabTest
 import unittest
-from armoryengine.Decorators import EmailOutput
+from armoryengine.Decorators import EmailOutput, rpcWorkerMethod, \
+   RPC_WORKER_CPU, RPC_WORKER_IO
 
 
 # NOT a real unit test. To verify this test properly
@@ -34,6 +35,23 @@ class EmailOutputTest(TiabTest):
 def someStringOutputFunction(inputString):
    return "Hello " + inputString
 
+
+class RpcWorkerMethodTest(unittest.TestCase):
+
+   def testMarked(self):
+      @rpcWorkerMethod(RPC_WORKER_IO, walletArg=0)
+      def jsonrpc_slow(inB58ID):
+         return inB58ID
+      self.assertEqual(jsonrpc_slow('abc'), 'abc')
+      self.assertEqual(jsonrpc_slow.rpcWorker, RPC_WORKER_IO)
+      self.assertEqual(jsonrpc_slow.rpcWalletArg, 0)
+
+      @rpcWorkerMethod()
+      def jsonrpc_slowcpu():
+         pass
+      self.assertEqual(jsonrpc_slowcpu.rpcWorker, RPC_WORKER_CPU)
+      self.assertEqual(jsonrpc_slowcpu.rpcWalletArg, None)
+
 # Running tests with "python <module name>" will NOT work for any Armory tests
 # You must run tests with "python -m unittest <module name>" or run all tests with "python -m unittest discover"
 # if __name__ == "__main__":
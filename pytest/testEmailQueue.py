@@ -0,0 +1,169 @@
+import sys
+sys.path.append('..')
+import asyncore
+import email
+import os
+import shutil
+import smtpd
+import smtplib
+import tempfile
+import threading
+import time
+import unittest
+
+from armoryengine.ArmoryUtils import *
+from armoryengine.EmailQueue import *
+
+
+################################################################################
+# Stand-in SMTP server that keeps what it receives
+class LocalSmtpServer(smtpd.SMTPServer):
+   def __init__(self):
+      smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+      self.port = self.socket.getsockname()[1]
+      self.received = []
+      self.nConnect = 0
+
+   def handle_accept(self):
+      self.nConnect += 1
+      smtpd.SMTPServer.handle_accept(self)
+
+   def process_message(self, peer, mailfrom, rcpttos, data):
+      self.received.append((mailfrom, rcpttos, email.message_from_string(data)))
+
+
+def connectLocal(server, send_from, password):
+   # No STARTTLS or AUTH on the stand-in
+   host,port = server.split(':')
+   return smtplib.SMTP(host, int(port))
+
+
+################################################################################
+class EmailQueueTest(unittest.TestCase):
+
+   def setUp(self):
+      self.spoolDir = tempfile.mkdtemp()
+      self.smtpServer = LocalSmtpServer()
+      self.server = '127.0.0.1:%d' % self.smtpServer.port
+      self.asyncThread = threading.Thread(target=asyncore.loop, \
+                                          kwargs={'timeout': 0.05})
+      self.asyncThread.daemon = True
+      self.asyncThread.start()
+
+   def tearDown(self):
+      self.smtpServer.close()
+      self.asyncThread.join()
+      shutil.rmtree(self.spoolDir)
+
+   def makeQueue(self, batchDelay=0.2, spoolWait=EMAIL_SPOOL_WAIT):
+      return EmailQueue(self.spoolDir, batchDelay, connectLocal, spoolWait)
+
+   #############################################################################
+   def testBatchAndReuse(self):
+      queue = self.makeQueue()
+      queue.start()
+      queue.queueEmail('a@x.com', self.server, 'pw', 'b@y.com:c@y.com', \
+                       'New block', 'first')
+      queue.queueEmail('a@x.com', self.server, 'pw', 'b@y.com:c@y.com', \
+                       'New block', 'second')
+      queue.queueEmail('a@x.com', self.server, 'pw', 'd@y.com', \
+                       'New block', 'third')
+      self.assertTrue(queue.waitUntilSent(10))
+      queue.stop()
+
+      self.assertEqual(len(self.smtpServer.received), 2)
+      mailfrom,rcpttos,msg = self.smtpServer.received[0]
+      self.assertEqual(rcpttos, ['b@y.com', 'c@y.com'])
+      self.assertEqual(msg['Subject'], 'New block (2 notifications)')
+      body = msg.get_payload()[0].get_payload()
+      self.assertTrue(body.index('first') < body.index('second'))
+      self.assertEqual(self.smtpServer.received[1][1], ['d@y.com'])
+      # One connection for both messages, nothing left in the spool
+      self.assertEqual(self.smtpServer.nConnect, 1)
+      self.assertEqual(os.listdir(self.spoolDir), [])
+
+   #############################################################################
+   def testSpoolSurvivesRestart(self):
+      queue = self.makeQueue()
+      queue.queueEmail('a@x.com', self.server, 'secretpw', 'b@y.com', 'Hi', \
+                       'text')
+      # Never started, as if the process died before sending
+      spoolFiles = os.listdir(self.spoolDir)
+      self.assertEqual(len(spoolFiles), 1)
+      with open(os.path.join(self.spoolDir, spoolFiles[0])) as f:
+         self.assertFalse('secretpw' in f.read())
+
+      # Nothing goes out until the sender supplies the password again
+      queue = self.makeQueue()
+      self.assertEqual(queue.getNumQueued(), 1)
+      self.assertEqual(queue.getNumWaiting(), 1)
+      queue.start()
+      self.assertTrue(queue.waitUntilSent(1))
+      self.assertEqual(len(self.smtpServer.received), 0)
+
+      queue.queueEmail('a@x.com', self.server, 'secretpw', 'b@y.com', \
+                       'Again', 'more text')
+      self.assertEqual(queue.getNumWaiting(), 0)
+      self.assertTrue(queue.waitUntilSent(10))
+      queue.stop()
+      self.assertEqual(sorted([r[2]['Subject'] for r in \
+                               self.smtpServer.received]), ['Again', 'Hi'])
+      self.assertEqual(os.listdir(self.spoolDir), [])
+
+   #############################################################################
+   def testResumeSpooled(self):
+      queue = self.makeQueue()
+      queue.queueEmail('a@x.com', self.server, 'pw', 'b@y.com', 'Hi', 'text')
+
+      # Setting the sender up again sends what it left, without a new e-mail
+      queue = self.makeQueue()
+      queue.start()
+      self.assertEqual(queue.resumeSpooled('z@x.com', self.server, 'pw'), 0)
+      self.assertEqual(queue.resumeSpooled('a@x.com', self.server, 'pw'), 1)
+      self.assertTrue(queue.waitUntilSent(10))
+      queue.stop()
+      self.assertEqual([r[2]['Subject'] for r in self.smtpServer.received], \
+                       ['Hi'])
+      self.assertEqual(os.listdir(self.spoolDir), [])
+
+   #############################################################################
+   def testSpoolExpires(self):
+      queue = self.makeQueue()
+      queue.queueEmail('a@x.com', self.server, 'pw', 'b@y.com', 'Hi', 'text')
+
+      queue = self.makeQueue(spoolWait=0.2)
+      self.assertEqual(queue.getNumWaiting(), 1)
+      queue.start()
+      for i in range(100):
+         if queue.getNumQueued() == 0:
+            break
+         time.sleep(0.05)
+      queue.stop()
+      self.assertEqual(queue.getNumQueued(), 0)
+      self.assertEqual(len(self.smtpServer.received), 0)
+      self.assertEqual(os.listdir(self.spoolDir), [])
+
+   #############################################################################
+   def testRetry(self):
+      # Nothing listens on the port of a closed server
+      deadServer = LocalSmtpServer()
+      deadPort = deadServer.port
+      deadServer.close()
+
+      queue = self.makeQueue(0)
+      queue.start()
+      queue.queueEmail('a@x.com', '127.0.0.1:%d' % deadPort, 'pw', 'b@y.com', \
+                       'Hi', 'text')
+      self.assertFalse(queue.waitUntilSent(1))
+      queue.stop()
+
+      entry = queue.entries.values()[0]
+      self.assertEqual(entry['attempts'], 1)
+      self.assertTrue(entry['nextTry'] > RightNow() + EMAIL_RETRY_MIN/2)
+      self.assertEqual(len(os.listdir(self.spoolDir)), 1)
+
+
+# Running tests with "python <module name>" will NOT work for any Armory tests
+# You must run tests with "python -m unittest <module name>" or run all tests with "python -m unittest discover"
+# if __name__ == "__main__":
+#    unittest.main()
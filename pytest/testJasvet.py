@@ -111,3 +111,38 @@ class JasvetTester(unittest.TestCase):
       self.assertEqual(d[:31], b'-----BEGIN BITCOIN MESSAGE-----')
       self.assertEqual(d[-29:], b'-----END BITCOIN MESSAGE-----')
 
+
+   def testJacobianMul(self):
+      G = generator_secp256k1
+      twoG = G * 2
+      self.assertEqual(twoG.x(), 0xC6047F9441ED7D6D3045406E95C07CD85C778E4B8CEF3CA7ABAC09B95C709EE5L)
+      self.assertEqual(twoG.y(), 0x1AE168FEA63DC339A3C58419466CEAEEF7F632653266D0E1236431A950CFE52AL)
+      # Fixed-base table, generic multiplication and the affine additions
+      # all agree
+      P = G.double()
+      Pgen = Point(curve_secp256k1, P.x(), P.y())
+      for k in range(1, 40):
+         Pk = G * (k+1)
+         self.assertEqual((Pk.x(), Pk.y()), (P.x(), P.y()))
+         self.assertEqual(((Pgen*k).x(), (Pgen*k).y()), ((G*(2*k)).x(), (G*(2*k)).y()))
+         P = P + G
+      minusG = G * (G.order() - 1)
+      self.assertEqual((minusG.x(), minusG.y()), (G.x(), curve_secp256k1.p() - G.y()))
+      self.assertEqual(G * G.order(), INFINITY)
+      u1, u2 = 0x1234567890abcdefL << 100, 0xfedcba0987654321L << 120
+      Q = mul_add_G(u1, u2, Pgen)
+      R = G*u1 + Pgen*u2
+      self.assertEqual((Q.x(), Q.y()), (R.x(), R.y()))
+
+   def testBatchVerify(self):
+      sigList = []
+      for i in range(4):
+         sv0 = ASv0(chr(i+1)*32, b'Hello world %d' % i)
+         sigList.append((sv0['b64-signature'], sv0['message'], 'v0'))
+      sigList.append((sigList[0][0], b'Not the signed message', 'v0'))
+      sigList.append((b'bad', b'Hello world', 'v0'))
+      addrList = verifySignatures(sigList)
+      for i in range(4):
+         self.assertEqual(addrList[i], verifySignature(sigList[i][0], sigList[i][1]))
+      self.assertNotEqual(addrList[4], addrList[0])
+      self.assertEqual(addrList[5], None)
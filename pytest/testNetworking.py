@@ -0,0 +1,227 @@
+import sys
+sys.path.append('..')
+import unittest
+
+from armoryengine.ArmoryUtils import MAGIC_BYTES, hex_to_binary
+from armoryengine.BinaryUnpacker import BinaryUnpacker
+from armoryengine.Block import PyBlockHeader
+from armoryengine.Networking import NetworkFrameDecoder, NetworkStats, \
+   PyMessage, PayloadInv, PayloadPing, MSG_INV_TX, MSG_INV_BLOCK, \
+   LazyPyMessage, PayloadBlock, LazyPayloadBlock, ArmoryClient, \
+   PayloadHeaders, PayloadGetBlocks, PayloadGetHeaders, PayloadAddr, \
+   MSG_HEADER_STRUCT, MAX_PAYLOAD_SIZE
+from armoryengine.Transaction import PyTx
+
+
+tx1raw = hex_to_binary( \
+   '01000000016290dce984203b6a5032e543e9e272d8bce934c7de4d15fa0fe44d'
+   'd49ae4ece9010000008b48304502204f2fa458d439f957308bca264689aa175e'
+   '3b7c5f78a901cb450ebd20936b2c500221008ea3883a5b80128e55c9c6070aa6'
+   '264e1e0ce3d18b7cd7e85108ce3d18b7419a0141044202550a5a6d3bb81549c4'
+   'a7803b1ad59cdbba4770439a4923624a8acfc7d34900beb54a24188f7f0a4068'
+   '9d905d4847cc7d6c8d808a457d833c2d44ef83f76bffffffff0242582c0a0000'
+   '00001976a914c1b4695d53b6ee57a28647ce63e45665df6762c288ac80d1f008'
+   '000000001976a9140e0aec36fe2545fb31a41164fb6954adcd96b34288ac00000000')
+tx2raw = hex_to_binary( \
+   '0100000001f658dbc28e703d86ee17c9a2d3b167a8508b082fa0745f55be5144'
+   'a4369873aa010000008c49304602210041e1186ca9a41fdfe1569d5d807ca7ff'
+   '6c5ffd19d2ad1be42f7f2a20cdc8f1cc0221003366b5d64fe81e53910e156914'
+   '091d12646bc0d1d662b7a65ead3ebe4ab8f6c40141048d103d81ac9691cf13f3'
+   'fc94e44968ef67b27f58b27372c13108552d24a6ee04785838f34624b294afee'
+   '83749b64478bb8480c20b242c376e77eea2b3dc48b4bffffffff0200e1f50500'
+   '0000001976a9141b00a2f6899335366f04b277e19d777559c35bc888ac40aeeb'
+   '02000000001976a9140e0aec36fe2545fb31a41164fb6954adcd96b34288ac00000000')
+
+
+################################################################################
+def makeInvMessage(nInv):
+   inv = PayloadInv()
+   for i in range(nInv):
+      inv.invList.append([MSG_INV_TX if i%2 else MSG_INV_BLOCK, chr(i)*32])
+   return PyMessage(payload=inv)
+
+
+################################################################################
+class NetworkFrameDecoderTest(unittest.TestCase):
+
+   #############################################################################
+   def testWholeMessages(self):
+      msgs = [makeInvMessage(3), PyMessage(payload=PayloadPing()), \
+              makeInvMessage(40)]
+      decoder = NetworkFrameDecoder()
+      decoder.feed(''.join([m.serialize() for m in msgs]))
+      frames = decoder.popFrames()
+      self.assertEqual(len(frames), 3)
+      self.assertEqual(decoder.getBufferedSize(), 0)
+      for (magic,cmd,payload),msg in zip(frames, msgs):
+         self.assertEqual(magic, MAGIC_BYTES)
+         self.assertEqual(cmd, msg.cmd)
+         self.assertEqual(payload, msg.payload.serialize())
+
+      decoded = PyMessage().unserializePayload(*frames[2][1:])
+      self.assertEqual(decoded.payload.invList, msgs[2].payload.invList)
+
+   #############################################################################
+   def testChunkedStream(self):
+      # Feed one byte at a time, frames only come out once they're complete
+      first  = makeInvMessage(5).serialize()
+      stream = first + makeInvMessage(7).serialize()
+      decoder = NetworkFrameDecoder()
+      frames = []
+      for i in range(len(stream)):
+         decoder.feed(stream[i])
+         newFrames = decoder.popFrames()
+         if newFrames:
+            self.assertTrue(i+1 in [len(first), len(stream)])
+         frames.extend(newFrames)
+      self.assertEqual(len(frames), 2)
+      self.assertEqual(decoder.getBufferedSize(), 0)
+
+   #############################################################################
+   def testBadChecksum(self):
+      good = makeInvMessage(2).serialize()
+      bad  = good[:20] + '\x00\x00\x00\x00' + good[24:]
+      decoder = NetworkFrameDecoder()
+      decoder.feed(bad + good)
+      frames = decoder.popFrames()
+      self.assertEqual(len(frames), 1)
+      self.assertEqual(decoder.nBadChecksum, 1)
+
+   #############################################################################
+   def testOversizedFrame(self):
+      good = makeInvMessage(2).serialize()
+      huge = MSG_HEADER_STRUCT.pack(MAGIC_BYTES, 'block', MAX_PAYLOAD_SIZE+1,
+                                    '\x00'*4)
+      decoder = NetworkFrameDecoder()
+      decoder.feed(good + huge + '\x00'*1000)
+      self.assertEqual(len(decoder.popFrames()), 1)
+      self.assertTrue(decoder.isBroken())
+      self.assertEqual(decoder.getBufferedSize(), 0)
+
+      # Nothing more is buffered, and the client hangs up
+      decoder.feed(good)
+      self.assertEqual(decoder.getBufferedSize(), 0)
+      self.assertEqual(decoder.popFrames(), [])
+
+      hangups = []
+      class StubFactory(object):
+         netStats = NetworkStats()
+         lazyCommands = set()
+      class StubTransport(object):
+         loseConnection = lambda self: hangups.append(True)
+      client = ArmoryClient()
+      client.factory = StubFactory()
+      client.transport = StubTransport()
+      client.dataReceived(huge)
+      self.assertEqual(hangups, [True])
+
+   #############################################################################
+   def testNetworkStats(self):
+      stats = NetworkStats()
+      stats.addBytes(100)
+      stats.addMessage('tx', 0.5)
+      stats.addMessage('tx', 1.5)
+      stats.addMessage('inv', 1.0)
+      result = stats.getStats()
+      self.assertEqual(result['bytes'], 100)
+      self.assertEqual(result['messages'], 3)
+      self.assertEqual(result['commands']['tx']['count'], 2)
+      self.assertEqual(result['commands']['tx']['avgParseSec'], 1.0)
+      self.assertEqual(result['commands']['tx']['maxParseSec'], 1.5)
+      stats.reset()
+      self.assertEqual(stats.getStats()['messages'], 0)
+
+
+   #############################################################################
+   def testPayloadListsNotShared(self):
+      for payloadClass,attr in [(PayloadBlock, 'txList'), \
+                                (PayloadHeaders, 'headerList'), \
+                                (PayloadGetBlocks, 'hashList'), \
+                                (PayloadGetHeaders, 'hashList'), \
+                                (PayloadAddr, 'addrList')]:
+         getattr(payloadClass(), attr).append('x')
+         self.assertEqual(getattr(payloadClass(), attr), [])
+
+
+################################################################################
+class LazyPayloadTest(unittest.TestCase):
+
+   #############################################################################
+   def makeBlockPayload(self):
+      header = PyBlockHeader()
+      header.prevBlkHash = '\x11'*32
+      header.merkleRoot  = '\x22'*32
+      header.timestamp   = 1400000000
+      header.diffBits    = '\xff\xff\x00\x1d'
+      header.nonce       = 12345
+      txList = [PyTx().unserialize(tx1raw), PyTx().unserialize(tx2raw)]
+      return PayloadBlock(header, txList)
+
+   #############################################################################
+   def testLazyMessage(self):
+      payload = self.makeBlockPayload()
+      fullMsg = PyMessage(payload=payload)
+      frames = NetworkFrameDecoder()
+      frames.feed(fullMsg.serialize())
+      magic,cmd,rawPayload = frames.popFrames()[0]
+
+      msg = LazyPyMessage().unserializePayload(cmd, rawPayload, magic)
+      self.assertFalse(msg.isDecoded())
+      self.assertEqual(msg.serialize(), fullMsg.serialize())
+      self.assertFalse(msg.isDecoded())
+
+      self.assertTrue(isinstance(msg.payload, LazyPayloadBlock))
+      self.assertTrue(msg.isDecoded())
+      self.assertEqual(msg.payload.getHeader().getHash(), payload.header.getHash())
+      self.assertEqual(msg.serialize(), fullMsg.serialize())
+
+   #############################################################################
+   def testLazyPayloadBlock(self):
+      payload = self.makeBlockPayload()
+      lazyBlock = LazyPayloadBlock().unserialize(payload.serialize())
+      self.assertEqual(lazyBlock.getNumTx(), 2)
+      self.assertEqual(lazyBlock.getTxHashList(), payload.getTxHashList())
+
+      # Nothing gets decoded until we ask for a specific tx
+      self.assertEqual(lazyBlock.txList.txCache, [None, None])
+      self.assertEqual(lazyBlock.txList[1].serialize(), tx2raw)
+      self.assertEqual(lazyBlock.txList.txCache[0], None)
+      self.assertEqual([tx.serialize() for tx in lazyBlock.txList], \
+                                                             [tx1raw, tx2raw])
+      self.assertEqual(lazyBlock.serialize(), payload.serialize())
+
+      # Plain BinaryUnpackers work too, from their current position
+      blkData = BinaryUnpacker('\xff' + payload.serialize())
+      blkData.advance(1)
+      lazyBlock = LazyPayloadBlock().unserialize(blkData)
+      self.assertEqual(lazyBlock.serialize(), payload.serialize())
+      self.assertEqual(blkData.getRemainingSize(), 0)
+
+   #############################################################################
+   def testLazyBlockProcessed(self):
+      newBlocks = []
+      class StubFactory(object):
+         func_newBlock = lambda self,header,txList: \
+                                          newBlocks.append((header,txList))
+      client = ArmoryClient()
+      client.factory = StubFactory()
+
+      payload = self.makeBlockPayload()
+      rawPayload = payload.serialize()
+      client.processMessage(LazyPyMessage().unserializePayload('block', \
+                                                               rawPayload))
+      self.assertEqual(len(newBlocks), 1)
+      header,txList = newBlocks[0]
+      self.assertEqual(header.getHash(), payload.header.getHash())
+      self.assertEqual(txList.txCache, [None, None])
+
+      # A truncated block is skipped instead of raising out of the handler
+      client.processMessage(LazyPyMessage().unserializePayload('block', \
+                                                         rawPayload[:-40]))
+      self.assertEqual(len(newBlocks), 1)
+
+
+# Running tests with "python <module name>" will NOT work for any Armory tests
+# You must run tests with "python -m unittest <module name>" or run all tests with "python -m unittest discover"
+# if __name__ == "__main__":
+#    unittest.main()
@@ -0,0 +1,168 @@
+################################################################################
+#
+# Copyright (C) 2011-2015, Armory Technologies, Inc.
+# Distributed under the GNU Affero General Public License (AGPL v3)
+# See LICENSE or http://www.gnu.org/licenses/agpl.html
+#
+################################################################################
+import sys
+sys.path.append('..')
+sys.path.append('../samplemodules')
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import PassPhraseFinderPlugin
+from PassPhraseFinderPlugin import PassPhraseFinder, KnownSeg, \
+   UnknownCaseSeg, UnknownSeg
+
+
+################################################################################
+# Stand-ins for the wallet KDF and root address: the "KDF output" is the pass
+# phrase itself, and every pass phrase tried is recorded
+class FakeKdfOutput(object):
+   def __init__(self, passPhrase):
+      self.passPhrase = passPhrase
+
+   def destroy(self):
+      pass
+
+
+class FakeKdf(object):
+   def __init__(self, finder):
+      self.finder = finder
+
+   def DeriveKey(self, sbdPassPhrase):
+      return FakeKdfOutput(self.finder.tryPassPhrase(sbdPassPhrase.toBinStr()))
+
+
+class FakeRootAddr(object):
+   def __init__(self, passPhrase):
+      self.passPhrase = passPhrase
+
+   def verifyEncryptionKey(self, kdfOutput):
+      return kdfOutput.passPhrase == self.passPhrase
+
+
+class FakeWallet(object):
+   def __init__(self, passPhrase):
+      self.addrMap = {'ROOT': FakeRootAddr(passPhrase)}
+      self.labelName = 'Test Wallet'
+
+
+class RecordingFinder(PassPhraseFinder):
+   def __init__(self, passPhrase, checkpointPath, numWorkers, stopAfter=None):
+      PassPhraseFinder.__init__(self, FakeWallet(passPhrase), numWorkers, \
+                                checkpointPath)
+      self.stopAfter = stopAfter
+      self.tried = []
+      self.triedLock = threading.Lock()
+
+   def getThreadKdf(self):
+      return FakeKdf(self)
+
+   def tryPassPhrase(self, passPhrase):
+      with self.triedLock:
+         self.tried.append(passPhrase)
+         # Like the user pressing stop while this one is tested
+         if len(self.tried) == self.stopAfter:
+            self.isStopped = True
+      return passPhrase
+
+
+################################################################################
+class PassPhraseFinderTest(unittest.TestCase):
+
+   def setUp(self):
+      self.tempDir = tempfile.mkdtemp()
+      self.checkpointPath = os.path.join(self.tempDir, 'test.passsearch')
+      self.segList = [UnknownCaseSeg('ab').getSegList(), \
+                      KnownSeg('-').getSegList(), \
+                      UnknownSeg('123', 1, 2).getSegList()]
+      self.segOrdList = [[0, 1, 2], [2, 0], [1]]
+      self.origChunkSize = PassPhraseFinderPlugin.PASSPHRASE_CHUNK_SIZE
+      PassPhraseFinderPlugin.PASSPHRASE_CHUNK_SIZE = 5
+
+   def tearDown(self):
+      PassPhraseFinderPlugin.PASSPHRASE_CHUNK_SIZE = self.origChunkSize
+      shutil.rmtree(self.tempDir)
+
+   def search(self, finder, resume=True):
+      return finder.searchForPassPhrase(self.segList, self.segOrdList, \
+                                        lambda s: None, lambda: None, resume)
+
+   #############################################################################
+   def testIndexOrder(self):
+      finder = PassPhraseFinder(FakeWallet(''), 1, self.checkpointPath)
+      expected = list(finder.passPhraseGenerator(self.segList, self.segOrdList))
+      count = finder.countPassPhrases(self.segList, self.segOrdList)
+      # 4*1*12 + 12*4 + 1
+      self.assertEqual(count, 97)
+      self.assertEqual(len(expected), count)
+      self.assertEqual([finder.getPassPhraseByIndex(self.segList, \
+                                                    self.segOrdList, i) \
+                        for i in range(count)], expected)
+      self.assertRaises(IndexError, finder.getPassPhraseByIndex, \
+                        self.segList, self.segOrdList, count)
+
+   #############################################################################
+   def testResume(self):
+      finder = RecordingFinder(None, self.checkpointPath, 1)
+      allPassPhrases = list(finder.passPhraseGenerator(self.segList, \
+                                                       self.segOrdList))
+
+      # Stopped partway through a chunk
+      first = RecordingFinder(None, self.checkpointPath, 1, stopAfter=23)
+      self.assertEqual(self.search(first), None)
+      with open(self.checkpointPath) as f:
+         checkpoint = json.load(f)
+      self.assertEqual(checkpoint['nextIndex'], 23)
+      self.assertEqual(checkpoint['total'], len(allPassPhrases))
+      self.assertEqual(first.tried, allPassPhrases[:23])
+
+      # The rest, none skipped and none tried again
+      second = RecordingFinder(None, self.checkpointPath, 1)
+      self.assertEqual(self.search(second), None)
+      self.assertEqual(second.tried, allPassPhrases[23:])
+      self.assertFalse(os.path.exists(self.checkpointPath))
+
+   #############################################################################
+   def testResumeParallel(self):
+      allPassPhrases = list(RecordingFinder(None, self.checkpointPath, 1). \
+                       passPhraseGenerator(self.segList, self.segOrdList))
+      target = allPassPhrases[-3]
+
+      first = RecordingFinder(target, self.checkpointPath, 4, stopAfter=40)
+      self.assertEqual(self.search(first), None)
+      with open(self.checkpointPath) as f:
+         nextIndex = json.load(f)['nextIndex']
+      # Everything below the checkpoint was tried
+      self.assertTrue(set(allPassPhrases[:nextIndex]) <= set(first.tried))
+
+      # Nothing below the checkpoint is tried again, nothing is skipped up
+      # to the pass phrase.  Workers that were running when the search was
+      # stopped may have tried some above the checkpoint already.
+      second = RecordingFinder(target, self.checkpointPath, 4)
+      self.assertEqual(self.search(second), target)
+      self.assertEqual(len(set(second.tried)), len(second.tried))
+      self.assertTrue(set(second.tried) <= set(allPassPhrases[nextIndex:]))
+      self.assertTrue(set(allPassPhrases[nextIndex:-2]) <= set(second.tried))
+
+   #############################################################################
+   def testCheckpointForOtherSearch(self):
+      finder = RecordingFinder(None, self.checkpointPath, 1)
+      searchID = finder.getSearchID(self.segList, self.segOrdList)
+      finder.writeCheckpoint(searchID, 50, 97)
+      self.assertEqual(finder.readCheckpoint(searchID), 50)
+      otherID = finder.getSearchID(self.segList, [[0, 1, 2]])
+      self.assertNotEqual(otherID, searchID)
+      self.assertEqual(finder.readCheckpoint(otherID), 0)
+
+
+# Running tests with "python <module name>" will NOT work for any Armory tests
+# You must run tests with "python -m unittest <module name>" or run all tests with "python -m unittest discover"
+# if __name__ == "__main__":
+#    unittest.main()
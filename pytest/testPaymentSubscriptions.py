@@ -0,0 +1,147 @@
+################################################################################
+#
+# Copyright (C) 2011-2015, Armory Technologies, Inc.
+# Distributed under the GNU Affero General Public License (AGPL v3)
+# See LICENSE or http://www.gnu.org/licenses/agpl.html
+#
+################################################################################
+import sys
+sys.path.append('..')
+import unittest
+
+from twisted.internet import defer, task
+
+from armoryd import PaymentSubscriptions, SUBSCRIPTION_IDLE_EXPIRE
+from armoryengine.ArmoryUtils import SCRADDR_P2PKH_BYTE, RightNow
+
+
+ADDR_A = SCRADDR_P2PKH_BYTE + '\xaa'*20
+ADDR_B = SCRADDR_P2PKH_BYTE + '\xbb'*20
+
+
+################################################################################
+class PaymentSubscriptionsTest(unittest.TestCase):
+
+   def setUp(self):
+      # (scrAddr, minconf) -> amount received, and the lookups made
+      self.received = {}
+      self.lookups = []
+      self.clock = task.Clock()
+      self.subs = PaymentSubscriptions(self.getReceived, self.clock)
+
+   def getReceived(self, scrAddr, minconf):
+      self.lookups.append((scrAddr, minconf))
+      return self.received.get((scrAddr, minconf), 0)
+
+   def getResult(self, d):
+      results = []
+      d.addBoth(results.append)
+      self.assertEqual(len(results), 1)
+      return results[0]
+
+   #############################################################################
+   def testSubscribe(self):
+      self.received[(ADDR_A, 0)] = 3000
+      sub = self.subs.subscribe([ADDR_A, ADDR_B], 5000)
+      self.assertTrue(self.subs.hasSubscriptions())
+      self.assertEqual(sub.received, {ADDR_A: 3000, ADDR_B: 0})
+      self.assertEqual(self.subs.addrIndex[ADDR_A], set([sub.subID]))
+
+      jsonMap = sub.toJSONMap()
+      self.assertEqual(jsonMap['seq'], 0)
+      self.assertEqual(jsonMap['received'], 0.00003)
+      self.assertFalse(jsonMap['paid'])
+
+   #############################################################################
+   def testUpdateAddresses(self):
+      sub0 = self.subs.subscribe([ADDR_A], 5000, minconf=0)
+      sub1 = self.subs.subscribe([ADDR_A], 5000, minconf=1)
+      sub2 = self.subs.subscribe([ADDR_A], 5000, minconf=1)
+      other = self.subs.subscribe([ADDR_B], 5000)
+
+      # Zero-conf payment: only the minconf=0 subscription changes, and each
+      # (address, minconf) is looked up once
+      self.received[(ADDR_A, 0)] = 6000
+      self.lookups = []
+      self.subs.updateAddresses([ADDR_A])
+      self.assertEqual(sorted(self.lookups), [(ADDR_A, 0), (ADDR_A, 1)])
+      self.assertEqual((sub0.seq, sub1.seq, sub2.seq, other.seq), (1, 0, 0, 0))
+      self.assertTrue(sub0.toJSONMap()['paid'])
+      self.assertFalse(sub1.toJSONMap()['paid'])
+
+      # Confirmed, but less than the amount asked for
+      self.received[(ADDR_A, 1)] = 4000
+      self.subs.updateAddresses([ADDR_A])
+      self.assertEqual((sub0.seq, sub1.seq, sub2.seq), (1, 1, 1))
+      self.assertFalse(sub1.toJSONMap()['paid'])
+
+      self.received[(ADDR_A, 1)] = 6000
+      self.subs.onNewBlock()
+      self.assertEqual((sub0.seq, sub1.seq, sub2.seq), (1, 2, 2))
+      self.assertTrue(sub1.toJSONMap()['paid'])
+
+   #############################################################################
+   def testWaitFires(self):
+      sub = self.subs.subscribe([ADDR_A], 5000)
+      # A change the client hasn't seen yet comes back right away
+      self.assertEqual(self.subs.wait(sub.subID, -1, 30)['seq'], 0)
+
+      d = self.subs.wait(sub.subID, 0, 30)
+      self.assertFalse(d.called)
+      self.received[(ADDR_A, 0)] = 5000
+      self.subs.updateAddresses([ADDR_A])
+
+      jsonMap = self.getResult(d)
+      self.assertEqual(jsonMap['seq'], 1)
+      self.assertTrue(jsonMap['paid'])
+      self.assertEqual(sub.waiters, [])
+      self.assertEqual(self.clock.getDelayedCalls(), [])
+
+   #############################################################################
+   def testWaitTimesOut(self):
+      sub = self.subs.subscribe([ADDR_A], 5000)
+      d = self.subs.wait(sub.subID, 0, 30)
+      self.clock.advance(29)
+      self.assertFalse(d.called)
+      self.clock.advance(1)
+      self.assertEqual(self.getResult(d)['seq'], 0)
+      self.assertEqual(sub.waiters, [])
+
+   #############################################################################
+   def testWaitCancelled(self):
+      # What the RPC server does when the client disconnects
+      sub = self.subs.subscribe([ADDR_A], 5000)
+      d = self.subs.wait(sub.subID, 0, 30)
+      d.cancel()
+      self.assertTrue(self.getResult(d).check(defer.CancelledError))
+      self.assertEqual(sub.waiters, [])
+      self.assertEqual(self.clock.getDelayedCalls(), [])
+
+   #############################################################################
+   def testUnsubscribeAndExpire(self):
+      sub = self.subs.subscribe([ADDR_A, ADDR_B], 5000)
+      keep = self.subs.subscribe([ADDR_B], 5000)
+      d = self.subs.wait(sub.subID, 0, 30)
+
+      # Waiters get the last state instead of waiting for the timeout
+      self.subs.unsubscribe(sub.subID)
+      self.assertEqual(self.getResult(d)['id'], sub.subID)
+      self.assertFalse(self.subs.addrIndex.has_key(ADDR_A))
+      self.assertEqual(self.subs.addrIndex[ADDR_B], set([keep.subID]))
+      self.assertRaises(KeyError, self.subs.wait, sub.subID, 0, 30)
+
+      # Idle subscriptions expire, unless somebody waits on them
+      idle = self.subs.subscribe([ADDR_A], 5000)
+      idle.lastUsed = RightNow() - SUBSCRIPTION_IDLE_EXPIRE - 1
+      keep.lastUsed = idle.lastUsed
+      self.subs.wait(keep.subID, 0, 30)
+      keep.lastUsed = idle.lastUsed
+      self.subs.expireIdle()
+      self.assertEqual(self.subs.subMap.keys(), [keep.subID])
+      self.assertFalse(self.subs.addrIndex.has_key(ADDR_A))
+
+
+# Running tests with "python <module name>" will NOT work for any Armory tests
+# You must run tests with "python -m unittest <module name>" or run all tests with "python -m unittest discover"
+# if __name__ == "__main__":
+#    unittest.main()
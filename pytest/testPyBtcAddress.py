@@ -12,8 +12,11 @@ import unittest
 
 from CppBlockUtils import CryptoECDSA, SecureBinaryData
 from armoryengine.ArmoryUtils import hex_to_binary, RightNow, int_to_binary, \
-   checkAddrStrValid, hash256, UnserializeError, hash160_to_addrStr
-from armoryengine.PyBtcAddress import PyBtcAddress
+   checkAddrStrValid, hash256, UnserializeError, hash160_to_addrStr, \
+   KeyDataError
+from armoryengine.PyBtcAddress import PyBtcAddress, PyBtcAddressCompact, \
+   ChainDerivationEngine
+import armoryengine.PyBtcAddress
 
 
 sys.argv.append('--nologging')
@@ -326,7 +329,108 @@ class PyBtcAddressTest(TiabTest):
       self.assertEqual(priv2, priv2b)
    
    # TODO: Add coverage for condition where TheBDM is in BlockchainReady state.
-   
+
+   def testChainDerivationEngine(self):
+      chaincode = SecureBinaryData(hex_to_binary('ee'*32))
+      privRoot = PyBtcAddress().createFromPlainKeyData(PRIVATE_KEY, ADDRESS_20)
+      privRoot.markAsRootAddr(chaincode)
+      pubRoot = PyBtcAddress().createFromPublicKeyData(privRoot.binPublicKey65)
+      pubRoot.markAsRootAddr(chaincode)
+
+      engine = ChainDerivationEngine(numWorkers=3)
+      try:
+         for root in [privRoot, pubRoot]:
+            serialList = []
+            prevAddr = root
+            for i in range(20):
+               prevAddr = prevAddr.extendAddressChain()
+               serialList.append(prevAddr)
+
+            engineList = engine.extendChain(root, 20)
+            self.assertEqual([a.getAddr160() for a in engineList],
+                             [a.getAddr160() for a in serialList])
+            self.assertEqual([a.chainIndex for a in engineList], range(20))
+            self.assertEqual(engineList[-1].binPrivKey32_Plain.toHexStr(),
+                             serialList[-1].binPrivKey32_Plain.toHexStr())
+      finally:
+         engine.shutdown()
+
+      self.assertEqual(engine.nDerived, 40)
+      self.assertTrue(engine.getAddrPerSec() > 0)
+
+   def testChainDerivationEngineBadCheck(self):
+      chaincode = SecureBinaryData(hex_to_binary('ee'*32))
+      privRoot = PyBtcAddress().createFromPlainKeyData(PRIVATE_KEY, ADDRESS_20)
+      privRoot.markAsRootAddr(chaincode)
+      serialList = []
+      prevAddr = privRoot
+      for i in range(10):
+         prevAddr = prevAddr.extendAddressChain()
+         serialList.append(prevAddr)
+
+      # The second computation of address 5 disagrees with the first
+      class BadCheckEngine(ChainDerivationEngine):
+         def submitCheck(self, keyCheck, logLine):
+            if self.curIndex == 5:
+               keyCheck[4].destroy()
+               keyCheck = keyCheck[:4] + (SecureBinaryData('\x01'*32),)
+            ChainDerivationEngine.submitCheck(self, keyCheck, logLine)
+
+      loggedLines = []
+      origWriteLog = armoryengine.PyBtcAddress.writeMultiplierLog
+      armoryengine.PyBtcAddress.writeMultiplierLog = loggedLines.extend
+      engine = BadCheckEngine(numWorkers=2)
+      try:
+         engineList = engine.extendChain(privRoot, 10)
+      finally:
+         engine.shutdown()
+         armoryengine.PyBtcAddress.writeMultiplierLog = origWriteLog
+
+      # Only the checks before the bad one count, the rest is re-derived
+      self.assertEqual(len(loggedLines), 5)
+      self.assertEqual([a.getAddr160() for a in engineList],
+                       [a.getAddr160() for a in serialList])
+      self.assertEqual([a.chainIndex for a in engineList], range(10))
+      self.assertEqual(engineList[-1].binPrivKey32_Plain.toHexStr(),
+                       serialList[-1].binPrivKey32_Plain.toHexStr())
+   
+   def testCompactAddress(self):
+      chaincode = SecureBinaryData(hex_to_binary('ee'*32))
+      privAddr = PyBtcAddress().createFromPlainKeyData(PRIVATE_KEY, ADDRESS_20)
+      self.assertRaises(KeyDataError, PyBtcAddressCompact().createFromPyBtcAddress, privAddr)
+
+      pubAddr = PyBtcAddress().createFromPublicKeyData(PUBLIC_KEY)
+      pubAddr.markAsRootAddr(chaincode)
+      pubAddr = pubAddr.extendAddressChain()
+      pubAddr.walletByteLoc = 1234
+      pubAddr.touch(1400000000, TEST_BLOCK_NUM)
+      compAddr = PyBtcAddressCompact().createFromPyBtcAddress(pubAddr)
+
+      self.assertEqual(compAddr.serialize(), pubAddr.serialize())
+      self.assertEqual(compAddr.toPyBtcAddress().serialize(), pubAddr.serialize())
+      self.assertEqual(compAddr.getAddrStr(), pubAddr.getAddrStr())
+      self.assertEqual(compAddr.getAddr160(), pubAddr.getAddr160())
+      self.assertEqual(compAddr.binPublicKey65.toHexStr(), pubAddr.binPublicKey65.toHexStr())
+      self.assertEqual(compAddr.getChainCode().toHexStr(), chaincode.toHexStr())
+      self.assertEqual(compAddr.chainIndex, 0)
+      self.assertEqual(compAddr.walletByteLoc, 1234)
+      self.assertEqual(compAddr.getTimeRange(), pubAddr.getTimeRange())
+      self.assertEqual(compAddr.getBlockRange(), pubAddr.getBlockRange())
+      self.assertFalse(compAddr.hasPrivKey())
+      self.assertFalse(compAddr.isLocked)
+      self.assertFalse(hasattr(compAddr, '__dict__'))
+
+      # Extending the chain and touching work without promoting it
+      self.assertEqual(compAddr.extendAddressChain().serialize(),
+                       pubAddr.extendAddressChain().serialize())
+      compAddr.touch(1500000000, TEST_BLOCK_NUM+1)
+      pubAddr.touch(1500000000, TEST_BLOCK_NUM+1)
+      self.assertEqual(compAddr.serialize(), pubAddr.serialize())
+
+      # Copies are full addresses
+      self.assertTrue(isinstance(compAddr.copy(), PyBtcAddress))
+      self.assertEqual(compAddr.copy().serialize(), pubAddr.serialize())
+      
    def testTouch(self):
       self.verifyBlockHeight()
       testAddr = PyBtcAddress().createFromPlainKeyData(PRIVATE_KEY, ADDRESS_20, publicKey65=PUBLIC_KEY)
@@ -16,6 +16,8 @@ from armoryengine.ArmoryUtils import convertKeyDataToAddress, \
    hash256, binary_to_hex, hex_to_binary, CLI_OPTIONS, \
    WalletLockError, InterruptTestError, MULTISIG_FILE_NAME
 from armoryengine.PyBtcWallet import PyBtcWallet
+from armoryengine.PyBtcAddress import PyBtcAddress, PyBtcAddressCompact, \
+                                     ChainDerivationEngine
 from armoryengine.BDM import TheBDM
 
 
@@ -91,6 +93,202 @@ class PyBtcWalletTest(TiabTest):
       lboxWltB = PyBtcWallet().readWalletFile(lboxWltBFile)
       self.assertTrue(lboxWltB.isWltSigningAnyLockbox(lockboxList))
       
+   def testComputeNextAddressBatch(self):
+      # A second copy of the same wallet, extended one address at a time
+      seqPath = os.path.join(self.armoryHomeDir, 'armory_seq_test_.wallet')
+      seqBackupPath = os.path.join(self.armoryHomeDir, 'armory_seq_test_backup.wallet')
+      self.removeFileList([seqPath, seqBackupPath])
+      self.addCleanup(self.removeFileList, [seqPath, seqBackupPath])
+      seqWlt = PyBtcWallet().createNewWallet(newWalletFilePath=seqPath, \
+                                          withEncrypt=False, \
+                                          plainRootKey=self.privKey, \
+                                          chaincode=self.chainstr, \
+                                          IV=SecureBinaryData(hex_to_binary('77'*16)), \
+                                          shortLabel=self.shortlabel, \
+                                          armoryHomeDir = self.armoryHomeDir)
+      seq160List = [seqWlt.computeNextAddress() for i in range(25)]
+
+      progress = []
+      startIndex = self.wlt.lastComputedChainIndex
+      batch160List = self.wlt.computeNextAddressBatch(25, \
+                              Progress=lambda i,n: progress.append((i,n)))
+      self.assertEqual(batch160List, seq160List)
+      self.assertEqual(progress[-1], (25,25))
+      self.assertEqual(self.wlt.lastComputedChainIndex, startIndex+25)
+      self.assertEqual(self.wlt.getAddress160ByChainIndex(startIndex+25), \
+                       batch160List[-1])
+      self.assertEqual(self.wlt.computeNextAddressBatch(0), [])
+
+      # Everything made it to the file
+      wlt2 = PyBtcWallet().readWalletFile(self.wlt.walletPath)
+      self.assertTrue(self.wlt.isEqualTo(wlt2))
+
+   def testLazyUnlock(self):
+      lazyPath = os.path.join(self.armoryHomeDir, 'armory_lazy_test_.wallet')
+      lazyBackupPath = os.path.join(self.armoryHomeDir, 'armory_lazy_test_backup.wallet')
+      self.removeFileList([lazyPath, lazyBackupPath])
+      self.addCleanup(self.removeFileList, [lazyPath, lazyBackupPath])
+      passphrase = SecureBinaryData('hello')
+      wltE = PyBtcWallet().createNewWallet(newWalletFilePath=lazyPath, \
+                                          withEncrypt=True, \
+                                          plainRootKey=SecureBinaryData('\xbb'*32), \
+                                          securePassphrase=passphrase, \
+                                          chaincode=SecureBinaryData('\xdd'*32), \
+                                          IV=SecureBinaryData(hex_to_binary('66'*16)), \
+                                          shortLabel=self.shortlabel, \
+                                          armoryHomeDir = self.armoryHomeDir)
+      # Chained while locked, keys are computed on the next unlock
+      new160List = [wltE.computeNextAddress() for i in range(3)]
+      self.assertTrue(wltE.addrMap[new160List[-1]].createPrivKeyNextUnlock)
+
+      # Reference keys from a full unlock of a second copy
+      wltFull = PyBtcWallet().readWalletFile(lazyPath)
+      wltFull.unlock(securePassphrase=passphrase)
+      addr160List = [a160 for idx,a160,addrObj in \
+                                 wltFull.getAddrListSortedByChainIndex()][:10]
+
+      wltE.unlock(securePassphrase=passphrase, lazy=True)
+      self.assertFalse(wltE.isLocked)
+      self.assertTrue(all([a.isLocked for a in wltE.addrMap.values()]))
+
+      # Public data only, nothing gets decrypted
+      self.assertTrue(wltE.getAddrByHash160(new160List[0]).isLocked)
+      self.assertTrue(wltE.getAddrByHash160(addr160List[0]).isLocked)
+      self.assertEqual(len(wltE.lazyUnlockedAddrs), 0)
+
+      for a160 in [new160List[-1]] + addr160List:
+         addrObj = wltE.getAddrByHash160(a160, withPrivKey=True)
+         self.assertFalse(addrObj.isLocked)
+         self.assertEqual(addrObj.binPrivKey32_Plain.toHexStr(), \
+                          wltFull.addrMap[a160].binPrivKey32_Plain.toHexStr())
+
+      # The LRU bound relocks the least recently used keys
+      wltE.lazyKeyCacheSize = 2
+      wltE.relockLazyKeys()
+      self.assertEqual(len(wltE.lazyUnlockedAddrs), 2)
+      self.assertTrue(wltE.addrMap[new160List[-1]].isLocked)
+      self.assertFalse(wltE.addrMap[addr160List[-1]].isLocked)
+
+      # Extending the chain leaves no decrypted keys outside the LRU
+      wltE.computeNextAddress()
+      wltE.computeNextAddressBatch(5)
+      chainEngine = ChainDerivationEngine()
+      try:
+         wltE.computeNextAddressBatch(5, chainEngine=chainEngine)
+      finally:
+         chainEngine.shutdown()
+      self.assertTrue(all([a.isLocked for a160,a in wltE.addrMap.iteritems() \
+                                     if not a160 in wltE.lazyUnlockedAddrs]))
+
+      # Imported keys stay encrypted until used, and then go in the LRU
+      import160 = convertKeyDataToAddress(self.privKey2)
+      wltE.importExternalAddressData(privKey=self.privKey2)
+      self.assertTrue(wltE.addrMap[import160].isLocked)
+      addrObj = wltE.getAddrByHash160(import160, withPrivKey=True)
+      self.assertEqual(addrObj.binPrivKey32_Plain.toHexStr(), \
+                       self.privKey2.toHexStr())
+      self.assertTrue(import160 in wltE.lazyUnlockedAddrs)
+
+      wltE.lock()
+      self.assertTrue(wltE.isLocked)
+      self.assertFalse(wltE.lazyUnlock)
+      self.assertTrue(all([a.isLocked for a in wltE.addrMap.values()]))
+
+      # Keys computed by the lazy unlock made it to the file
+      wlt2 = PyBtcWallet().readWalletFile(lazyPath)
+      self.assertFalse(wlt2.addrMap[new160List[-1]].createPrivKeyNextUnlock)
+
+   def testLazyLoad(self):
+      self.wlt.computeNextAddressBatch(10)
+      self.wlt.setComment(self.wlt.getAddress160ByChainIndex(3), 'lazy')
+      eagerWlt = PyBtcWallet().readWalletFile(self.wlt.walletPath)
+      lazyWlt = PyBtcWallet().readWalletFile(self.wlt.walletPath, \
+                                             verifyIntegrity=False, lazyLoad=True)
+
+      # Only the index is read, nothing is loaded but the root
+      self.assertEqual(len(lazyWlt.addrMap), len(eagerWlt.addrMap))
+      self.assertEqual(len(lazyWlt.addrMap.getPendingList()), len(eagerWlt.addrMap)-1)
+      self.assertEqual(lazyWlt.linearAddr160List, eagerWlt.linearAddr160List)
+      self.assertEqual(lazyWlt.chainIndexMap, eagerWlt.chainIndexMap)
+      self.assertEqual(lazyWlt.lastComputedChainAddr160, eagerWlt.lastComputedChainAddr160)
+      self.assertEqual(lazyWlt.commentsMap, eagerWlt.commentsMap)
+      a160 = eagerWlt.getAddress160ByChainIndex(5)
+      self.assertEqual(lazyWlt.addrMap.getChainIndex(a160), 5)
+
+      addrObj = lazyWlt.getAddrByHash160(a160)
+      self.assertTrue(lazyWlt.addrMap.isLoaded(a160))
+      self.assertEqual(addrObj.serialize(), eagerWlt.addrMap[a160].serialize())
+      self.assertEqual(addrObj.walletByteLoc, eagerWlt.addrMap[a160].walletByteLoc)
+      self.assertEqual(len(lazyWlt.addrMap.getPendingList()), len(eagerWlt.addrMap)-2)
+
+      # Writing to the file detaches it from the index
+      lazyWlt.computeNextAddress()
+      self.assertTrue(lazyWlt.isEqualTo(PyBtcWallet().readWalletFile(lazyWlt.walletPath)))
+
+   def testLazyLoadWatchOnly(self):
+      watchPath = os.path.join(self.armoryHomeDir, 'armory_lazywatch_test_.wallet')
+      watchBackupPath = os.path.join(self.armoryHomeDir, 'armory_lazywatch_test_backup.wallet')
+      self.removeFileList([watchPath, watchBackupPath])
+      self.addCleanup(self.removeFileList, [watchPath, watchBackupPath])
+      self.wlt.computeNextAddressBatch(10)
+      self.wlt.forkOnlineWallet(watchPath)
+
+      # Reading the forked root address fixes it in the file, which must not
+      # pull the mapped file out from under the index
+      lazyWlt = PyBtcWallet().readWalletFile(watchPath, lazyLoad=True)
+      eagerWlt = PyBtcWallet().readWalletFile(watchPath)
+      self.assertEqual(lazyWlt.linearAddr160List, eagerWlt.linearAddr160List)
+      self.assertEqual(lazyWlt.chainIndexMap, eagerWlt.chainIndexMap)
+      self.assertTrue(lazyWlt.isEqualTo(eagerWlt))
+
+   def testLazyLoadFixesByteErrors(self):
+      self.wlt.computeNextAddressBatch(10)
+      a160 = self.wlt.getAddress160ByChainIndex(7)
+      addrData = self.wlt.addrMap[a160].serialize()
+      # Flip a byte of the chaincode, the checksum lets us correct it
+      errLoc = self.wlt.addrMap[a160].walletByteLoc + 40
+      wltfile = open(self.wlt.walletPath, 'r+b')
+      wltfile.seek(errLoc)
+      wltfile.write(chr(ord(addrData[40]) ^ 0x01))
+      wltfile.close()
+
+      lazyWlt = PyBtcWallet().readWalletFile(self.wlt.walletPath, lazyLoad=True)
+      lazyWlt.addrCheckThread.join()
+      self.assertEqual(lazyWlt.addrCheckThread.getOutput(), 1)
+      self.assertTrue(lazyWlt.addrMap.isLoaded(a160))
+
+      wltfile = open(self.wlt.walletPath, 'rb')
+      wltfile.seek(errLoc)
+      self.assertEqual(wltfile.read(1), addrData[40])
+      wltfile.close()
+
+   def testCompactAddrs(self):
+      watchPath = os.path.join(self.armoryHomeDir, 'armory_watch_test_.wallet')
+      watchBackupPath = os.path.join(self.armoryHomeDir, 'armory_watch_test_backup.wallet')
+      self.removeFileList([watchPath, watchBackupPath])
+      self.addCleanup(self.removeFileList, [watchPath, watchBackupPath])
+      self.wlt.forkOnlineWallet(watchPath)
+
+      fullWlt = PyBtcWallet().readWalletFile(watchPath)
+      for lazyLoad in [False, True]:
+         compWlt = PyBtcWallet().readWalletFile(watchPath, lazyLoad=lazyLoad, \
+                                                compactAddrs=True)
+         a160 = compWlt.lastComputedChainAddr160
+         self.assertTrue(isinstance(compWlt.addrMap[a160], PyBtcAddressCompact))
+         self.assertTrue(compWlt.isEqualTo(fullWlt))
+
+         # Only promoted when asked for with the key data
+         addrObj = compWlt.getAddrByHash160(a160)
+         self.assertTrue(isinstance(addrObj, PyBtcAddressCompact))
+         addrObj = compWlt.getAddrByHash160(a160, withPrivKey=True)
+         self.assertTrue(isinstance(addrObj, PyBtcAddress))
+         self.assertTrue(compWlt.addrMap[a160] is addrObj)
+
+      # New addresses are compact too, and make it to the file
+      new160 = compWlt.computeNextAddress()
+      self.assertTrue(isinstance(compWlt.addrMap[new160], PyBtcAddressCompact))
+      self.assertTrue(compWlt.isEqualTo(PyBtcWallet().readWalletFile(watchPath)))
+
    # Remove wallet files, need fresh dir for this test
    
    def testPyBtcWallet(self):
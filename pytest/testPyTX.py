@@ -16,7 +16,10 @@ from armoryengine.PyBtcAddress import PyBtcAddress
 from armoryengine.Script import PyScriptProcessor
 from armoryengine.Transaction import PyTx, PyTxIn, PyOutPoint, PyTxOut, \
    PyCreateAndSignTx, getMultisigScriptInfo, BlockComponent,\
-   PyCreateAndSignTx_old
+   PyCreateAndSignTx_old, LedgerCursor, LedgerValueCache, \
+   determineSentToSelfAmtCached, TheLedgerValueCache
+import armoryengine.Transaction
+from armoryengine.BDM import TheBDM
 
 
 
@@ -454,6 +457,120 @@ class PyTXTest(TiabTest):
    
    # TODO:  Add some tests for the OP_CHECKMULTISIG support in TxDP
 
+
+class FakeLedgerWallet(object):
+   # History pages of integers, each page oldest first like the C++ wallet
+   def __init__(self, pageSizes):
+      self.pages = []
+      n = sum(pageSizes)
+      for size in pageSizes:
+         self.pages.append(range(n-size, n))
+         n -= size
+      self.fetched = []
+
+   def getHistoryPageCount(self):
+      return len(self.pages)
+
+   def getHistoryPageAsVector(self, pageId):
+      self.fetched.append(pageId)
+      return list(self.pages[pageId])
+
+
+class LedgerCursorTest(unittest.TestCase):
+
+   def setUp(self):
+      self.origUtxoEpoch = TheBDM.utxoEpoch
+
+   def tearDown(self):
+      TheBDM.utxoEpoch = self.origUtxoEpoch
+
+   def testGetSlice(self):
+      wlt = FakeLedgerWallet([5, 3, 7, 4])
+      cursor = LedgerCursor(wlt, maxCachedPages=1)
+      allEntries = range(18, -1, -1)
+      self.assertEqual(cursor.getSlice(0, 100), allEntries)
+      for fromIdx in range(20):
+         for count in [1, 3, 8]:
+            self.assertEqual(cursor.getSlice(fromIdx, count),
+                             allEntries[fromIdx:fromIdx+count])
+
+      # Once the page counts are known, only the overlapping pages are fetched
+      wlt.fetched = []
+      cursor.getSlice(0, 1)
+      cursor.getSlice(9, 2)
+      self.assertEqual(wlt.fetched, [0, 2])
+
+      # A new epoch drops what the cursor knew about the pages
+      TheBDM.utxoEpoch += 1
+      wlt.fetched = []
+      cursor.getSlice(9, 2)
+      self.assertEqual(wlt.fetched, [0, 1, 2])
+
+
+class LedgerValueCacheTest(unittest.TestCase):
+
+   def setUp(self):
+      self.origReorgEpoch = TheBDM.reorgEpoch
+
+   def tearDown(self):
+      TheBDM.reorgEpoch = self.origReorgEpoch
+      TheLedgerValueCache.clear()
+
+   def testLRUAndEviction(self):
+      cache = LedgerValueCache(maxEntries=3)
+      self.assertEqual(cache.lookup('a'*32, None, 'fee'), (False, None))
+      cache.store('a'*32, None, 'fee', 1000)
+      cache.store('b'*32, 'wltA', 'comment', 'b')
+      cache.store('c'*32, 'wltA', 'comment', 'c')
+      self.assertEqual(cache.lookup('a'*32, None, 'fee'), (True, 1000))
+
+      # 'b' is now the least recently used
+      cache.store('d'*32, 'wltB', 'comment', 'd')
+      self.assertEqual(cache.lookup('b'*32, 'wltA', 'comment'), (False, None))
+      self.assertEqual(cache.lookup('c'*32, 'wltA', 'comment'), (True, 'c'))
+
+      cache.evictWallet('wltA', 'comment')
+      self.assertEqual(cache.lookup('c'*32, 'wltA', 'comment'), (False, None))
+      self.assertEqual(cache.lookup('d'*32, 'wltB', 'comment'), (True, 'd'))
+
+      stats = cache.getStats()
+      self.assertEqual((stats['hits'], stats['misses'], stats['evictions']),
+                       (3, 3, 1))
+
+      # A reorg drops everything
+      TheBDM.reorgEpoch += 1
+      self.assertEqual(cache.lookup('a'*32, None, 'fee'), (False, None))
+      self.assertEqual(cache.getStats()['size'], 0)
+
+   def testSentToSelfForCppWallet(self):
+      # getledger only has the cppWallet, which has no uniqueIDB58
+      class FakeLedgerEntry(object):
+         def getTxHash(self):     return 'e'*32
+         def isSentToSelf(self):  return True
+         def getBlockNum(self):   return 1000
+
+      computed = []
+      def fakeDetermine(le, wlt):
+         computed.append(wlt)
+         return (5000, 1)
+
+      origDetermine = armoryengine.Transaction.determineSentToSelfAmt
+      armoryengine.Transaction.determineSentToSelfAmt = fakeDetermine
+      TheLedgerValueCache.clear()
+      try:
+         le, cppWallet = FakeLedgerEntry(), object()
+         for i in range(3):
+            self.assertEqual(determineSentToSelfAmtCached(le, cppWallet, \
+                                                          'wltA'), (5000, 1))
+         self.assertEqual(computed, [cppWallet])
+
+         # Without an ID there's nothing to key the cache on
+         determineSentToSelfAmtCached(le, cppWallet)
+         self.assertEqual(len(computed), 2)
+      finally:
+         armoryengine.Transaction.determineSentToSelfAmt = origDetermine
+         TheLedgerValueCache.clear()
+
 # Running tests with "python <module name>" will NOT work for any Armory tests
 # You must run tests with "python -m unittest <module name>" or run all tests with "python -m unittest discover"
 # if __name__ == "__main__":
@@ -0,0 +1,210 @@
+################################################################################
+#
+# Copyright (C) 2011-2015, Armory Technologies, Inc.
+# Distributed under the GNU Affero General Public License (AGPL v3)
+# See LICENSE or http://www.gnu.org/licenses/agpl.html
+#
+################################################################################
+import sys
+sys.path.append('..')
+import threading
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from armoryd import RpcDispatcher
+from armoryengine.Decorators import rpcWorkerMethod, RPC_WORKER_CPU, \
+   RPC_WORKER_IO
+
+
+# How long a worker call waits for the other calls of a test, so a broken
+# dispatcher fails the test instead of hanging it
+CALL_WAIT = 5
+
+
+################################################################################
+class RpcDispatcherTest(unittest.TestCase):
+
+   def setUp(self):
+      self.dispatcher = RpcDispatcher(2, 2)
+      self.dispatcher.start()
+
+   def tearDown(self):
+      self.dispatcher.stop()
+
+   def callOn(self, lockID, func, *args):
+      return self.dispatcher.callFunction(func.__name__, func, \
+                                          lambda: lockID, args)
+
+   #############################################################################
+   @defer.inlineCallbacks
+   def testSerializedPerWallet(self):
+      firstRunning = threading.Event()
+      releaseFirst = threading.Event()
+      order = []
+
+      @rpcWorkerMethod(RPC_WORKER_IO)
+      def first():
+         order.append('first start')
+         firstRunning.set()
+         releaseFirst.wait(CALL_WAIT)
+         order.append('first end')
+         return 1
+
+      @rpcWorkerMethod(RPC_WORKER_IO)
+      def second():
+         order.append('second')
+         return 2
+
+      d1 = self.callOn('wltA', first)
+      d2 = self.callOn('wltA', second)
+      firstRunning.wait(CALL_WAIT)
+      # The second call waits for the wallet lock, not for a worker
+      self.assertTrue(self.dispatcher.isWalletBusy('wltA'))
+      self.assertFalse(d2.called)
+      releaseFirst.set()
+
+      results = yield defer.gatherResults([d1, d2])
+      self.assertEqual(results, [1, 2])
+      self.assertEqual(order, ['first start', 'first end', 'second'])
+      self.assertFalse(self.dispatcher.isWalletBusy('wltA'))
+
+   #############################################################################
+   @defer.inlineCallbacks
+   def testParallelAcrossWallets(self):
+      started = {'wltA': threading.Event(), 'wltB': threading.Event()}
+
+      def makeCall(mine, other):
+         @rpcWorkerMethod(RPC_WORKER_CPU)
+         def call():
+            started[mine].set()
+            # Only True if the other wallet's call runs at the same time
+            return started[other].wait(CALL_WAIT)
+         return call
+
+      results = yield defer.gatherResults([ \
+                        self.callOn('wltA', makeCall('wltA', 'wltB')),
+                        self.callOn('wltB', makeCall('wltB', 'wltA'))])
+      self.assertEqual(results, [True, True])
+
+   #############################################################################
+   @defer.inlineCallbacks
+   def testErrorPropagation(self):
+      @rpcWorkerMethod(RPC_WORKER_IO)
+      def failing():
+         raise ValueError('bad wallet data')
+
+      @rpcWorkerMethod(RPC_WORKER_IO)
+      def working():
+         return 'ok'
+
+      # Errors come back through the Deferred, on workers and the reactor
+      yield self.assertFailure(self.callOn('wltA', failing), ValueError)
+      failing.rpcWorker = None
+      yield self.assertFailure(self.callOn('wltA', failing), ValueError)
+
+      # ... and the failed calls gave the wallet lock back
+      result = yield self.callOn('wltA', working)
+      self.assertEqual(result, 'ok')
+      stats = self.dispatcher.getStats()
+      self.assertEqual(stats['methods']['failing']['run']['calls'], 2)
+      self.assertEqual(stats['queued'], 0)
+      self.assertEqual(stats['active'], 0)
+
+   #############################################################################
+   @defer.inlineCallbacks
+   def testCancel(self):
+      # What the RPC server does when a client disconnects
+      workerRunning = threading.Event()
+      releaseWorker = threading.Event()
+
+      @rpcWorkerMethod(RPC_WORKER_IO)
+      def slow():
+         workerRunning.set()
+         releaseWorker.wait(CALL_WAIT)
+
+      @rpcWorkerMethod(RPC_WORKER_IO)
+      def queued():
+         return 'never run'
+
+      d1 = self.callOn('wltA', slow)
+      d2 = self.callOn('wltA', queued)
+      workerRunning.wait(CALL_WAIT)
+
+      d2.cancel()
+      yield self.assertFailure(d2, defer.CancelledError)
+      self.assertEqual(self.dispatcher.getStats()['queued'], 0)
+
+      # The thread can't be stopped, so it keeps the wallet lock until done
+      d1.cancel()
+      yield self.assertFailure(d1, defer.CancelledError)
+      self.assertTrue(self.dispatcher.isWalletBusy('wltA'))
+      releaseWorker.set()
+
+      @rpcWorkerMethod(RPC_WORKER_IO)
+      def after():
+         return 'ok'
+      result = yield self.callOn('wltA', after)
+      self.assertEqual(result, 'ok')
+      self.assertTrue(self.dispatcher.methodStats.has_key('slow'))
+      self.assertFalse(self.dispatcher.methodStats.has_key('queued'))
+
+   #############################################################################
+   @defer.inlineCallbacks
+   def testRunWithWalletLock(self):
+      workerRunning = threading.Event()
+      releaseWorker = threading.Event()
+      order = []
+
+      @rpcWorkerMethod(RPC_WORKER_IO)
+      def rpcCall():
+         workerRunning.set()
+         releaseWorker.wait(CALL_WAIT)
+         order.append('rpc')
+
+      def notification():
+         order.append('notification')
+
+      d1 = self.callOn('wltA', rpcCall)
+      workerRunning.wait(CALL_WAIT)
+      d2 = self.dispatcher.runWithWalletLock(lambda: 'wltA', notification)
+      self.assertFalse(d2.called)
+      releaseWorker.set()
+
+      yield defer.gatherResults([d1, d2])
+      self.assertEqual(order, ['rpc', 'notification'])
+
+   #############################################################################
+   @defer.inlineCallbacks
+   def testRunWithWalletLockAfterSwitch(self):
+      workerRunning = threading.Event()
+      releaseWorker = threading.Event()
+      activeWallet = ['wltA']
+
+      @rpcWorkerMethod(RPC_WORKER_IO)
+      def rpcCall():
+         workerRunning.set()
+         releaseWorker.wait(CALL_WAIT)
+
+      def notification():
+         return self.dispatcher.isWalletBusy('wltB')
+
+      d1 = self.callOn('wltA', rpcCall)
+      workerRunning.wait(CALL_WAIT)
+      d2 = self.dispatcher.runWithWalletLock(lambda: activeWallet[0], \
+                                             notification)
+      # The active wallet changes while the notification waits, so it has
+      # to run under the new wallet's lock
+      activeWallet[0] = 'wltB'
+      releaseWorker.set()
+
+      results = yield defer.gatherResults([d1, d2])
+      self.assertEqual(results[1], True)
+      self.assertFalse(self.dispatcher.isWalletBusy('wltA'))
+      self.assertFalse(self.dispatcher.isWalletBusy('wltB'))
+
+
+# Running tests with "python <module name>" will NOT work for any Armory tests
+# You must run tests with "python -m unittest <module name>" or run all tests with "python -m unittest discover"
+# if __name__ == "__main__":
+#    unittest.main()
@@ -21,3 +21,97 @@ class SigningTester(unittest.TestCase):
          j = binary_to_int(s, BIGENDIAN)
          self.assertTrue( j <= SECP256K1_ORDER / 2)
 
+
+   def testSigHashCache(self):
+      # A 3-input, 2-output tx with non-empty input scripts
+      pytx = PyTx()
+      pytx.version  = 1
+      pytx.lockTime = 0
+      pytx.inputs   = []
+      pytx.outputs  = []
+      for i in range(3):
+         txin = PyTxIn()
+         txin.outpoint  = PyOutPoint(chr(i)*32, i)
+         txin.binScript = chr(0x40+i)*(70+i)
+         txin.intSeq    = UINT32_MAX - i
+         pytx.inputs.append(txin)
+      for i in range(2):
+         txout = PyTxOut()
+         txout.value     = (i+1)*ONE_BTC
+         txout.binScript = chr(0x76+i)*25
+         pytx.outputs.append(txout)
+
+      cache = SigHashCache(pytx)
+      prevScript = hex_to_binary('76a914' + '11'*20 + '88ac')
+      for i in range(3):
+         expected = generatePreHashTxMsgToSign(pytx, i, prevScript)
+         self.assertEqual(cache.getPreHashMsg(i, prevScript), expected[0])
+         self.assertEqual(generatePreHashTxMsgToSign(pytx, i, prevScript, \
+                                          sigHashCache=cache), expected)
+         self.assertEqual(cache.getInputIndex(pytx.inputs[i].outpoint.serialize()), i)
+
+      self.assertEqual(cache.getInputIndex('\xff'*36), -1)
+      self.assertTrue(cache.isCacheFor(pytx))
+      self.assertFalse(cache.isCacheFor(pytx.copy()))
+      self.assertRaises(SignatureError, cache.getPreHashMsg, 0, prevScript, 2)
+
+      # Modifying the tx in place invalidates the cache, but the input
+      # scripts aren't part of any preimage
+      pytx.inputs[0].binScript = '\x00'*72
+      self.assertTrue(cache.isCacheFor(pytx))
+      pytx.outputs[1].value += 1
+      self.assertFalse(cache.isCacheFor(pytx))
+      pytx.outputs[1].value -= 1
+      pytx.lockTime = 400000
+      self.assertFalse(cache.isCacheFor(pytx))
+
+
+   def testSigVerifyEngine(self):
+      # 3 single-sig inputs, each funded by its own fake supporting tx
+      privKeys = [SecureBinaryData(chr(i+1)*32) for i in range(3)]
+      ustxiList = []
+      for i,prv in enumerate(privKeys):
+         pub = CryptoECDSA().ComputePublicKey(prv).toBinStr()
+         supportTx = PyTx()
+         supportTx.version  = 1
+         supportTx.lockTime = 0
+         txin = PyTxIn()
+         txin.outpoint  = PyOutPoint(chr(i)*32, 0)
+         txin.binScript = ''
+         txin.intSeq    = UINT32_MAX
+         txout = PyTxOut()
+         txout.value     = ONE_BTC
+         txout.binScript = hash160_to_p2pkhash_script(hash160(pub))
+         supportTx.inputs  = [txin]
+         supportTx.outputs = [txout]
+         ustxiList.append(UnsignedTxInput(supportTx.serialize(), 0, None, pub))
+
+      dtxo = DecoratedTxOut(hash160_to_p2pkhash_script('\x42'*20), ONE_BTC)
+      ustx = UnsignedTransaction().createFromUnsignedTxIO(ustxiList, [dtxo])
+      for i,prv in enumerate(privKeys):
+         ustx.createAndInsertSignatureForInput(i, prv)
+
+      engine = SigVerifyEngine(numWorkers=2, chunkSize=1)
+      try:
+         self.assertTrue(ustx.verifySigsAllInputs())
+         self.assertTrue(ustx.verifySigsAllInputs(engine))
+         self.assertTrue(ustx.evaluateSigningStatus(verifyEngine=engine).canBroadcast)
+
+         # Swap in the input-0 signature on input 1: present but invalid
+         ustx.ustxInputs[1].signatures[0] = ustx.ustxInputs[0].signatures[0]
+         self.assertFalse(ustx.verifySigsAllInputs())
+         self.assertFalse(ustx.verifySigsAllInputs(engine))
+         self.assertFalse(ustx.verifySigsAllInputs(engine, stopOnFirstFail=True))
+         self.assertTrue(ustx.evaluateSigningStatus().canBroadcast)
+
+         sigStat = ustx.evaluateSigningStatus(verifyEngine=engine)
+         self.assertFalse(sigStat.canBroadcast)
+         self.assertEqual([s.invalidSigs for s in sigStat.statusList], [[],[0],[]])
+
+         owners, sigChecks = ustx.getAllSigChecks()
+         self.assertEqual(owners, [(0,0), (1,0), (2,0)])
+         self.assertEqual(engine.verifyBatch(sigChecks), [True, False, True])
+         self.assertEqual(engine.verifyBatch(sigChecks, stopOnFirstFail=True),
+                                                         [True, False, None])
+      finally:
+         engine.shutdown()
@@ -0,0 +1,79 @@
+import sys
+sys.path.append('..')
+import threading
+import unittest
+
+from armoryengine.ArmoryUtils import *
+from armoryengine.Timer import *
+
+
+@TimeThisFunction
+def timedRecursive(n):
+   if n > 0:
+      return timedRecursive(n-1) + 1
+   return 0
+
+@TimeThisFunction
+def timedOuter():
+   return timedRecursive(3)
+
+@TimeThisFunction
+def timedRaise():
+   raise ValueError('forced error')
+
+
+################################################################################
+class TimerTest(unittest.TestCase):
+
+   def setUp(self):
+      self.wasEnabled = isPerfStatsEnabled()
+      setPerfStatsEnabled(True)
+      Timer().resetAllTimers()
+
+   def tearDown(self):
+      setPerfStatsEnabled(self.wasEnabled)
+      Timer().resetAllTimers()
+
+   #############################################################################
+   def testNestedAndRecursive(self):
+      self.assertEqual(timedOuter(), 3)
+      stats = Timer().getPerfStats()
+      self.assertEqual(stats['timedOuter']['calls'], 1)
+      self.assertEqual(stats['timedRecursive']['calls'], 4)
+      self.assertEqual(set(stats['timedRecursive']['parents'].keys()), \
+                       set(['timedOuter', 'timedRecursive']))
+      self.assertTrue(stats['timedOuter']['self'] <= stats['timedOuter']['total'])
+      self.assertTrue(stats['timedRecursive']['total'] <= \
+                      stats['timedOuter']['total'])
+
+   #############################################################################
+   def testException(self):
+      self.assertRaises(ValueError, timedRaise)
+      self.assertRaises(ValueError, timedRaise)
+      self.assertEqual(Timer().getPerfStats()['timedRaise']['calls'], 2)
+      # Nothing left running, so the next call is a top-level call
+      timedOuter()
+      self.assertEqual(Timer().getPerfStats()['timedOuter']['parents'].keys(), \
+                       [''])
+
+   #############################################################################
+   def testThreads(self):
+      thrs = [threading.Thread(target=timedOuter) for i in range(4)]
+      for thr in thrs:
+         thr.start()
+      for thr in thrs:
+         thr.join()
+      timedOuter()
+      self.assertEqual(Timer().getPerfStats()['timedOuter']['calls'], 5)
+
+   #############################################################################
+   def testDisabled(self):
+      setPerfStatsEnabled(False)
+      timedOuter()
+      self.assertFalse(Timer().getPerfStats().has_key('timedOuter'))
+
+
+# Running tests with "python <module name>" will NOT work for any Armory tests
+# You must run tests with "python -m unittest <module name>" or run all tests with "python -m unittest discover"
+# if __name__ == "__main__":
+#    unittest.main()
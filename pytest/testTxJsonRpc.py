@@ -0,0 +1,187 @@
+################################################################################
+#
+# Copyright (C) 2011-2015, Armory Technologies, Inc.
+# Distributed under the GNU Affero General Public License (AGPL v3)
+# See LICENSE or http://www.gnu.org/licenses/agpl.html
+#
+################################################################################
+import sys
+sys.path.append('..')
+import json
+from StringIO import StringIO
+import unittest
+
+from twisted.internet import defer
+from twisted.internet.error import ConnectionLost
+from twisted.python.failure import Failure
+
+from txjsonrpc import jsonrpclib
+from txjsonrpc.web import jsonrpc
+
+
+################################################################################
+# Just enough of twisted.web's Request for JSONRPC.render()
+class FakeRequest(object):
+   def __init__(self, body):
+      self.content = StringIO(body)
+      self.written = []
+      self.finished = False
+      self.finishDeferreds = []
+
+   def setHeader(self, name, value):
+      pass
+
+   def write(self, data):
+      self.written.append(data)
+
+   def notifyFinish(self):
+      d = defer.Deferred()
+      self.finishDeferreds.append(d)
+      return d
+
+   def finish(self):
+      self.finished = True
+      for d in self.finishDeferreds:
+         d.callback(None)
+
+   def loseConnection(self):
+      for d in self.finishDeferreds:
+         d.errback(Failure(ConnectionLost()))
+
+   def getReply(self):
+      return json.loads(''.join(self.written))
+
+
+################################################################################
+class TestResource(jsonrpc.JSONRPC):
+   def __init__(self):
+      jsonrpc.JSONRPC.__init__(self)
+      self.waiters = []
+      self.cancelled = 0
+
+   def jsonrpc_add(self, a, b):
+      return a + b
+
+   def jsonrpc_fail(self):
+      raise jsonrpclib.Fault(123, 'bad params')
+
+   def jsonrpc_wait(self):
+      def cancel(d):
+         self.cancelled += 1
+      d = defer.Deferred(cancel)
+      self.waiters.append(d)
+      return d
+
+
+################################################################################
+class JsonRpcDisconnectTest(unittest.TestCase):
+
+   def render(self, calls):
+      request = FakeRequest(json.dumps(calls))
+      self.resource.render(request)
+      return request
+
+   def setUp(self):
+      self.resource = TestResource()
+
+   #############################################################################
+   def testCallCancelledOnDisconnect(self):
+      request = self.render({'jsonrpc': '2.0', 'id': 1, 'method': 'wait', \
+                             'params': []})
+      self.assertEqual(self.resource.cancelled, 0)
+      request.loseConnection()
+      self.assertEqual(self.resource.cancelled, 1)
+      # Nothing is written to the lost connection
+      self.assertEqual(request.written, [])
+      self.assertFalse(request.finished)
+
+   #############################################################################
+   def testBatchCancelledOnDisconnect(self):
+      request = self.render([
+         {'jsonrpc': '2.0', 'id': 1, 'method': 'add', 'params': [1, 2]},
+         {'jsonrpc': '2.0', 'id': 2, 'method': 'wait', 'params': []}])
+      request.loseConnection()
+      self.assertEqual(self.resource.cancelled, 1)
+      self.assertEqual(request.written, [])
+
+   #############################################################################
+   def testFinishedNormally(self):
+      request = self.render({'jsonrpc': '2.0', 'id': 1, 'method': 'wait', \
+                             'params': []})
+      self.resource.waiters[0].callback('paid')
+      self.assertEqual(request.getReply()['result'], 'paid')
+      self.assertTrue(request.finished)
+      self.assertEqual(self.resource.cancelled, 0)
+
+
+################################################################################
+class JsonRpcBatchTest(unittest.TestCase):
+
+   def render(self, body):
+      request = FakeRequest(body)
+      self.resource.render(request)
+      return request
+
+   def setUp(self):
+      self.resource = TestResource()
+
+   #############################################################################
+   def testMixedBatch(self):
+      request = self.render(json.dumps([
+         {'jsonrpc': '2.0', 'id': 1, 'method': 'add', 'params': [1, 2]},
+         {'jsonrpc': '2.0', 'id': 2, 'method': 'fail', 'params': []},
+         {'jsonrpc': '2.0', 'id': 3, 'method': 'nosuchmethod', 'params': []},
+         {'jsonrpc': '2.0', 'id': 4, 'method': 'add', 'params': [3, 4]}]))
+      replies = request.getReply()
+      self.assertEqual([r['id'] for r in replies], [1, 2, 3, 4])
+      self.assertEqual(replies[0]['result'], 3)
+      self.assertEqual(replies[1]['error']['faultCode'], 123)
+      self.assertEqual(replies[2]['error']['faultCode'],
+                       jsonrpclib.METHOD_NOT_FOUND)
+      self.assertEqual(replies[3]['result'], 7)
+
+   #############################################################################
+   def testNotifications(self):
+      # Calls without an id are run, but get no response
+      request = self.render(json.dumps([
+         {'jsonrpc': '2.0', 'method': 'wait', 'params': []},
+         {'jsonrpc': '2.0', 'id': 1, 'method': 'add', 'params': [1, 2]}]))
+      self.assertFalse(request.finished)
+      self.resource.waiters[0].callback('done')
+      replies = request.getReply()
+      self.assertEqual(len(replies), 1)
+      self.assertEqual(replies[0]['id'], 1)
+
+      # ... and a batch of only notifications gets no reply at all
+      request = self.render(json.dumps([
+         {'jsonrpc': '2.0', 'method': 'add', 'params': [1, 2]},
+         {'jsonrpc': '2.0', 'method': 'fail', 'params': []}]))
+      self.assertTrue(request.finished)
+      self.assertEqual(''.join(request.written), '')
+
+   #############################################################################
+   def testEmptyBatch(self):
+      reply = self.render('[]').getReply()
+      self.assertTrue(isinstance(reply, dict))
+      self.assertEqual(reply['id'], None)
+      self.assertEqual(reply['error']['faultCode'],
+                       jsonrpclib.INVALID_JSONRPC)
+
+   #############################################################################
+   def testInvalidElement(self):
+      replies = self.render(json.dumps([
+         1,
+         {'jsonrpc': '2.0', 'id': 1, 'method': 'add', 'params': [1, 2]},
+         'add'])).getReply()
+      self.assertEqual(len(replies), 3)
+      for i in [0, 2]:
+         self.assertEqual(replies[i]['id'], None)
+         self.assertEqual(replies[i]['error']['faultCode'],
+                          jsonrpclib.INVALID_JSONRPC)
+      self.assertEqual(replies[1]['result'], 3)
+
+
+# Running tests with "python <module name>" will NOT work for any Armory tests
+# You must run tests with "python -m unittest <module name>" or run all tests with "python -m unittest discover"
+# if __name__ == "__main__":
+#    unittest.main()
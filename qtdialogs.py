@@ -5787,7 +5787,7 @@ class DlgDispTxInfo(ArmoryDialog):
                      scrAddr = script_to_scrAddr(triplet[2])
                      svPairDisp.append([scrAddr, triplet[1]])
                   else:
-                     txAmt, changeIndex = determineSentToSelfAmt(le, wlt)
+                     txAmt, changeIndex = determineSentToSelfAmtCached(le, wlt)
                      for i, triplet in enumerate(self.data[FIELDS.OutList]):
                         if not i == changeIndex:
                            scrAddr = script_to_scrAddr(triplet[2])
@@ -9703,7 +9703,7 @@ class DlgExportTxHistory(ArmoryDialog):
                   rawAmt = str2coin(row[COL.Amount])
                else:
                   #if SentToSelf, balance and total rolling balance should only take fee in account
-                  rawAmt = getFeeForTx(hex_to_binary(row[COL.TxHash])) * -1
+                  rawAmt = getFeeForTxCached(hex_to_binary(row[COL.TxHash])) * -1
                   
                if order == order_ascending:
                   wltBalances[row[COL.WltID]] += rawAmt
@@ -9732,7 +9732,7 @@ class DlgExportTxHistory(ArmoryDialog):
                   vals.append(self.main.allLockboxes[self.main.lockboxIDMap[row[COL.WltID]]].shortName.replace(',', ';'))                  
    
                wltEffect = row[COL.Amount]
-               txFee = getFeeForTx(hex_to_binary(row[COL.TxHash]))
+               txFee = getFeeForTxCached(hex_to_binary(row[COL.TxHash]))
                if float(wltEffect) >= 0:
                   if row[COL.toSelf] == False:
                      vals.append(wltEffect.strip())
@@ -117,7 +117,8 @@ def signAnnounceFiles(wltPath):
    
    wlt.unlock(securePassphrase=passwd)
    passwd.destroy()
-   addrObj = wlt.getAddrByHash160(addrStr_to_hash160(signAddress)[1])
+   addrObj = wlt.getAddrByHash160(addrStr_to_hash160(signAddress)[1], \
+                                  withPrivKey=True)
    
    def doSignFile(inFile, outFile):
       with open(inFile, 'rb') as f:
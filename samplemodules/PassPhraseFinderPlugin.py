@@ -1,14 +1,20 @@
+from collections import deque
+import hashlib
+import json
+from multiprocessing.pool import ThreadPool
+import multiprocessing
 from operator import add, mul
 import os
+import threading
 
 from PyQt4.Qt import QPushButton, SIGNAL, QTextEdit, QScrollArea, QTabWidget, \
    QLineEdit, QAbstractTableModel, QModelIndex, Qt, QVariant, QTableView, QIcon,\
    QDialogButtonBox, QGridLayout, QLabel, QComboBox, QMenu, QCursor, QListWidget,\
    QListWidgetItem, QMessageBox, QString
 
-from CppBlockUtils import SecureBinaryData
+from CppBlockUtils import SecureBinaryData, KdfRomix
 from armoryengine.ArmoryUtils import RightNow, script_to_addrStr, \
-   addrStr_to_hash160, enum, isASCII, PyBackgroundThread
+   addrStr_to_hash160, enum, isASCII, PyBackgroundThread, LOGEXCEPT
 from armoryengine.PyBtcWallet import PyBtcWallet
 from qtdefines import QRichLabel, makeHorizFrame, GETFONT, relaxedSizeNChar, \
    makeVertFrame, tightSizeNChar, initialColResize, ArmoryDialog,\
@@ -492,10 +498,25 @@ class UnknownSeg(PwdSeg):
 
 
 
+# Candidates handed to a worker at a time.  Progress is checkpointed, and the
+# stop flag is seen by the caller, once per completed chunk
+PASSPHRASE_CHUNK_SIZE = 16
+
+# Seconds between progress lines (and checkpoint writes)
+PASSPHRASE_REPORT_INTERVAL = 10
+
 class PassPhraseFinder(object): 
-   def __init__(self, wallet):
+   def __init__(self, wallet, numWorkers=None, checkpointPath=None):
       self.wallet = wallet
       self.isStopped = False
+      if numWorkers is None:
+         numWorkers = multiprocessing.cpu_count()
+      self.numWorkers = max(int(numWorkers), 1)
+      if checkpointPath is None:
+         checkpointPath = os.path.splitext(wallet.walletPath)[0] + '.passsearch'
+      self.checkpointPath = checkpointPath
+      self.threadData = threading.local()
+      self.triesPerSec = 0.0
 
 
    def countPassPhrases(self, segList, segOrdList):
@@ -526,50 +547,170 @@ class PassPhraseFinder(object):
          orderedSegList = [segList[segIndex] for segIndex in segOrd]
          for result in self.recursivePassPhraseGenerator(orderedSegList):
             yield result
-   
-   def searchForPassPhrase(self, segList, segOrdList, outputCallback, endCallback):
+
+   # Returns the index-th PassPhrase yielded by passPhraseGenerator, without
+   # generating the ones before it.  Within an ordering the index is a mixed
+   # radix number whose last digit picks from the last segment.
+   def getPassPhraseByIndex(self, segList, segOrdList, index):
+      for segOrd in segOrdList:
+         orderedSegList = [segList[segIndex] for segIndex in segOrd]
+         ordCount = reduce(mul, [len(seg) for seg in orderedSegList], 1)
+         if index >= ordCount:
+            index -= ordCount
+            continue
+         parts = []
+         for seg in reversed(orderedSegList):
+            index,digit = divmod(index, len(seg))
+            parts.append(seg[digit])
+         return ''.join(reversed(parts))
+      raise IndexError('Pass phrase index out of range')
+
+   # Identifies a search space, so that a checkpoint is only ever used to
+   # resume the exact same search
+   def getSearchID(self, segList, segOrdList):
+      h = hashlib.sha256()
+      for seg in segList:
+         h.update('%d:' % len(seg))
+         h.update('\x00'.join(seg))
+      for segOrd in segOrdList:
+         h.update(',' + '.'.join([str(i) for i in segOrd]))
+      return h.hexdigest()
+
+   def readCheckpoint(self, searchID):
+      if not os.path.exists(self.checkpointPath):
+         return 0
+      try:
+         with open(self.checkpointPath, 'r') as f:
+            checkpoint = json.load(f)
+         if checkpoint['searchID'] == searchID:
+            return int(checkpoint['nextIndex'])
+      except (IOError, ValueError, KeyError, TypeError):
+         LOGEXCEPT('Ignoring unreadable pass phrase search checkpoint')
+      return 0
+
+   def writeCheckpoint(self, searchID, nextIndex, passPhraseCount):
+      tmpPath = self.checkpointPath + '.tmp'
+      with open(tmpPath, 'w') as f:
+         json.dump({'searchID': searchID, 'nextIndex': nextIndex, \
+                    'total': passPhraseCount}, f)
+      if os.path.exists(self.checkpointPath):
+         os.remove(self.checkpointPath)
+      os.rename(tmpPath, self.checkpointPath)
+
+   def clearCheckpoint(self):
+      if os.path.exists(self.checkpointPath):
+         os.remove(self.checkpointPath)
+
+   # KdfRomix keeps its lookup table in the object, so every worker thread
+   # gets its own copy of the wallet KDF
+   def getThreadKdf(self):
+      kdf = getattr(self.threadData, 'kdf', None)
+      if kdf is None:
+         wltKdf = self.wallet.kdf
+         kdf = KdfRomix(wltKdf.getMemoryReqtBytes(), \
+                        wltKdf.getNumIterations(), \
+                        SecureBinaryData(wltKdf.getSalt().toBinStr()))
+         self.threadData.kdf = kdf
+      return kdf
+
+   # Runs in the worker pool.  Returns the pass phrase if it is in
+   # [startIndex, endIndex), otherwise None, and the index of the first
+   # candidate not tested (endIndex unless the search was stopped)
+   def searchIndexRange(self, segList, segOrdList, startIndex, endIndex):
+      kdf = self.getThreadKdf()
+      rootAddr = self.wallet.addrMap['ROOT']
+      for i in xrange(startIndex, endIndex):
+         if self.isStopped:
+            return None, i
+         p = self.getPassPhraseByIndex(segList, segOrdList, i)
+         kdfOutput = kdf.DeriveKey(SecureBinaryData(p))
+         try:
+            if rootAddr.verifyEncryptionKey(kdfOutput):
+               return p, i + 1
+         finally:
+            kdfOutput.destroy()
+      return None, endIndex
+
+   def searchForPassPhrase(self, segList, segOrdList, outputCallback, \
+                                                endCallback, resume=True):
       # if segOrdList is nonempty seglist must be non-empty too
       if len(segOrdList) == 0:
          QMessageBox.warning(self.main, tr('Invalid'), tr("""
             No segment orderings have been specified."""), QMessageBox.Ok)
       passPhraseCount = self.countPassPhrases(segList, segOrdList)
+      searchID = self.getSearchID(segList, segOrdList)
+      startIndex = self.readCheckpoint(searchID) if resume else 0
+      if startIndex > 0:
+         outputCallback('Resuming search at pass phrase %d/%d\n' % \
+                                             (startIndex, passPhraseCount))
+
+      # Chunks are handed out in index order, with at most two per worker
+      # in flight, and collected in the same order.  So every index below
+      # nextIndex has been tested, and that is what goes into the
+      # checkpoint.  After a stop, the chunks in flight are still collected
+      # for as long as they were finished.
+      pool = ThreadPool(self.numWorkers)
+      pending = deque()
+      nextChunk = startIndex
+      nextIndex = startIndex
       startTime = RightNow()
-      found = False
+      lastReport = startTime
       result = None
-      outputLine = ''
-      for i,p in enumerate(self.passPhraseGenerator(segList, segOrdList)):
-         isValid = self.wallet.verifyPassphrase( SecureBinaryData(p) ) 
-            
-         if isValid:
-            # If the passphrase was wrong, it would error out, and not continue
-            outputCallback(outputLine)
-            outputCallback('\nPassphrase found!\n')
-            outputCallback('\tThe Pass Phrase for ' + self.wallet.labelName + ' is: ' + p + '\n')
-            outputCallback('Thanks for using this script.  If you recovered coins because of it, \n')
-            outputCallback('please consider donating :) \n')
-            outputCallback('   1ArmoryXcfq7TnCSuZa9fQjRYwJ4bkRKfv\n')
-            result = p
-            found = True
-            break
-         elif i%100==0:
-            telapsed = (RightNow() - startTime)/3600.
-            outputCallback( ('\n%d/%d passphrases tested... (%0.1f hours so far)'%(i,passPhraseCount,telapsed)).rjust(40))
-         outputLine += p
-         if i % 10 == 9:
-            outputCallback(outputLine)
-            outputLine = ''
-         else:
-            outputLine += ' '
-         if self.isStopped:
-            return result
-      if not found:
+      try:
+         while nextIndex < passPhraseCount:
+            while nextChunk < passPhraseCount and not self.isStopped and \
+                  len(pending) < 2*self.numWorkers:
+               chunkEnd = min(nextChunk + PASSPHRASE_CHUNK_SIZE, passPhraseCount)
+               pending.append((chunkEnd, pool.apply_async( \
+                  self.searchIndexRange, \
+                  [segList, segOrdList, nextChunk, chunkEnd])))
+               nextChunk = chunkEnd
+            if len(pending) == 0:
+               break
+
+            chunkEnd,asyncResult = pending.popleft()
+            result,testedTo = asyncResult.get()
+            if result is not None:
+               break
+            nextIndex = testedTo
+            if testedTo < chunkEnd:
+               # Stopped partway, the chunks after it don't count
+               break
+
+            if RightNow() - lastReport >= PASSPHRASE_REPORT_INTERVAL:
+               lastReport = RightNow()
+               telapsed = lastReport - startTime
+               self.triesPerSec = (nextIndex - startIndex) / max(telapsed, 0.001)
+               self.writeCheckpoint(searchID, nextIndex, passPhraseCount)
+               outputCallback(('\n%d/%d passphrases tested... ' \
+                  '(%0.1f hours so far, %0.1f tries/sec) last tried: %s' % \
+                  (nextIndex, passPhraseCount, telapsed/3600., \
+                  self.triesPerSec, self.getPassPhraseByIndex(segList, \
+                                          segOrdList, nextIndex-1))).rjust(40))
+      finally:
+         self.isStopped = self.isStopped or result is not None
+         pool.close()
+         pool.join()
+
+      if result is None and nextIndex < passPhraseCount:
+         # Stopped by the user, keep the checkpoint up to date for next time
+         self.writeCheckpoint(searchID, nextIndex, passPhraseCount)
+         return result
+
+      self.clearCheckpoint()
+      if result is not None:
+         outputCallback('\nPassphrase found!\n')
+         outputCallback('\tThe Pass Phrase for ' + self.wallet.labelName + ' is: ' + result + '\n')
+         outputCallback('Thanks for using this script.  If you recovered coins because of it, \n')
+         outputCallback('please consider donating :) \n')
+         outputCallback('   1ArmoryXcfq7TnCSuZa9fQjRYwJ4bkRKfv\n')
+      else:
          outputCallback('Script finished!\n')
          outputCallback('Sorry, none of the provided passphrases were correct :(')
       endCallback()
       return result
 
 
-
 SEGDEFCOLS = enum('index', 'type', 'text', 'minLength', 'maxLength', 'totalCombinations')
 SEGTYPES = enum('known', 'unknownCase', 'unknownOrder')
 
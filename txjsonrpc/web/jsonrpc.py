@@ -84,11 +84,7 @@ class JSONRPC(resource.Resource, BaseSubhandler):
         resource.Resource.__init__(self)
         BaseSubhandler.__init__(self)
 
-    def render(self, request):
-        request.content.seek(0, 0)
-        # Unmarshal the JSON-RPC data.
-        content = request.content.read()
-        parsed = jsonrpclib.loads(content)
+    def _getCallInfo(self, parsed):
         functionPath = parsed.get("method")
         args = parsed.get('params')
         id = parsed.get('id')
@@ -99,6 +95,16 @@ class JSONRPC(resource.Resource, BaseSubhandler):
             version = jsonrpclib.VERSION_1
         else:
             version = jsonrpclib.VERSION_PRE1
+        return functionPath, args, id, version
+
+    def render(self, request):
+        request.content.seek(0, 0)
+        # Unmarshal the JSON-RPC data.
+        content = request.content.read()
+        parsed = jsonrpclib.loads(content)
+        if isinstance(parsed, list):
+            return self._renderBatch(parsed, request)
+        functionPath, args, id, version = self._getCallInfo(parsed)
         # XXX this all needs to be re-worked to support logic for multiple
         # versions...
         try:
@@ -108,11 +114,22 @@ class JSONRPC(resource.Resource, BaseSubhandler):
         else:
             request.setHeader("content-type", "text/json")
             d = defer.maybeDeferred(function, *args)
+            finished = request.notifyFinish()
+            finished.addErrback(self._ebConnectionLost, [d])
             d.addErrback(self._ebRender, id)
-            d.addCallback(self._cbRender, request, id, version)
+            d.addCallback(self._cbRender, request, id, version, finished)
         return server.NOT_DONE_YET
 
-    def _cbRender(self, result, request, id, version):
+    def _ebConnectionLost(self, failure, deferreds):
+        # The client went away before the result was ready (e.g. a long
+        # poll): nobody is waiting for it any more
+        for d in deferreds:
+            d.cancel()
+
+    def _cbRender(self, result, request, id, version, finished=None):
+        if finished is not None and finished.called:
+            # The connection was lost, there is nobody to write to
+            return
         if isinstance(result, Handler):
             result = result.result
         if version == jsonrpclib.VERSION_PRE1:
@@ -131,9 +148,78 @@ class JSONRPC(resource.Resource, BaseSubhandler):
     def _ebRender(self, failure, id):
         if isinstance(failure.value, jsonrpclib.Fault):
             return failure.value
+        if failure.check(defer.CancelledError):
+            # Cancelled by _ebConnectionLost, not an error of the call
+            return jsonrpclib.Fault(self.FAILURE, "cancelled")
         log.err(failure)
         return jsonrpclib.Fault(self.FAILURE, "error")
 
+    def _renderBatch(self, calls, request):
+        """
+        A JSON-RPC 2.0 batch: a list of calls in one request, answered with a
+        list of responses in one reply.  The calls are started in the order
+        given.  Calls without an id (notifications) get no response, and a
+        batch of only notifications gets an empty reply.
+        """
+        request.setHeader("content-type", "text/json")
+        if not calls:
+            # Not a valid batch, so the reply is a single error response
+            f = jsonrpclib.Fault(jsonrpclib.INVALID_JSONRPC, "empty batch")
+            self._cbRender(f, request, None, jsonrpclib.VERSION_2)
+            return server.NOT_DONE_YET
+
+        deferreds = []
+        for call in calls:
+            if not isinstance(call, dict):
+                f = jsonrpclib.Fault(jsonrpclib.INVALID_JSONRPC,
+                                     "invalid call in batch")
+                deferreds.append(defer.succeed(
+                    jsonrpclib.dumps(f, version=jsonrpclib.VERSION_2)))
+                continue
+            functionPath, args, id, version = self._getCallInfo(call)
+            try:
+                function = self._getFunction(functionPath)
+            except jsonrpclib.Fault, f:
+                d = defer.succeed(f)
+            else:
+                d = defer.maybeDeferred(function, *(args or []))
+                d.addCallback(self._cbHandlerResult)
+                d.addErrback(self._ebRender, id)
+            d.addCallback(self._cbSerialize, id, version)
+            deferreds.append(d)
+
+        finished = request.notifyFinish()
+        finished.addErrback(self._ebConnectionLost, deferreds)
+        d = defer.gatherResults(deferreds)
+        d.addCallback(self._writeBatch, request, finished)
+        return server.NOT_DONE_YET
+
+    def _cbHandlerResult(self, result):
+        if isinstance(result, Handler):
+            return result.result
+        return result
+
+    def _cbSerialize(self, result, id, version):
+        if id is None and version == jsonrpclib.VERSION_2:
+            return None
+        if version == jsonrpclib.VERSION_PRE1:
+            if not isinstance(result, jsonrpclib.Fault):
+                result = (result,)
+        try:
+            return jsonrpclib.dumps(result, version=version, id=id)
+        except:
+            f = jsonrpclib.Fault(self.FAILURE, "can't serialize output")
+            return jsonrpclib.dumps(f, version=version, id=id)
+
+    def _writeBatch(self, responses, request, finished=None):
+        if finished is not None and finished.called:
+            return
+        responses = [r for r in responses if r is not None]
+        s = "[" + ",".join(responses) + "]" if responses else ""
+        request.setHeader("content-length", str(len(s)))
+        request.write(s)
+        request.finish()
+
 
 class QueryProtocol(http.HTTPClient):
 
@@ -2930,13 +2930,13 @@ class DlgMultiSpendReview(ArmoryDialog):
       if ib.lockbox:
          # If a lockbox, all USTXIs require the same signing key
          for ustxi in ib.ustxiList:
-            addrObj = wlt.getAddrByHash160(a160)
+            addrObj = wlt.getAddrByHash160(a160, withPrivKey=True)
             ustxi.createAndInsertSignature(pytx, addrObj.binPrivKey32_Plain)
       else:
          # Not lockboxes... may have to access multiple keys in wallet
          for ustxi in ib.ustxiList:
             a160 = CheckHash160(ustxi.scrAddrs[0])
-            addrObj = wlt.getAddrByHash160(a160)
+            addrObj = wlt.getAddrByHash160(a160, withPrivKey=True)
             ustxi.createAndInsertSignature(pytx, addrObj.binPrivKey32_Plain)
 
       self.evalSigStat()
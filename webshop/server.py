@@ -14,7 +14,9 @@ import base64
 import httplib
 import json
 import os
+import socket
 import sys
+import threading
 
 
 ORDERS_DIRECTORY = "orders"
@@ -44,24 +46,106 @@ products = {
 options = {}
 lockbox_args = None
 
+# Each thread keeps one connection to armoryd open (HTTP keep-alive) and
+# the credentials are only read once
+armoryd_local = threading.local()
+armoryd_auth = None
+
+def armoryd_connection():
+    global armoryd_auth
+    if armoryd_auth is None:
+        subdir = "testnet3"
+        conf = os.path.join(os.getenv('HOME'), '.armory', subdir, "armoryd.conf")
+        user_pass = open(conf, 'r').read()
+        armoryd_auth = "Basic " + base64.b64encode(user_pass)
+    if getattr(armoryd_local, "conn", None) is None:
+        port = 18225
+        if options.mainnet:
+            port = 8225
+        armoryd_local.conn = httplib.HTTPConnection("localhost", port)
+    return armoryd_local.conn
+
+def armoryd_post(data):
+    serialized = json.dumps(data)
+    for attempt in range(2):
+        c = armoryd_connection()
+        headers = {
+            "Content-Type": "application/json",
+            "Content-Length":len(serialized),
+            "Authorization":armoryd_auth,
+        }
+        try:
+            c.request("POST","/", serialized, headers)
+            return json.loads(c.getresponse().read())
+        except (httplib.BadStatusLine, socket.error):
+            # armoryd closed the idle connection before this request got
+            # there; open a new one and send it again
+            c.close()
+            armoryd_local.conn = None
+            if attempt > 0:
+                raise
+
 def armoryd_request(method, params):
-    subdir = "testnet3"
-    conf = os.path.join(os.getenv('HOME'), '.armory', subdir, "armoryd.conf")
-    user_pass = open(conf, 'r').read()
-    port = 18225
-    if options.mainnet:
-        port = 8225
-    c = httplib.HTTPConnection("localhost", port)
     data = {"jsonrpc":"1.0","id":1,"method":method,"params":params}
-    serialized = json.dumps(data)
-    headers = {
-        "Content-Type": "application/json",
-        "Content-Length":len(serialized),
-        "Authorization":"Basic " + base64.b64encode(user_pass),
-    }
-    c.request("POST","/", serialized, headers)
-    response = json.loads(c.getresponse().read())
-    return response["result"]
+    return armoryd_post(data)["result"]
+
+def armoryd_batch(calls):
+    """
+    Make several calls in one round trip.  calls is a list of
+    (method, params); the calls run in that order and their results are
+    returned in the same order.  Raises RuntimeError if any call failed.
+    """
+    data = [{"jsonrpc":"2.0","id":i,"method":method,"params":params}
+            for i,(method,params) in enumerate(calls)]
+    reply = armoryd_post(data)
+    if not isinstance(reply, list):
+        # armoryd rejected the batch as a whole
+        raise RuntimeError("armoryd batch failed: %s" % reply.get("error"))
+    # Responses may come back in any order, match them up by id
+    responses = dict([(r.get("id"), r) for r in reply])
+    results = []
+    for i,(method,params) in enumerate(calls):
+        response = responses.get(i)
+        if response is None:
+            raise RuntimeError("armoryd sent no response to %s" % method)
+        error = response.get("error")
+        if error:
+            if isinstance(error, dict):
+                error = error.get("faultString", error)
+            raise RuntimeError("armoryd %s failed: %s" % (method, error))
+        results.append(response["result"])
+    return results
+
+# armoryd tells us about payments to an address instead of us polling it;
+# one subscription per (address, amount), shared by all the requests for it
+payment_subs = {}
+payment_subs_lock = threading.Lock()
+
+def payment_wait(address, amount=0, seq=-1, timeout=0):
+    """
+    Wait up to timeout seconds for the amount received by address to change
+    from the state numbered seq.  Returns armoryd's subscription state, with
+    "received", "paid" and "seq" keys.
+    """
+    for attempt in range(2):
+        with payment_subs_lock:
+            sub_id = payment_subs.get((address, amount))
+            if sub_id is None:
+                sub = armoryd_request("subscribepayment", [address, amount])
+                if "Error" in sub:
+                    # e.g. the address isn't in any wallet armoryd has loaded
+                    raise RuntimeError(sub["Error Value"])
+                payment_subs[(address, amount)] = sub["id"]
+                if seq != sub["seq"] or timeout <= 0:
+                    return sub
+                sub_id = sub["id"]
+        sub = armoryd_request("waitforpayment", [sub_id, seq, timeout])
+        if "Error" not in sub:
+            return sub
+        # armoryd dropped the subscription (restarted or idle), make another
+        with payment_subs_lock:
+            payment_subs.pop((address, amount), None)
+    raise RuntimeError(sub["Error Value"])
 
 @app.route("/")
 def home():
@@ -92,8 +176,9 @@ def refund():
                 amount = order["total"] - 0.0001
                 lboxid = order["lboxid"]
                 if lboxid:
-                    armoryd_request("setactivelockbox", [lboxid])
-                    asciitx = armoryd_request("createlockboxustxtoaddress", [refundaddress, amount])
+                    asciitx = armoryd_batch([
+                        ("setactivelockbox", [lboxid]),
+                        ("createlockboxustxtoaddress", [refundaddress, amount])])[1]
                 if type(asciitx) == dict and asciitx["Error Value"]:
                     error = asciitx["Error Value"]
                     if error[:10] == "You have 0":
@@ -176,8 +261,7 @@ def pay():
 
 @app.route("/check/<path:address>")
 def check(address):
-    amount = armoryd_request("getreceivedbyaddress", address)
-    return amount
+    return str(payment_wait(address)["received"])
 
 @app.route("/add/<path:product>/<path:quantity>")
 def add(product, quantity):
@@ -238,13 +322,15 @@ def ws_disconnect():
 def ws_listen(message):
     address = message['bitcoinaddress']
     amount = message['amount']
-    # wait until we receive something
+    # wait until we receive something; armoryd answers when the amount
+    # received changes, or after 30 seconds
     received = 0
-    while received < amount:
-        old_received = received
-        received = armoryd_request("getreceivedbyaddress", [address, 0])
-        if old_received != received:
+    sub = payment_wait(address, amount)
+    while sub["received"] < amount:
+        if sub["received"] != received:
+            received = sub["received"]
             emit('broadcast', {'data': "received %s" % received})
+        sub = payment_wait(address, amount, sub["seq"], 30)
     emit('broadcast', {'data': "paid"})
 
 